@@ -0,0 +1,101 @@
+# This file isn't called in normal operation - it's for timing ActivityMatcher on heavy users' histories.
+# Lists a synthetic multi-year history from several services (TZ-aware, naive, a little off, and hours off, as services
+# manage to be) and matches each activity as _accumulateActivities does - against the sorted-list window scan it replaced.
+# Usage: python activity_matcher_benchmark.py [activities] [services] [runs]
+
+from tapiriik.services.interchange import Activity, ActivityType
+from tapiriik.sync.activity_matcher import ActivityMatcher
+from datetime import datetime, timedelta
+import bisect
+import pytz
+import random
+import sys
+import time
+
+ACTIVITIES = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+SERVICES = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+RUNS = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+def best_of(fn):
+	best = None
+	result = None
+	for x in range(RUNS):
+		start = time.time()
+		result = fn()
+		elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best, result
+
+def history(rng):
+	# Roughly one activity a day, sometimes two close together
+	tz = pytz.timezone("America/Denver")
+	types = [ActivityType.Running, ActivityType.Cycling, ActivityType.MountainBiking, ActivityType.Swimming]
+	starts = []
+	start = datetime(2010, 1, 1, 7)
+	for x in range(ACTIVITIES):
+		start += timedelta(hours=rng.choice([2, 20, 24, 24, 28, 48]), minutes=rng.randint(0, 59), seconds=rng.randint(0, 59))
+		starts.append((start, rng.choice(types)))
+	services = []
+	for svc in range(SERVICES):
+		listing = []
+		for start, act_type in starts:
+			if rng.random() < 0.1:
+				continue # Not on every service
+			act = Activity()
+			if svc % 4 == 0:
+				act.StartTime = tz.localize(start)
+			elif svc % 4 == 1:
+				act.StartTime = start # Naive local time
+			elif svc % 4 == 2:
+				act.StartTime = tz.localize(start + timedelta(seconds=rng.randint(-90, 90)))
+			else:
+				act.StartTime = start + timedelta(hours=rng.choice([0, 0, -7, 7, 1]))
+			act.Type = act_type if rng.random() < 0.9 else ActivityType.Other
+			act.CalculateUID()
+			listing.append(act)
+		services.append(listing)
+	return services
+
+def window_scan(services):
+	# The pre-ActivityMatcher approach - bisect the sorted list to +/- 38 hours, then test everything in between
+	reference = ActivityMatcher([])
+	activities = []
+	decisions = []
+	fake = Activity()
+	for listing in services:
+		for act in listing:
+			act_naive = act.StartTime.replace(tzinfo=None)
+			fake.StartTime = act_naive - ActivityMatcher.TimezoneErrorPeriod
+			right = bisect.bisect_right(activities, fake)
+			fake.StartTime = act_naive + ActivityMatcher.TimezoneErrorPeriod
+			left = bisect.bisect_left(activities, fake)
+			existing = None
+			for x in activities[left:right]:
+				if reference._matches(act, x):
+					existing = x
+					break
+			if existing is None:
+				bisect.insort_left(activities, act)
+			decisions.append(id(existing) if existing is not None else None)
+	return decisions
+
+def bucketed(services):
+	matcher = ActivityMatcher([])
+	activities = []
+	decisions = []
+	for listing in services:
+		for act in listing:
+			existing = matcher.Find(act)
+			if existing is None:
+				bisect.insort_left(activities, act) # Still kept, as _accumulateActivities does
+				matcher.Add(act)
+			decisions.append(id(existing) if existing is not None else None)
+	return decisions
+
+services = history(random.Random(0))
+print("%d activities from %d services (%d listed):" % (ACTIVITIES, SERVICES, sum(len(x) for x in services)))
+scan_time, scan_decisions = best_of(lambda: window_scan(services))
+print("  %-34s %8.1f ms" % ("window scan", scan_time * 1000))
+bucketed_time, bucketed_decisions = best_of(lambda: bucketed(services))
+print("  %-34s %8.1f ms" % ("ActivityMatcher", bucketed_time * 1000))
+print("  %d merged, %s" % (len([x for x in bucketed_decisions if x is not None]), "same merge decisions" if bucketed_decisions == scan_decisions else "MERGE DECISIONS DIFFER"))
@@ -0,0 +1,18 @@
+# Moves activity records from the old layout (one activity_records document per user, holding every record)
+#  to activity_record_entries (one document per record). Sync workers migrate users as they're loaded anyway, so this
+#  just gets it done ahead of time - it's safe to run (or re-run) alongside them.
+from tapiriik.database import db
+from tapiriik.sync.activity_record import ActivityRecordStore
+
+print("Setting up indexes")
+ActivityRecordStore.EnsureIndexes()
+
+user_ids = [x["UserID"] for x in db.activity_records.find({}, {"UserID": True})]
+total = len(user_ids)
+migrated_records = 0
+for idx, user_id in enumerate(user_ids):
+	migrated_records += ActivityRecordStore.MigrateUser(user_id)
+	if idx % 100 == 0:
+		print("%3d%% %d users, %d records" % (round(idx * 100 / total), idx, migrated_records))
+
+print("Migrated %d records for %d users" % (migrated_records, total))
@@ -0,0 +1,30 @@
+# This file isn't called in normal operation - it's for timing AutoPauseCalculator on long activities.
+# Compares waypoint_types against the two-pass, sort-everything calculation it replaced.
+# Usage: python autopause_benchmark.py [waypoints] [runs]
+
+from tapiriik.services.auto_pause import AutoPauseCalculator
+from tapiriik.testing.statistics import _recorded_waypoints, _reference_auto_pause
+import random
+import sys
+import time
+
+WAYPOINTS = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+RUNS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+def best_of(fn):
+	best = None
+	for x in range(RUNS):
+		start = time.time()
+		fn()
+		elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+waypoints = _recorded_waypoints(random.Random(0), points=WAYPOINTS)
+elapsed = (waypoints[-1].Timestamp - waypoints[0].Timestamp).total_seconds()
+for fraction in (0.9, 0.5):
+	target = elapsed * fraction
+	print("%d waypoints, target %d%% of elapsed:" % (WAYPOINTS, fraction * 100))
+	print("  %-34s %8.1f ms" % ("two-pass reference", best_of(lambda: _reference_auto_pause(waypoints, target)) * 1000))
+	print("  %-34s %8.1f ms" % ("waypoint_types", best_of(lambda: AutoPauseCalculator.waypoint_types(waypoints, target)) * 1000))
+	print("  %-34s %8.1f ms" % ("calculate (generator)", best_of(lambda: list(AutoPauseCalculator.calculate(waypoints, target))) * 1000))
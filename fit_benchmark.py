@@ -0,0 +1,63 @@
+# This file isn't called in normal operation - it's for timing FITIO.Parse on long activities.
+# Compares parsing the activity as FIT against parsing the same activity as TCX (what services like TrainAsONE were downloaded
+# as before), and the struct-compiled data message decoding on its own - and checks the two parsers agree on the waypoints.
+# Usage: python fit_benchmark.py [waypoints] [runs]
+
+from tapiriik.services.fit import FITIO, FITMessageDecoder
+from tapiriik.services.tcx import TCXIO
+from tapiriik.services.interchange import Activity, ActivityStatistic, ActivityStatisticUnit, ActivityType, Lap, Location, Waypoint, WaypointType
+from datetime import datetime, timedelta
+import pytz
+import random
+import struct
+import sys
+import time
+
+WAYPOINTS = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+RUNS = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+LAPS = 10
+
+def best_of(fn):
+	best = None
+	for x in range(RUNS):
+		start = time.time()
+		fn()
+		elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+def large_activity():
+	# Every waypoint with the same fields, as a device would record them
+	rng = random.Random(0)
+	act = Activity(actType=ActivityType.Cycling, tz=pytz.utc)
+	timestamp = datetime(2015, 6, 1, 7, 30, tzinfo=pytz.utc)
+	lat, lon, alt = 45.0, -75.0, 100.0
+	for lap_idx in range(LAPS):
+		lap = Lap(startTime=timestamp)
+		lap.Stats.Distance = ActivityStatistic(ActivityStatisticUnit.Meters, value=1000) # Required by the TCX parser
+		for x in range(WAYPOINTS // LAPS):
+			lat += (rng.random() - 0.5) / 5000
+			lon += (rng.random() - 0.5) / 5000
+			alt += rng.random() - 0.5
+			lap.Waypoints.append(Waypoint(timestamp, location=Location(lat, lon, alt), hr=float(rng.randint(80, 190)), cadence=float(rng.randint(0, 100)), power=float(rng.randint(0, 400))))
+			timestamp += timedelta(seconds=1)
+		lap.EndTime = lap.Waypoints[-1].Timestamp
+		act.Laps.append(lap)
+	act.Laps[0].Waypoints[0].Type = WaypointType.Start
+	act.Laps[-1].Waypoints[-1].Type = WaypointType.End
+	act.StartTime = act.Laps[0].StartTime
+	act.EndTime = act.Laps[-1].EndTime
+	return act
+
+act = large_activity()
+fitData = FITIO.Dump(act)
+tcxData = TCXIO.Dump(act).encode("utf-8")
+print("%d waypoints, %.2f MB of FIT, %.1f MB of TCX:" % (WAYPOINTS, len(fitData) / 1024 / 1024, len(tcxData) / 1024 / 1024))
+print("  %-34s %8.1f ms" % ("TCXIO.Parse", best_of(lambda: TCXIO.Parse(tcxData)) * 1000))
+print("  %-34s %8.1f ms" % ("FITIO.Parse", best_of(lambda: FITIO.Parse(fitData)) * 1000))
+header_len, data_len = fitData[0], struct.unpack_from("<I", fitData, 4)[0]
+print("  %-34s %8.1f ms" % ("FITMessageDecoder.Messages alone", best_of(lambda: list(FITMessageDecoder().Messages(fitData, header_len, header_len + data_len))) * 1000))
+
+fit, tcx = FITIO.Parse(fitData), TCXIO.Parse(tcxData)
+same = [(wp.Timestamp, wp.HR, wp.Power) for wp in fit.GetFlatWaypoints()] == [(wp.Timestamp, wp.HR, wp.Power) for wp in tcx.GetFlatWaypoints()]
+print("  %s" % ("same waypoints" if same else "WAYPOINTS DIFFER"))
@@ -0,0 +1,131 @@
+# This file isn't called in normal operation - it's for timing GPXIO.Parse on long tracks, and how much memory it takes.
+# Compares, against what they replaced:
+#  - the strict ISO 8601 timestamp fast path, against dateutil
+#  - the streaming (iterparse) Parse with precompiled tag names, against the full-tree walk with namespaced finds and
+#    dateutil for every point - peak memory is measured in a fresh process for each, as the growth in max RSS
+# Usage: python gpx_benchmark.py [waypoints] [runs]
+
+from tapiriik.services.gpx import GPXIO, _parseTimestamp
+from tapiriik.services.interchange import Activity, ActivityStatistic, ActivityStatisticUnit, Waypoint, Location, Lap
+from tapiriik.services.statistic_calculator import ActivityStatisticCalculator
+from tapiriik.testing.statistics import _random_activity
+from lxml import etree
+import copy
+import dateutil.parser
+import multiprocessing
+import os
+import pytz
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+WAYPOINTS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+RUNS = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+LAPS = 10
+
+def best_of(fn):
+	best = None
+	for x in range(RUNS):
+		start = time.time()
+		fn()
+		elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+def full_tree_parse(gpxData):
+	# As Parse used to go about it
+	ns = copy.deepcopy(GPXIO.Namespaces)
+	del ns[None]
+	act = Activity()
+	root = etree.XML(gpxData)
+	ns["gpx"] = root.nsmap[None]
+	xtrk = root.find("gpx:trk", namespaces=ns)
+	for xtrkseg in xtrk.findall("gpx:trkseg", namespaces=ns):
+		lap = Lap()
+		for xtrkpt in xtrkseg.findall("gpx:trkpt", namespaces=ns):
+			wp = Waypoint()
+			wp.Timestamp = dateutil.parser.parse(xtrkpt.find("gpx:time", namespaces=ns).text)
+			wp.Location = Location(float(xtrkpt.attrib["lat"]), float(xtrkpt.attrib["lon"]), None)
+			eleEl = xtrkpt.find("gpx:ele", namespaces=ns)
+			if eleEl is not None:
+				wp.Location.Altitude = float(eleEl.text)
+			extEl = xtrkpt.find("gpx:extensions", namespaces=ns)
+			if extEl is not None:
+				gpxtpxExtEl = extEl.find("gpxtpx:TrackPointExtension", namespaces=ns)
+				if gpxtpxExtEl is not None:
+					hrEl = gpxtpxExtEl.find("gpxtpx:hr", namespaces=ns)
+					if hrEl is not None:
+						wp.HR = float(hrEl.text)
+					cadEl = gpxtpxExtEl.find("gpxtpx:cad", namespaces=ns)
+					if cadEl is not None:
+						wp.Cadence = float(cadEl.text)
+					tempEl = gpxtpxExtEl.find("gpxtpx:atemp", namespaces=ns)
+					if tempEl is not None:
+						wp.Temp = float(tempEl.text)
+				gpxdataHR = extEl.find("gpxdata:hr", namespaces=ns)
+				if gpxdataHR is not None:
+					wp.HR = float(gpxdataHR.text)
+				gpxdataCadence = extEl.find("gpxdata:cadence", namespaces=ns)
+				if gpxdataCadence is not None:
+					wp.Cadence = float(gpxdataCadence.text)
+			lap.Waypoints.append(wp)
+		act.Laps.append(lap)
+	act.Stats.Distance = ActivityStatistic(ActivityStatisticUnit.Meters, value=ActivityStatisticCalculator.CalculateDistance(act))
+	return act
+
+def peak_memory(parse, path, results):
+	with open(path, "rb") as f:
+		gpxData = f.read()
+	before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	parse(gpxData)
+	results.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+
+def in_process(target, *args):
+	# Forked before this process has parsed (or generated) anything, so there's no freed memory lying around to reuse
+	results = multiprocessing.Queue()
+	proc = multiprocessing.Process(target=target, args=args + (results,))
+	proc.start()
+	result = results.get()
+	proc.join()
+	return result
+
+def write_large_gpx(path, results):
+	act = _random_activity(random.Random(0), laps=LAPS, points=WAYPOINTS // LAPS)
+	for lap in act.Laps:
+		for wp in lap.Waypoints:
+			wp.Timestamp = pytz.utc.localize(wp.Timestamp)
+			wp.Location = wp.Location or Location(45, -75, None) # GPX has no location-free points
+	act.Stationary = False
+	with open(path, "wb") as f:
+		f.write(GPXIO.Dump(act).encode("utf-8"))
+	results.put(None)
+
+if __name__ == "__main__":
+	rng = random.Random(0)
+	timestamps = []
+	for x in range(WAYPOINTS):
+		seconds = rng.randint(0, 86399)
+		timestamps.append(rng.choice(["2015-06-01T%02d:%02d:%02dZ", "2015-06-01T%02d:%02d:%02d.250Z", "2015-06-01T%02d:%02d:%02d-05:00"]) % (seconds // 3600, seconds // 60 % 60, seconds % 60))
+	print("%d timestamps:" % WAYPOINTS)
+	print("  %-34s %8.1f ms" % ("dateutil", best_of(lambda: [dateutil.parser.parse(x) for x in timestamps]) * 1000))
+	print("  %-34s %8.1f ms" % ("ISO 8601 fast path", best_of(lambda: [_parseTimestamp(x) for x in timestamps]) * 1000))
+
+	workdir = tempfile.mkdtemp()
+	path = os.path.join(workdir, "large.gpx")
+	try:
+		in_process(write_large_gpx, path)
+		parsers = (("full tree", full_tree_parse), ("iterparse (Parse)", GPXIO.Parse))
+		peaks = [in_process(peak_memory, parse, path) / 1024 for label, parse in parsers] # ru_maxrss is in KB on Linux
+		with open(path, "rb") as f:
+			gpxData = f.read()
+		print("%d waypoints, %.1f MB of GPX:" % (WAYPOINTS, len(gpxData) / 1024 / 1024))
+		for (label, parse), peak in zip(parsers, peaks):
+			print("  %-34s %8.1f ms %8.1f MB peak" % (label, best_of(lambda: parse(gpxData)) * 1000, peak))
+		old, new = full_tree_parse(gpxData), GPXIO.Parse(gpxData)
+		same = [(wp.Timestamp, wp.Location.Latitude, wp.HR) for wp in old.GetFlatWaypoints()] == [(wp.Timestamp, wp.Location.Latitude, wp.HR) for wp in new.GetFlatWaypoints()]
+		print("  %s" % ("same waypoints" if same else "WAYPOINTS DIFFER"))
+	finally:
+		shutil.rmtree(workdir)
@@ -0,0 +1,69 @@
+# This file isn't called in normal operation - it's for checking RateLimit.Limit under contention.
+# Runs a number of worker processes against one limit, then reports throughput, how long each call took, and the busiest
+# span of the limit's length (which should never exceed the limit).
+# Usage: python ratelimit_benchmark.py [workers] [seconds] [--mongo]
+
+from tapiriik.services.ratelimiting import RateLimit, RateLimitExceededException
+from datetime import timedelta
+import multiprocessing
+import sys
+import time
+import uuid
+
+WORKERS = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+DURATION = float(sys.argv[2]) if len(sys.argv) > 2 and not sys.argv[2].startswith("--") else 30
+LIMITS = [(timedelta(seconds=10), 500), (timedelta(seconds=60), 2000)]
+
+def worker(key, deadline, use_mongo, results):
+	if use_mongo:
+		import tapiriik.services.ratelimiting
+		tapiriik.services.ratelimiting.redis = None
+	acquired = []
+	call_times = []
+	rejected = 0
+	while time.time() < deadline:
+		start = time.time()
+		try:
+			RateLimit.Limit(key, LIMITS, max_wait=max(0, deadline - time.time()))
+		except RateLimitExceededException:
+			rejected += 1
+			continue
+		finally:
+			call_times.append(time.time() - start)
+		acquired.append(time.time())
+	results.put((acquired, call_times, rejected))
+
+if __name__ == "__main__":
+	use_mongo = "--mongo" in sys.argv
+	key = "benchmark-%s" % uuid.uuid4()
+	if use_mongo:
+		RateLimit.Refresh(key, LIMITS)
+	results = multiprocessing.Queue()
+	deadline = time.time() + DURATION
+	print("%d workers for %ds against %s (%s)" % (WORKERS, DURATION, LIMITS, "ratelimit database" if use_mongo else "Redis"))
+	procs = [multiprocessing.Process(target=worker, args=(key, deadline, use_mongo, results)) for x in range(WORKERS)]
+	[x.start() for x in procs]
+	acquired = []
+	call_times = []
+	rejected = 0
+	for x in procs:
+		worker_acquired, worker_call_times, worker_rejected = results.get()
+		acquired += worker_acquired
+		call_times += worker_call_times
+		rejected += worker_rejected
+	[x.join() for x in procs]
+
+	acquired.sort()
+	call_times.sort()
+	print("Acquired %d (%.1f/sec), %d rejected" % (len(acquired), len(acquired) / DURATION, rejected))
+	if call_times:
+		print("Call time: median %.4fs, 99th percentile %.4fs, max %.4fs" % (call_times[len(call_times) // 2], call_times[int(len(call_times) * 0.99)], call_times[-1]))
+	for timespan, count in LIMITS:
+		span = timespan.total_seconds()
+		busiest = 0
+		start_idx = 0
+		for idx, ts in enumerate(acquired):
+			while acquired[start_idx] <= ts - span:
+				start_idx += 1
+			busiest = max(busiest, idx - start_idx + 1)
+		print("Busiest %ds: %d of %d allowed%s" % (span, busiest, count, "" if busiest <= count else " - EXCEEDED"))
@@ -0,0 +1,29 @@
+# This file isn't called in normal operation - it's for checking how long it takes to get the services going.
+# Each step runs in a fresh interpreter (so nothing's already imported), and the best of a few runs is reported.
+# Usage: python service_startup_benchmark.py [service ID] [runs]
+
+import subprocess
+import sys
+
+SERVICE_ID = sys.argv[1] if len(sys.argv) > 1 else "strava"
+RUNS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+STEPS = [
+	("import tapiriik.services", "from tapiriik.services import Service"),
+	("Service.FromID(%r)" % SERVICE_ID, "Service.FromID(%r)" % SERVICE_ID),
+	("Service.List()", "Service.List()"),
+	("PreferredDownloadPriorityRanks()", "Service.PreferredDownloadPriorityRanks()")
+]
+
+def time_steps():
+	script = "import time\nresults = []\n"
+	for name, code in STEPS:
+		script += "start = time.time()\n%s\nresults.append(time.time() - start)\n" % code
+	script += "print(' '.join(str(x) for x in results))\n"
+	output = subprocess.check_output([sys.executable, "-c", script])
+	return [float(x) for x in output.decode("utf-8").split()[-len(STEPS):]]
+
+runs = [time_steps() for x in range(RUNS)]
+for idx, (name, code) in enumerate(STEPS):
+	times = [run[idx] for run in runs]
+	print("%-40s best %8.1f ms, worst %8.1f ms" % (name, min(times) * 1000, max(times) * 1000))
@@ -0,0 +1,38 @@
+# This file isn't called in normal operation - it's for timing ActivityStatisticCalculator on long activities.
+# Compares the single-pass Calculate against the separate distance/timer time/HR passes it replaced, and CalculateDistance against the scalar distance pass.
+# Usage: python statistics_benchmark.py [waypoints] [runs]
+
+from tapiriik.services.statistic_calculator import ActivityStatisticCalculator
+from tapiriik.testing.statistics import _random_activity, _reference_distance, _reference_timer_time, _reference_hr
+import random
+import sys
+import time
+
+WAYPOINTS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+RUNS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+LAPS = 10
+
+def best_of(fn):
+	best = None
+	for x in range(RUNS):
+		start = time.time()
+		fn()
+		elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+def scalar(act):
+	# Each of these used to flatten the waypoints for itself
+	_reference_distance(act.ReadFlatWaypoints())
+	_reference_timer_time(act.ReadFlatWaypoints())
+	_reference_hr(act.ReadFlatWaypoints())
+
+rng = random.Random(0)
+for columns in (False, True):
+	act = _random_activity(rng, laps=LAPS, points=WAYPOINTS // LAPS, columns=columns)
+	print("%d waypoints, %s:" % (WAYPOINTS, "WaypointColumns laps" if columns else "list laps"))
+	print("  %-34s %8.1f ms" % ("separate scalar passes", best_of(lambda: scalar(act)) * 1000))
+	print("  %-34s %8.1f ms" % ("Calculate", best_of(lambda: ActivityStatisticCalculator.Calculate(act)) * 1000))
+	print("  %-34s %8.1f ms" % ("CalculateLaps", best_of(lambda: ActivityStatisticCalculator.CalculateLaps(act)) * 1000))
+	print("  %-34s %8.1f ms" % ("scalar distance", best_of(lambda: _reference_distance(act.ReadFlatWaypoints())) * 1000))
+	print("  %-34s %8.1f ms" % ("CalculateDistance", best_of(lambda: ActivityStatisticCalculator.CalculateDistance(act)) * 1000))
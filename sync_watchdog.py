@@ -29,9 +29,9 @@ for worker in db.sync_workers.find({"Host": host}):
         os.kill(worker["Process"], signal.SIGKILL)
         alive = False
 
-    # Clear it from the database if it's not alive.
+    # Clear it from the database if it's not alive (along with the records for its other task slots).
     if not alive:
-        db.sync_workers.remove({"_id": worker["_id"]})
+        db.sync_workers.remove({"Process": worker["Process"], "Host": host})
         # Unlock users attached to it.
         db.users.update({"SynchronizationWorker": worker["Process"], "SynchronizationHost": host}, {"$unset":{"SynchronizationWorker": True}}, multi=True)
 
@@ -11,18 +11,36 @@ from tapiriik.requests_lib import patch_requests_with_default_timeout, patch_req
 from tapiriik import settings
 from tapiriik.database import db, close_connections
 from pymongo import ReturnDocument
+import resource
 import sys
 import subprocess
 import socket
 
-RecycleInterval = 1
+RecycleInterval = settings.SYNC_WORKER_RECYCLE_USERS
 
 oldCwd = os.getcwd()
 WorkerVersion = subprocess.Popen(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, cwd=os.path.dirname(__file__)).communicate()[0].strip()
 os.chdir(oldCwd)
 
-def sync_heartbeat(state, user=None):
-    db.sync_workers.update({"_id": heartbeat_rec_id}, {"$set": {"Heartbeat": datetime.utcnow(), "State": state, "User": user}})
+def sync_heartbeat(state, user=None, slot=0):
+    db.sync_workers.update({"_id": heartbeat_rec_ids[slot]}, {"$set": {"Heartbeat": datetime.utcnow(), "State": state, "User": user, "HTTPConnections": HTTPSessions.Stats()}})
+
+def current_rss():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        # No /proc - the peak will have to do
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def should_recycle():
+    if settings.SYNC_WORKER_MAX_RSS_MB is None:
+        return False
+    rss = current_rss()
+    if rss > settings.SYNC_WORKER_MAX_RSS_MB * 1024 * 1024:
+        worker_message("recycling at %d MB RSS" % (rss // (1024 * 1024)))
+        return True
+    return False
 
 worker_message("initialized")
 
@@ -36,23 +54,28 @@ worker_message("initialized")
 # (plus, we no longer query with Process/Host in sync_hearbeat)
 
 sys.stdout.flush()
-heartbeat_rec = db.sync_workers.find_one_and_update(
-	{
-		"Process": os.getpid(),
-		"Host": socket.gethostname()
-	}, { 
-		"$set": {
+# One record per task slot, each with its own heartbeat
+heartbeat_rec_ids = []
+for slot in range(settings.SYNC_WORKER_TASKS):
+	heartbeat_rec = db.sync_workers.find_one_and_update(
+		{
 			"Process": os.getpid(),
 			"Host": socket.gethostname(),
-			"Heartbeat": datetime.utcnow(),
-			"Startup":  datetime.utcnow(),
-			"Version": WorkerVersion,
-			"Index": settings.WORKER_INDEX,
-			"State": "startup"
-		}
-	}, upsert=True,
-	return_document=ReturnDocument.AFTER)
-heartbeat_rec_id = heartbeat_rec["_id"]
+			"Slot": slot
+		}, { 
+			"$set": {
+				"Process": os.getpid(),
+				"Host": socket.gethostname(),
+				"Slot": slot,
+				"Heartbeat": datetime.utcnow(),
+				"Startup":  datetime.utcnow(),
+				"Version": WorkerVersion,
+				"Index": settings.WORKER_INDEX,
+				"State": "startup"
+			}
+		}, upsert=True,
+		return_document=ReturnDocument.AFTER)
+	heartbeat_rec_ids.append(heartbeat_rec["_id"])
 
 patch_requests_with_default_timeout(timeout=60)
 
@@ -65,17 +88,19 @@ print(" %d -> Index %s\n -> Interface %s" % (os.getpid(), settings.WORKER_INDEX,
 # We defer including the main body of the application till here so the settings aren't captured before we've set them up.
 # The better way would be to defer initializing services until they're requested, but it's 10:30 and this will work just as well.
 from tapiriik.sync import Sync
+from tapiriik.services.http_sessions import HTTPSessions
 
 Sync.InitializeWorkerBindings()
 
-sync_heartbeat("ready")
+for slot in range(settings.SYNC_WORKER_TASKS):
+    sync_heartbeat("ready", slot=slot)
 
 worker_message("ready")
 
-Sync.PerformGlobalSync(heartbeat_callback=sync_heartbeat, version=WorkerVersion, max_users=RecycleInterval)
+Sync.PerformGlobalSync(heartbeat_callback=sync_heartbeat, version=WorkerVersion, max_users=RecycleInterval, tasks=settings.SYNC_WORKER_TASKS, recycle_check=should_recycle)
 
 worker_message("shutting down cleanly")
-db.sync_workers.remove({"_id": heartbeat_rec_id})
+db.sync_workers.remove({"_id": {"$in": heartbeat_rec_ids}})
 close_connections()
 worker_message("shut down")
 sys.stdout.flush()
@@ -0,0 +1,19 @@
+# Moves the SynchronizedActivities arrays out of connection documents and into the synchronized_activities collection.
+#  Sync workers migrate connections as they're loaded anyway, so this just gets it done ahead of time - it's safe to run (or re-run) alongside them.
+from tapiriik.database import db
+from tapiriik.services.synchronized_activities import SynchronizedActivityStore
+
+print("Setting up indexes")
+SynchronizedActivityStore.EnsureIndexes()
+
+connection_ids = [x["_id"] for x in db.connections.find({"SynchronizedActivities": {"$exists": True}}, {"_id": True})]
+total = len(connection_ids)
+migrated_uids = 0
+for idx, connection_id in enumerate(connection_ids):
+	connection = db.connections.find_one({"_id": connection_id}, {"SynchronizedActivities": True})
+	if connection:
+		migrated_uids += SynchronizedActivityStore.MigrateConnection(connection_id, connection.get("SynchronizedActivities", []))
+	if idx % 100 == 0:
+		print("%3d%% %d connections, %d UIDs" % (round(idx * 100 / total), idx, migrated_uids))
+
+print("Migrated %d UIDs for %d connections" % (migrated_uids, total))
@@ -2,6 +2,7 @@ from tapiriik.payments import *
 from .totp import *
 from tapiriik.database import db
 from tapiriik.sync import Sync
+from tapiriik.sync.activity_record import ActivityRecordStore
 from tapiriik.services import ServiceRecord
 from tapiriik.settings import DIAG_AUTH_TOTP_SECRET, DIAG_AUTH_PASSWORD
 from datetime import datetime, timedelta
@@ -180,7 +181,7 @@ class User:
             for user in activeUsers:
                 if len(user["ConnectedServices"]) - 1 == 0:
                     # I guess we're done here?
-                    db.activity_records.remove({"UserID": user["_id"]})
+                    ActivityRecordStore.Remove(user["_id"])
                     db.users.remove({"_id": user["_id"]})
 
     def AuthByService(serviceRecord):
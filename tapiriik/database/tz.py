@@ -1,12 +1,89 @@
-from tapiriik.database import tzdb
+from tapiriik.database import tzdb, cachedb
+from tapiriik.settings import TZ_CACHE_GRID_SIZE, TZ_CACHE_LOCAL_SIZE, TZ_CACHE_LIFETIME, TZ_INDEX_PATH
 from bson.son import SON
+from collections import OrderedDict
+from datetime import datetime
+import os
+import threading
+
+_tz_index = None
+
+def _getTZIndex():
+	global _tz_index
+	if _tz_index is None and TZ_INDEX_PATH and os.path.exists(TZ_INDEX_PATH):
+		from tapiriik.database.tz_index import TZIndex
+		_tz_index = TZIndex(TZ_INDEX_PATH)
+	return _tz_index
 
 def TZLookup(lat, lng):
-	pt = [lng, lat]
-	res = tzdb.boundaries.find_one({"Boundary": {"$geoIntersects": {"$geometry": {"type":"Point", "coordinates": pt}}}}, {"TZID": True})
-	if not res:
-		res = tzdb.boundaries.find_one({"Boundary": {"$near": {"$geometry": {"type": "Point", "coordinates": pt}, "$maxDistance": 200000}}}, {"TZID": True})
-	res = res["TZID"] if res else None
+	index = _getTZIndex()
+	if index:
+		res = index.Intersecting(lat, lng)
+		if not res:
+			res = index.Nearest(lat, lng, 200000)
+	else:
+		pt = [lng, lat]
+		res = tzdb.boundaries.find_one({"Boundary": {"$geoIntersects": {"$geometry": {"type":"Point", "coordinates": pt}}}}, {"TZID": True})
+		if not res:
+			res = tzdb.boundaries.find_one({"Boundary": {"$near": {"$geometry": {"type": "Point", "coordinates": pt}, "$maxDistance": 200000}}}, {"TZID": True})
+		res = res["TZID"] if res else None
 	if not res or res == "uninhabited":
 		res = round(lng / 15)
 	return res
+
+class TZCache:
+	# Read-through cache in front of TZLookup, keyed on a quantized lat/lng grid cell.
+	# Lookups hit an in-process LRU first, then the shared tz_cache collection (TTL-indexed), then the boundary DB.
+	_local = OrderedDict()
+	_lock = threading.Lock()
+	_indexEnsured = False
+	_hits = {"local": 0, "db": 0}
+	_misses = 0
+
+	def CellKey(lat, lng):
+		return "%d:%d" % (round(lat / TZ_CACHE_GRID_SIZE), round(lng / TZ_CACHE_GRID_SIZE))
+
+	def Lookup(lat, lng):
+		cell = TZCache.CellKey(lat, lng)
+		with TZCache._lock:
+			if cell in TZCache._local:
+				TZCache._local.move_to_end(cell)
+				TZCache._hits["local"] += 1
+				return TZCache._local[cell]
+
+		cached = cachedb.tz_cache.find_one({"Cell": cell}, {"TZ": True})
+		if cached:
+			res = cached["TZ"]
+			with TZCache._lock:
+				TZCache._hits["db"] += 1
+		else:
+			res = TZLookup(lat, lng)
+			TZCache._ensureIndex()
+			cachedb.tz_cache.update({"Cell": cell}, {"$set": {"Cell": cell, "TZ": res, "Latitude": lat, "Longitude": lng, "Timestamp": datetime.utcnow()}}, upsert=True)
+			with TZCache._lock:
+				TZCache._misses += 1
+
+		TZCache._remember(cell, res)
+		return res
+
+	def _remember(cell, res):
+		with TZCache._lock:
+			TZCache._local[cell] = res
+			TZCache._local.move_to_end(cell)
+			while len(TZCache._local) > TZ_CACHE_LOCAL_SIZE:
+				TZCache._local.popitem(last=False)
+
+	def _ensureIndex():
+		if TZCache._indexEnsured:
+			return
+		cachedb.tz_cache.ensure_index("Cell")
+		cachedb.tz_cache.ensure_index("Timestamp", expireAfterSeconds=int(TZ_CACHE_LIFETIME.total_seconds()))
+		TZCache._indexEnsured = True
+
+	def Stats():
+		with TZCache._lock:
+			return {"LocalHits": TZCache._hits["local"], "DBHits": TZCache._hits["db"], "Misses": TZCache._misses, "LocalSize": len(TZCache._local)}
+
+	def Clear():
+		with TZCache._lock:
+			TZCache._local.clear()
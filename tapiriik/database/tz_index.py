@@ -0,0 +1,192 @@
+from array import array
+import json
+import math
+import mmap
+import struct
+
+# A compact, read-only point-in-polygon index over the tz_world boundaries.
+# It's written once (by tz_ingest.py, or TZIndex.Build from the boundaries collection) and memory-mapped by each worker,
+#  so the OS shares a single copy of the pages between every process on the box.
+#
+# Layout: magic, header length, JSON header (TZIDs + array offsets), then 8-byte-aligned native arrays:
+#  PolyTZ[P]           - index into TZIDs for each polygon
+#  PolyRings[P+1]      - offsets into RingVertices for each polygon's rings (outer + holes, even-odd)
+#  PolyBBox[4P]        - min lng, min lat, max lng, max lat
+#  RingVertices[R+1]   - offsets (in points) into Vertices for each ring
+#  Vertices[2V]        - lng, lat pairs
+#  CellPolys[C+1]      - offsets into CellPolyList for each 1-degree grid cell
+#  CellPolyList[...]   - polygon indices overlapping each cell (by bounding box)
+
+_MAGIC = b"TZIDX001"
+_ARRAYS = (("PolyTZ", "I"), ("PolyRings", "I"), ("PolyBBox", "d"), ("RingVertices", "I"), ("Vertices", "d"), ("CellPolys", "I"), ("CellPolyList", "I"))
+_GRID_W = 360
+_GRID_H = 180
+_METERS_PER_DEGREE = 111195
+
+def _cell(lng, lat):
+	x = min(_GRID_W - 1, max(0, int(math.floor(lng + 180))))
+	y = min(_GRID_H - 1, max(0, int(math.floor(lat + 90))))
+	return y * _GRID_W + x
+
+class TZIndex:
+	def __init__(self, path):
+		self._file = open(path, "rb")
+		self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+		if self._map[:len(_MAGIC)] != _MAGIC:
+			self._map.close()
+			self._file.close()
+			raise ValueError("%s is not a TZ index" % path)
+		header_len = struct.unpack_from("<I", self._map, len(_MAGIC))[0]
+		header_start = len(_MAGIC) + 4
+		header = json.loads(self._map[header_start:header_start + header_len].decode("utf-8"))
+		self.TZIDs = header["TZIDs"]
+		view = memoryview(self._map)
+		for name, typecode in _ARRAYS:
+			offset, length = header["Arrays"][name]
+			setattr(self, "_" + name, view[offset:offset + length].cast(typecode))
+
+	def Close(self):
+		for name, typecode in _ARRAYS:
+			getattr(self, "_" + name).release()
+		self._map.close()
+		self._file.close()
+
+	def _candidates(self, cells):
+		seen = set()
+		for cell in cells:
+			for idx in range(self._CellPolys[cell], self._CellPolys[cell + 1]):
+				poly = self._CellPolyList[idx]
+				if poly not in seen:
+					seen.add(poly)
+					yield poly
+
+	def _contains(self, poly, lng, lat):
+		bbox = self._PolyBBox
+		if lng < bbox[poly * 4] or lat < bbox[poly * 4 + 1] or lng > bbox[poly * 4 + 2] or lat > bbox[poly * 4 + 3]:
+			return False
+		verts = self._Vertices
+		inside = False
+		for ring in range(self._PolyRings[poly], self._PolyRings[poly + 1]):
+			start = self._RingVertices[ring]
+			end = self._RingVertices[ring + 1]
+			j = end - 1
+			for i in range(start, end):
+				xi = verts[i * 2]
+				yi = verts[i * 2 + 1]
+				xj = verts[j * 2]
+				yj = verts[j * 2 + 1]
+				if (yi > lat) != (yj > lat) and lng < (xj - xi) * (lat - yi) / (yj - yi) + xi:
+					inside = not inside
+				j = i
+		return inside
+
+	def _distance(self, poly, lng, lat, lng_scale):
+		# Planar (equirectangular) distance to the nearest ring edge, in meters - plenty accurate at a 200km radius.
+		verts = self._Vertices
+		best = None
+		for ring in range(self._PolyRings[poly], self._PolyRings[poly + 1]):
+			start = self._RingVertices[ring]
+			end = self._RingVertices[ring + 1]
+			j = end - 1
+			for i in range(start, end):
+				# Wrap the longitude deltas so distances across the antimeridian come out right
+				ax = ((verts[j * 2] - lng + 180) % 360 - 180) * lng_scale
+				ay = verts[j * 2 + 1] - lat
+				bx = ((verts[i * 2] - lng + 180) % 360 - 180) * lng_scale
+				by = verts[i * 2 + 1] - lat
+				dx = bx - ax
+				dy = by - ay
+				seg_len = dx * dx + dy * dy
+				t = 0 if seg_len == 0 else max(0, min(1, -(ax * dx + ay * dy) / seg_len))
+				px = ax + t * dx
+				py = ay + t * dy
+				dist = px * px + py * py
+				if best is None or dist < best:
+					best = dist
+				j = i
+		return math.sqrt(best) * _METERS_PER_DEGREE if best is not None else None
+
+	def Intersecting(self, lat, lng):
+		for poly in self._candidates((_cell(lng, lat),)):
+			if self._contains(poly, lng, lat):
+				return self.TZIDs[self._PolyTZ[poly]]
+		return None
+
+	def Nearest(self, lat, lng, max_distance):
+		lng_scale = max(math.cos(math.radians(lat)), 0.01)
+		radius_lat = max_distance / _METERS_PER_DEGREE
+		radius_lng = min(180, radius_lat / lng_scale)
+		cells = set()
+		for y in range(int(math.floor(lat - radius_lat)), int(math.floor(lat + radius_lat)) + 1):
+			if y < -90 or y >= 90:
+				continue
+			for x in range(int(math.floor(lng - radius_lng)), int(math.floor(lng + radius_lng)) + 1):
+				cells.add((y + 90) * _GRID_W + ((x + 180) % _GRID_W))
+		best_dist = max_distance
+		best_poly = None
+		for poly in self._candidates(sorted(cells)):
+			dist = self._distance(poly, lng, lat, lng_scale)
+			if dist is not None and dist <= best_dist:
+				best_dist = dist
+				best_poly = poly
+		return self.TZIDs[self._PolyTZ[best_poly]] if best_poly is not None else None
+
+	def Build(path, boundaries):
+		""" boundaries is an iterable of (TZID, GeoJSON Polygon/MultiPolygon geometry) """
+		tzids = []
+		tzid_map = {}
+		arrays = dict((name, array(typecode)) for name, typecode in _ARRAYS)
+		arrays["PolyRings"].append(0)
+		arrays["RingVertices"].append(0)
+		cell_lists = [[] for x in range(_GRID_W * _GRID_H)]
+
+		for tzid, geometry in boundaries:
+			if tzid not in tzid_map:
+				tzid_map[tzid] = len(tzids)
+				tzids.append(tzid)
+			polygons = geometry["coordinates"] if geometry["type"] == "MultiPolygon" else [geometry["coordinates"]]
+			for rings in polygons:
+				poly = len(arrays["PolyTZ"])
+				arrays["PolyTZ"].append(tzid_map[tzid])
+				min_lng = min_lat = float("inf")
+				max_lng = max_lat = float("-inf")
+				for ring in rings:
+					for lng, lat in ((pt[0], pt[1]) for pt in ring):
+						arrays["Vertices"].extend((lng, lat))
+						min_lng, max_lng = min(min_lng, lng), max(max_lng, lng)
+						min_lat, max_lat = min(min_lat, lat), max(max_lat, lat)
+					arrays["RingVertices"].append(len(arrays["Vertices"]) // 2)
+				arrays["PolyRings"].append(len(arrays["RingVertices"]) - 1)
+				arrays["PolyBBox"].extend((min_lng, min_lat, max_lng, max_lat))
+				for y in range(_cell(0, min_lat) // _GRID_W, _cell(0, max_lat) // _GRID_W + 1):
+					for x in range(_cell(min_lng, 0) % _GRID_W, _cell(max_lng, 0) % _GRID_W + 1):
+						cell_lists[y * _GRID_W + x].append(poly)
+
+		arrays["CellPolys"].append(0)
+		for cell_list in cell_lists:
+			arrays["CellPolyList"].extend(cell_list)
+			arrays["CellPolys"].append(len(arrays["CellPolyList"]))
+
+		# The offsets depend on the header length, which depends on the offsets - so lay out with a generously-padded header.
+		header = {"TZIDs": tzids, "Arrays": {}}
+		header_room = len(json.dumps(header).encode("utf-8")) + 64 * len(_ARRAYS)
+		offset = len(_MAGIC) + 4 + header_room
+		for name, typecode in _ARRAYS:
+			offset += -offset % 8
+			length = len(arrays[name]) * arrays[name].itemsize
+			header["Arrays"][name] = (offset, length)
+			offset += length
+		header_bytes = json.dumps(header).encode("utf-8")
+		assert len(header_bytes) <= header_room
+
+		with open(path, "wb") as f:
+			f.write(_MAGIC)
+			f.write(struct.pack("<I", len(header_bytes)))
+			f.write(header_bytes)
+			for name, typecode in _ARRAYS:
+				f.write(b"\0" * (header["Arrays"][name][0] - f.tell()))
+				arrays[name].tofile(f)
+
+	def BuildFromDB(path):
+		from tapiriik.database import tzdb
+		TZIndex.Build(path, ((x["TZID"], x["Boundary"]) for x in tzdb.boundaries.find({}, {"TZID": True, "Boundary": True})))
@@ -2,6 +2,7 @@
 # (c) 2018 Anton Ashmarin, aashmarin@gmail.com
 from tapiriik.database import db
 from tapiriik.services.service_base import ServiceAuthenticationType, ServiceBase
+from tapiriik.services.pacing import PacingScope
 from tapiriik.services.service_record import ServiceRecord
 from tapiriik.services.interchange import UploadedActivity, ActivityType, ActivityStatistic, ActivityStatisticUnit, Waypoint, Location, Lap
 from tapiriik.services.api import APIException, UserException, UserExceptionType, APIExcludeActivity
@@ -29,6 +30,7 @@ class AerobiaService(ServiceBase):
     RequiresExtendedAuthorizationDetails = True
     UserProfileURL = "https://www.aerobia.ru/users/{0}"
     UserActivityURL = "https://www.aerobia.ru/users/{0}/workouts/{1}"
+    RequestPacing = [(PacingScope.Account, 5)]
 
     # common -> aerobia (garmin tcx sport names)
     # todo may better to include this into tcxio logic instead
@@ -187,6 +189,7 @@ class AerobiaService(ServiceBase):
         resp = None
         ex = Exception()
         for i in range(0, retry_count):
+            self._pace(serviceRecord)
             try:
                 resp = request_call(args)
                 break
@@ -196,8 +199,8 @@ class AerobiaService(ServiceBase):
             except requests.exceptions.ConnectTimeout as ex:
                 # Aerobia sometimes answer like
                 # Failed to establish a new connection: [WinError 10060] may happen while listing.
-                # wait a bit and retry
-                time.sleep(.2)
+                # retry, once the pacing allows
+                pass
         if resp is None:
             raise ex
         return resp
@@ -300,9 +300,7 @@ class BeginnerTriathleteService(ServiceBase):
 
                 if contentType:
                     if contentType == _DeviceFileTypes.FIT:
-                        # Oh no! Not supported! So close ....
-                        # FITIO.Parse(res.content, activity)
-                        return activity
+                        FITIO.Parse(res.content, activity)
                     if contentType == _DeviceFileTypes.TCX:
                         TCXIO.Parse(res.content, activity)
                     if contentType == _DeviceFileTypes.GPX:
@@ -15,7 +15,6 @@ import logging
 import lxml
 import pickle
 import re
-import requests
 logger = logging.getLogger(__name__)
 
 class DropboxService(ServiceBase):
@@ -70,7 +69,7 @@ class DropboxService(ServiceBase):
                 "oauth1_token": serviceRec.Authorization["Key"],
                 "oauth1_token_secret": serviceRec.Authorization["Secret"]
             }
-            res = requests.post("https://api.dropboxapi.com/2/auth/token/from_oauth1",
+            res = self._http.post("https://api.dropboxapi.com/2/auth/token/from_oauth1",
                                 json=upgrade_data,
                                 auth=self._app_credentials(serviceRec.Authorization["Full"]))
             token = res.json()["oauth2_token"]
@@ -81,7 +80,7 @@ class DropboxService(ServiceBase):
             })
         else:
             token = serviceRec.Authorization["Token"]
-        return dropbox.Dropbox(token)
+        return dropbox.Dropbox(token, session=self._http)
 
     def WebInit(self):
         self.UserAuthorizationURL = reverse("oauth_redirect", kwargs={"service": "dropbox"})
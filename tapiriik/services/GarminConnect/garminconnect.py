@@ -1,5 +1,6 @@
-from tapiriik.settings import WEB_ROOT, HTTP_SOURCE_ADDR, GARMIN_CONNECT_USER_WATCH_ACCOUNTS
+from tapiriik.settings import WEB_ROOT, GARMIN_CONNECT_USER_WATCH_ACCOUNTS
 from tapiriik.services.service_base import ServiceAuthenticationType, ServiceBase
+from tapiriik.services.pacing import PacingScope
 from tapiriik.services.service_record import ServiceRecord
 from tapiriik.services.interchange import UploadedActivity, ActivityType, ActivityStatistic, ActivityStatisticUnit, Waypoint, Location, Lap
 from tapiriik.services.api import APIException, APIWarning, APIExcludeActivity, UserException, UserExceptionType
@@ -14,7 +15,6 @@ from tapiriik.database import cachedb, db
 from django.core.urlresolvers import reverse
 import pytz
 from datetime import datetime, timedelta
-import requests
 import os
 import math
 import logging
@@ -22,7 +22,6 @@ import time
 import json
 import re
 import random
-import tempfile
 import json
 from urllib.parse import urlencode
 logger = logging.getLogger(__name__)
@@ -40,6 +39,8 @@ class GarminConnectService(ServiceBase):
     # a) create a reasonable schema to allow for these updates.
     # b) write a query to reset the counters in the existing schema.
     DownloadRetryCount = 6
+    # I appear to been banned from Garmin Connect while determining this.
+    RequestPacing = [(PacingScope.SourceAddress, 1)]
 
     ConfigurationDefaults = {
         "WatchUserKey": None,
@@ -129,7 +130,7 @@ class GarminConnectService(ServiceBase):
     def __init__(self):
         cachedHierarchy = cachedb.gc_type_hierarchy.find_one()
         if not cachedHierarchy:
-            rawHierarchy = requests.get("https://connect.garmin.com/modern/proxy/activity-service/activity/activityTypes", headers=self._obligatory_headers).text
+            rawHierarchy = self._http.get("https://connect.garmin.com/modern/proxy/activity-service/activity/activityTypes", headers=self._obligatory_headers).text
             self._activityHierarchy = json.loads(rawHierarchy)
             cachedb.gc_type_hierarchy.insert({"Hierarchy": rawHierarchy})
         else:
@@ -142,32 +143,9 @@ class GarminConnectService(ServiceBase):
             self._typeKeyParentMap[x["typeKey"]] = x["parentTypeId"]
             self._typeIdKeyMap[x["typeId"]] = x["typeKey"] 
             
-        rate_lock_path = tempfile.gettempdir() + "/gc_rate.%s.lock" % HTTP_SOURCE_ADDR
-        # Ensure the rate lock file exists (...the easy way)
-        open(rate_lock_path, "a").close()
-        self._rate_lock = open(rate_lock_path, "r+")
-        
 
     def _rate_limit(self):
-        import fcntl, struct, time
-        min_period = 1  # I appear to been banned from Garmin Connect while determining this.
-        fcntl.flock(self._rate_lock,fcntl.LOCK_EX)
-        try:
-            self._rate_lock.seek(0)
-            last_req_start = self._rate_lock.read()
-            if not last_req_start:
-                last_req_start = 0
-            else:
-                last_req_start = float(last_req_start)
-
-            wait_time = max(0, min_period - (time.time() - last_req_start))
-            time.sleep(wait_time)
-
-            self._rate_lock.seek(0)
-            self._rate_lock.write(str(time.time()))
-            self._rate_lock.flush()
-        finally:
-            fcntl.flock(self._rate_lock,fcntl.LOCK_UN)
+        self._pace()
 
     def _request_with_reauth(self, req_lambda, serviceRecord=None, email=None, password=None, force_skip_cache=False):
         for i in range(self._reauthAttempts + 1):
@@ -190,7 +168,7 @@ class GarminConnectService(ServiceBase):
             password = CredentialStore.Decrypt(record.ExtendedAuthorization["Password"])
             email = CredentialStore.Decrypt(record.ExtendedAuthorization["Email"])
 
-        session = requests.Session()
+        session = self._newSession()
 
         # JSIG CAS, cool I guess.
         # Not quite OAuth though, so I'll continue to collect raw credentials.
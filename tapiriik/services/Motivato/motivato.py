@@ -1,5 +1,6 @@
-from tapiriik.settings import WEB_ROOT, HTTP_SOURCE_ADDR
+from tapiriik.settings import WEB_ROOT
 from tapiriik.services.service_base import ServiceAuthenticationType, ServiceBase
+from tapiriik.services.pacing import PacingScope
 from tapiriik.services.interchange import UploadedActivity, ActivityType, ActivityStatistic, ActivityStatisticUnit, Waypoint, Location, Lap
 from tapiriik.services.api import APIException, APIWarning, UserException, UserExceptionType
 from tapiriik.services.sessioncache import SessionCache
@@ -11,7 +12,6 @@ import requests
 import logging
 import time
 import json
-import tempfile
 logger = logging.getLogger(__name__)
 
 class MotivatoService(ServiceBase):
@@ -20,6 +20,7 @@ class MotivatoService(ServiceBase):
     DisplayAbbreviation = "MOT"
     AuthenticationType = ServiceAuthenticationType.UsernamePassword
     RequiresExtendedAuthorizationDetails = True
+    RequestPacing = [(PacingScope.SourceAddress, 1)]
 
     _activityMappings={
         ActivityType.Running: 1,
@@ -59,12 +60,6 @@ class MotivatoService(ServiceBase):
 
     _urlRoot = "http://motivato.pl"
 
-    def __init__(self):
-        rate_lock_path = tempfile.gettempdir() + "/m_rate.%s.lock" % HTTP_SOURCE_ADDR
-        # Ensure the rate lock file exists (...the easy way)
-        open(rate_lock_path, "a").close()
-        self._rate_lock = open(rate_lock_path, "r+")
-
     def WebInit(self):
         self.UserAuthorizationURL = WEB_ROOT + reverse("auth_simple", kwargs={"service": self.ID})
 
@@ -348,29 +343,7 @@ class MotivatoService(ServiceBase):
         return session
 
     def _rate_limit(self):
-        import fcntl, time
-        min_period = 1
-        print("Waiting for lock")
-        fcntl.flock(self._rate_lock,fcntl.LOCK_EX)
-        try:
-            print("Have lock")
-            self._rate_lock.seek(0)
-            last_req_start = self._rate_lock.read()
-            if not last_req_start:
-                last_req_start = 0
-            else:
-                last_req_start = float(last_req_start)
-
-            wait_time = max(0, min_period - (time.time() - last_req_start))
-            time.sleep(wait_time)
-
-            self._rate_lock.seek(0)
-            self._rate_lock.write(str(time.time()))
-            self._rate_lock.flush()
-
-            print("Rate limited for %f" % wait_time)
-        finally:
-            fcntl.flock(self._rate_lock,fcntl.LOCK_UN)
+        self._pace()
 
     def DeleteCachedData(self, serviceRecord):
         # nothing cached...
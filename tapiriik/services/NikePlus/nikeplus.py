@@ -225,11 +225,12 @@ class NikePlusService(ServiceBase):
         lap = Lap(startTime=activity.StartTime, endTime=activity.EndTime)
         lap.Stats = activity.Stats
         activity.Laps = [lap]
-        # I thought I wrote StreamSampler to be generator-friendly - nope.
-        streams = {k: list(v) for k,v in streams.items()}
-
         # The docs are unclear on which of these are actually stream metrics, oh well
-        def stream_waypoint(offset, speed=None, distance=None, heartrate=None, calories=None, steps=None, watts=None, gps=None, **kwargs):
+        # The rest (steps, fuel...) are merged in too, so there's still a waypoint at each of their offsets
+        names = ("speed", "distance", "heartrate", "calories", "watts", "gps")
+        names += tuple(sorted(set(streams.keys()) - set(names)))
+        for offset, values in StreamSampler.Sample(streams, names):
+            speed, distance, heartrate, calories, watts, gps = values[:6]
             wp = Waypoint()
             wp.Timestamp = activity.StartTime + timedelta(seconds=offset)
             wp.Speed = float(speed) if speed else None
@@ -242,8 +243,6 @@ class NikePlusService(ServiceBase):
                 wp.Location = Location(lat=float(gps["latitude"]), lon=float(gps["longitude"]), alt=float(gps["elevation"]))
             lap.Waypoints.append(wp)
 
-        StreamSampler.SampleWithCallback(stream_waypoint, streams)
-
         activity.Stationary = len(lap.Waypoints) == 0
 
         return activity
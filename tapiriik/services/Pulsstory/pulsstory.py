@@ -239,7 +239,7 @@ class PulsstoryService(ServiceBase):
         self._convertList(streamData, "cadence", rawData, "Cadence")
         self._convertPathList(streamData, "path", rawData)
 
-        def _addWaypoint(timestamp, path=None, heart_rate=None, power=None, distance=None, speed=None, cadence=None):
+        for timestamp, (path, heart_rate, power, distance, speed, cadence) in StreamSampler.Sample(streamData, ("path", "heart_rate", "power", "distance", "speed", "cadence")):
             waypoint = Waypoint(activity.StartTime + timedelta(seconds=timestamp))
             if path:
                 if path["latitude"] != 0 and path["longitude"] != 0:
@@ -252,8 +252,6 @@ class PulsstoryService(ServiceBase):
             waypoint.Power = power
             lap.Waypoints.append(waypoint)
 
-        StreamSampler.SampleWithCallback(_addWaypoint, streamData)
-
         activity.Stationary = len(lap.Waypoints) == 0
         activity.GPS = any(wp.Location and wp.Location.Longitude is not None and wp.Location.Latitude is not None for wp in lap.Waypoints)
         if not activity.Stationary:
@@ -8,7 +8,6 @@ from tapiriik.services.interchange import UploadedActivity, ActivityType, Activi
 from tapiriik.database import cachedb, redis
 from django.core.urlresolvers import reverse
 from datetime import datetime, timedelta
-import requests
 import urllib.parse
 import json
 import logging
@@ -89,7 +88,7 @@ class RunKeeperService(ServiceBase):
         params = {"grant_type": "authorization_code", "code": code, "client_id": RUNKEEPER_CLIENT_ID, "client_secret": RUNKEEPER_CLIENT_SECRET, "redirect_uri": WEB_ROOT + reverse("oauth_return", kwargs={"service": "runkeeper"})}
 
         response = self._rate_limit("auth_token",
-                                    lambda: requests.post("https://runkeeper.com/apps/token",
+                                    lambda: self._http.post("https://runkeeper.com/apps/token",
                                                           data=urllib.parse.urlencode(params),
                                                           headers={"Content-Type": "application/x-www-form-urlencoded"}))
 
@@ -104,7 +103,7 @@ class RunKeeperService(ServiceBase):
 
     def RevokeAuthorization(self, serviceRecord):
         resp = self._rate_limit("revoke_token",
-                                lambda: requests.post("https://runkeeper.com/apps/de-authorize",
+                                lambda: self._http.post("https://runkeeper.com/apps/de-authorize",
                                                       data={"access_token": serviceRecord.Authorization["Token"]}))
         if resp.status_code != 204 and resp.status_code != 200:
             raise APIException("Unable to deauthorize RK auth token, status " + str(resp.status_code) + " resp " + resp.text)
@@ -123,7 +122,7 @@ class RunKeeperService(ServiceBase):
                 uris = json.loads(uris_json.decode('utf-8'))
             else:
                 response = self._rate_limit("user",
-                                            lambda: requests.get("https://api.runkeeper.com/user/",
+                                            lambda: self._http.get("https://api.runkeeper.com/user/",
                                                                  headers=self._apiHeaders(serviceRecord)))
                 if response.status_code != 200:
                     if response.status_code == 401 or response.status_code == 403:
@@ -143,7 +142,7 @@ class RunKeeperService(ServiceBase):
 
     def _getUserId(self, serviceRecord):
         resp = self._rate_limit("user",
-                                lambda: requests.get("https://api.runkeeper.com/user/",
+                                lambda: self._http.get("https://api.runkeeper.com/user/",
                                                      headers=self._apiHeaders(serviceRecord)))
         if resp.status_code != 200:
             raise APIException("Failed to retrieve RK user metadata %s: %s" % (resp.status_code, resp.text))
@@ -159,7 +158,7 @@ class RunKeeperService(ServiceBase):
 
         while True:
             response = self._rate_limit("list",
-                                        lambda: requests.get(pageUri,
+                                        lambda: self._http.get(pageUri,
                                                              headers=self._apiHeaders(serviceRecord)))
             if response.status_code != 200:
                 if response.status_code == 401 or response.status_code == 403:
@@ -213,7 +212,7 @@ class RunKeeperService(ServiceBase):
             ridedata = cachedb.rk_activity_cache.find_one({"uri": activityID})
         if not AGGRESSIVE_CACHE or ridedata is None:
             response = self._rate_limit("download",
-                                        lambda: requests.get("https://api.runkeeper.com" + activityID,
+                                        lambda: self._http.get("https://api.runkeeper.com" + activityID,
                                                              headers=self._apiHeaders(serviceRecord)))
             if response.status_code != 200:
                 if response.status_code == 401 or response.status_code == 403:
@@ -257,7 +256,7 @@ class RunKeeperService(ServiceBase):
                 else:
                     streamData[stream] = [(x["timestamp"], x[stream]) for x in rawData[stream]] # Change up format for StreamSampler
 
-        def _addWaypoint(timestamp, path=None, heart_rate=None, calories=None, distance=None):
+        for timestamp, (path, heart_rate, calories, distance) in StreamSampler.Sample(streamData, ("path", "heart_rate", "calories", "distance")):
             waypoint = Waypoint(activity.StartTime + timedelta(seconds=timestamp))
             if path:
                 if path["latitude"] != 0 and path["longitude"] != 0:
@@ -268,7 +267,6 @@ class RunKeeperService(ServiceBase):
             waypoint.Distance = distance
 
             lap.Waypoints.append(waypoint)
-        StreamSampler.SampleWithCallback(_addWaypoint, streamData)
 
         activity.Stationary = len(lap.Waypoints) == 0
         activity.GPS = any(wp.Location and wp.Location.Longitude is not None and wp.Location.Latitude is not None for wp in lap.Waypoints)
@@ -283,7 +281,7 @@ class RunKeeperService(ServiceBase):
         headers = self._apiHeaders(serviceRecord)
         headers["Content-Type"] = "application/vnd.com.runkeeper.NewFitnessActivity+json"
         response = self._rate_limit("upload",
-                                    lambda: requests.post(uris["fitness_activities"],
+                                    lambda: self._http.post(uris["fitness_activities"],
                                                           headers=headers,
                                                           data=json.dumps(uploadData)))
 
@@ -334,7 +332,7 @@ class RunKeeperService(ServiceBase):
             if auto_pause and not any(wp.Type == WaypointType.Pause for wp in flat_wps):
                 # ...but not if we don't know the intended moving time
                 if activity.Stats.MovingTime.Value:
-                    wp_type_iter = AutoPauseCalculator.calculate(flat_wps, activity.Stats.MovingTime.asUnits(ActivityStatisticUnit.Seconds).Value)
+                    wp_type_iter = AutoPauseCalculator.waypoint_types(flat_wps, activity.Stats.MovingTime.asUnits(ActivityStatisticUnit.Seconds).Value)
 
             inPause = False
             for waypoint, waypoint_type in zip(flat_wps, wp_type_iter):
@@ -385,7 +383,7 @@ class RunKeeperService(ServiceBase):
     def DeleteActivity(self, serviceRecord, uri):
         headers = self._apiHeaders(serviceRecord)
         del_res = self._rate_limit("delete",
-                                   lambda: requests.delete("https://api.runkeeper.com/%s" % uri,
+                                   lambda: self._http.delete("https://api.runkeeper.com/%s" % uri,
                                                            headers=headers))
         del_res.raise_for_status()
 
@@ -9,7 +9,6 @@ import pytz
 from datetime import timedelta
 import dateutil.parser
 from dateutil.tz import tzutc
-import requests
 import json
 import re
 import urllib.parse
@@ -154,7 +153,7 @@ class SportTracksService(ServiceBase):
             # Use refresh token to get access token
             # Hardcoded return URI to get around the lack of URL reversing without loading up all the Django stuff
             params = {"grant_type": "refresh_token", "refresh_token": serviceRecord.Authorization["RefreshToken"], "client_id": SPORTTRACKS_CLIENT_ID, "client_secret": SPORTTRACKS_CLIENT_SECRET, "redirect_uri": "https://tapiriik.com/auth/return/sporttracks"}
-            response = requests.post("https://api.sporttracks.mobi/oauth2/token", data=urllib.parse.urlencode(params), headers={"Content-Type": "application/x-www-form-urlencoded"})
+            response = self._http.post("https://api.sporttracks.mobi/oauth2/token", data=urllib.parse.urlencode(params), headers={"Content-Type": "application/x-www-form-urlencoded"})
             if response.status_code != 200:
                 if response.status_code >= 400 and response.status_code < 500:
                     raise APIException("Could not retrieve refreshed token %s %s" % (response.status_code, response.text), block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
@@ -170,14 +169,14 @@ class SportTracksService(ServiceBase):
         code = req.GET.get("code")
         params = {"grant_type": "authorization_code", "code": code, "client_id": SPORTTRACKS_CLIENT_ID, "client_secret": SPORTTRACKS_CLIENT_SECRET, "redirect_uri": WEB_ROOT + reverse("oauth_return", kwargs={"service": "sporttracks"})}
 
-        response = requests.post("https://api.sporttracks.mobi/oauth2/token", data=urllib.parse.urlencode(params), headers={"Content-Type": "application/x-www-form-urlencoded"})
+        response = self._http.post("https://api.sporttracks.mobi/oauth2/token", data=urllib.parse.urlencode(params), headers={"Content-Type": "application/x-www-form-urlencoded"})
         if response.status_code != 200:
             print(response.text)
             raise APIException("Invalid code")
         access_token = response.json()["access_token"]
         refresh_token = response.json()["refresh_token"]
 
-        uid_res = requests.post("https://api.sporttracks.mobi/api/v2/system/connect", headers={"Authorization": "Bearer %s" % access_token})
+        uid_res = self._http.post("https://api.sporttracks.mobi/api/v2/system/connect", headers={"Authorization": "Bearer %s" % access_token})
         uid = uid_res.json()["user"]["uid"]
 
         return (uid, {"RefreshToken": refresh_token})
@@ -200,7 +199,7 @@ class SportTracksService(ServiceBase):
 
         while True:
             logger.debug("Req against " + pageUri)
-            res = requests.get(pageUri, headers=headers)
+            res = self._http.get(pageUri, headers=headers)
             try:
                 res = res.json()
             except ValueError:
@@ -271,7 +270,7 @@ class SportTracksService(ServiceBase):
     def _downloadActivity(self, serviceRecord, activity, returnFirstLocation=False):
         activityURI = activity.ServiceData["ActivityURI"]
         headers = self._getAuthHeaders(serviceRecord)
-        activityData = requests.get(activityURI, headers=headers)
+        activityData = self._http.get(activityURI, headers=headers)
         activityData = activityData.json()
 
         if "clock_duration" in activityData:
@@ -557,7 +556,7 @@ class SportTracksService(ServiceBase):
 
         headers = self._getAuthHeaders(serviceRecord)
         headers.update({"Content-Type": "application/json"})
-        upload_resp = requests.post(self.OpenFitEndpoint + "/fitnessActivities.json", data=json.dumps(activityData), headers=headers)
+        upload_resp = self._http.post(self.OpenFitEndpoint + "/fitnessActivities.json", data=json.dumps(activityData), headers=headers)
         if upload_resp.status_code != 200:
             if upload_resp.status_code == 401:
                 raise APIException("ST.mobi trial expired", block=True, user_exception=UserException(UserExceptionType.AccountExpired, intervention_required=True))
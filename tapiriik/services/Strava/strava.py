@@ -10,7 +10,6 @@ from django.core.urlresolvers import reverse
 from datetime import datetime, timedelta
 from urllib.parse import urlencode
 import calendar
-import requests
 import os
 import logging
 import pytz
@@ -107,13 +106,13 @@ class StravaService(ServiceBase):
     def _requestWithAuth(self, reqLambda, serviceRecord):
         self._globalRateLimit()
 
-        session = requests.Session()
+        session = self._newSession()
 
         if time.time() > serviceRecord.Authorization.get("AccessTokenExpiresAt", 0) - 60:
             # Expired access token, or still running (now-deprecated) indefinite access token.
             refreshToken = serviceRecord.Authorization.get("RefreshToken",
                                                            serviceRecord.Authorization.get("OAuthToken"))
-            response = requests.post("https://www.strava.com/oauth/token", data={
+            response = self._http.post("https://www.strava.com/oauth/token", data={
                 "grant_type": "refresh_token",
                 "refresh_token": refreshToken,
                 "client_id": STRAVA_CLIENT_ID,
@@ -137,7 +136,7 @@ class StravaService(ServiceBase):
         code = req.GET.get("code")
         params = {"grant_type": "authorization_code", "code": code, "client_id": STRAVA_CLIENT_ID, "client_secret": STRAVA_CLIENT_SECRET, "redirect_uri": WEB_ROOT + reverse("oauth_return", kwargs={"service": "strava"})}
 
-        response = requests.post("https://www.strava.com/oauth/token", data=params)
+        response = self._http.post("https://www.strava.com/oauth/token", data=params)
         if response.status_code != 200:
             raise APIException("Invalid code")
         data = response.json()
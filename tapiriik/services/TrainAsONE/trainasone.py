@@ -4,7 +4,6 @@ from tapiriik.services.service_record import ServiceRecord
 from tapiriik.services.interchange import UploadedActivity, ActivityType, ActivityStatistic, ActivityStatisticUnit, Waypoint, WaypointType, Location, Lap
 from tapiriik.services.api import APIException, UserException, UserExceptionType, APIExcludeActivity
 from tapiriik.services.fit import FITIO
-from tapiriik.services.tcx import TCXIO
 
 from django.core.urlresolvers import reverse
 from datetime import datetime, timedelta
@@ -120,13 +119,12 @@ class TrainAsONEService(ServiceBase):
     def DownloadActivity(self, serviceRecord, activity):
         activity_id = activity.ServiceData["id"]
 
-	# Switch URL to /api/sync/activity/fit/ once FITIO.Parse() available
-        resp = requests.get(TRAINASONE_SERVER_URL + "/api/sync/activity/tcx/" + activity_id, headers=self._apiHeaders(serviceRecord.Authorization))
+        resp = requests.get(TRAINASONE_SERVER_URL + "/api/sync/activity/fit/" + activity_id, headers=self._apiHeaders(serviceRecord.Authorization))
 
         try:
-            TCXIO.Parse(resp.content, activity)
+            FITIO.Parse(resp.content, activity)
         except ValueError as e:
-            raise APIExcludeActivity("TCX parse error " + str(e), user_exception=UserException(UserExceptionType.Corrupt))
+            raise APIExcludeActivity("FIT parse error " + str(e), user_exception=UserException(UserExceptionType.Corrupt))
 
         return activity
 
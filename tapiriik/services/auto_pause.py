@@ -1,90 +1,110 @@
-import itertools
+import heapq
+from array import array
 from collections import defaultdict
 from tapiriik.services.interchange import WaypointType
 
-def pairwise(gen):
-    x, y = itertools.tee(gen)
-    next(y, None)
-    return zip(x, y)
-
 
 class AutoPauseCalculator:
     @classmethod
     def calculate(cls, waypoints, target_duration):
+        yield from cls.waypoint_types(waypoints, target_duration)
+
+    @classmethod
+    def waypoint_types(cls, waypoints, target_duration):
+        """ The WaypointType (regular/pause/resume) for each waypoint, such that the activity's duration comes out nearest target_duration """
+        types = array("b")
         if not waypoints:
-            yield from ()
+            return types
+        if len(waypoints) < 2:
+            types.append(WaypointType.Regular)
+            return types
 
         if type(target_duration) not in [float, int]:
             target_duration = target_duration.total_seconds()
 
-        # First, get a list of the inter-waypoint durations and distance deltas
-        inter_wp_times = []
-        inter_wp_distances_with_times = [] # Not in any real units
+        # First, get the inter-waypoint durations and distance deltas, in a single pass
+        nan = float("nan")
+        delta_ts = array("d")
+        delta_ds = array("d") # Not in any real units - NaN where either end has no location
+        inter_wp_distances = [] # (delta_d, index, delta_t), so they pop off the heap in the order a stable sort would give
         delta_t_frequencies = defaultdict(int)
-        for wp_a, wp_b in pairwise(waypoints):
-            delta_t = (wp_b.Timestamp - wp_a.Timestamp).total_seconds()
-            delta_t_frequencies[round(delta_t)] += 1
-            inter_wp_times.append(delta_t)
-            if wp_a.Location and wp_b.Location and wp_a.Location.Latitude is not None and wp_b.Location.Latitude is not None:
-                inter_wp_distances_with_times.append(((wp_a.Location.Latitude - wp_b.Location.Latitude) ** 2 + (wp_a.Location.Longitude - wp_b.Location.Longitude) ** 2, delta_t))
-
-        inter_wp_times.sort(reverse=True)
-        inter_wp_distances_with_times.sort(key=lambda x: x[0])
+        last_timestamp = None
+        last_lat = last_lng = None
+        for idx, wp in enumerate(waypoints):
+            timestamp = wp.Timestamp
+            loc = wp.Location
+            if loc and loc.Latitude is not None:
+                lat, lng = loc.Latitude, loc.Longitude
+            else:
+                lat = lng = None
+            if idx:
+                delta_t = (timestamp - last_timestamp).total_seconds()
+                delta_t_frequencies[round(delta_t)] += 1
+                delta_ts.append(delta_t)
+                if lat is not None and last_lat is not None:
+                    delta_d = (last_lat - lat) ** 2 + (last_lng - lng) ** 2
+                    inter_wp_distances.append((delta_d, idx, delta_t))
+                    delta_ds.append(delta_d)
+                else:
+                    delta_ds.append(nan)
+            last_timestamp = timestamp
+            last_lat, last_lng = lat, lng
 
-        # Guesstimate what the sampling rate is
-        delta_t_mode = sorted(delta_t_frequencies.items(), key=lambda x: x[1])[-1][0]
+        # Guesstimate what the sampling rate is (the most common interval - the last one seen, if there's a tie)
+        delta_t_mode = None
+        mode_frequency = 0
+        for delta_t, frequency in delta_t_frequencies.items():
+            if frequency >= mode_frequency:
+                delta_t_mode, mode_frequency = delta_t, frequency
 
         # ...should sum to the elapsed duration, so we'll cheat
         elapsed_duration = (waypoints[-1].Timestamp - waypoints[0].Timestamp).total_seconds()
 
-        # Then, walk through our list until we recover enough time - call this the auto-pause threshold for time
+        # Then, walk through the intervals, longest first, until we recover enough time - call this the auto-pause threshold for time
         # This is an attempt to discover times when they paused the activity (missing data for a significant period of time)
+        # Only as many as are needed come off the heap, rather than sorting the lot
         recovered_duration = 0
 
         auto_pause_time_threshold = None
-        inter_times_iter = iter(inter_wp_times)
-        try:
-            while elapsed_duration - recovered_duration > target_duration:
-                new_thresh = next(inter_times_iter)
-                # Bail out before we enter the zone of pausing the entire activity
-                if new_thresh <= delta_t_mode * 2:
-                    break
-                auto_pause_time_threshold = new_thresh
-                recovered_duration += auto_pause_time_threshold
-        except StopIteration:
-            pass
+        inter_wp_times = [-x for x in delta_ts]
+        heapq.heapify(inter_wp_times)
+        while inter_wp_times and elapsed_duration - recovered_duration > target_duration:
+            new_thresh = -heapq.heappop(inter_wp_times)
+            # Bail out before we enter the zone of pausing the entire activity
+            if new_thresh <= delta_t_mode * 2:
+                break
+            auto_pause_time_threshold = new_thresh
+            recovered_duration += auto_pause_time_threshold
 
         # And the same for distances, if we didn't find enough time via the inter-waypoint time method
         # This is the traditional "auto-pause" where, if the user is stationary the activity is paused
         # So, we look for points where they were moving the least and pause during them
         auto_pause_dist_threshold = None
-        inter_dist_iter = iter(inter_wp_distances_with_times)
-        try:
-            while elapsed_duration - recovered_duration > target_duration:
-                auto_pause_dist_threshold, delta_t = next(inter_dist_iter)
-                recovered_duration += delta_t
-        except StopIteration:
-            pass
+        heapq.heapify(inter_wp_distances)
+        while inter_wp_distances and elapsed_duration - recovered_duration > target_duration:
+            auto_pause_dist_threshold, idx, delta_t = heapq.heappop(inter_wp_distances)
+            recovered_duration += delta_t
 
         if auto_pause_dist_threshold == 0:
             raise ValueError("Bad auto-pause distance threshold %f" % auto_pause_dist_threshold)
 
-        # Then re-iter through our waypoints and return wapoint type (regular/pause/resume) for each
+        # Then run back through the deltas and work out the waypoint type (regular/pause/resume) for each
         # We do this instead of overwriting the waypoint values since that would mess up uploads to other serivces that don't want this automatic calculation
         # We decrement recovered_duration back to 0 and stop adding pauses after that point, in the hopes of having the best success hitting the target duration
+        time_threshold = auto_pause_time_threshold if auto_pause_time_threshold is not None else float("inf")
+        dist_threshold = auto_pause_dist_threshold if auto_pause_dist_threshold is not None else float("-inf")
+        pause, resume, regular = WaypointType.Pause, WaypointType.Resume, WaypointType.Regular
         in_pause = False
-        for wp_a, wp_b in pairwise(waypoints):
-            delta_t = (wp_b.Timestamp - wp_a.Timestamp).total_seconds()
-            delta_d = None
-            if wp_a.Location and wp_b.Location and wp_a.Location.Latitude is not None and wp_b.Location.Latitude is not None:
-                delta_d = (wp_a.Location.Latitude - wp_b.Location.Latitude) ** 2 + (wp_a.Location.Longitude - wp_b.Location.Longitude) ** 2
-            if ((auto_pause_time_threshold is not None and delta_t > auto_pause_time_threshold) or (auto_pause_dist_threshold is not None and delta_d is not None and delta_d < auto_pause_dist_threshold)) and recovered_duration > 0:
+        for delta_t, delta_d in zip(delta_ts, delta_ds):
+            # (NaN distances never compare less than the threshold)
+            if (delta_t > time_threshold or delta_d < dist_threshold) and recovered_duration > 0:
                 recovered_duration -= delta_t
-                yield WaypointType.Pause
+                types.append(pause)
                 in_pause = True
             else:
-                yield WaypointType.Resume if in_pause else WaypointType.Regular
+                types.append(resume if in_pause else regular)
                 in_pause = False
 
-        # Since we were iterating pairwise above, we need 1 extra for the last waypoint
-        yield WaypointType.Resume if in_pause else WaypointType.Regular
+        # Since we were working with the deltas above, we need 1 extra for the last waypoint
+        types.append(resume if in_pause else regular)
+        return types
@@ -1,8 +1,10 @@
 from datetime import datetime, timedelta
-from .interchange import WaypointType, ActivityStatisticUnit, ActivityType, LapIntensity, LapTriggerMethod
-from .devices import DeviceIdentifier, DeviceIdentifierType
+from .interchange import WaypointType, Activity, ActivityStatistic, ActivityStatistics, ActivityStatisticUnit, ActivityType, Waypoint, WaypointColumns, Location, Lap, LapIntensity, LapTriggerMethod
+from .devices import DeviceIdentifier, DeviceIdentifierType, Device
+from tapiriik.settings import WAYPOINT_COLUMNS
 import struct
 import sys
+import threading
 import pytz
 
 class FITFileType:
@@ -19,6 +21,7 @@ class FITEvent:
 class FITEventType:
 	Start = 0
 	Stop = 1
+	StopAll = 4
 
 # It's not a coincidence that these enums match the ones in interchange perfectly
 class FITLapIntensity:
@@ -85,47 +88,48 @@ class FITMessageGenerator:
 		self._types = {}
 		self._messageTemplates = {}
 		self._definitions = {}
-		self._result = []
+		self._definitionLookup = {}
+		self._result = bytearray()
 		# All our convience functions for preparing the field types to be packed.
+		# They return the raw value to pack with the type's PackFormat.
 		def stringFormatter(input):
 			raise Exception("Not implemented")
 		def dateTimeFormatter(input):
 			# UINT32
 			# Seconds since UTC 00:00 Dec 31 1989. If <0x10000000 = system time
 			if input is None:
-				return struct.pack("<I", 0xFFFFFFFF)
-			delta = round((input - datetime(hour=0, minute=0, month=12, day=31, year=1989)).total_seconds())
-			return struct.pack("<I", delta)
+				return 0xFFFFFFFF
+			return round((input - datetime(hour=0, minute=0, month=12, day=31, year=1989)).total_seconds())
 		def msecFormatter(input):
 			# UINT32
 			if input is None:
-				return struct.pack("<I", 0xFFFFFFFF)
-			return struct.pack("<I", round((input if type(input) is not timedelta else input.total_seconds()) * 1000))
+				return 0xFFFFFFFF
+			return round((input if type(input) is not timedelta else input.total_seconds()) * 1000)
 		def mmPerSecFormatter(input):
 			# UINT16
 			if input is None:
-				return struct.pack("<H", 0xFFFF)
-			return struct.pack("<H", round(input * 1000))
+				return 0xFFFF
+			return round(input * 1000)
 		def cmFormatter(input):
 			# UINT32
 			if input is None:
-				return struct.pack("<I", 0xFFFFFFFF)
-			return struct.pack("<I", round(input * 100))
+				return 0xFFFFFFFF
+			return round(input * 100)
 		def altitudeFormatter(input):
 			# UINT16
 			if input is None:
-				return struct.pack("<H", 0xFFFF)
-			return struct.pack("<H", round((input + 500) * 5)) # Increments of 1/5, offset from -500m :S
+				return 0xFFFF
+			return round((input + 500) * 5) # Increments of 1/5, offset from -500m :S
 		def semicirclesFormatter(input):
 			# SINT32
 			if input is None:
-				return struct.pack("<i", 0x7FFFFFFF) # FIT-defined invalid value
-			return struct.pack("<i", round(input * (2 ** 31 / 180)))
+				return 0x7FFFFFFF # FIT-defined invalid value
+			return round(input * (2 ** 31 / 180))
 		def versionFormatter(input):
 			# UINT16
 			if input is None:
-				return struct.pack("<H", 0xFFFF)
-			return struct.pack("<H", round(input * 100))
+				return 0xFFFF
+			return round(input * 100)
 
 
 		def defType(name, *args, **kwargs):
@@ -151,13 +155,13 @@ class FITMessageGenerator:
 		defType("byte", 0x0D, 1, "B", 0xFF) # This isn't totally correct, docs say "an array of bytes"
 
 		# Not strictly FIT fields, but convenient.
-		defType("date_time", 0x86, 4, None, 0xFFFFFFFF, formatter=dateTimeFormatter)
-		defType("duration_msec", 0x86, 4, None, 0xFFFFFFFF, formatter=msecFormatter)
-		defType("distance_cm", 0x86, 4, None, 0xFFFFFFFF, formatter=cmFormatter)
-		defType("mmPerSec", 0x84, 2, None, 0xFFFF, formatter=mmPerSecFormatter)
-		defType("semicircles", 0x85, 4, None, 0x7FFFFFFF, formatter=semicirclesFormatter)
-		defType("altitude", 0x84, 2, None, 0xFFFF, formatter=altitudeFormatter)
-		defType("version", 0x84, 2, None, 0xFFFF, formatter=versionFormatter)
+		defType("date_time", 0x86, 4, "I", 0xFFFFFFFF, formatter=dateTimeFormatter)
+		defType("duration_msec", 0x86, 4, "I", 0xFFFFFFFF, formatter=msecFormatter)
+		defType("distance_cm", 0x86, 4, "I", 0xFFFFFFFF, formatter=cmFormatter)
+		defType("mmPerSec", 0x84, 2, "H", 0xFFFF, formatter=mmPerSecFormatter)
+		defType("semicircles", 0x85, 4, "i", 0x7FFFFFFF, formatter=semicirclesFormatter)
+		defType("altitude", 0x84, 2, "H", 0xFFFF, formatter=altitudeFormatter)
+		defType("version", 0x84, 2, "H", 0xFFFF, formatter=versionFormatter)
 
 		def defMsg(name, *args):
 			self._messageTemplates[name] = FITMessageTemplate(name, *args)
@@ -270,10 +274,37 @@ class FITMessageGenerator:
 			)
 
 	def _write(self, contents):
-		self._result.append(contents)
+		self._result += contents
 
 	def GetResult(self):
-		return b''.join(self._result)
+		return bytes(self._result)
+
+	def _fieldConverter(self, field_type):
+		# Prepares a value to be packed with the rest of the message in one go - values that still can't be packed fall back to _packField
+		if field_type.Formatter:
+			return field_type.Formatter
+		invalid = field_type.InvalidValue
+		if field_type.PackFormat in ["B","b", "H", "h", "I", "i"]:
+			return lambda value: invalid if value is None else round(value)
+		return lambda value: invalid if value is None else value
+
+	def _packField(self, field_name, field_type, value):
+		try:
+			if field_type.Formatter:
+				return struct.pack("<" + field_type.PackFormat, field_type.Formatter(value))
+			sanitized_value = value
+			if sanitized_value is None:
+				return struct.pack("<" + field_type.PackFormat, field_type.InvalidValue)
+			if field_type.PackFormat in ["B","b", "H", "h", "I", "i"]:
+				sanitized_value = round(sanitized_value)
+			try:
+				return struct.pack("<" + field_type.PackFormat, sanitized_value)
+			except struct.error as e: # I guess more specific exception types were too much to ask for.
+				if "<=" in str(e) or "out of range" in str(e):
+					return struct.pack("<" + field_type.PackFormat, field_type.InvalidValue)
+				raise
+		except Exception as e:
+			raise Exception("Failed packing %s=%s - %s" % (field_name, value, e))
 
 	def _defineMessage(self, local_no, global_message, field_names):
 		assert local_no < 16 and local_no >= 0
@@ -294,7 +325,14 @@ class FITMessageGenerator:
 				field_type = self._types[field["Type"]]
 				pack_tuple += (field["Number"], field_type.Size, field_type.TypeField)
 				local_fields[field_name] = field
-		self._definitions[local_no] = FITMessageTemplate(global_message.Name, local_no, local_fields)
+		defn = FITMessageTemplate(global_message.Name, local_no, local_fields)
+		# The data messages for this definition are packed with a single precompiled struct
+		field_types = [self._types[defn.Fields[field_name]["Type"]] for field_name in defn.FieldNameList]
+		defn.Packer = struct.Struct("<B" + "".join(x.PackFormat for x in field_types))
+		defn.FieldTypes = list(zip(defn.FieldNameList, field_types))
+		defn.Converters = [(field_name, self._fieldConverter(field_type)) for field_name, field_type in defn.FieldTypes]
+		self._definitions[local_no] = defn
+		self._definitionLookup[(global_message.Name, frozenset(local_fields.keys()))] = defn
 		self._write(struct.pack("<BBBHB" + ("BBB" * field_count), *pack_tuple))
 		return self._definitions[local_no]
 
@@ -303,20 +341,13 @@ class FITMessageGenerator:
 		globalDefn = self._messageTemplates[name]
 
 		# Create a subset of the global message's fields
-		localFieldNamesSet = set()
-		for fieldName in kwargs:
-			localFieldNamesSet.add(fieldName)
+		localFieldNamesSet = frozenset(kwargs)
 
 		# I'll look at this later
 		compressTS = False
 
 		# Are these fields covered by an existing local message type?
-		active_definition = None
-		for defn_n in self._definitions:
-			defn = self._definitions[defn_n]
-			if defn.Name == name:
-				if defn.FieldNameSet == localFieldNamesSet:
-					active_definition = defn
+		active_definition = self._definitionLookup.get((name, localFieldNamesSet))
 
 		# If not, create a new local message type with these fields
 		if not active_definition:
@@ -334,31 +365,149 @@ class FITMessageGenerator:
 		else:
 			messageHeader = messageHeader | active_definition.Number
 
-		packResult = [struct.pack("<B", messageHeader)]
-		for field_name in active_definition.FieldNameList:
-			field = active_definition.Fields[field_name]
-			field_type = self._types[field["Type"]]
-			try:
-				if field_type.Formatter:
-					result = field_type.Formatter(kwargs[field_name])
+		try:
+			packResult = active_definition.Packer.pack(messageHeader, *[convert(kwargs[field_name]) for field_name, convert in active_definition.Converters])
+		except Exception:
+			# Something's out of range (or unpackable) - go field-by-field to substitute the invalid value, or report which
+			packResult = struct.pack("<B", messageHeader) + b''.join(self._packField(field_name, field_type, kwargs[field_name]) for field_name, field_type in active_definition.FieldTypes)
+		self._write(packResult)
+
+def _buildCRCTable():
+	table = []
+	for byte in range(256):
+		crc = byte
+		for bit in range(8):
+			crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+		table.append(crc)
+	return table
+
+_CRC_TABLE = _buildCRCTable()
+
+class _FITLocalDefinition:
+	__slots__ = ("Name", "Struct", "Fields", "TimestampIndex")
+
+class FITMessageDecoder:
+	""" Reads the messages out of a FIT file, using the same type and message tables FITMessageGenerator writes with.
+
+		Each definition message is compiled into a struct.Struct - fields (and messages) we have no template for are skipped as pad bytes -
+		so decoding a data message is a single unpack_from plus picking the known fields out of the resulting tuple.
+	"""
+	_epoch = datetime(1989, 12, 31, tzinfo=pytz.utc)
+	_messages = None # Global message number -> (name, {field number: (field name, type name)})
+	_baseTypes = None # Base type number -> FITMessageDataType
+	_structs = {} # Format string -> struct.Struct, shared between files since the same definitions turn up over and over
+
+	# The reverse of FITMessageGenerator's formatters
+	_readers = {
+		"date_time": lambda x: FITMessageDecoder._epoch + timedelta(seconds=x),
+		"duration_msec": lambda x: x / 1000,
+		"distance_cm": lambda x: x / 100,
+		"mmPerSec": lambda x: x / 1000,
+		"altitude": lambda x: x / 5 - 500,
+		"semicircles": lambda x: x * (180 / 2 ** 31),
+		"version": lambda x: x / 100,
+	}
+
+	def __init__(self):
+		if FITMessageDecoder._messages is None:
+			fmg = FITMessageGenerator()
+			baseTypes = {}
+			for dataType in fmg._types.values():
+				if dataType.PackFormat and not dataType.Formatter and (dataType.TypeField & 0x1F) not in baseTypes:
+					baseTypes[dataType.TypeField & 0x1F] = dataType
+			messages = {}
+			for template in fmg._messageTemplates.values():
+				messages[template.Number] = (template.Name, dict((x["Number"], (x["Name"], x["Type"])) for x in template.Fields.values()))
+			FITMessageDecoder._baseTypes = baseTypes
+			FITMessageDecoder._messages = messages
+		self._definitions = {}
+
+	def _define(self, header, data, offset):
+		# Returns the definition, and the offset past the definition message
+		arch = data[offset + 1]
+		endian = ">" if arch == 1 else "<"
+		global_no, field_count = struct.unpack_from(endian + "HB", data, offset + 2)
+		offset += 5
+		name, templateFields = FITMessageDecoder._messages.get(global_no, (None, {}))
+
+		defn = _FITLocalDefinition()
+		defn.Name = name
+		defn.Fields = []
+		defn.TimestampIndex = None
+		packFormat = [endian]
+		for field_offset in range(offset, offset + field_count * 3, 3):
+			field_no, size, base_type = data[field_offset:field_offset + 3]
+			# Timestamps are read from every message (known or not), since compressed timestamps are relative to the last one
+			templateField = templateFields.get(field_no, ("timestamp", "date_time") if field_no == 253 else None)
+			dataType = FITMessageDecoder._baseTypes.get(base_type & 0x1F)
+			if templateField and dataType and dataType.Size == size:
+				if field_no == 253:
+					defn.TimestampIndex = len(defn.Fields)
+				# Floats are invalid when all 1s, i.e. NaN - those are caught by the x != x check while decoding
+				defn.Fields.append((templateField[0], FITMessageDecoder._readers.get(templateField[1]), dataType.InvalidValue))
+				packFormat.append(dataType.PackFormat)
+			else:
+				packFormat.append("%dx" % size)
+		offset += field_count * 3
+
+		if header & 0x20:
+			# Developer fields - always skipped
+			dev_field_count = data[offset]
+			offset += 1
+			for field_offset in range(offset, offset + dev_field_count * 3, 3):
+				packFormat.append("%dx" % data[field_offset + 1])
+			offset += dev_field_count * 3
+
+		packFormat = "".join(packFormat)
+		if packFormat not in FITMessageDecoder._structs:
+			FITMessageDecoder._structs[packFormat] = struct.Struct(packFormat)
+		defn.Struct = FITMessageDecoder._structs[packFormat]
+		return defn, offset
+
+	def Messages(self, data, offset, end):
+		""" Yields (message name, {field name: value}) for each known data message between offset and end """
+		definitions = self._definitions
+		epoch = FITMessageDecoder._epoch
+		last_timestamp = None
+		try:
+			while offset < end:
+				header = data[offset]
+				if header & 0x80:
+					# Compressed timestamp header - a 5-bit rollover offset from the last full timestamp
+					defn = definitions[(header >> 5) & 0x3]
+					if last_timestamp is None:
+						raise ValueError("Compressed timestamp before any full timestamp")
+					time_offset = header & 0x1F
+					last_timestamp = (last_timestamp & ~0x1F) + time_offset + (0x20 if time_offset < (last_timestamp & 0x1F) else 0)
+					timestamp = last_timestamp
+				elif header & 0x40:
+					definitions[header & 0xF], offset = self._define(header, data, offset + 1)
+					continue
 				else:
-					sanitized_value = kwargs[field_name]
-					if sanitized_value is None:
-						result = struct.pack("<" + field_type.PackFormat, field_type.InvalidValue)
-					else:
-						if field_type.PackFormat in ["B","b", "H", "h", "I", "i"]:
-							sanitized_value = round(sanitized_value)
-						try:
-							result = struct.pack("<" + field_type.PackFormat, sanitized_value)
-						except struct.error as e: # I guess more specific exception types were too much to ask for.
-							if "<=" in str(e) or "out of range" in str(e):
-								result = struct.pack("<" + field_type.PackFormat, field_type.InvalidValue)
-							else:
-								raise
-			except Exception as e:
-				raise Exception("Failed packing %s=%s - %s" % (field_name, kwargs[field_name], e))
-			packResult.append(result)
-		self._write(b''.join(packResult))
+					defn = definitions[header & 0xF]
+					timestamp = None
+				values = defn.Struct.unpack_from(data, offset + 1)
+				offset += 1 + defn.Struct.size
+
+				if defn.TimestampIndex is not None:
+					raw_timestamp = values[defn.TimestampIndex]
+					if raw_timestamp != 0xFFFFFFFF:
+						last_timestamp = raw_timestamp
+				if defn.Name is None:
+					continue
+
+				message = {}
+				for value, (name, reader, invalid) in zip(values, defn.Fields):
+					if value == invalid or value != value:
+						continue
+					message[name] = reader(value) if reader else value
+				if timestamp is not None:
+					message["timestamp"] = epoch + timedelta(seconds=timestamp)
+				yield defn.Name, message
+		except KeyError as e:
+			raise ValueError("Data message for undefined local message type %s" % e)
+		except (struct.error, IndexError):
+			raise ValueError("Truncated FIT message at offset %d" % offset)
 
 
 class FITIO:
@@ -374,16 +523,42 @@ class FITIO:
 	_subSportMap = {
 		# ActivityType.MountainBiking: 8 there's an issue with cadence upload and this type with GC, so...
 	}
+	# (sport, sub_sport) -> type, with None matching any sub sport
+	_sportReverseMap = {
+		(1, None): ActivityType.Running,
+		(2, None): ActivityType.Cycling,
+		(2, 8): ActivityType.MountainBiking,
+		(4, 15): ActivityType.Elliptical,
+		(5, None): ActivityType.Swimming,
+		(11, None): ActivityType.Walking,
+		(12, None): ActivityType.CrossCountrySkiing,
+		(13, None): ActivityType.DownhillSkiing,
+		(14, None): ActivityType.Snowboarding,
+		(15, None): ActivityType.Rowing,
+		(17, None): ActivityType.Hiking,
+	}
+	_lapIntensityMap = {
+		FITLapIntensity.Active: LapIntensity.Active,
+		FITLapIntensity.Rest: LapIntensity.Rest,
+		FITLapIntensity.Warmup: LapIntensity.Warmup,
+		FITLapIntensity.Cooldown: LapIntensity.Cooldown,
+	}
+	_lapTriggerMap = {
+		FITLapTriggerMethod.Manual: LapTriggerMethod.Manual,
+		FITLapTriggerMethod.Time: LapTriggerMethod.Time,
+		FITLapTriggerMethod.Distance: LapTriggerMethod.Distance,
+		FITLapTriggerMethod.PositionStart: LapTriggerMethod.PositionStart,
+		FITLapTriggerMethod.PositionLap: LapTriggerMethod.PositionLap,
+		FITLapTriggerMethod.PositionWaypoint: LapTriggerMethod.PositionWaypoint,
+		FITLapTriggerMethod.PositionMarked: LapTriggerMethod.PositionMarked,
+		FITLapTriggerMethod.SessionEnd: LapTriggerMethod.SessionEnd,
+		FITLapTriggerMethod.FitnessEquipment: LapTriggerMethod.FitnessEquipment,
+	}
 	def _calculateCRC(bytestring, crc=0):
-		crc_table = [0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401, 0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400]
+		# A byte at a time - the same CRC-16 as the FIT SDK's two nibble lookups per byte
+		crc_table = _CRC_TABLE
 		for byte in bytestring:
-			tmp = crc_table[crc & 0xF]
-			crc = (crc >> 4) & 0x0FFF
-			crc = crc ^ tmp ^ crc_table[byte & 0xF]
-
-			tmp = crc_table[crc & 0xF]
-			crc = (crc >> 4) & 0x0FFF
-			crc = crc ^ tmp ^ crc_table[(byte >> 4) & 0xF]
+			crc = (crc >> 8) ^ crc_table[(crc ^ byte) & 0xFF]
 		return crc
 
 	def _generateHeader(dataLength):
@@ -394,10 +569,191 @@ class FITIO:
 		tag = ".FIT"
 		return struct.pack("<BBHI4s", header_len, protocolVer, profileVer, dataLength, tag.encode("ASCII"))
 
-	def Parse(raw_file):
-		raise Exception("Not implemented")
+	def _parseStats(msg, stats):
+		# The reverse of Dump's _mapStat calls - session and lap messages share field names
+		_stat = msg.get
+		stats.TimerTime = ActivityStatistic(ActivityStatisticUnit.Seconds, value=_stat("total_timer_time"))
+		stats.MovingTime = ActivityStatistic(ActivityStatisticUnit.Seconds, value=_stat("total_moving_time"))
+		stats.Distance = ActivityStatistic(ActivityStatisticUnit.Meters, value=_stat("total_distance"))
+		stats.Energy = ActivityStatistic(ActivityStatisticUnit.Kilocalories, value=_stat("total_calories"))
+		stats.Speed = ActivityStatistic(ActivityStatisticUnit.MetersPerSecond, avg=_stat("avg_speed"), max=_stat("max_speed"))
+		stats.HR = ActivityStatistic(ActivityStatisticUnit.BeatsPerMinute, avg=_stat("avg_heart_rate"), max=_stat("max_heart_rate"))
+		stats.Cadence = ActivityStatistic(ActivityStatisticUnit.RevolutionsPerMinute, avg=_stat("avg_cadence"), max=_stat("max_cadence"))
+		stats.Power = ActivityStatistic(ActivityStatisticUnit.Watts, avg=_stat("avg_power"), max=_stat("max_power"))
+		stats.Elevation = ActivityStatistic(ActivityStatisticUnit.Meters, avg=_stat("avg_altitude"), max=_stat("max_altitude"), min=_stat("min_altitude"), gain=_stat("total_ascent"), loss=_stat("total_descent"))
+		stats.Temperature = ActivityStatistic(ActivityStatisticUnit.DegreesCelcius, avg=_stat("avg_temperature"), max=_stat("max_temperature"))
+
+	def _moveToRunCadence(stats):
+		stats.RunCadence = ActivityStatistic(ActivityStatisticUnit.StepsPerMinute, avg=stats.Cadence.Average, max=stats.Cadence.Max)
+		stats.Cadence = ActivityStatistic(ActivityStatisticUnit.RevolutionsPerMinute)
+
+	def _parseLap(msg, lap):
+		lap.StartTime = msg.get("start_time")
+		lap.EndTime = msg.get("timestamp")
+		if lap.EndTime is None and lap.StartTime is not None and "total_elapsed_time" in msg:
+			lap.EndTime = lap.StartTime + timedelta(seconds=msg["total_elapsed_time"])
+		FITIO._parseStats(msg, lap.Stats)
+		lap.Intensity = FITIO._lapIntensityMap.get(msg.get("intensity"), LapIntensity.Active)
+		lap.Trigger = FITIO._lapTriggerMap.get(msg.get("lap_trigger"), LapTriggerMethod.Manual)
+
+	def _parseRecord(msg):
+		wp = Waypoint(msg["timestamp"])
+		if "position_lat" in msg and "position_long" in msg:
+			wp.Location = Location(msg["position_lat"], msg["position_long"], msg.get("altitude"))
+		elif "altitude" in msg:
+			wp.Location = Location(None, None, msg["altitude"])
+		wp.HR = msg.get("heart_rate")
+		wp.Cadence = msg.get("cadence")
+		wp.Power = msg.get("power")
+		wp.Temp = msg.get("temperature")
+		wp.Calories = msg.get("calories")
+		wp.Distance = msg.get("distance")
+		wp.Speed = msg.get("speed")
+		return wp
+
+	def Parse(raw_file, act=None):
+		act = act if act else Activity()
+		act.GPS = False
+
+		if len(raw_file) < 12:
+			raise ValueError("FIT file too short")
+		header_len = raw_file[0]
+		if header_len < 12 or raw_file[8:12] != b".FIT":
+			raise ValueError("Not a FIT file")
+		data_len = struct.unpack_from("<I", raw_file, 4)[0]
+		if len(raw_file) < header_len + data_len:
+			raise ValueError("Truncated FIT file")
+
+		laps = []
+		sessions = []
+		lap_waypoints = WaypointColumns() if WAYPOINT_COLUMNS else []
+		paused = resuming = False
+		device = {}
+		for name, msg in FITMessageDecoder().Messages(raw_file, header_len, header_len + data_len):
+			if name == "record":
+				if "timestamp" not in msg:
+					continue
+				wp = FITIO._parseRecord(msg)
+				if wp.Location and wp.Location.Latitude is not None:
+					act.GPS = True
+				if paused:
+					wp.Type = WaypointType.Pause
+				elif resuming:
+					wp.Type = WaypointType.Resume
+					resuming = False
+				lap_waypoints.append(wp)
+			elif name == "event":
+				if msg.get("event") == FITEvent.Timer:
+					if msg.get("event_type") in (FITEventType.Stop, FITEventType.StopAll):
+						paused = True
+						resuming = False
+					elif msg.get("event_type") == FITEventType.Start and paused:
+						paused = False
+						resuming = True
+			elif name == "lap":
+				lap = Lap()
+				FITIO._parseLap(msg, lap)
+				lap.Waypoints = lap_waypoints
+				lap_waypoints = WaypointColumns() if WAYPOINT_COLUMNS else []
+				if lap.StartTime is None and len(lap.Waypoints):
+					lap.StartTime = lap.Waypoints[0].Timestamp
+				if lap.EndTime is None and len(lap.Waypoints):
+					lap.EndTime = lap.Waypoints[-1].Timestamp
+				laps.append(lap)
+			elif name == "session":
+				sessions.append(msg)
+			elif name == "file_id":
+				device.update(dict((k, v) for k, v in msg.items() if k in ("manufacturer", "product", "serial_number")))
+			elif name == "device_info":
+				if msg.get("device_index") == 0 and "software_version" in msg:
+					device["software_version"] = msg["software_version"]
+
+		if lap_waypoints:
+			# Records after the last lap message (or a file without any)
+			laps.append(Lap(startTime=lap_waypoints[0].Timestamp, endTime=lap_waypoints[-1].Timestamp, waypointList=lap_waypoints))
+		act.Laps = laps
+
+		if sessions:
+			sport = sessions[0].get("sport")
+			if not act.Type or act.Type == ActivityType.Other:
+				act.Type = FITIO._sportReverseMap.get((sport, sessions[0].get("sub_sport")), FITIO._sportReverseMap.get((sport, None), ActivityType.Other))
+			act.StartTime = sessions[0].get("start_time")
+			act.EndTime = sessions[-1].get("timestamp")
+		act.StartTime = act.StartTime if act.StartTime else (act.Laps[0].StartTime if len(act.Laps) else None)
+		act.EndTime = act.EndTime if act.EndTime else (act.Laps[-1].EndTime if len(act.Laps) else None)
+
+		if "manufacturer" in device:
+			devId = DeviceIdentifier.FindMatchingIdentifierOfType(DeviceIdentifierType.FIT, {"Manufacturer": device["manufacturer"], "Product": device.get("product")})
+			if devId:
+				verMaj = verMin = None
+				if "software_version" in device:
+					verMaj, verMin = divmod(round(device["software_version"] * 100), 100)
+				act.Device = Device(devId, device.get("serial_number"), verMaj=verMaj, verMin=verMin)
+
+		if act.CountTotalWaypoints():
+			act.Stationary = False
+			act.GetFlatWaypoints()[0].Type = WaypointType.Start
+			act.GetFlatWaypoints()[-1].Type = WaypointType.End
+		else:
+			act.Stationary = True
+
+		# FIT has one cadence field - Dump fills it with the run cadence for these types, so it goes back there
+		use_run_cadence = act.Type in [ActivityType.Running, ActivityType.Walking, ActivityType.Hiking]
+		if use_run_cadence:
+			for lap in act.Laps:
+				for wp in lap.Waypoints:
+					wp.RunCadence, wp.Cadence = wp.Cadence, None
+				FITIO._moveToRunCadence(lap.Stats)
+
+		if len(sessions) == 1:
+			session_stats = ActivityStatistics()
+			FITIO._parseStats(sessions[0], session_stats)
+			if use_run_cadence:
+				FITIO._moveToRunCadence(session_stats)
+		elif len(act.Laps) == 1:
+			session_stats = act.Laps[0].Stats
+		else:
+			session_stats = ActivityStatistics() # Blank
+			for lap in act.Laps:
+				session_stats.sumWith(lap.Stats)
+		session_stats.update(act.Stats) # External source is authorative
+		act.Stats = session_stats
+
+		act.CalculateUID()
+		return act
+
+	# Guard the activities' dump caches - striped, rather than a lock per activity, so activities can still be (deep)copied
+	_dumpCacheLock = threading.Lock()
+	_dumpLocks = [threading.Lock() for x in range(32)]
+
+	def _dumpFingerprint(act):
+		# Cheap, but enough to notice the activity being re-timed, its stats changing, or its laps or waypoints being swapped out
+		# - nothing edits waypoints in place between uploads, so the count and the timestamps at either end will do for those
+		def statsFingerprint(stats):
+			return tuple((stat.Units, stat.Value, stat.Average, stat.Min, stat.Max, stat.Gain, stat.Loss) for stat in (getattr(stats, key) for key in ActivityStatistics._statKeys))
+		def waypointsFingerprint(waypoints):
+			if not len(waypoints):
+				return (0, None, None)
+			return (len(waypoints), waypoints[0].Timestamp, waypoints[-1].Timestamp)
+		return (act.StartTime, act.EndTime, act.Type, act.Device, statsFingerprint(act.Stats),
+			tuple((id(lap), lap.StartTime, lap.EndTime, lap.Intensity, lap.Trigger, waypointsFingerprint(lap.Waypoints), statsFingerprint(lap.Stats)) for lap in act.Laps))
 
 	def Dump(act, drop_pauses=False):
+		# Every destination that takes FIT files would encode the same activity, so the result is kept on the activity (per set of options)
+		# Concurrent uploads of the activity wait on whichever got there first, rather than encoding it again
+		with FITIO._dumpCacheLock:
+			cache = getattr(act, "_fitDumpCache", None)
+			if cache is None:
+				cache = act._fitDumpCache = {}
+		with FITIO._dumpLocks[id(cache) % len(FITIO._dumpLocks)]:
+			fingerprint = FITIO._dumpFingerprint(act)
+			if drop_pauses in cache and cache[drop_pauses][0] == fingerprint:
+				return cache[drop_pauses][1]
+			result = FITIO._encode(act, drop_pauses)
+			cache[drop_pauses] = (fingerprint, result)
+			return result
+
+	def _encode(act, drop_pauses):
 		def toUtc(ts):
 			if ts.tzinfo:
 				return ts.astimezone(pytz.utc).replace(tzinfo=None)
@@ -481,7 +837,7 @@ class FITIO:
 
 		inPause = False
 		for lap in act.Laps:
-			for wp in lap.Waypoints:
+			for wp in lap.ReadWaypoints():
 				if wp.Type == WaypointType.Resume and inPause:
 					fmg.GenerateMessage("event", timestamp=toUtc(wp.Timestamp), event=FITEvent.Timer, event_type=FITEventType.Start)
 					inPause = False
@@ -1,10 +1,33 @@
 from lxml import etree
 from pytz import UTC
-import copy
 import dateutil.parser
+import dateutil.tz
 from datetime import datetime
-from .interchange import WaypointType, Activity, Waypoint, Location, Lap, ActivityStatistic, ActivityStatisticUnit
+import io
+import re
+from .interchange import WaypointType, Activity, Waypoint, WaypointColumns, Location, Lap, ActivityStatistic, ActivityStatisticUnit
 from .statistic_calculator import ActivityStatisticCalculator
+from tapiriik.settings import WAYPOINT_COLUMNS
+
+_ISO8601_RE = re.compile(r"^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d+))?(Z|[+-]\d\d:?\d\d)?$")
+_UTC = dateutil.tz.tzutc()
+
+def _parseTimestamp(text):
+    # Nearly every GPX timestamp is strict ISO 8601 - only hand the odd ones to dateutil, which is far slower.
+    match = _ISO8601_RE.match(text)
+    if not match:
+        return dateutil.parser.parse(text)
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    tz = None
+    if offset == "Z":
+        tz = _UTC
+    elif offset:
+        offsetSeconds = (int(offset[1:3]) * 60 + int(offset[-2:])) * 60
+        tz = _UTC if not offsetSeconds else dateutil.tz.tzoffset(None, offsetSeconds if offset[0] == "+" else -offsetSeconds)
+    try:
+        return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), int(fraction[:6].ljust(6, "0")) if fraction else 0, tz)
+    except ValueError:
+        return dateutil.parser.parse(text)
 
 class GPXIO:
     Namespaces = {
@@ -14,79 +37,112 @@ class GPXIO:
         "gpxext": "http://www.garmin.com/xmlschemas/GpxExtensions/v3"
     }
 
+    def _parseTrackpoint(xtrkpt, tags):
+        wp = Waypoint()
+
+        wp.Timestamp = _parseTimestamp(xtrkpt.find(tags["time"]).text)
+        wp.Timestamp.replace(tzinfo=UTC)
+
+        wp.Location = Location(float(xtrkpt.attrib["lat"]), float(xtrkpt.attrib["lon"]), None)
+        eleEl = xtrkpt.find(tags["ele"])
+        if eleEl is not None:
+            wp.Location.Altitude = float(eleEl.text)
+        extEl = xtrkpt.find(tags["extensions"])
+        if extEl is not None:
+            gpxtpxExtEl = extEl.find(_GPXTPX_TAGS["TrackPointExtension"])
+            if gpxtpxExtEl is not None:
+                hrEl = gpxtpxExtEl.find(_GPXTPX_TAGS["hr"])
+                if hrEl is not None:
+                    wp.HR = float(hrEl.text)
+                cadEl = gpxtpxExtEl.find(_GPXTPX_TAGS["cad"])
+                if cadEl is not None:
+                    wp.Cadence = float(cadEl.text)
+                tempEl = gpxtpxExtEl.find(_GPXTPX_TAGS["atemp"])
+                if tempEl is not None:
+                    wp.Temp = float(tempEl.text)
+            gpxdataHR = extEl.find(_GPXDATA_TAGS["hr"])
+            if gpxdataHR is not None:
+                wp.HR = float(gpxdataHR.text)
+            gpxdataCadence = extEl.find(_GPXDATA_TAGS["cadence"])
+            if gpxdataCadence is not None:
+                wp.Cadence = float(gpxdataCadence.text)
+        return wp
+
     def Parse(gpxData, activity=None, suppress_validity_errors=False):
-        ns = copy.deepcopy(GPXIO.Namespaces)
-        ns["gpx"] = ns[None]
-        del ns[None]
+        # Streams through the document, clearing each trkpt once it's been read.
+        # Problems are raised only once the whole document is read, and in the same order a tree walk would find them.
         act = Activity() if not activity else activity
 
         act.GPS = True # All valid GPX files have GPS data
 
-        try:
-            root = etree.XML(gpxData)
-        except:
-            root = etree.fromstring(gpxData)
+        if isinstance(gpxData, str):
+            gpxData = gpxData.encode("utf-8")
 
-        # GPSBabel produces files with the GPX/1/0 schema - I have no clue what's new in /1
-        # So, blindly accept whatever we're given!
-        ns["gpx"] = root.nsmap[None]
+        root = xmeta = xtrk = xtrkseg = lap = tags = None
+        rootError = None
+        errors = []
+        startTime = None
+        endTime = None
 
-        xmeta = root.find("gpx:metadata", namespaces=ns)
-        if xmeta is not None:
-            xname = xmeta.find("gpx:name", namespaces=ns)
-            if xname is not None:
-                act.Name = xname.text
-        xtrk = root.find("gpx:trk", namespaces=ns)
+        for event, el in etree.iterparse(io.BytesIO(gpxData), events=("start", "end"), tag=_STREAMED_TAGS):
+            if root is None:
+                root = el.getroottree().getroot()
+                try:
+                    # GPSBabel produces files with the GPX/1/0 schema - I have no clue what's new in /1
+                    # So, blindly accept whatever we're given!
+                    tags = dict((tag, "{%s}%s" % (root.nsmap[None], tag)) for tag in ("metadata", "name", "trk", "trkseg", "trkpt", "time", "ele", "extensions"))
+                except Exception as e:
+                    rootError = e
+            if rootError:
+                el.clear()
+                continue
+
+            if event == "start":
+                if el.tag == tags["trk"] and xtrk is None and el.getparent() is root:
+                    xtrk = el
+                elif el.tag == tags["trkseg"] and xtrk is not None and el.getparent() is xtrk:
+                    xtrkseg = el
+                    lap = Lap(waypointList=WaypointColumns() if WAYPOINT_COLUMNS else None)
+            elif el.tag == tags["trkpt"]:
+                if xtrkseg is not None and el.getparent() is xtrkseg and not errors:
+                    try:
+                        wp = GPXIO._parseTrackpoint(el, tags)
+                    except Exception as e:
+                        errors.append(e)
+                    else:
+                        if startTime is None or wp.Timestamp < startTime:
+                            startTime = wp.Timestamp
+                        if endTime is None or wp.Timestamp > endTime:
+                            endTime = wp.Timestamp
+                        lap.Waypoints.append(wp)
+                # Done with it (and whatever came before it)
+                el.clear()
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
+            elif el is xtrkseg:
+                if not errors:
+                    act.Laps.append(lap)
+                    if not len(lap.Waypoints) and not suppress_validity_errors:
+                        errors.append(ValueError("Track segment without points"))
+                    elif len(lap.Waypoints):
+                        lap.StartTime = lap.Waypoints[0].Timestamp
+                        lap.EndTime = lap.Waypoints[-1].Timestamp
+                el.clear()
+                xtrkseg = lap = None
+            elif el.tag == tags["metadata"] and xmeta is None and el.getparent() is root:
+                xmeta = el
+                xname = xmeta.find(tags["name"])
+                if xname is not None:
+                    act.Name = xname.text
+
+        if rootError:
+            raise rootError
 
         if xtrk is None:
             raise ValueError("Invalid GPX")
 
-        xtrksegs = xtrk.findall("gpx:trkseg", namespaces=ns)
-        startTime = None
-        endTime = None
-
-        for xtrkseg in xtrksegs:
-            lap = Lap()
-            for xtrkpt in xtrkseg.findall("gpx:trkpt", namespaces=ns):
-                wp = Waypoint()
-
-                wp.Timestamp = dateutil.parser.parse(xtrkpt.find("gpx:time", namespaces=ns).text)
-                wp.Timestamp.replace(tzinfo=UTC)
-                if startTime is None or wp.Timestamp < startTime:
-                    startTime = wp.Timestamp
-                if endTime is None or wp.Timestamp > endTime:
-                    endTime = wp.Timestamp
-
-                wp.Location = Location(float(xtrkpt.attrib["lat"]), float(xtrkpt.attrib["lon"]), None)
-                eleEl = xtrkpt.find("gpx:ele", namespaces=ns)
-                if eleEl is not None:
-                    wp.Location.Altitude = float(eleEl.text)
-                extEl = xtrkpt.find("gpx:extensions", namespaces=ns)
-                if extEl is not None:
-                    gpxtpxExtEl = extEl.find("gpxtpx:TrackPointExtension", namespaces=ns)
-                    if gpxtpxExtEl is not None:
-                        hrEl = gpxtpxExtEl.find("gpxtpx:hr", namespaces=ns)
-                        if hrEl is not None:
-                            wp.HR = float(hrEl.text)
-                        cadEl = gpxtpxExtEl.find("gpxtpx:cad", namespaces=ns)
-                        if cadEl is not None:
-                            wp.Cadence = float(cadEl.text)
-                        tempEl = gpxtpxExtEl.find("gpxtpx:atemp", namespaces=ns)
-                        if tempEl is not None:
-                            wp.Temp = float(tempEl.text)
-                    gpxdataHR = extEl.find("gpxdata:hr", namespaces=ns)
-                    if gpxdataHR is not None:
-                        wp.HR = float(gpxdataHR.text)
-                    gpxdataCadence = extEl.find("gpxdata:cadence", namespaces=ns)
-                    if gpxdataCadence is not None:
-                        wp.Cadence = float(gpxdataCadence.text)
-                lap.Waypoints.append(wp)
-            act.Laps.append(lap)
-            if not len(lap.Waypoints) and not suppress_validity_errors:
-                raise ValueError("Track segment without points")
-            elif len(lap.Waypoints):
-                lap.StartTime = lap.Waypoints[0].Timestamp
-                lap.EndTime = lap.Waypoints[-1].Timestamp
+        if errors:
+            raise errors[0]
 
         if not len(act.Laps) and not suppress_validity_errors:
             raise ValueError("File with no track segments")
@@ -123,7 +179,7 @@ class GPXIO:
         inPause = False
         for lap in activity.Laps:
             trkseg = etree.SubElement(trk, "trkseg")
-            for wp in lap.Waypoints:
+            for wp in lap.ReadWaypoints():
                 if wp.Location is None or wp.Location.Latitude is None or wp.Location.Longitude is None:
                     continue  # drop the point
                 if wp.Type == WaypointType.Pause:
@@ -151,3 +207,8 @@ class GPXIO:
                         etree.SubElement(gpxtpxexts, GPXTPX + "atemp").text = str(wp.Temp)
 
         return etree.tostring(root, pretty_print=True, xml_declaration=True, encoding="UTF-8").decode("UTF-8")
+
+_GPXTPX_TAGS = dict((tag, "{%s}%s" % (GPXIO.Namespaces["gpxtpx"], tag)) for tag in ("TrackPointExtension", "hr", "cad", "atemp"))
+_GPXDATA_TAGS = dict((tag, "{%s}%s" % (GPXIO.Namespaces["gpxdata"], tag)) for tag in ("hr", "cadence"))
+# The GPX namespace itself isn't known until the root element's been read
+_STREAMED_TAGS = ("{*}metadata", "{*}trk", "{*}trkseg", "{*}trkpt")
@@ -0,0 +1,104 @@
+from tapiriik import settings
+from requests.adapters import HTTPAdapter
+from http.cookiejar import DefaultCookiePolicy
+import requests
+import threading
+
+class ServiceHTTPAdapter(HTTPAdapter):
+    """ Keeps a service's connections alive between requests, and applies the default timeout, source address and user agent
+        (the same as requests_lib patches in globally, for everything else)
+    """
+    def __init__(self, service_id, timeout=None, source_address=None, user_agent=None, **kwargs):
+        self.ServiceID = service_id
+        self.Timeout = timeout
+        self.SourceAddress = source_address
+        self.UserAgent = user_agent
+        self.Requests = 0
+        self.NewConnections = 0
+        self._statsLock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def __reduce__(self):
+        # Sessions get pickled into SessionCache - when they come back out, they should use this process' pool
+        return (HTTPSessions.Adapter, (self.ServiceID,))
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.SourceAddress:
+            kwargs["source_address"] = self.SourceAddress
+        super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, *args, **kwargs):
+        if self.SourceAddress:
+            kwargs["source_address"] = self.SourceAddress
+        return super().proxy_manager_for(*args, **kwargs)
+
+    def _pool(self, request, verify, proxies, cert):
+        # The pool send will draw on - since requests 2.32.2 that's keyed on the TLS settings too, and get_connection is deprecated
+        if hasattr(HTTPAdapter, "get_connection_with_tls_context"):
+            return self.get_connection_with_tls_context(request, verify, proxies=proxies, cert=cert)
+        return self.get_connection(request.url, proxies)
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if timeout is None:
+            timeout = self.Timeout
+        if self.UserAgent and request.headers.get("User-Agent", "").startswith("python-requests/"):
+            request.headers["User-Agent"] = self.UserAgent
+        pool = self._pool(request, verify, proxies, cert)
+        connections = pool.num_connections
+        try:
+            return super().send(request, stream=stream, timeout=timeout, verify=verify, cert=cert, proxies=proxies)
+        finally:
+            with self._statsLock:
+                self.Requests += 1
+                self.NewConnections += pool.num_connections - connections
+
+class _ServiceSession(requests.Session):
+    def close(self):
+        # The connections belong to the service's pool, not this session
+        pass
+
+class HTTPSessions:
+    """ One connection pool per service, shared by all its requests in this process.
+
+        Get returns a session shared by everything, which doesn't keep cookies - for stateless (e.g. OAuth) APIs.
+        New returns a session of its own (for cookie-based logins and the like) that still draws on the service's pool.
+    """
+    _adapters = {}
+    _shared = {}
+    _lock = threading.Lock()
+
+    def Adapter(service_id):
+        with HTTPSessions._lock:
+            if service_id not in HTTPSessions._adapters:
+                source_address = settings.HTTP_SOURCE_ADDR
+                # It's only resolved to a single address in the workers - elsewhere, we take what we're given
+                source_address = (source_address, 0) if isinstance(source_address, str) and source_address != "0.0.0.0" else None
+                HTTPSessions._adapters[service_id] = ServiceHTTPAdapter(service_id,
+                                                                        timeout=settings.HTTP_TIMEOUT,
+                                                                        source_address=source_address,
+                                                                        user_agent=settings.HTTP_USER_AGENT,
+                                                                        pool_connections=settings.HTTP_POOL_CONNECTIONS,
+                                                                        pool_maxsize=settings.HTTP_POOL_MAXSIZE)
+            return HTTPSessions._adapters[service_id]
+
+    def New(service_id):
+        adapter = HTTPSessions.Adapter(service_id)
+        session = _ServiceSession()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def Get(service_id):
+        session = HTTPSessions._shared.get(service_id)
+        if session is None:
+            session = HTTPSessions.New(service_id)
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            session = HTTPSessions._shared.setdefault(service_id, session)
+        return session
+
+    def Stats():
+        """ Requests made and connections opened by each service, in this process """
+        stats = {}
+        for service_id, adapter in list(HTTPSessions._adapters.items()):
+            stats[service_id] = {"Requests": adapter.Requests, "NewConnections": adapter.NewConnections, "Reused": adapter.Requests - adapter.NewConnections}
+        return stats
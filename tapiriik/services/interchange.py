@@ -1,6 +1,7 @@
 from datetime import timedelta, datetime
-from tapiriik.database import cachedb
-from tapiriik.database.tz import TZLookup
+from array import array
+from tapiriik.database.tz import TZCache
+import bisect
 import hashlib
 import pytz
 
@@ -58,6 +59,36 @@ class ActivityType:  # taken from RK API docs. The text values have no meaning e
         return False
 
 
+def _localizer(tz):
+    """ tz.localize, for a run of timestamps - pytz's DST-aware localize is slow, but the answer can't change until the next transition,
+        so the last one is reused for anything more than a day clear of the transitions either side of it
+    """
+    if not isinstance(tz, pytz.tzinfo.DstTzInfo):
+        return tz.localize
+    transitions = tz._utc_transition_times
+    margin = timedelta(days=1)
+    last = [None, None, None] # tzinfo, and the (wall-clock) range it's good for
+
+    def localize(dt):
+        tzinfo, start, end = last
+        if tzinfo is not None and start <= dt < end:
+            return dt.replace(tzinfo=tzinfo)
+        localized = tz.localize(dt)
+        tzinfo = localized.tzinfo
+        idx = bisect.bisect_right(transitions, dt - tzinfo._utcoffset)
+        if idx == 0 or tz._tzinfos[tz._transition_info[idx - 1]] is not tzinfo:
+            # A wall time that doesn't exist (in a DST gap) gets the tzinfo from before the transition, though it's after it in UTC
+            return localized
+        last[0] = tzinfo
+        last[1] = transitions[idx - 1] + tzinfo._utcoffset + margin if idx > 1 else datetime.min
+        last[2] = transitions[idx] + tzinfo._utcoffset - margin if idx < len(transitions) else datetime.max
+        return localized
+    return localize
+
+class TimestampSanityError(ValueError):
+    """ Raised by Activity.CheckTimestampSanity (and Normalize) """
+    pass
+
 class Activity:
     def __init__(self, startTime=None, endTime=None, actType=ActivityType.Other, distance=None, name=None, notes=None, tz=None, lapList=None, private=False, fallbackTz=None, stationary=None, gps=None, device=None):
         self.StartTime = startTime
@@ -92,6 +123,10 @@ class Activity:
     def GetFlatWaypoints(self):
         return [wp for waypoints in [x.Waypoints for x in self.Laps] for wp in waypoints]
 
+    def ReadFlatWaypoints(self):
+        """ Like GetFlatWaypoints, but for reading only (see Lap.ReadWaypoints) """
+        return [wp for lap in self.Laps for wp in lap.ReadWaypoints()]
+
     def GetFirstWaypointWithLocation(self):
         loc_wp = None
         for lap in self.Laps:
@@ -105,16 +140,17 @@ class Activity:
         """ run localize() on all contained dates to tag them with the activity TZ (doesn't change values) """
         if self.TZ is None:
             raise ValueError("TZ not set")
+        localize = _localizer(self.TZ)
         if self.StartTime and self.StartTime.tzinfo is None:
-            self.StartTime = self.TZ.localize(self.StartTime)
+            self.StartTime = localize(self.StartTime)
         if self.EndTime and self.EndTime.tzinfo is None:
-            self.EndTime = self.TZ.localize(self.EndTime)
+            self.EndTime = localize(self.EndTime)
         for lap in self.Laps:
-            lap.StartTime = self.TZ.localize(lap.StartTime) if lap.StartTime.tzinfo is None else lap.StartTime
-            lap.EndTime = self.TZ.localize(lap.EndTime) if lap.EndTime.tzinfo is None else lap.EndTime
+            lap.StartTime = localize(lap.StartTime) if lap.StartTime.tzinfo is None else lap.StartTime
+            lap.EndTime = localize(lap.EndTime) if lap.EndTime.tzinfo is None else lap.EndTime
             for wp in lap.Waypoints:
                 if wp.Timestamp.tzinfo is None:
-                    wp.Timestamp = self.TZ.localize(wp.Timestamp)
+                    wp.Timestamp = localize(wp.Timestamp)
         self.CalculateUID()
 
     def AdjustTZ(self):
@@ -145,15 +181,12 @@ class Activity:
             self.TZ = self.FallbackTZ
             return self.TZ
 
-        # I guess at some point it will be faster to perform a full lookup than digging through this table.
-        res = TZLookup(loc.Latitude, loc.Longitude)
-        cachedTzData = {"TZ": res, "Latitude": loc.Latitude, "Longitude": loc.Longitude}
-        cachedb.tz_cache.insert(cachedTzData)
+        res = TZCache.Lookup(loc.Latitude, loc.Longitude)
 
-        if type(cachedTzData["TZ"]) != str:
-            self.TZ = pytz.FixedOffset(cachedTzData["TZ"] * 60)
+        if type(res) != str:
+            self.TZ = pytz.FixedOffset(res * 60)
         else:
-            self.TZ = pytz.timezone(cachedTzData["TZ"])
+            self.TZ = pytz.timezone(res)
         return self.TZ
 
     def EnsureTZ(self, recalculate=False):
@@ -184,7 +217,7 @@ class Activity:
                 raise ValueError("Exactly 0 waypoints")
             if wptCt == 1:
                 raise ValueError("Only 1 waypoint")
-        if self.Stats.Distance.Value is not None and self.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value > 1000 * 1000:
+        if self.Stats.Distance.Value is not None and self.Stats.Distance.convertedValue(ActivityStatisticUnit.Meters) > 1000 * 1000:
             raise ValueError("Exceedingly long activity (distance)")
         if self.StartTime.replace(tzinfo=None) > (datetime.now() + timedelta(days=5)):
             raise ValueError("Activity is from the future")
@@ -240,37 +273,37 @@ class Activity:
         out_of_bounds_leeway = timedelta(minutes=10)
 
         if self.StartTime.tzinfo != self.TZ:
-            raise ValueError("Activity StartTime TZ mismatch - %s master vs %s instance" % (self.TZ, self.StartTime.tzinfo))
+            raise TimestampSanityError("Activity StartTime TZ mismatch - %s master vs %s instance" % (self.TZ, self.StartTime.tzinfo))
         if self.EndTime.tzinfo != self.TZ:
-            raise ValueError("Activity EndTime TZ mismatch - %s master vs %s instance" % (self.TZ, self.EndTime.tzinfo))
+            raise TimestampSanityError("Activity EndTime TZ mismatch - %s master vs %s instance" % (self.TZ, self.EndTime.tzinfo))
 
         for lap in self.Laps:
             if lap.StartTime.tzinfo != self.TZ:
-                raise ValueError("Lap StartTime TZ mismatch - %s master vs %s instance" % (self.TZ, lap.StartTime.tzinfo))
+                raise TimestampSanityError("Lap StartTime TZ mismatch - %s master vs %s instance" % (self.TZ, lap.StartTime.tzinfo))
             if lap.EndTime.tzinfo != self.TZ:
-                raise ValueError("Lap EndTime TZ mismatch - %s master vs %s instance" % (self.TZ, lap.EndTime.tzinfo))
+                raise TimestampSanityError("Lap EndTime TZ mismatch - %s master vs %s instance" % (self.TZ, lap.EndTime.tzinfo))
 
             for wp in lap.Waypoints:
                 if wp.Timestamp.tzinfo != self.TZ:
-                    raise ValueError("Waypoint TZ mismatch - %s master vs %s instance" % (self.TZ, wp.Timestamp.tzinfo))
+                    raise TimestampSanityError("Waypoint TZ mismatch - %s master vs %s instance" % (self.TZ, wp.Timestamp.tzinfo))
 
                 if lap.StartTime - wp.Timestamp > out_of_bounds_leeway:
-                    raise ValueError("Waypoint occurs too far before lap")
+                    raise TimestampSanityError("Waypoint occurs too far before lap")
 
                 if wp.Timestamp - lap.EndTime > out_of_bounds_leeway:
-                    raise ValueError("Waypoint occurs too far after lap")
+                    raise TimestampSanityError("Waypoint occurs too far after lap")
 
                 if self.StartTime - wp.Timestamp > out_of_bounds_leeway:
-                    raise ValueError("Waypoint occurs too far before activity")
+                    raise TimestampSanityError("Waypoint occurs too far before activity")
 
                 if wp.Timestamp - self.EndTime > out_of_bounds_leeway:
-                    raise ValueError("Waypoint occurs too far after activity")
+                    raise TimestampSanityError("Waypoint occurs too far after activity")
 
             if self.StartTime - lap.StartTime > out_of_bounds_leeway:
-                raise ValueError("Lap starts too far before activity")
+                raise TimestampSanityError("Lap starts too far before activity")
 
             if lap.EndTime - self.EndTime > out_of_bounds_leeway:
-                raise ValueError("Lap ends too far after activity")
+                raise TimestampSanityError("Lap ends too far after activity")
 
     def CleanStats(self):
         """
@@ -278,51 +311,129 @@ class Activity:
             So, rather than propagating these, or bailing, we silently strip them, in hopes that destinations will do a better job of calculating them.
             Most of the upper limits match the FIT spec
         """
+        ranges = {
+            "Power": (ActivityStatisticUnit.Watts, 0, 5000),
+            "Speed": (ActivityStatisticUnit.KilometersPerHour, 0, 150),
+            "Elevation": (ActivityStatisticUnit.Meters, -500, 8850), # Props for bringing your Forerunner up Everest
+            "HR": (ActivityStatisticUnit.BeatsPerMinute, 15, 300), # Please visit the ER before you email me about these limits
+            "Cadence": (ActivityStatisticUnit.RevolutionsPerMinute, 0, 255), # FIT
+            "RunCadence": (ActivityStatisticUnit.StepsPerMinute, 0, 255), # FIT
+            "Strides": (ActivityStatisticUnit.Strides, 1, 9999999),
+            "Temperature": (ActivityStatisticUnit.DegreesCelcius, -62, 50),
+            "Energy": (ActivityStatisticUnit.Kilocalories, 1, 65535), # FIT
+            "Distance": (ActivityStatisticUnit.Kilometers, 0, 1000) # You can let me know when you ride 1000 km and I'll up this.
+        }
+        checkFields = ("Average", "Max", "Min", "Value")
+
         def _cleanStatsObj(stats):
-            ranges = {
-                "Power": (ActivityStatisticUnit.Watts, 0, 5000),
-                "Speed": (ActivityStatisticUnit.KilometersPerHour, 0, 150),
-                "Elevation": (ActivityStatisticUnit.Meters, -500, 8850), # Props for bringing your Forerunner up Everest
-                "HR": (ActivityStatisticUnit.BeatsPerMinute, 15, 300), # Please visit the ER before you email me about these limits
-                "Cadence": (ActivityStatisticUnit.RevolutionsPerMinute, 0, 255), # FIT
-                "RunCadence": (ActivityStatisticUnit.StepsPerMinute, 0, 255), # FIT
-                "Strides": (ActivityStatisticUnit.Strides, 1, 9999999),
-                "Temperature": (ActivityStatisticUnit.DegreesCelcius, -62, 50),
-                "Energy": (ActivityStatisticUnit.Kilocalories, 1, 65535), # FIT
-                "Distance": (ActivityStatisticUnit.Kilometers, 0, 1000) # You can let me know when you ride 1000 km and I'll up this.
-            }
-            checkFields = ("Average", "Max", "Min", "Value")
-            for key in ranges:
-                raw_stat = getattr(stats, key)
-                stat = raw_stat.asUnits(ranges[key][0])
+            for key, (units, low, high) in ranges.items():
+                stat = getattr(stats, key)
                 for field in checkFields:
-                    value = getattr(stat, field)
-                    if value is not None and (value < ranges[key][1] or value > ranges[key][2]):
-                        raw_stat._samples[field] = 0 # Need to update the original (raw_stat), not the asUnits copy (stat)
-                        setattr(raw_stat, field, None)
+                    value = stat.convertedValue(units, field)
+                    if value is not None and (value < low or value > high):
+                        stat._samples[field] = 0
+                        setattr(stat, field, None)
 
         _cleanStatsObj(self.Stats)
         for lap in self.Laps:
             _cleanStatsObj(lap.Stats)
 
+    def _cleanWaypoint(wp):
+        if wp.Distance and wp.Distance < 0:
+            wp.Distance = 0
+        if wp.Speed and wp.Speed < 0:
+            wp.Speed = 0
+        if wp.Cadence and wp.Cadence < 0:
+            wp.Cadence = 0
+        if wp.RunCadence and wp.RunCadence < 0:
+            wp.RunCadence = 0
+        if wp.Power and wp.Power < 0:
+            wp.Power = 0
+        if wp.Calories and wp.Calories < 0:
+            wp.Calories = 0 # Are there any devices that track your caloric intake? Interesting idea...
+        if wp.HR and wp.HR < 0:
+            wp.HR = 0
+
     def CleanWaypoints(self):
         # Similarly, we sometimes get complete nonsense like negative distance
-        waypoints = self.GetFlatWaypoints()
-        for wp in waypoints:
-            if wp.Distance and wp.Distance < 0:
-                wp.Distance = 0
-            if wp.Speed and wp.Speed < 0:
-                wp.Speed = 0
-            if wp.Cadence and wp.Cadence < 0:
-                wp.Cadence = 0
-            if wp.RunCadence and wp.RunCadence < 0:
-                wp.RunCadence = 0
-            if wp.Power and wp.Power < 0:
-                wp.Power = 0
-            if wp.Calories and wp.Calories < 0:
-                wp.Calories = 0 # Are there any devices that track your caloric intake? Interesting idea...
-            if wp.HR and wp.HR < 0:
-                wp.HR = 0
+        for lap in self.Laps:
+            for wp in lap.Waypoints:
+                Activity._cleanWaypoint(wp)
+
+    def Normalize(self, recalculateTZ=False):
+        """ CleanWaypoints, EnsureTZ and CheckTimestampSanity, in that order - but in a single pass over the waypoints.
+            Problems determining the TZ raise as soon as they're hit, as they would from EnsureTZ.
+            The first failed timestamp sanity check raises TimestampSanityError (with the same message CheckTimestampSanity would give),
+            but not until every waypoint has been cleaned and given the TZ.
+            CleanStats is left to the caller, so its errors aren't mistaken for TZ problems.
+        """
+        tz = self.CalculateTZ(recalculate=recalculateTZ)
+        # As EnsureTZ - DefineTZ tags naive timestamps with the TZ, AdjustTZ converts aware ones into it
+        define = self.StartTime.tzinfo is None
+        if define:
+            localize = _localizer(tz)
+            if self.StartTime and self.StartTime.tzinfo is None:
+                self.StartTime = localize(self.StartTime)
+            if self.EndTime and self.EndTime.tzinfo is None:
+                self.EndTime = localize(self.EndTime)
+        else:
+            self.StartTime = self.StartTime.astimezone(tz)
+            self.EndTime = self.EndTime.astimezone(tz)
+
+        out_of_bounds_leeway = timedelta(minutes=10)
+        insane = None # The first thing CheckTimestampSanity would have raised about
+        if self.StartTime.tzinfo != tz:
+            insane = "Activity StartTime TZ mismatch - %s master vs %s instance" % (tz, self.StartTime.tzinfo)
+        elif self.EndTime.tzinfo != tz:
+            insane = "Activity EndTime TZ mismatch - %s master vs %s instance" % (tz, self.EndTime.tzinfo)
+        act_start, act_end = self.StartTime, self.EndTime
+
+        clean = Activity._cleanWaypoint
+        for lap in self.Laps:
+            if define:
+                lap.StartTime = localize(lap.StartTime) if lap.StartTime.tzinfo is None else lap.StartTime
+                lap.EndTime = localize(lap.EndTime) if lap.EndTime.tzinfo is None else lap.EndTime
+            else:
+                lap.StartTime = lap.StartTime.astimezone(tz)
+                lap.EndTime = lap.EndTime.astimezone(tz)
+            lap_start, lap_end = lap.StartTime, lap.EndTime
+            if insane is None:
+                if lap_start.tzinfo != tz:
+                    insane = "Lap StartTime TZ mismatch - %s master vs %s instance" % (tz, lap_start.tzinfo)
+                elif lap_end.tzinfo != tz:
+                    insane = "Lap EndTime TZ mismatch - %s master vs %s instance" % (tz, lap_end.tzinfo)
+
+            for wp in lap.Waypoints:
+                clean(wp)
+
+                timestamp = wp.Timestamp
+                if define:
+                    if timestamp.tzinfo is None:
+                        timestamp = wp.Timestamp = localize(timestamp)
+                else:
+                    timestamp = wp.Timestamp = timestamp.astimezone(tz)
+
+                if insane is None:
+                    if timestamp.tzinfo != tz:
+                        insane = "Waypoint TZ mismatch - %s master vs %s instance" % (tz, timestamp.tzinfo)
+                    elif lap_start - timestamp > out_of_bounds_leeway:
+                        insane = "Waypoint occurs too far before lap"
+                    elif timestamp - lap_end > out_of_bounds_leeway:
+                        insane = "Waypoint occurs too far after lap"
+                    elif act_start - timestamp > out_of_bounds_leeway:
+                        insane = "Waypoint occurs too far before activity"
+                    elif timestamp - act_end > out_of_bounds_leeway:
+                        insane = "Waypoint occurs too far after activity"
+
+            if insane is None:
+                if act_start - lap_start > out_of_bounds_leeway:
+                    insane = "Lap starts too far before activity"
+                elif lap_end - act_end > out_of_bounds_leeway:
+                    insane = "Lap ends too far after activity"
+
+        self.CalculateUID()
+        if insane is not None:
+            raise TimestampSanityError(insane)
 
     def __str__(self):
         return "Activity (" + self.Type + ") Start " + str(self.StartTime) + " " + str(self.TZ) + " End " + str(self.EndTime) + " stat " + str(self.Stationary)
@@ -384,7 +495,11 @@ class Lap:
         self.Trigger = trigger
         self.Intensity = intensity
         self.Stats = stats if stats else ActivityStatistics()
-        self.Waypoints = waypointList if waypointList else []
+        self.Waypoints = waypointList if waypointList is not None else [] # Or WaypointColumns
+
+    def ReadWaypoints(self):
+        """ The lap's waypoints, for reading only - from WaypointColumns, these are detached copies rather than views """
+        return self.Waypoints.Snapshots() if isinstance(self.Waypoints, WaypointColumns) else self.Waypoints
 
     def __str__(self):
         return str(self.StartTime) + "-" + str(self.EndTime) + " " + str(self.Intensity) + " (" + str(self.Trigger) + ") " + str(len(self.Waypoints)) + " wps"
@@ -501,13 +616,30 @@ class ActivityStatistic:
         newStat = ActivityStatistic(units)
         newStat._samples = self._samples
         newStat.Units = units
+        steps = None
         for k in ActivityStatistic._typeKeys:
             old_value = getattr(self, k, None)
             if old_value is not None:
-                setattr(newStat, k, ActivityStatistic.convertValue(old_value, self.Units, units))
+                if steps is None:
+                    steps = ActivityStatistic._conversionSteps(self.Units, units)
+                setattr(newStat, k, ActivityStatistic._applyConversion(old_value, steps))
         return newStat
 
-    def convertValue(value, from_units, to_units):
+    def convertedValue(self, units, field="Value"):
+        """ The same as asUnits(units).<field>, without making a new ActivityStatistic """
+        value = getattr(self, field)
+        if value is None or units == self.Units:
+            return value
+        return ActivityStatistic._applyConversion(value, ActivityStatistic._conversionSteps(self.Units, units))
+
+    # (from_units, to_units) -> the steps convertValue takes between them, so the path is only searched for once
+    _conversionStepCache = {}
+
+    def _conversionSteps(from_units, to_units):
+        steps = ActivityStatistic._conversionStepCache.get((from_units, to_units))
+        if steps is not None:
+            return steps
+
         def recurseFindConversionPath(unit, target, stack):
             assert(unit != target)
             for transform in ActivityStatistic._conversions.keys():
@@ -527,26 +659,44 @@ class ActivityStatistic:
         conversionPath = recurseFindConversionPath(from_units, to_units, [])
         if not conversionPath:
             raise ValueError("No conversion from %s to %s" % (from_units, to_units))
+        original_units = from_units
+        # Each step is a factor to multiply or divide by, or a function to apply
+        steps = []
         for transform in conversionPath:
-            if type(ActivityStatistic._conversions[transform]) is float or type(ActivityStatistic._conversions[transform]) is int:
+            conversion = ActivityStatistic._conversions[transform]
+            if type(conversion) is float or type(conversion) is int:
                 if from_units == transform[0]:
-                    value = value * ActivityStatistic._conversions[transform]
+                    steps.append((conversion, False))
                     from_units = transform[1]
                 else:
-                    value = value / ActivityStatistic._conversions[transform]
+                    steps.append((conversion, True))
                     from_units = transform[0]
             else:
                 if from_units == transform[0]:
-                    func = ActivityStatistic._conversions[transform][0] if type(ActivityStatistic._conversions[transform]) is tuple else ActivityStatistic._conversions[transform]
-                    value = func(value)
+                    steps.append((conversion[0] if type(conversion) is tuple else conversion, None))
                     from_units = transform[1]
                 else:
-                    if type(ActivityStatistic._conversions[transform]) is not tuple:
+                    if type(conversion) is not tuple:
                         raise ValueError("No transform function for %s to %s" % (from_units, to_units))
-                    value = ActivityStatistic._conversions[transform][1](value)
+                    steps.append((conversion[1], None))
                     from_units = transform[0]
+        steps = tuple(steps)
+        ActivityStatistic._conversionStepCache[(original_units, to_units)] = steps
+        return steps
+
+    def _applyConversion(value, steps):
+        for conversion, divide in steps:
+            if divide is None:
+                value = conversion(value)
+            elif divide:
+                value = value / conversion
+            else:
+                value = value * conversion
         return value
 
+    def convertValue(value, from_units, to_units):
+        return ActivityStatistic._applyConversion(value, ActivityStatistic._conversionSteps(from_units, to_units))
+
     def coalesceWith(self, stat):
         stat = stat.asUnits(self.Units)
         items = ["Value", "Max", "Min", "Average", "Gain", "Loss"]
@@ -657,3 +807,191 @@ class Location:
 
     def __ne__(self, other):
         return not self.__eq__(other)
+
+
+_NAN = float("nan")
+_NO_TIMESTAMP = -2 ** 63
+
+def _valueColumnProperty(name):
+    def get(self):
+        value = getattr(self._columns, name)[self._index]
+        return None if value != value else value
+    def set(self, value):
+        getattr(self._columns, name)[self._index] = _NAN if value is None else value
+    return property(get, set)
+
+class WaypointLocationView(Location):
+    """ A Location stored in a WaypointColumns row """
+    __slots__ = ["_columns", "_index"]
+    def __init__(self, columns, index):
+        self._columns = columns
+        self._index = index
+
+    Latitude = _valueColumnProperty("Latitude")
+    Longitude = _valueColumnProperty("Longitude")
+    Altitude = _valueColumnProperty("Altitude")
+
+class WaypointView(Waypoint):
+    """ A Waypoint stored in a WaypointColumns row - reads and writes go straight through to the columns """
+    __slots__ = ["_columns", "_index"]
+    def __init__(self, columns, index):
+        self._columns = columns
+        self._index = index
+
+    HR = _valueColumnProperty("HR")
+    Calories = _valueColumnProperty("Calories")
+    Power = _valueColumnProperty("Power")
+    Temp = _valueColumnProperty("Temp")
+    Cadence = _valueColumnProperty("Cadence")
+    RunCadence = _valueColumnProperty("RunCadence")
+    Distance = _valueColumnProperty("Distance")
+    Speed = _valueColumnProperty("Speed")
+
+    @property
+    def Timestamp(self):
+        return self._columns._decodeTimestamp(self._columns.Timestamps[self._index])
+
+    @Timestamp.setter
+    def Timestamp(self, value):
+        self._columns.Timestamps[self._index] = self._columns._encodeTimestamp(value)
+
+    @property
+    def Type(self):
+        return self._columns.Types[self._index]
+
+    @Type.setter
+    def Type(self, value):
+        self._columns.Types[self._index] = value
+
+    @property
+    def Location(self):
+        return WaypointLocationView(self._columns, self._index) if self._columns.HasLocation[self._index] else None
+
+    @Location.setter
+    def Location(self, value):
+        self._columns._setLocation(self._index, value)
+
+class WaypointColumns:
+    """ Array-backed storage for a lap's waypoints - a column per field, rather than a Waypoint, Location and datetime per point.
+
+        Indexing and iteration give WaypointViews, which read and write through to the columns, so code written against lists of
+        Waypoints keeps working (but a Location assigned to a view is copied in, not referenced). Read-only consumers should use
+        Snapshots() - or the columns themselves, where missing values are NaN.
+        Numeric fields come back as floats, and every timestamp in the lap is given in the same TZ (the last one assigned).
+    """
+    ValueColumns = ("Latitude", "Longitude", "Altitude", "HR", "Calories", "Power", "Temp", "Cadence", "RunCadence", "Distance", "Speed")
+    _epoch = datetime(1970, 1, 1)
+    _utcEpoch = pytz.utc.localize(datetime(1970, 1, 1))
+
+    def __init__(self, waypoints=None):
+        self.TZ = None
+        self.Aware = None # Decided by the first timestamp
+        self.Timestamps = array("q") # Microseconds since the epoch - UTC if aware, wall-clock if not
+        self.Types = array("b")
+        self.HasLocation = array("b")
+        for name in WaypointColumns.ValueColumns:
+            setattr(self, name, array("d"))
+        if waypoints:
+            self.extend(waypoints)
+
+    def _zone(self, tzinfo):
+        # pytz hands out a tzinfo per UTC offset, but we need the zone to turn UTC back into local time
+        return pytz.timezone(tzinfo.zone) if isinstance(tzinfo, pytz.tzinfo.DstTzInfo) else tzinfo
+
+    def _encodeTimestamp(self, timestamp):
+        if timestamp is None:
+            return _NO_TIMESTAMP
+        aware = timestamp.tzinfo is not None
+        if self.Aware is None:
+            self.Aware = aware
+        elif aware != self.Aware:
+            self._convertTimestamps(timestamp.tzinfo)
+        if aware:
+            self.TZ = self._zone(timestamp.tzinfo)
+            delta = timestamp - WaypointColumns._utcEpoch
+        else:
+            delta = timestamp - WaypointColumns._epoch
+        return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+    def _decodeTimestamp(self, value):
+        if value == _NO_TIMESTAMP:
+            return None
+        if self.Aware:
+            return (WaypointColumns._utcEpoch + timedelta(microseconds=value)).astimezone(self.TZ)
+        return WaypointColumns._epoch + timedelta(microseconds=value)
+
+    def _convertTimestamps(self, tzinfo):
+        # Mixing naive and aware timestamps - convert the rest the same way DefineTZ would (or strip their TZs)
+        existing = [self._decodeTimestamp(x) for x in self.Timestamps]
+        if tzinfo is not None:
+            zone = self._zone(tzinfo)
+            existing = [(zone.localize(x) if hasattr(zone, "localize") else x.replace(tzinfo=zone)) if x is not None else None for x in existing]
+        else:
+            existing = [x.replace(tzinfo=None) if x is not None else None for x in existing]
+        self.Aware = tzinfo is not None
+        self.TZ = None
+        for idx, timestamp in enumerate(existing):
+            self.Timestamps[idx] = self._encodeTimestamp(timestamp)
+
+    def _setLocation(self, idx, location):
+        if location is None:
+            self.HasLocation[idx] = 0
+            self.Latitude[idx] = self.Longitude[idx] = self.Altitude[idx] = _NAN
+        else:
+            self.HasLocation[idx] = 1
+            self.Latitude[idx] = _NAN if location.Latitude is None else location.Latitude
+            self.Longitude[idx] = _NAN if location.Longitude is None else location.Longitude
+            self.Altitude[idx] = _NAN if location.Altitude is None else location.Altitude
+
+    def _set(self, idx, wp):
+        self.Timestamps[idx] = self._encodeTimestamp(wp.Timestamp)
+        self.Types[idx] = wp.Type
+        self._setLocation(idx, wp.Location)
+        for name in WaypointColumns.ValueColumns[3:]:
+            value = getattr(wp, name)
+            getattr(self, name)[idx] = _NAN if value is None else value
+
+    def append(self, wp):
+        self.Timestamps.append(_NO_TIMESTAMP)
+        self.Types.append(0)
+        self.HasLocation.append(0)
+        for name in WaypointColumns.ValueColumns:
+            getattr(self, name).append(_NAN)
+        self._set(len(self.Timestamps) - 1, wp)
+
+    def extend(self, waypoints):
+        for wp in waypoints:
+            self.append(wp)
+
+    def __len__(self):
+        return len(self.Timestamps)
+
+    def _normalizeIndex(self, idx):
+        length = len(self.Timestamps)
+        if idx < 0:
+            idx += length
+        if idx < 0 or idx >= length:
+            raise IndexError("waypoint index out of range")
+        return idx
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [WaypointView(self, x) for x in range(*idx.indices(len(self.Timestamps)))]
+        return WaypointView(self, self._normalizeIndex(idx))
+
+    def __setitem__(self, idx, wp):
+        self._set(self._normalizeIndex(idx), wp)
+
+    def __iter__(self):
+        for idx in range(len(self.Timestamps)):
+            yield WaypointView(self, idx)
+
+    def Snapshots(self):
+        """ Yields detached Waypoints built straight from the columns - cheaper than views when every field is read """
+        decode = self._decodeTimestamp
+        columns = [getattr(self, name) for name in WaypointColumns.ValueColumns]
+        for timestamp, ptType, hasLocation, lat, lon, alt, hr, cal, pwr, temp, cad, rcad, dist, spd in zip(self.Timestamps, self.Types, self.HasLocation, *columns):
+            yield Waypoint(decode(timestamp), ptType,
+                           Location(None if lat != lat else lat, None if lon != lon else lon, None if alt != alt else alt) if hasLocation else None,
+                           hr=None if hr != hr else hr, calories=None if cal != cal else cal, power=None if pwr != pwr else pwr, temp=None if temp != temp else temp,
+                           cadence=None if cad != cad else cad, runCadence=None if rcad != rcad else rcad, distance=None if dist != dist else dist, speed=None if spd != spd else spd)
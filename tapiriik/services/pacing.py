@@ -0,0 +1,120 @@
+from tapiriik.database import redis
+from tapiriik import settings
+import logging
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class PacingScope:
+    Global = "global"
+    SourceAddress = "source" # Per egress address - HTTP_SOURCE_ADDR, or the host when that's left to the OS
+    Account = "account"
+
+# Hands out request slots first-come-first-served: each call reserves the earliest time allowed by all of its keys, and pushes
+# each key's next slot back by its interval. Callers then sleep until their slot - nobody spins on a lock.
+# KEYS are the pacing keys followed by their stats keys; ARGV is the current time, how long (seconds) to keep the stats once they
+# stop being updated, then each pacing key's interval (seconds). Returns the wait as a string, since Lua numbers come back truncated.
+_RESERVE_SCRIPT = """
+local count = #KEYS / 2
+local now = tonumber(ARGV[1])
+local stats_ttl = tonumber(ARGV[2])
+local slot = now
+for i = 1, count do
+    local next_slot = tonumber(redis.call("GET", KEYS[i]))
+    if next_slot ~= nil and next_slot > slot then
+        slot = next_slot
+    end
+end
+local wait = slot - now
+for i = 1, count do
+    local next_slot = slot + tonumber(ARGV[i + 2])
+    redis.call("SET", KEYS[i], tostring(next_slot), "PX", math.ceil((next_slot - now) * 1000) + 1000)
+    local stats = KEYS[count + i]
+    redis.call("HINCRBY", stats, "Requests", 1)
+    redis.call("HINCRBYFLOAT", stats, "TotalWait", tostring(wait))
+    if wait > (tonumber(redis.call("HGET", stats, "MaxWait")) or 0) then
+        redis.call("HSET", stats, "MaxWait", tostring(wait))
+    end
+    redis.call("EXPIRE", stats, stats_ttl)
+end
+return tostring(wait)
+"""
+
+class Pacer:
+    """ Spaces out requests to a service across every worker, per ServiceBase.RequestPacing ([(PacingScope, requests per second),...]).
+        Without Redis (or while it's unreachable), requests are only paced within the process.
+    """
+    _reserveScript = None
+    StatsTTL = 86400 * 7
+    _localSlots = {}
+    _localLock = threading.Lock()
+
+    def _sourceAddress():
+        # HTTP_SOURCE_ADDR is only resolved to a single address in the workers (and it's the wildcard by default)
+        # - anywhere else, the OS picks the interface, so each host gets its own pace
+        source_address = settings.HTTP_SOURCE_ADDR
+        if isinstance(source_address, str) and source_address not in ("", "0.0.0.0", "::"):
+            return source_address
+        return socket.gethostname()
+
+    def _key(service_id, scope, account=None):
+        if scope == PacingScope.SourceAddress:
+            return "pacing:%s:%s:%s" % (service_id, scope, Pacer._sourceAddress())
+        elif scope == PacingScope.Account:
+            return "pacing:%s:%s:%s" % (service_id, scope, account)
+        return "pacing:%s:%s" % (service_id, scope)
+
+    def _statsKey(service_id, scope, account=None):
+        # Per-account stats would leave a hash behind for every account - those are kept for the service as a whole
+        if scope == PacingScope.Account:
+            return "pacing:%s:%s:stats" % (service_id, scope)
+        return Pacer._key(service_id, scope, account) + ":stats"
+
+    def Reserve(service_id, pacing, account=None):
+        """ Reserves the next request slot - returns how many seconds away it is """
+        keys = []
+        stats_keys = []
+        intervals = []
+        for scope, rate in pacing:
+            if scope == PacingScope.Account and account is None:
+                continue
+            keys.append(Pacer._key(service_id, scope, account))
+            stats_keys.append(Pacer._statsKey(service_id, scope, account))
+            intervals.append(1 / rate)
+        if not keys:
+            return 0
+        if redis is not None:
+            from redis.exceptions import ConnectionError as RedisConnectionError
+            now = time.time()
+            try:
+                if Pacer._reserveScript is None:
+                    Pacer._reserveScript = redis.register_script(_RESERVE_SCRIPT)
+                return float(Pacer._reserveScript(keys=keys + stats_keys, args=["%.6f" % now, Pacer.StatsTTL] + [repr(x) for x in intervals]))
+            except RedisConnectionError:
+                logger.warning("Redis unavailable for %s pacing - pacing within the process" % service_id)
+        now = time.time()
+        with Pacer._localLock:
+            slot = max([now] + [Pacer._localSlots.get(key, now) for key in keys])
+            for key, interval in zip(keys, intervals):
+                Pacer._localSlots[key] = slot + interval
+        return slot - now
+
+    def Wait(service_id, pacing, account=None):
+        wait = Pacer.Reserve(service_id, pacing, account)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def Stats(service_id):
+        """ Requests paced, and the total and longest waits for them, for each of the service's pacing keys (all accounts together) """
+        if redis is None:
+            return {}
+        stats = {}
+        for stats_key in redis.scan_iter(match="pacing:%s:*:stats" % service_id):
+            key = stats_key.decode("utf-8")[:-len(":stats")]
+            raw = dict((k.decode("utf-8"), float(v)) for k, v in redis.hgetall(stats_key).items())
+            stats[key] = {"Requests": int(raw.get("Requests", 0)), "TotalWait": raw.get("TotalWait", 0), "MaxWait": raw.get("MaxWait", 0)}
+            stats[key]["AverageWait"] = stats[key]["TotalWait"] / stats[key]["Requests"] if stats[key]["Requests"] else 0
+        return stats
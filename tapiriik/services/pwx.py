@@ -260,7 +260,7 @@ class PWXIO:
             xsegment = etree.SubElement(xworkout, "segment")
             _writeSummaryData(xsegment, lap, time_ref=activity.StartTime)
 
-        for wp in activity.GetFlatWaypoints():
+        for wp in activity.ReadFlatWaypoints():
             xsample = etree.SubElement(xworkout, "sample")
             etree.SubElement(xsample, "timeoffset").text = str((wp.Timestamp - activity.StartTime).total_seconds())
 
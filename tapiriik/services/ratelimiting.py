@@ -1,31 +1,119 @@
-from tapiriik.database import ratelimit as rl_db
-from tapiriik.settings import TOTAL_SYNC_WORKERS
+from tapiriik.database import ratelimit as rl_db, redis
+from tapiriik.settings import TOTAL_SYNC_WORKERS, RATE_LIMIT_BURST
 from pymongo.read_preferences import ReadPreference
 from datetime import datetime, timedelta
+import logging
 import math
 import time
 
+logger = logging.getLogger(__name__)
+
 class RateLimitExceededException(Exception):
-	pass
+	def __init__(self, retry_after=None):
+		Exception.__init__(self, "Rate limit exceeded" + (" - retry after %.1fs" % retry_after if retry_after is not None else ""))
+		self.RetryAfter = retry_after
+
+# One token bucket per limit, all checked and drawn from together.
+# KEYS are the buckets; ARGV is the tokens wanted, the current time, then the capacity and refill rate (per second) of each bucket.
+# Returns 0 if the tokens were taken, otherwise how many seconds until they'd all be available - as a string, since Lua numbers come back truncated.
+_TOKEN_BUCKET_SCRIPT = """
+local requested = tonumber(ARGV[1])
+local now = tonumber(ARGV[2])
+local levels = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+	local capacity = tonumber(ARGV[i * 2 + 1])
+	local rate = tonumber(ARGV[i * 2 + 2])
+	local state = redis.call("HMGET", key, "tokens", "ts")
+	local tokens = tonumber(state[1])
+	if tokens == nil then
+		tokens = capacity
+	else
+		tokens = math.min(capacity, tokens + math.max(0, now - tonumber(state[2])) * rate)
+	end
+	levels[i] = tokens
+	if tokens < requested then
+		wait = math.max(wait, (requested - tokens) / rate)
+	end
+end
+if wait > 0 then
+	return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+	local capacity = tonumber(ARGV[i * 2 + 1])
+	local rate = tonumber(ARGV[i * 2 + 2])
+	redis.call("HMSET", key, "tokens", tostring(levels[i] - requested), "ts", tostring(now))
+	redis.call("EXPIRE", key, math.ceil(capacity / rate) + 1)
+end
+return "0"
+"""
 
 class RateLimit:
-	def Limit(key, preemptive_sleep_limits=()):
+	_tokenBucketScript = None
+
+	def Limit(key, limits=(), tokens=1, max_wait=0):
+		""" Takes tokens from each of the limits ([(timespan, max-count),...]) on key, waiting up to max_wait seconds for them.
+			Raises RateLimitExceededException (with the RetryAfter it would have taken) if they can't be had in time.
+			Uses token buckets in Redis, or the windows in the ratelimit database (kept by ratelimit_cron.py) without it.
+		"""
+		if not limits:
+			return
+		if redis is not None:
+			from redis.exceptions import ConnectionError as RedisConnectionError
+			try:
+				return RateLimit._limitTokenBucket(key, limits, tokens, max_wait)
+			except RedisConnectionError:
+				logger.warning("Redis unavailable for %s rate limit - falling back to the ratelimit database" % key)
+		RateLimit._limitWindows(key, limits if max_wait else (), tokens)
+
+	def _bucketParameters(timespan, count):
+		# A full bucket's burst on top of a window's refill mustn't top count, wherever the window falls
+		capacity = max(1, math.floor(count * RATE_LIMIT_BURST))
+		rate = max(count - capacity, 1) / timespan.total_seconds()
+		return capacity, rate
+
+	def Acquire(key, limits, tokens=1):
+		""" Tries to take tokens from each of the limits at once - returns 0 if they were taken, otherwise the seconds until they could be """
+		if RateLimit._tokenBucketScript is None:
+			RateLimit._tokenBucketScript = redis.register_script(_TOKEN_BUCKET_SCRIPT)
+		keys = []
+		args = [tokens, "%.6f" % time.time()]
+		for timespan, count in limits:
+			capacity, rate = RateLimit._bucketParameters(timespan, count)
+			if tokens > capacity:
+				raise ValueError("Can't take %d tokens at once from %s's %s limit" % (tokens, key, timespan))
+			keys.append("ratelimit:%s:%d" % (key, timespan.total_seconds()))
+			args += [capacity, repr(rate)]
+		return float(RateLimit._tokenBucketScript(keys=keys, args=args))
+
+	def _limitTokenBucket(key, limits, tokens, max_wait):
+		deadline = time.time() + max_wait
+		while True:
+			retry_after = RateLimit.Acquire(key, limits, tokens)
+			if not retry_after:
+				return
+			if time.time() + retry_after > deadline:
+				raise RateLimitExceededException(retry_after)
+			time.sleep(retry_after)
+
+	def _limitWindows(key, preemptive_sleep_limits, tokens):
 		preemptive_sleep = 0
 		for timespan, count in preemptive_sleep_limits:
 			preemptive_sleep = max(preemptive_sleep, timespan.total_seconds() / (count / TOTAL_SYNC_WORKERS))
 
-		time.sleep(preemptive_sleep)
+		time.sleep(preemptive_sleep * tokens)
 
-		current_limits = rl_db.limits.find({"Key": key}, {"Max": 1, "Count": 1})
+		current_limits = rl_db.limits.find({"Key": key}, {"Max": 1, "Count": 1, "Expires": 1})
 		for limit in current_limits:
-			if limit["Max"] < limit["Count"]:
+			if limit["Max"] < limit["Count"] + tokens - 1:
 				# We can't continue without exceeding this limit
 				# Don't want to halt the synchronization worker to wait for 15min-1 hour
 				# So...
-				raise RateLimitExceededException()
-		rl_db.limits.update({"Key": key}, {"$inc": {"Count": 1}}, multi=True)
+				raise RateLimitExceededException(max(0, (limit["Expires"] - datetime.utcnow()).total_seconds()))
+		rl_db.limits.update({"Key": key}, {"$inc": {"Count": tokens}}, multi=True)
 
 	def Refresh(key, limits):
+		# Only the ratelimit database fallback (used without Redis) needs this
 		# Limits is in format [(timespan, max-count),...]
 		# The windows are anchored at midnight
 		# The timespan is used to uniquely identify limit instances between runs
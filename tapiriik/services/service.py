@@ -1,7 +1,57 @@
-from tapiriik.services import *
 from .service_record import ServiceRecord
 from tapiriik.database import db, cachedb
 from bson.objectid import ObjectId
+import importlib
+import threading
+
+# Services are only imported (and instantiated) once they're asked for, so the workers and scripts that only deal with a few of them
+# don't have to load them all - in the order they're listed: (ID, module, class)
+_serviceModules = (
+    ("runkeeper", "tapiriik.services.RunKeeper", "RunKeeperService"),
+    ("strava", "tapiriik.services.Strava", "StravaService"),
+    ("garminconnect", "tapiriik.services.GarminConnect", "GarminConnectService"),
+    ("endomondo", "tapiriik.services.Endomondo", "EndomondoService"),
+    ("sporttracks", "tapiriik.services.SportTracks", "SportTracksService"),
+    ("dropbox", "tapiriik.services.Dropbox", "DropboxService"),
+    ("trainingpeaks", "tapiriik.services.TrainingPeaks", "TrainingPeaksService"),
+    ("rwgps", "tapiriik.services.RideWithGPS", "RideWithGPSService"),
+    ("trainasone", "tapiriik.services.TrainAsONE", "TrainAsONEService"),
+    ("pulsstory", "tapiriik.services.Pulsstory", "PulsstoryService"),
+    ("motivato", "tapiriik.services.Motivato", "MotivatoService"),
+    ("nikeplus", "tapiriik.services.NikePlus", "NikePlusService"),
+    ("velohero", "tapiriik.services.VeloHero", "VeloHeroService"),
+    ("trainerroad", "tapiriik.services.TrainerRoad", "TrainerRoadService"),
+    ("smashrun", "tapiriik.services.Smashrun", "SmashrunService"),
+    ("beginnertriathlete", "tapiriik.services.BeginnerTriathlete", "BeginnerTriathleteService"),
+    ("setio", "tapiriik.services.Setio", "SetioService"),
+    ("singletracker", "tapiriik.services.Singletracker", "SingletrackerService"),
+    ("aerobia", "tapiriik.services.Aerobia", "AerobiaService"),
+)
+
+# Ideally, we'd make an informed decision based on whatever features the activity had
+# ...but that would require either a) downloading it from evry service or b) storing a lot more activity metadata
+# So, I think this will do for now
+_downloadPriority = (
+    "trainerroad", # Special case, since TR has a lot more data in some very specific areas
+    "garminconnect", # The reference
+    "smashrun",  # TODO: not sure if this is the right place, but it seems to have a lot of data
+    "sporttracks", # Pretty much equivalent to GC, no temperature (not that GC temperature works all thar well now, but I digress)
+    "trainingpeaks", # No seperate run cadence, but has temperature
+    "dropbox", # Equivalent to any of the above
+    "rwgps", # Uses TCX for everything, so same as Dropbox
+    "trainasone",
+    "velohero", # PWX export, no temperature
+    "strava", # No laps
+    "endomondo", # No laps, no cadence
+    "runkeeper", # No laps, no cadence, no power
+    "beginnertriathlete", # No temperature
+    "motivato",
+    "nikeplus",
+    "pulsstory",
+    "setio",
+    "singletracker",
+    "aerobia"
+)
 
 # Really don't know why I didn't make most of this part of the ServiceBase.
 class Service:
@@ -13,69 +63,70 @@ class Service:
         "auto_pause": False
     }
 
+    _serviceModuleMap = {x[0]: x[1:] for x in _serviceModules}
+    _loadLock = threading.RLock()
+
     def Init():
-        Service._serviceMappings = {x.ID: x for x in Service.List()}
-        for svc in Service.List():
-            if svc.IDAliases:
-                Service._serviceMappings.update({x: svc for x in svc.IDAliases})
+        Service._serviceMappings = {}
+        Service._privateServices = None
+        Service._list = None
+        Service._downloadPriorityList = None
+        Service._downloadPriorityRanks = None
+
+    def _register(svc):
+        Service._serviceMappings[svc.ID] = svc
+        if svc.IDAliases:
+            Service._serviceMappings.update({x: svc for x in svc.IDAliases})
+
+    def _loadPrivateServices():
+        with Service._loadLock:
+            if Service._privateServices is None:
+                try:
+                    from private.tapiriik.services import PRIVATE_SERVICES
+                except ImportError:
+                    PRIVATE_SERVICES = []
+                for svc in PRIVATE_SERVICES:
+                    Service._register(svc)
+                Service._privateServices = tuple(PRIVATE_SERVICES)
+            return Service._privateServices
+
+    def _load(id):
+        with Service._loadLock:
+            if id in Service._serviceMappings:
+                return Service._serviceMappings[id]
+            if id in Service._serviceModuleMap:
+                module_name, class_name = Service._serviceModuleMap[id]
+                svc = getattr(importlib.import_module(module_name), class_name)()
+                Service._register(svc)
+                return svc
+            # Could be a private service, or an alias - nothing for it but to load them all
+            Service.List()
+            if id in Service._serviceMappings:
+                return Service._serviceMappings[id]
+            raise ValueError
 
     def FromID(id):
         if id in Service._serviceMappings:
             return Service._serviceMappings[id]
-        raise ValueError
+        return Service._load(id)
 
     def List():
-        private_svc_map = {svc.ID: svc for svc in PRIVATE_SERVICES}
-        svc_list = (
-            private_svc_map.get("garminconnect2"),
-            RunKeeper,
-            Strava,
-            GarminConnect,
-            Endomondo,
-            SportTracks,
-            Dropbox,
-            TrainingPeaks,
-            RideWithGPS,
-            TrainAsONE,
-            Pulsstory,
-            Motivato,
-            NikePlus,
-            VeloHero,
-            TrainerRoad,
-            Smashrun,
-            BeginnerTriathlete,
-            Setio,
-            Singletracker,
-            Aerobia,
-            private_svc_map.get("runsense")
-        )
-        return tuple(x for x in svc_list if x is not None)
+        if Service._list is None:
+            private_svc_map = {svc.ID: svc for svc in Service._loadPrivateServices()}
+            svc_list = (private_svc_map.get("garminconnect2"),) + tuple(Service._load(x[0]) for x in _serviceModules) + (private_svc_map.get("runsense"),)
+            Service._list = tuple(x for x in svc_list if x is not None)
+        return Service._list
 
     def PreferredDownloadPriorityList():
-        # Ideally, we'd make an informed decision based on whatever features the activity had
-        # ...but that would require either a) downloading it from evry service or b) storing a lot more activity metadata
-        # So, I think this will do for now
-        return [
-            TrainerRoad, # Special case, since TR has a lot more data in some very specific areas
-            GarminConnect, # The reference
-            Smashrun,  # TODO: not sure if this is the right place, but it seems to have a lot of data
-            SportTracks, # Pretty much equivalent to GC, no temperature (not that GC temperature works all thar well now, but I digress)
-            TrainingPeaks, # No seperate run cadence, but has temperature
-            Dropbox, # Equivalent to any of the above
-            RideWithGPS, # Uses TCX for everything, so same as Dropbox
-            TrainAsONE,
-            VeloHero, # PWX export, no temperature
-            Strava, # No laps
-            Endomondo, # No laps, no cadence
-            RunKeeper, # No laps, no cadence, no power
-            BeginnerTriathlete, # No temperature
-            Motivato,
-            NikePlus,
-            Pulsstory,
-            Setio,
-            Singletracker,
-            Aerobia
-        ] + PRIVATE_SERVICES
+        if Service._downloadPriorityList is None:
+            Service._downloadPriorityList = tuple(Service.FromID(x) for x in _downloadPriority) + Service._loadPrivateServices()
+        return Service._downloadPriorityList
+
+    def PreferredDownloadPriorityRanks():
+        """ Service ID -> rank in PreferredDownloadPriorityList, best first """
+        if Service._downloadPriorityRanks is None:
+            Service._downloadPriorityRanks = {svc.ID: idx for idx, svc in enumerate(Service.PreferredDownloadPriorityList())}
+        return Service._downloadPriorityRanks
 
     def WebInit():
         from tapiriik.settings import WEB_ROOT
@@ -98,7 +149,7 @@ class Service:
         # Should really figure out how to mangle pymongo into doing the serialization for me...
         extendedAuthDetailsForStorage = CredentialStore.FlattenShadowedCredentials(extendedAuthDetails) if extendedAuthDetails else None
         if serviceRecord is None:
-            db.connections.insert({"ExternalID": uid, "Service": service.ID, "SynchronizedActivities": [], "Authorization": authDetails, "ExtendedAuthorization": extendedAuthDetailsForStorage if persistExtendedAuthDetails else None})
+            db.connections.insert({"ExternalID": uid, "Service": service.ID, "Authorization": authDetails, "ExtendedAuthorization": extendedAuthDetailsForStorage if persistExtendedAuthDetails else None})
             serviceRecord = ServiceRecord(db.connections.find_one({"ExternalID": uid, "Service": service.ID}))
             serviceRecord.ExtendedAuthorization = extendedAuthDetails # So SubscribeToPartialSyncTrigger can use it (we don't save the whole record after this point)
             if service.PartialSyncTriggerRequiresPolling:
@@ -136,5 +187,6 @@ class Service:
         svc.RevokeAuthorization(serviceRecord)
         cachedb.extendedAuthDetails.remove({"ID": serviceRecord._id})
         db.connections.remove({"_id": serviceRecord._id})
+        db.synchronized_activities.remove({"Connection": serviceRecord._id})
 
 Service.Init()
@@ -1,4 +1,7 @@
 from tapiriik.services.ratelimiting import RateLimit, RateLimitExceededException
+from tapiriik.services.pacing import Pacer
+from tapiriik.services.http_sessions import HTTPSessions
+from tapiriik.settings import RATE_LIMIT_MAX_WAIT
 from tapiriik.services.api import ServiceException, UserExceptionType, UserException
 
 class ServiceAuthenticationType:
@@ -69,8 +72,15 @@ class ServiceBase:
     # Global rate limiting options
     # For when there's a limit on the API key itself
     GlobalRateLimits = []
-    # Preemptively sleep to avoid hitting the limits
+    # Wait (up to RATE_LIMIT_MAX_WAIT) for the limits to allow a call, rather than failing straight away
     GlobalRateLimitsPreemptiveSleep = False
+    # Minimum spacing of requests, shared by every worker - [(PacingScope, requests per second),...]
+    # Services call _pace before each request
+    RequestPacing = []
+
+    # How many of this service's downloads/uploads a single sync may have in flight at once (see SYNC_PIPELINE_WORKERS)
+    # Calls are otherwise paced by RequestPacing/GlobalRateLimits as usual, so only raise this if the API tolerates parallel requests
+    PipelineConcurrency = 1
 
     @property
     def PartialSyncTriggerRequiresPolling(self):
@@ -153,9 +163,24 @@ class ServiceBase:
     def ConfigurationUpdating(self, serviceRecord, newConfig, oldConfig):
         pass
 
+    @property
+    def _http(self):
+        """ A keep-alive session shared by all this service's requests - it doesn't keep cookies """
+        return HTTPSessions.Get(self.ID)
+
+    def _newSession(self):
+        """ A session of its own, for requests that need cookies, on the same connections as _http """
+        return HTTPSessions.New(self.ID)
+
+    def _pace(self, serviceRecord=None):
+        account = None
+        if serviceRecord:
+            account = serviceRecord.ExternalID or serviceRecord._id
+        return Pacer.Wait(self.ID, self.RequestPacing, account=account)
+
     def _globalRateLimit(self):
         try:
-            RateLimit.Limit(self.ID, self.GlobalRateLimits if self.GlobalRateLimitsPreemptiveSleep else ())
-        except RateLimitExceededException:
-            raise ServiceException("Global rate limit reached", user_exception=UserException(UserExceptionType.RateLimited))
+            RateLimit.Limit(self.ID, self.GlobalRateLimits, max_wait=RATE_LIMIT_MAX_WAIT if self.GlobalRateLimitsPreemptiveSleep else 0)
+        except RateLimitExceededException as e:
+            raise ServiceException("Global rate limit reached (retry after %ds)" % e.RetryAfter, user_exception=UserException(UserExceptionType.RateLimited))
 
@@ -1,104 +1,311 @@
 from datetime import timedelta
-from .interchange import WaypointType
+from array import array
+from .interchange import WaypointType, WaypointColumns, ActivityStatistics
+import itertools
+import math
+
+class WaypointArrays:
+    """ An activity's waypoints flattened into one set of columns (as in WaypointColumns - missing values are NaN), with the index
+        range each lap covers. Laps already stored as WaypointColumns are copied over column by column, without decoding anything.
+    """
+    Columns = ("Latitude", "Longitude", "Altitude", "HR", "Cadence", "RunCadence", "Power", "Speed")
+
+    def __init__(self, act):
+        self.Timestamps = array("q")
+        self.Types = array("b")
+        self.HasLocation = array("b")
+        for name in WaypointArrays.Columns:
+            setattr(self, name, array("d"))
+        self.LapRanges = []
+        self._aware = None
+        for lap in act.Laps:
+            start = len(self.Timestamps)
+            if isinstance(lap.Waypoints, WaypointColumns):
+                if lap.Waypoints.Aware is not None:
+                    if self._aware is not None and lap.Waypoints.Aware != self._aware:
+                        raise TypeError("can't compare offset-naive and offset-aware timestamps")
+                    self._aware = lap.Waypoints.Aware
+                self.Timestamps.extend(lap.Waypoints.Timestamps)
+                self.Types.extend(lap.Waypoints.Types)
+                self.HasLocation.extend(lap.Waypoints.HasLocation)
+                for name in WaypointArrays.Columns:
+                    getattr(self, name).extend(getattr(lap.Waypoints, name))
+            else:
+                self._extend(lap.Waypoints)
+            self.LapRanges.append((start, len(self.Timestamps)))
+
+    def _extend(self, waypoints):
+        nan = float("nan")
+        naive_epoch, utc_epoch = WaypointColumns._epoch, WaypointColumns._utcEpoch
+        timestamps, types, has_location = self.Timestamps, self.Types, self.HasLocation
+        latitudes, longitudes, altitudes = self.Latitude, self.Longitude, self.Altitude
+        hrs, cadences, run_cadences, powers, speeds = self.HR, self.Cadence, self.RunCadence, self.Power, self.Speed
+        for wp in waypoints:
+            timestamp = wp.Timestamp
+            if timestamp is None:
+                timestamps.append(-2 ** 63)
+            else:
+                # Encoded as WaypointColumns would - though mixing naive and aware timestamps is as much an error as ever
+                aware = timestamp.tzinfo is not None
+                if self._aware is None:
+                    self._aware = aware
+                elif aware != self._aware:
+                    raise TypeError("can't compare offset-naive and offset-aware timestamps")
+                delta = timestamp - (utc_epoch if aware else naive_epoch)
+                timestamps.append((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+            types.append(wp.Type)
+            loc = wp.Location
+            if loc is None:
+                has_location.append(0)
+                latitudes.append(nan)
+                longitudes.append(nan)
+                altitudes.append(nan)
+            else:
+                has_location.append(1)
+                latitudes.append(nan if loc.Latitude is None else loc.Latitude)
+                longitudes.append(nan if loc.Longitude is None else loc.Longitude)
+                altitudes.append(nan if loc.Altitude is None else loc.Altitude)
+            hrs.append(nan if wp.HR is None else wp.HR)
+            cadences.append(nan if wp.Cadence is None else wp.Cadence)
+            run_cadences.append(nan if wp.RunCadence is None else wp.RunCadence)
+            powers.append(nan if wp.Power is None else wp.Power)
+            speeds.append(nan if wp.Speed is None else wp.Speed)
+
+    def __len__(self):
+        return len(self.Timestamps)
+
+def _averageMax(values, skip_zero=False):
+    values = [x for x in values if x == x and (x or not skip_zero)]
+    if not values:
+        return None, None
+    return sum(values) / len(values), max(values)
+
+def _segmentDistance(last_lat, last_lon, lat, lon, dz):
+    # As the crow flies, in meters, with the length of a degree taken at the second point's latitude - dz is the change in altitude
+    lat_rads = lat * math.pi / 180
+    meters_lat_degree = 1000 * 111.13292 + 1.175 * math.cos(4 * lat_rads) - 559.82 * math.cos(2 * lat_rads)
+    meters_lon_degree = 1000 * 111.41284 * math.cos(lat_rads) - 93.5 * math.cos(3 * lat_rads)
+    dx = (lon - last_lon) * meters_lon_degree
+    dy = (lat - last_lat) * meters_lat_degree
+    return math.sqrt(dx ** 2 + dy ** 2 + dz ** 2)
 
 class ActivityStatisticCalculator:
     ImplicitPauseTime = timedelta(minutes=1, seconds=5)
+    # Slower than this between two points (m/s), and we count it as standing still
+    MovingSpeedThreshold = 0.5
 
-    def CalculateDistance(act, startWpt=None, endWpt=None):
-        import math
-        dist = 0
-        altHold = None  # seperate from the lastLoc variable, since we want to hold the altitude as long as required
-        lastTimestamp = lastLoc = None
+    def Calculate(act, start=None, end=None, waypoints=None):
+        """ Works out the statistics for the activity's waypoints from start up to end (indexes into the flattened waypoints,
+            as in ReadFlatWaypoints) in a single pass:
+            - distance (ignoring pauses, explicit or implicit)
+            - timer time (time between waypoints, less pauses) and moving time (the part of that spent moving)
+            - elevation min/max/gain/loss
+            - HR (zero readings excluded), cadence, run cadence, power and speed avg/max
+            Pass in WaypointArrays to reuse them between calls.
+        """
+        waypoints = waypoints if waypoints is not None else WaypointArrays(act)
+        start = 0 if start is None else start
+        end = len(waypoints) if end is None else end
 
-        flatWaypoints = act.GetFlatWaypoints()
+        timestamps = waypoints.Timestamps
+        types = waypoints.Types
+        has_location = waypoints.HasLocation
+        latitudes = waypoints.Latitude
+        longitudes = waypoints.Longitude
+        altitudes = waypoints.Altitude
+        pause_type = WaypointType.Pause
+        implicit_pause = ActivityStatisticCalculator.ImplicitPauseTime.total_seconds() * 1000000
+        moving_threshold = ActivityStatisticCalculator.MovingSpeedThreshold
+        segment_distance = _segmentDistance
+        no_timestamp = -2 ** 63
 
-        if not startWpt:
-            startWpt = flatWaypoints[0]
-        if not endWpt:
-            endWpt = flatWaypoints[-1]
+        distance = 0
+        located = False # Whether there's been a location to measure distance from
+        timer_time = moving_time = 0
+        timed = False # Whether there have been two timestamps to measure time between
+        timer_last = last_timestamp = None
+        last_lat = last_lon = last_alt = last_loc_timestamp = alt_hold = None
+        gain = loss = 0
+        min_elevation = max_elevation = last_elevation = None
 
-        for x in range(flatWaypoints.index(startWpt), flatWaypoints.index(endWpt) + 1):
-            timeDelta = flatWaypoints[x].Timestamp - lastTimestamp if lastTimestamp else None
-            lastTimestamp = flatWaypoints[x].Timestamp
+        for x in range(start, end):
+            timestamp = timestamps[x]
+            if timestamp == no_timestamp:
+                timestamp = None
+            pt_type = types[x]
 
-            if flatWaypoints[x].Type == WaypointType.Pause or (timeDelta and timeDelta > ActivityStatisticCalculator.ImplicitPauseTime):
-                lastLoc = None  # don't count distance while paused
-                continue
+            # Timer time - the time to each waypoint from the last, unless there's been a pause since
+            delta = timestamp - timer_last if timer_last is not None and timestamp is not None else None
+            timer_last = timestamp
+            if delta is not None:
+                timed = True
+            if pt_type == pause_type:
+                timer_last = None
+            elif delta and delta > implicit_pause:
+                delta = None  # Implicit pauses
+            if delta:
+                timer_time += delta
 
-            loc = flatWaypoints[x].Location
-            if loc is None or loc.Longitude is None or loc.Latitude is None:
-                # Used to throw an exception in this case, but the TCX schema allows for location-free waypoints, so we'll just patch over it.
-                continue
+            # Distance - as the crow flies between located waypoints, with altitude held over those that don't have one
+            gap = timestamp - last_timestamp if last_timestamp is not None and timestamp is not None else None
+            last_timestamp = timestamp
+            lat = latitudes[x]
+            lon = longitudes[x]
+            alt = altitudes[x]
+            if pt_type == pause_type or (gap and gap > implicit_pause):
+                located = False  # don't count distance while paused
+            elif has_location[x] and lat == lat and lon == lon:
+                # (the TCX schema allows for location-free waypoints, so those are just skipped over)
+                if located:
+                    alt_hold = last_alt if last_alt == last_alt else alt_hold
+                    dz = alt - alt_hold if alt == alt and alt_hold is not None else 0 # incorporate the altitude when possible
+                    segment = segment_distance(last_lat, last_lon, lat, lon, dz)
+                    distance += segment
+                    if timestamp is not None and last_loc_timestamp is not None and timestamp > last_loc_timestamp:
+                        elapsed = timestamp - last_loc_timestamp
+                        if segment / (elapsed / 1000000) >= moving_threshold:
+                            moving_time += elapsed
+                located = True
+                last_lat = lat
+                last_lon = lon
+                last_alt = alt
+                last_loc_timestamp = timestamp
 
-            if loc and lastLoc:
-                altHold = lastLoc.Altitude if lastLoc.Altitude is not None else altHold
-                latRads = loc.Latitude * math.pi / 180
-                meters_lat_degree = 1000 * 111.13292 + 1.175 * math.cos(4 * latRads) - 559.82 * math.cos(2 * latRads)
-                meters_lon_degree = 1000 * 111.41284 * math.cos(latRads) - 93.5 * math.cos(3 * latRads)
-                dx = (loc.Longitude - lastLoc.Longitude) * meters_lon_degree
-                dy = (loc.Latitude - lastLoc.Latitude) * meters_lat_degree
-                if loc.Altitude is not None and altHold is not None:  # incorporate the altitude when possible
-                    dz = loc.Altitude - altHold
+            # Elevation - across pauses too, since the climb still happened
+            if has_location[x] and alt == alt:
+                if last_elevation is not None:
+                    if alt > last_elevation:
+                        gain += alt - last_elevation
+                    else:
+                        loss += last_elevation - alt
                 else:
-                    dz = 0
-                dist += math.sqrt(dx ** 2 + dy ** 2 + dz ** 2)
-            lastLoc = loc
+                    min_elevation = max_elevation = alt
+                min_elevation = min(min_elevation, alt)
+                max_elevation = max(max_elevation, alt)
+                last_elevation = alt
 
-        return dist
+        avg_hr, max_hr = _averageMax(waypoints.HR[start:end], skip_zero=True)
+        avg_cadence, max_cadence = _averageMax(waypoints.Cadence[start:end])
+        avg_run_cadence, max_run_cadence = _averageMax(waypoints.RunCadence[start:end])
+        avg_power, max_power = _averageMax(waypoints.Power[start:end])
+        avg_speed, max_speed = _averageMax(waypoints.Speed[start:end])
 
-    def CalculateTimerTime(act, startWpt=None, endWpt=None):
-        flatWaypoints = []
-        for lap in act.Laps:
-            flatWaypoints.append(lap.Waypoints)
+        has_distance = last_lat is not None
+        if has_distance and moving_time:
+            avg_speed = distance / (moving_time / 1000000)
+        return ActivityStatistics(distance=distance if has_distance else None,
+                                  timer_time=timer_time / 1000000 if timed else None,
+                                  moving_time=moving_time / 1000000 if has_distance and timed else None,
+                                  avg_speed=avg_speed * 3.6 if avg_speed is not None else None,
+                                  max_speed=max_speed * 3.6 if max_speed is not None else None,
+                                  max_elevation=max_elevation,
+                                  min_elevation=min_elevation,
+                                  gained_elevation=gain if last_elevation is not None else None,
+                                  lost_elevation=loss if last_elevation is not None else None,
+                                  avg_hr=avg_hr, max_hr=max_hr,
+                                  avg_cadence=avg_cadence, max_cadence=max_cadence,
+                                  avg_run_cadence=avg_run_cadence, max_run_cadence=max_run_cadence,
+                                  avg_power=avg_power, max_power=max_power)
+
+    def CalculateLaps(act):
+        """ Statistics for each of the activity's laps, from its own waypoints (so no distance or time is counted between laps) """
+        waypoints = WaypointArrays(act)
+        return [ActivityStatisticCalculator.Calculate(act, start, end, waypoints=waypoints) for start, end in waypoints.LapRanges]
+
+    def _range(act, startWpt, endWpt):
+        # The waypoints are located by value, as ReadFlatWaypoints hands out copies
+        if not startWpt and not endWpt:
+            return None, None
+        flatWaypoints = act.ReadFlatWaypoints()
+        start = flatWaypoints.index(startWpt) if startWpt else None
+        end = flatWaypoints.index(endWpt) + 1 if endWpt else None
+        return start, end
 
-        if len(flatWaypoints) < 3:
+    def _columnDistance(waypoints, start, end):
+        # Calculate's distance, and nothing else
+        timestamps = waypoints.Timestamps
+        types = waypoints.Types
+        has_location = waypoints.HasLocation
+        latitudes = waypoints.Latitude
+        longitudes = waypoints.Longitude
+        altitudes = waypoints.Altitude
+        pause_type = WaypointType.Pause
+        implicit_pause = ActivityStatisticCalculator.ImplicitPauseTime.total_seconds() * 1000000
+        segment_distance = _segmentDistance
+        no_timestamp = -2 ** 63
+
+        distance = 0
+        located = False
+        last_timestamp = last_lat = last_lon = last_alt = alt_hold = None
+        for x in range(start, end):
+            timestamp = timestamps[x]
+            if timestamp == no_timestamp:
+                timestamp = None
+            gap = timestamp - last_timestamp if last_timestamp is not None and timestamp is not None else None
+            last_timestamp = timestamp
+            if types[x] == pause_type or (gap and gap > implicit_pause):
+                located = False
+                continue
+            lat = latitudes[x]
+            lon = longitudes[x]
+            if not has_location[x] or lat != lat or lon != lon:
+                continue
+            alt = altitudes[x]
+            if located:
+                alt_hold = last_alt if last_alt == last_alt else alt_hold
+                dz = alt - alt_hold if alt == alt and alt_hold is not None else 0
+                distance += segment_distance(last_lat, last_lon, lat, lon, dz)
+            located = True
+            last_lat = lat
+            last_lon = lon
+            last_alt = alt
+        return distance
+
+    def _waypointDistance(waypoints):
+        # The same again, straight off the waypoints - for list laps, that's quicker than flattening them into WaypointArrays first
+        pause_type = WaypointType.Pause
+        implicit_pause = ActivityStatisticCalculator.ImplicitPauseTime
+        segment_distance = _segmentDistance
+
+        distance = 0
+        last_timestamp = last_loc = alt_hold = None
+        for wp in waypoints:
+            timestamp = wp.Timestamp
+            gap = timestamp - last_timestamp if last_timestamp is not None and timestamp is not None else None
+            last_timestamp = timestamp
+            if wp.Type == pause_type or (gap and gap > implicit_pause):
+                last_loc = None
+                continue
+            loc = wp.Location
+            if loc is None or loc.Latitude is None or loc.Longitude is None:
+                continue
+            if last_loc is not None:
+                alt_hold = last_loc.Altitude if last_loc.Altitude is not None else alt_hold
+                dz = loc.Altitude - alt_hold if loc.Altitude is not None and alt_hold is not None else 0
+                distance += segment_distance(last_loc.Latitude, last_loc.Longitude, loc.Latitude, loc.Longitude, dz)
+            last_loc = loc
+        return distance
+
+    def CalculateDistance(act, startWpt=None, endWpt=None):
+        """ Just the distance Calculate would give - without working out everything else, or copying list laps into WaypointArrays """
+        start, end = ActivityStatisticCalculator._range(act, startWpt, endWpt)
+        if all(isinstance(lap.Waypoints, WaypointColumns) for lap in act.Laps):
+            waypoints = WaypointArrays(act)
+            return ActivityStatisticCalculator._columnDistance(waypoints, start or 0, len(waypoints) if end is None else end)
+        waypoints = itertools.chain.from_iterable(lap.ReadWaypoints() for lap in act.Laps)
+        return ActivityStatisticCalculator._waypointDistance(itertools.islice(waypoints, start, end))
+
+    def CalculateTimerTime(act, startWpt=None, endWpt=None):
+        if act.CountTotalWaypoints() < 3:
             # Either no waypoints, or one at the start and one at the end
             raise ValueError("Not enough waypoints to calculate timer time")
-        duration = timedelta(0)
-        if not startWpt:
-            startWpt = flatWaypoints[0]
-        if not endWpt:
-            endWpt = flatWaypoints[-1]
-        lastTimestamp = None
-        for x in range(flatWaypoints.index(startWpt), flatWaypoints.index(endWpt) + 1):
-            wpt = flatWaypoints[x]
-            delta = wpt.Timestamp - lastTimestamp if lastTimestamp else None
-            lastTimestamp = wpt.Timestamp
-            if wpt.Type is WaypointType.Pause:
-                lastTimestamp = None
-            elif delta and delta > act.ImplicitPauseTime:
-                delta = None  # Implicit pauses
-            if delta:
-                duration += delta
+        start, end = ActivityStatisticCalculator._range(act, startWpt, endWpt)
+        duration = timedelta(seconds=ActivityStatisticCalculator.Calculate(act, start, end).TimerTime.Value or 0)
         if duration.total_seconds() == 0 and startWpt is None and endWpt is None:
             raise ValueError("Zero-duration activity")
         return duration
 
     def CalculateAverageMaxHR(act, startWpt=None, endWpt=None):
-        flatWaypoints = act.GetFlatWaypoints()
-
-        # Python can handle 600+ digit numbers, think it can handle this
-        maxHR = 0
-        cumulHR = 0
-        samples = 0
-
-        if not startWpt:
-            startWpt = flatWaypoints[0]
-        if not endWpt:
-            endWpt = flatWaypoints[-1]
-
-        for x in range(flatWaypoints.index(startWpt), flatWaypoints.index(endWpt) + 1):
-            wpt = flatWaypoints[x]
-            if wpt.HR:
-                if wpt.HR > maxHR:
-                    maxHR = wpt.HR
-                cumulHR += wpt.HR
-                samples += 1
-
-        if not samples:
-            return None, None
-
-        cumulHR = cumulHR / samples
-        return cumulHR, maxHR
-
-
+        start, end = ActivityStatisticCalculator._range(act, startWpt, endWpt)
+        hr = ActivityStatisticCalculator.Calculate(act, start, end).HR
+        return hr.Average, hr.Max
@@ -1,45 +1,79 @@
-class StreamSampler:
-    def SampleWithCallback(callback, streams):
-        """
-            *streams should be a dict in format {"stream1":[(ts1,val1), (ts2, val2)...]...} where ts is a numerical offset from the activity start.
-            Expect callback(time_offset, stream1=value1, stream2=value2) in chronological order. Stream values may be None
-            All samples are represented - none are dropped
-        """
-
-        # Collate the individual streams into discrete waypoints.
-        # There is no global sampling rate - waypoints are created for every new datapoint in any stream (simultaneous datapoints are included in the same waypoint)
-        # Resampling is based on the last known value of the stream - no interpolation or nearest-neighbour.
-
-        streamData = streams
-        streams = list(streams.keys())
-        print("Handling streams %s" % streams)
-
-        stream_indices = dict([(stream, -1) for stream in streams]) # -1 meaning the stream has yet to start
-        stream_lengths = dict([(stream, len(streamData[stream])) for stream in streams])
-
-        currentTimeOffset = 0
-
-        while True:
-            advance_stream = None
-            advance_offset = None
-            for stream in streams:
-                if stream_indices[stream] + 1 == stream_lengths[stream]:
-                    continue # We're at the end - can't advance
-                if advance_offset is None or streamData[stream][stream_indices[stream] + 1][0] - currentTimeOffset < advance_offset:
-                    advance_offset = streamData[stream][stream_indices[stream] + 1][0] - currentTimeOffset
-                    advance_stream = stream
-            if not advance_stream:
-                break # We've hit the end of every stream, stop
-            # Update the current time offset based on the key advancing stream (others may still be behind)
-            currentTimeOffset = streamData[advance_stream][stream_indices[advance_stream] + 1][0]
-            # Advance streams with the current timestamp, including advance_stream
-            for stream in streams:
-                if stream_indices[stream] + 1 == stream_lengths[stream]:
-                    continue # We're at the end - can't advance
-                if streamData[stream][stream_indices[stream] + 1][0] == currentTimeOffset: # Don't need to consider <, as then that stream would be advance_stream
-                    stream_indices[stream] += 1
-            callbackDataArgs = {}
-            for stream in streams:
-                if stream_indices[stream] >= 0:
-                    callbackDataArgs[stream] = streamData[stream][stream_indices[stream]][1]
-            callback(currentTimeOffset, **callbackDataArgs)
+import heapq
+
+class StreamSampler:
+    """
+        Collates individual streams into discrete waypoints.
+        There is no global sampling rate - waypoints are created for every new datapoint in any stream (simultaneous datapoints are included in the same waypoint)
+        Resampling is based on the last known value of the stream - no interpolation or nearest-neighbour.
+
+        streams should be a dict in format {"stream1":[(ts1,val1), (ts2, val2)...]...} where ts is a numerical offset from the activity start.
+        The streams can be any iterables (they're only read through once).
+        All samples are represented - none are dropped
+    """
+
+    def _merge(streams, names):
+        # Yields (offset, values, indices of the streams that advanced) - the lists are reused, so they're only good till the next one
+        iterators = [iter(streams.get(name, ())) for name in names]
+        values = [None] * len(names)
+
+        # Each stream has (at most) its next sample in the heap - (offset, stream index, value)
+        heap = []
+        for idx, iterator in enumerate(iterators):
+            for offset, value in iterator:
+                heap.append((offset, idx, value))
+                break
+        heapq.heapify(heap)
+
+        heappop = heapq.heappop
+        heappush = heapq.heappush
+        advanced = []
+        while heap:
+            # Advance every stream with a sample at the earliest offset
+            offset = heap[0][0]
+            while heap and heap[0][0] == offset:
+                sample = heappop(heap)
+                values[sample[1]] = sample[2]
+                advanced.append(sample[1])
+            yield offset, values, advanced
+            # ...only refilling the heap once they're all out, so a stream with several samples at the one offset gives a waypoint for each
+            for idx in advanced:
+                for next_offset, value in iterators[idx]:
+                    heappush(heap, (next_offset, idx, value))
+                    break
+            del advanced[:]
+
+    def Sample(streams, names=None):
+        """
+            Yields (time_offset, (value1, value2...)) in chronological order, with a value for each of names (by default, the keys of streams, in order).
+            A stream's value is None until it starts - or throughout, if it's named but not in streams.
+        """
+        names = tuple(streams.keys()) if names is None else tuple(names)
+        for offset, values, advanced in StreamSampler._merge(streams, names):
+            yield offset, tuple(values)
+
+    def SampleColumns(streams, names=None):
+        """
+            Returns (offsets, {"stream1": [value1, value2...]...}) - the same samples as Sample, as a column per stream.
+        """
+        names = tuple(streams.keys()) if names is None else tuple(names)
+        offsets = []
+        columns = [[] for name in names]
+        appenders = [column.append for column in columns]
+        for offset, values in StreamSampler.Sample(streams, names):
+            offsets.append(offset)
+            for append, value in zip(appenders, values):
+                append(value)
+        return offsets, dict(zip(names, columns))
+
+    def SampleWithCallback(callback, streams):
+        """
+            Expect callback(time_offset, stream1=value1, stream2=value2) in chronological order. Stream values may be None
+            Streams that have yet to start aren't passed at all.
+        """
+        names = tuple(streams.keys())
+        started = {}
+        for offset, values, advanced in StreamSampler._merge(streams, names):
+            if len(started) < len(names):
+                for idx in advanced:
+                    started[idx] = names[idx]
+            callback(offset, **{name: values[idx] for idx, name in started.items()})
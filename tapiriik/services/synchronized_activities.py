@@ -0,0 +1,47 @@
+from tapiriik.database import db
+from pymongo import UpdateOne
+
+class SynchronizedActivityStore:
+    """ The UIDs of activities known to be present on each connection, one document per (Connection, UID) in synchronized_activities.
+        These used to be kept in a SynchronizedActivities array on the connection itself, which grew until it hit the document
+        size limit - MigrateConnection moves them over (as connections are loaded for sync, or in bulk by synchronized_activities_migrate.py).
+    """
+
+    def EnsureIndexes():
+        db.synchronized_activities.ensure_index([("Connection", 1), ("UID", 1)], unique=True)
+
+    def Lookup(connection_ids, uids):
+        """ Which of these UIDs are already on each of these connections - connection ID -> set of UIDs, in one query """
+        present = dict((x, set()) for x in connection_ids)
+        if not present or not uids:
+            return present
+        for entry in db.synchronized_activities.find({"Connection": {"$in": list(present.keys())}, "UID": {"$in": list(uids)}}, {"Connection": True, "UID": True, "_id": False}):
+            present[entry["Connection"]].add(entry["UID"])
+        return present
+
+    def Operations(connection_id, uids):
+        """ For a bulk_write against synchronized_activities """
+        return [UpdateOne({"Connection": connection_id, "UID": uid}, {"$setOnInsert": {"Connection": connection_id, "UID": uid}}, upsert=True) for uid in uids]
+
+    def Count(connection_id):
+        return db.synchronized_activities.find({"Connection": connection_id}).count()
+
+    def Add(connection_id, uids):
+        operations = SynchronizedActivityStore.Operations(connection_id, uids)
+        if operations:
+            db.synchronized_activities.bulk_write(operations, ordered=False)
+
+    def Clear(connection_id):
+        db.synchronized_activities.delete_many({"Connection": connection_id})
+        db.connections.update({"_id": connection_id}, {"$unset": {"SynchronizedActivities": ""}})
+
+    def MigrateConnection(connection_id, uids):
+        """ Moves UIDs out of the connection's SynchronizedActivities array - safe to repeat, or to race with another migration """
+        if not uids:
+            return 0
+        uids = list(set(uids))
+        SynchronizedActivityStore.Add(connection_id, uids)
+        # Pulling (rather than unsetting) only the UIDs that were moved, in case anything was added in the meantime
+        db.connections.update({"_id": connection_id}, {"$pullAll": {"SynchronizedActivities": uids}})
+        db.connections.update({"_id": connection_id, "SynchronizedActivities": {"$size": 0}}, {"$unset": {"SynchronizedActivities": ""}})
+        return len(uids)
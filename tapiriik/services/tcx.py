@@ -1,10 +1,12 @@
 from lxml import etree
 from pytz import UTC
 import copy
+import io
 import dateutil.parser
 from datetime import timedelta
-from .interchange import WaypointType, Activity, ActivityStatistic, ActivityStatistics, ActivityStatisticUnit, ActivityType, Waypoint, Location, Lap, LapIntensity, LapTriggerMethod
+from .interchange import WaypointType, Activity, ActivityStatistic, ActivityStatistics, ActivityStatisticUnit, ActivityType, Waypoint, WaypointColumns, Location, Lap, LapIntensity, LapTriggerMethod
 from .devices import DeviceIdentifier, DeviceIdentifierType, Device
+from tapiriik.settings import WAYPOINT_COLUMNS
 
 
 class TCXIO:
@@ -17,29 +19,7 @@ class TCXIO:
         "xsi": "http://www.w3.org/2001/XMLSchema-instance"
     }
 
-    def Parse(tcxData, act=None):
-        ns = copy.deepcopy(TCXIO.Namespaces)
-        ns["tcx"] = ns[None]
-        del ns[None]
-
-        act = act if act else Activity()
-
-        act.GPS = False
-
-        try:
-            root = etree.XML(tcxData)
-        except:
-            root = etree.fromstring(tcxData)
-
-
-        xacts = root.find("tcx:Activities", namespaces=ns)
-        if xacts is None:
-            raise ValueError("No activities element in TCX")
-
-        xact = xacts.find("tcx:Activity", namespaces=ns)
-        if xact is None:
-            raise ValueError("No activity element in TCX")
-
+    def _parseActivityDetails(xact, act, ns):
         if not act.Type or act.Type == ActivityType.Other:
             if xact.attrib["Sport"] == "Biking":
                 act.Type = ActivityType.Cycling
@@ -64,151 +44,207 @@ class TCXIO:
                 verMin = int(xver.find("tcx:VersionMinor", namespaces=ns).text)
             act.Device = Device(devId, int(xcreator.find("tcx:UnitId", namespaces=ns).text), verMaj=verMaj, verMin=verMin) # ID vs Id: ???
 
-        xlaps = xact.findall("tcx:Lap", namespaces=ns)
-        startTime = None
-        endTime = None
-        for xlap in xlaps:
-
-            lap = Lap()
-            act.Laps.append(lap)
-
-            lap.StartTime = dateutil.parser.parse(xlap.attrib["StartTime"])
-            totalTimeEL = xlap.find("tcx:TotalTimeSeconds", namespaces=ns)
-            if totalTimeEL is None:
-                raise ValueError("Missing lap TotalTimeSeconds")
-            lap.Stats.TimerTime = ActivityStatistic(ActivityStatisticUnit.Seconds, float(totalTimeEL.text))
-
-            lap.EndTime = lap.StartTime + timedelta(seconds=float(totalTimeEL.text))
-
-            distEl = xlap.find("tcx:DistanceMeters", namespaces=ns)
-            energyEl = xlap.find("tcx:Calories", namespaces=ns)
-            triggerEl = xlap.find("tcx:TriggerMethod", namespaces=ns)
-            intensityEl = xlap.find("tcx:Intensity", namespaces=ns)
-
-            # Some applications slack off and omit these, despite the fact that they're required in the spec.
-            # I will, however, require lap distance, because, seriously.
-            if distEl is None:
-                raise ValueError("Missing lap DistanceMeters")
-
-            lap.Stats.Distance = ActivityStatistic(ActivityStatisticUnit.Meters, float(distEl.text))
-            if energyEl is not None and energyEl.text:
-                lap.Stats.Energy = ActivityStatistic(ActivityStatisticUnit.Kilocalories, float(energyEl.text))
-                if lap.Stats.Energy.Value == 0:
-                    lap.Stats.Energy.Value = None # It's dumb to make this required, but I digress.
-
-            if intensityEl is not None:
-                lap.Intensity = LapIntensity.Active if intensityEl.text == "Active" else LapIntensity.Rest
-            else:
-                lap.Intensity = LapIntensity.Active
-
-            if triggerEl is not None:
-                lap.Trigger = ({
-                    "Manual": LapTriggerMethod.Manual,
-                    "Distance": LapTriggerMethod.Distance,
-                    "Location": LapTriggerMethod.PositionMarked,
-                    "Time": LapTriggerMethod.Time,
-                    "HeartRate": LapTriggerMethod.Manual # I guess - no equivalent in FIT
-                    })[triggerEl.text]
-            else:
-                lap.Trigger = LapTriggerMethod.Manual # One would presume
-
-            maxSpdEl = xlap.find("tcx:MaximumSpeed", namespaces=ns)
-            if maxSpdEl is not None:
-                lap.Stats.Speed = ActivityStatistic(ActivityStatisticUnit.MetersPerSecond, max=float(maxSpdEl.text))
-
-            avgHREl = xlap.find("tcx:AverageHeartRateBpm", namespaces=ns)
-            if avgHREl is not None:
-                lap.Stats.HR = ActivityStatistic(ActivityStatisticUnit.BeatsPerMinute, avg=float(avgHREl.find("tcx:Value", namespaces=ns).text))
-
-            maxHREl = xlap.find("tcx:MaximumHeartRateBpm", namespaces=ns)
-            if maxHREl is not None:
-                lap.Stats.HR.update(ActivityStatistic(ActivityStatisticUnit.BeatsPerMinute, max=float(maxHREl.find("tcx:Value", namespaces=ns).text)))
-
-            # WF fills these in with invalid values.
-            lap.Stats.HR.Max = lap.Stats.HR.Max if lap.Stats.HR.Max and lap.Stats.HR.Max > 10 else None
-            lap.Stats.HR.Average = lap.Stats.HR.Average if lap.Stats.HR.Average and lap.Stats.HR.Average > 10 else None
-
-            cadEl = xlap.find("tcx:Cadence", namespaces=ns)
-            if cadEl is not None:
-                lap.Stats.Cadence = ActivityStatistic(ActivityStatisticUnit.RevolutionsPerMinute, avg=float(cadEl.text))
-
-            extsEl = xlap.find("tcx:Extensions", namespaces=ns)
-            if extsEl is not None:
-                lxEls = extsEl.findall("tpx:LX", namespaces=ns)
-                for lxEl in lxEls:
-                    avgSpeedEl = lxEl.find("tpx:AvgSpeed", namespaces=ns)
-                    if avgSpeedEl is not None:
-                        lap.Stats.Speed.update(ActivityStatistic(ActivityStatisticUnit.MetersPerSecond, avg=float(avgSpeedEl.text)))
-                    maxBikeCadEl = lxEl.find("tpx:MaxBikeCadence", namespaces=ns)
-                    if maxBikeCadEl is not None:
-                        lap.Stats.Cadence.update(ActivityStatistic(ActivityStatisticUnit.RevolutionsPerMinute, max=float(maxBikeCadEl.text)))
-                    maxPowerEl = lxEl.find("tpx:MaxWatts", namespaces=ns)
-                    if maxPowerEl is not None:
-                        lap.Stats.Power.update(ActivityStatistic(ActivityStatisticUnit.Watts, max=float(maxPowerEl.text)))
-                    avgPowerEl = lxEl.find("tpx:AvgWatts", namespaces=ns)
-                    if avgPowerEl is not None:
-                        lap.Stats.Power.update(ActivityStatistic(ActivityStatisticUnit.Watts, avg=float(avgPowerEl.text)))
-                    maxRunCadEl = lxEl.find("tpx:MaxRunCadence", namespaces=ns)
-                    if maxRunCadEl is not None:
-                        lap.Stats.RunCadence.update(ActivityStatistic(ActivityStatisticUnit.StepsPerMinute, max=float(maxRunCadEl.text)))
-                    avgRunCadEl = lxEl.find("tpx:AvgRunCadence", namespaces=ns)
-                    if avgRunCadEl is not None:
-                        lap.Stats.RunCadence.update(ActivityStatistic(ActivityStatisticUnit.StepsPerMinute, avg=float(avgRunCadEl.text)))
-                    stepsEl = lxEl.find("tpx:Steps", namespaces=ns)
-                    if stepsEl is not None:
-                        lap.Stats.Strides.update(ActivityStatistic(ActivityStatisticUnit.Strides, value=float(stepsEl.text)))
-
-            xtrkseg = xlap.find("tcx:Track", namespaces=ns)
-            if xtrkseg is None:
-                # Some TCX files have laps with no track - not sure if it's valid or not.
-                continue
-            for xtrkpt in xtrkseg.findall("tcx:Trackpoint", namespaces=ns):
-                wp = Waypoint()
-                tsEl = xtrkpt.find("tcx:Time", namespaces=ns)
-                if tsEl is None:
-                    raise ValueError("Trackpoint without timestamp")
-                wp.Timestamp = dateutil.parser.parse(tsEl.text)
-                wp.Timestamp.replace(tzinfo=UTC)
-                if startTime is None or wp.Timestamp < startTime:
-                    startTime = wp.Timestamp
-                if endTime is None or wp.Timestamp > endTime:
-                    endTime = wp.Timestamp
-                xpos = xtrkpt.find("tcx:Position", namespaces=ns)
-                if xpos is not None:
-                    act.GPS = True
-                    wp.Location = Location(float(xpos.find("tcx:LatitudeDegrees", namespaces=ns).text), float(xpos.find("tcx:LongitudeDegrees", namespaces=ns).text), None)
-                eleEl = xtrkpt.find("tcx:AltitudeMeters", namespaces=ns)
-                if eleEl is not None:
-                    wp.Location = wp.Location if wp.Location else Location(None, None, None)
-                    wp.Location.Altitude = float(eleEl.text)
-                distEl = xtrkpt.find("tcx:DistanceMeters", namespaces=ns)
-                if distEl is not None:
-                    wp.Distance = float(distEl.text)
-
-                hrEl = xtrkpt.find("tcx:HeartRateBpm", namespaces=ns)
-                if hrEl is not None:
-                    wp.HR = float(hrEl.find("tcx:Value", namespaces=ns).text)
-                cadEl = xtrkpt.find("tcx:Cadence", namespaces=ns)
-                if cadEl is not None:
-                    wp.Cadence = float(cadEl.text)
-                extsEl = xtrkpt.find("tcx:Extensions", namespaces=ns)
-                if extsEl is not None:
-                    tpxEl = extsEl.find("tpx:TPX", namespaces=ns)
-                    if tpxEl is not None:
-                        powerEl = tpxEl.find("tpx:Watts", namespaces=ns)
-                        if powerEl is not None:
-                            wp.Power = float(powerEl.text)
-                        speedEl = tpxEl.find("tpx:Speed", namespaces=ns)
-                        if speedEl is not None:
-                            wp.Speed = float(speedEl.text)
-                        runCadEl = tpxEl.find("tpx:RunCadence", namespaces=ns)
-                        if runCadEl is not None:
-                            wp.RunCadence = float(runCadEl.text)
-                lap.Waypoints.append(wp)
-                xtrkpt.clear()
-                del xtrkpt
-            if len(lap.Waypoints):
-                lap.EndTime = lap.Waypoints[-1].Timestamp
+
+    def _parseLap(xlap, lap, ns):
+        lap.StartTime = dateutil.parser.parse(xlap.attrib["StartTime"])
+        totalTimeEL = xlap.find("tcx:TotalTimeSeconds", namespaces=ns)
+        if totalTimeEL is None:
+            raise ValueError("Missing lap TotalTimeSeconds")
+        lap.Stats.TimerTime = ActivityStatistic(ActivityStatisticUnit.Seconds, float(totalTimeEL.text))
+
+        lap.EndTime = lap.StartTime + timedelta(seconds=float(totalTimeEL.text))
+
+        distEl = xlap.find("tcx:DistanceMeters", namespaces=ns)
+        energyEl = xlap.find("tcx:Calories", namespaces=ns)
+        triggerEl = xlap.find("tcx:TriggerMethod", namespaces=ns)
+        intensityEl = xlap.find("tcx:Intensity", namespaces=ns)
+
+        # Some applications slack off and omit these, despite the fact that they're required in the spec.
+        # I will, however, require lap distance, because, seriously.
+        if distEl is None:
+            raise ValueError("Missing lap DistanceMeters")
+
+        lap.Stats.Distance = ActivityStatistic(ActivityStatisticUnit.Meters, float(distEl.text))
+        if energyEl is not None and energyEl.text:
+            lap.Stats.Energy = ActivityStatistic(ActivityStatisticUnit.Kilocalories, float(energyEl.text))
+            if lap.Stats.Energy.Value == 0:
+                lap.Stats.Energy.Value = None # It's dumb to make this required, but I digress.
+
+        if intensityEl is not None:
+            lap.Intensity = LapIntensity.Active if intensityEl.text == "Active" else LapIntensity.Rest
+        else:
+            lap.Intensity = LapIntensity.Active
+
+        if triggerEl is not None:
+            lap.Trigger = ({
+                "Manual": LapTriggerMethod.Manual,
+                "Distance": LapTriggerMethod.Distance,
+                "Location": LapTriggerMethod.PositionMarked,
+                "Time": LapTriggerMethod.Time,
+                "HeartRate": LapTriggerMethod.Manual # I guess - no equivalent in FIT
+                })[triggerEl.text]
+        else:
+            lap.Trigger = LapTriggerMethod.Manual # One would presume
+
+        maxSpdEl = xlap.find("tcx:MaximumSpeed", namespaces=ns)
+        if maxSpdEl is not None:
+            lap.Stats.Speed = ActivityStatistic(ActivityStatisticUnit.MetersPerSecond, max=float(maxSpdEl.text))
+
+        avgHREl = xlap.find("tcx:AverageHeartRateBpm", namespaces=ns)
+        if avgHREl is not None:
+            lap.Stats.HR = ActivityStatistic(ActivityStatisticUnit.BeatsPerMinute, avg=float(avgHREl.find("tcx:Value", namespaces=ns).text))
+
+        maxHREl = xlap.find("tcx:MaximumHeartRateBpm", namespaces=ns)
+        if maxHREl is not None:
+            lap.Stats.HR.update(ActivityStatistic(ActivityStatisticUnit.BeatsPerMinute, max=float(maxHREl.find("tcx:Value", namespaces=ns).text)))
+
+        # WF fills these in with invalid values.
+        lap.Stats.HR.Max = lap.Stats.HR.Max if lap.Stats.HR.Max and lap.Stats.HR.Max > 10 else None
+        lap.Stats.HR.Average = lap.Stats.HR.Average if lap.Stats.HR.Average and lap.Stats.HR.Average > 10 else None
+
+        cadEl = xlap.find("tcx:Cadence", namespaces=ns)
+        if cadEl is not None:
+            lap.Stats.Cadence = ActivityStatistic(ActivityStatisticUnit.RevolutionsPerMinute, avg=float(cadEl.text))
+
+        extsEl = xlap.find("tcx:Extensions", namespaces=ns)
+        if extsEl is not None:
+            lxEls = extsEl.findall("tpx:LX", namespaces=ns)
+            for lxEl in lxEls:
+                avgSpeedEl = lxEl.find("tpx:AvgSpeed", namespaces=ns)
+                if avgSpeedEl is not None:
+                    lap.Stats.Speed.update(ActivityStatistic(ActivityStatisticUnit.MetersPerSecond, avg=float(avgSpeedEl.text)))
+                maxBikeCadEl = lxEl.find("tpx:MaxBikeCadence", namespaces=ns)
+                if maxBikeCadEl is not None:
+                    lap.Stats.Cadence.update(ActivityStatistic(ActivityStatisticUnit.RevolutionsPerMinute, max=float(maxBikeCadEl.text)))
+                maxPowerEl = lxEl.find("tpx:MaxWatts", namespaces=ns)
+                if maxPowerEl is not None:
+                    lap.Stats.Power.update(ActivityStatistic(ActivityStatisticUnit.Watts, max=float(maxPowerEl.text)))
+                avgPowerEl = lxEl.find("tpx:AvgWatts", namespaces=ns)
+                if avgPowerEl is not None:
+                    lap.Stats.Power.update(ActivityStatistic(ActivityStatisticUnit.Watts, avg=float(avgPowerEl.text)))
+                maxRunCadEl = lxEl.find("tpx:MaxRunCadence", namespaces=ns)
+                if maxRunCadEl is not None:
+                    lap.Stats.RunCadence.update(ActivityStatistic(ActivityStatisticUnit.StepsPerMinute, max=float(maxRunCadEl.text)))
+                avgRunCadEl = lxEl.find("tpx:AvgRunCadence", namespaces=ns)
+                if avgRunCadEl is not None:
+                    lap.Stats.RunCadence.update(ActivityStatistic(ActivityStatisticUnit.StepsPerMinute, avg=float(avgRunCadEl.text)))
+                stepsEl = lxEl.find("tpx:Steps", namespaces=ns)
+                if stepsEl is not None:
+                    lap.Stats.Strides.update(ActivityStatistic(ActivityStatisticUnit.Strides, value=float(stepsEl.text)))
+
+
+    def _parseTrackpoint(xtrkpt, act):
+        wp = Waypoint()
+        tsEl = xtrkpt.find(_TCX_TAGS["Time"])
+        if tsEl is None:
+            raise ValueError("Trackpoint without timestamp")
+        wp.Timestamp = dateutil.parser.parse(tsEl.text)
+        wp.Timestamp.replace(tzinfo=UTC)
+        xpos = xtrkpt.find(_TCX_TAGS["Position"])
+        if xpos is not None:
+            act.GPS = True
+            wp.Location = Location(float(xpos.find(_TCX_TAGS["LatitudeDegrees"]).text), float(xpos.find(_TCX_TAGS["LongitudeDegrees"]).text), None)
+        eleEl = xtrkpt.find(_TCX_TAGS["AltitudeMeters"])
+        if eleEl is not None:
+            wp.Location = wp.Location if wp.Location else Location(None, None, None)
+            wp.Location.Altitude = float(eleEl.text)
+        distEl = xtrkpt.find(_TCX_TAGS["DistanceMeters"])
+        if distEl is not None:
+            wp.Distance = float(distEl.text)
+
+        hrEl = xtrkpt.find(_TCX_TAGS["HeartRateBpm"])
+        if hrEl is not None:
+            wp.HR = float(hrEl.find(_TCX_TAGS["Value"]).text)
+        cadEl = xtrkpt.find(_TCX_TAGS["Cadence"])
+        if cadEl is not None:
+            wp.Cadence = float(cadEl.text)
+        extsEl = xtrkpt.find(_TCX_TAGS["Extensions"])
+        if extsEl is not None:
+            tpxEl = extsEl.find(_TPX_TAGS["TPX"])
+            if tpxEl is not None:
+                powerEl = tpxEl.find(_TPX_TAGS["Watts"])
+                if powerEl is not None:
+                    wp.Power = float(powerEl.text)
+                speedEl = tpxEl.find(_TPX_TAGS["Speed"])
+                if speedEl is not None:
+                    wp.Speed = float(speedEl.text)
+                runCadEl = tpxEl.find(_TPX_TAGS["RunCadence"])
+                if runCadEl is not None:
+                    wp.RunCadence = float(runCadEl.text)
+        return wp
+
+    def Parse(tcxData, act=None):
+        # Streams through the document, so only the trackpoint being read (and the lap/activity-level elements) are held in memory.
+        # Problems are raised only once the whole document is read, and in the same order a tree walk would find them.
+        ns = copy.deepcopy(TCXIO.Namespaces)
+        ns["tcx"] = ns[None]
+        del ns[None]
+
+        act = act if act else Activity()
+
+        act.GPS = False
+
+        if isinstance(tcxData, str):
+            tcxData = tcxData.encode("utf-8")
+
+        root = xacts = xact = xlap = xtrkseg = lap = None
+        lapErrors = []
+        trackpointError = None
+        for event, el in etree.iterparse(io.BytesIO(tcxData), events=("start", "end"), tag=_STREAMED_TAGS):
+            if root is None:
+                root = el.getroottree().getroot()
+            if event == "start":
+                if el.tag == _TCX_TAGS["Activities"]:
+                    if xacts is None and el.getparent() is root:
+                        xacts = el
+                elif el.tag == _TCX_TAGS["Activity"]:
+                    if xact is None and xacts is not None and el.getparent() is xacts:
+                        xact = el
+                elif el.tag == _TCX_TAGS["Lap"]:
+                    if xact is not None and el.getparent() is xact:
+                        xlap = el
+                        xtrkseg = None
+                        trackpointError = None
+                        lap = Lap(waypointList=WaypointColumns() if WAYPOINT_COLUMNS else None)
+                        act.Laps.append(lap)
+                elif el.tag == _TCX_TAGS["Track"]:
+                    # Only the first track in each lap is read
+                    if xlap is not None and xtrkseg is None and el.getparent() is xlap:
+                        xtrkseg = el
+            elif el.tag == _TCX_TAGS["Trackpoint"]:
+                if xtrkseg is not None and el.getparent() is xtrkseg and not lapErrors and trackpointError is None:
+                    try:
+                        lap.Waypoints.append(TCXIO._parseTrackpoint(el, act))
+                    except Exception as e:
+                        trackpointError = e
+                # Done with it (and whatever came before it)
+                el.clear()
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
+            elif el is xlap:
+                if not lapErrors:
+                    try:
+                        TCXIO._parseLap(xlap, lap, ns)
+                    except Exception as e:
+                        lapErrors.append(e)
+                    else:
+                        if trackpointError is not None:
+                            lapErrors.append(trackpointError)
+                        elif len(lap.Waypoints):
+                            lap.EndTime = lap.Waypoints[-1].Timestamp
+                xlap.clear()
+                xlap = xtrkseg = None
+
+        if xacts is None:
+            raise ValueError("No activities element in TCX")
+
+        if xact is None:
+            raise ValueError("No activity element in TCX")
+
+        TCXIO._parseActivityDetails(xact, act, ns)
+
+        if lapErrors:
+            raise lapErrors[0]
 
         act.StartTime = act.Laps[0].StartTime if len(act.Laps) else act.StartTime
         act.EndTime = act.Laps[-1].EndTime if len(act.Laps) else act.EndTime
@@ -319,7 +355,7 @@ class TCXIO:
         for lap in activity.Laps:
             xlap = xlaps[activity.Laps.index(lap)]
             track = None
-            for wp in lap.Waypoints:
+            for wp in lap.ReadWaypoints():
                 if wp.Type == WaypointType.Pause:
                     if inPause:
                         continue  # this used to be an exception, but I don't think that was merited
@@ -387,3 +423,8 @@ class TCXIO:
 
 
         return etree.tostring(root, pretty_print=True, xml_declaration=True, encoding="UTF-8").decode("UTF-8")
+
+# Fully-qualified tag names for the streaming parser's hot path
+_TCX_TAGS = dict((tag, "{%s}%s" % (TCXIO.Namespaces[None], tag)) for tag in ("Activities", "Activity", "Lap", "Track", "Trackpoint", "AltitudeMeters", "Cadence", "DistanceMeters", "Extensions", "HeartRateBpm", "LatitudeDegrees", "LongitudeDegrees", "Position", "Time", "Value"))
+_TPX_TAGS = dict((tag, "{%s}%s" % (TCXIO.Namespaces["tpx"], tag)) for tag in ("RunCadence", "Speed", "TPX", "Watts"))
+_STREAMED_TAGS = [_TCX_TAGS[tag] for tag in ("Activities", "Activity", "Lap", "Track", "Trackpoint")]
@@ -0,0 +1,147 @@
+from tapiriik.services.interchange import ActivityType
+from datetime import datetime, timedelta
+
+def _us(td):
+    return (td.days * 86400 + td.seconds) * 1000000 + td.microseconds
+
+class _MatcherEntry:
+    __slots__ = ("Activity", "Position", "UID", "Naive", "UTC", "Hourless")
+
+class ActivityMatcher:
+    """ Finds the already-listed activity (if any) that a newly-listed one duplicates.
+
+        This is the same decision _accumulateActivities used to make by scanning a sorted list over a +/-38 hour window,
+        but candidates are pulled from hash buckets on precomputed integer keys (naive/UTC microseconds, and the
+        "hourless" time used for the TZ-error checks), so only a handful of activities are ever compared directly.
+        Candidates are still ordered as they would have been in that sorted list (most recent first, newest insertion
+        first among equal start times), and the final check is the original predicate.
+    """
+    StartLeeway = timedelta(minutes=3)
+    TZOffsetLeeway = timedelta(minutes=1)
+    TimezoneErrorPeriod = timedelta(hours=38)
+
+    _epoch = datetime(1, 1, 1)
+    _startBucketSize = _us(StartLeeway)
+    _hourlessBucketSize = _us(TZOffsetLeeway)
+    _halfHour = _us(timedelta(minutes=30))
+
+    def __init__(self, activities):
+        self.Source = activities
+        self._entries = {}
+        self._uids = {}
+        self._naive = {}
+        self._utc = {}
+        self._hourless = {}
+        self._seq = 0
+        for idx, act in enumerate(activities):
+            self._index(act, idx)
+
+    def _keys(self, act, entry):
+        naive = act.StartTime.replace(tzinfo=None)
+        entry.UID = act.UID
+        entry.Naive = _us(naive - ActivityMatcher._epoch)
+        entry.UTC = entry.Naive - _us(act.StartTime.utcoffset()) if act.StartTime.tzinfo else None
+        entry.Hourless = entry.Naive - naive.hour * 3600 * 1000000
+
+    def _bucket(self, table, key, entry, remove=False):
+        if remove:
+            table[key].remove(entry)
+            if not table[key]:
+                del table[key]
+        else:
+            table.setdefault(key, []).append(entry)
+
+    def _buckets(self, entry, remove=False):
+        self._bucket(self._uids, entry.UID, entry, remove)
+        self._bucket(self._naive, entry.Naive // self._startBucketSize, entry, remove)
+        if entry.UTC is not None:
+            self._bucket(self._utc, entry.UTC // self._startBucketSize, entry, remove)
+        self._bucket(self._hourless, entry.Hourless // self._hourlessBucketSize, entry, remove)
+
+    def _index(self, act, tiebreak):
+        entry = _MatcherEntry()
+        entry.Activity = act
+        self._keys(act, entry)
+        # The position in the equivalent sorted list - it doesn't move if the start time is later changed by a merge.
+        entry.Position = (-entry.Naive, tiebreak)
+        self._entries[id(act)] = entry
+        self._buckets(entry)
+
+    def Add(self, act):
+        # Inserted ahead of activities with identical start times, as bisect.insort_left would have.
+        self._seq += 1
+        self._index(act, -self._seq)
+
+    def Update(self, act):
+        """ Re-keys an activity after its StartTime or UID were changed by merging """
+        entry = self._entries[id(act)]
+        self._buckets(entry, remove=True)
+        self._keys(act, entry)
+        self._buckets(entry)
+
+    def _candidates(self, key, table, bucket_size, offsets=(0,)):
+        for offset in offsets:
+            base = (key + offset) // bucket_size
+            for bucket in (base - 1, base, base + 1):
+                if bucket in table:
+                    yield from table[bucket]
+
+    def _matches(self, act, x):
+        # Verbatim from the original window scan - only the candidate selection has changed.
+        return (
+                    # Identical
+                    x.UID == act.UID
+                    or
+                    # Check to see if the activities are reasonably close together to be considered duplicate
+                    (x.StartTime is not None and
+                     act.StartTime is not None and
+                     (act.StartTime.tzinfo is not None) == (x.StartTime.tzinfo is not None) and
+                     abs(act.StartTime-x.StartTime) < self.StartLeeway
+                    )
+                    or
+                    # Try comparing the time as if it were TZ-aware and in the expected TZ (this won't actually change the value of the times being compared)
+                    (x.StartTime is not None and
+                     act.StartTime is not None and
+                     (act.StartTime.tzinfo is not None) != (x.StartTime.tzinfo is not None) and
+                     abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < self.StartLeeway
+                    )
+                    or
+                    # Same mm:ss but different hh, because of a TZ issue somewhere along the line (+/- 38 hours, see _accumulateActivities)
+                    (x.StartTime is not None and
+                     act.StartTime is not None and
+                     abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < self.TimezoneErrorPeriod and
+                     abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) < self.TZOffsetLeeway
+                     )
+                    or
+                    # Similarly, for half-hour time zones
+                    (x.StartTime is not None and
+                     act.StartTime is not None and
+                     abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < self.TimezoneErrorPeriod and
+                     abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) > timedelta(minutes=30) - (self.TZOffsetLeeway / 2) and
+                     abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) < timedelta(minutes=30) + (self.TZOffsetLeeway / 2)
+                     )
+                ) and (
+                    # Prevents closely-spaced activities of known different type from being lumped together - esp. important for manually-enetered ones
+                    x.Type == ActivityType.Other or act.Type == ActivityType.Other or x.Type == act.Type or ActivityType.AreVariants([act.Type, x.Type])
+                )
+
+    def Find(self, act):
+        probe = _MatcherEntry()
+        self._keys(act, probe)
+
+        candidates = set()
+        candidates.update(self._uids.get(probe.UID, ()))
+        candidates.update(self._candidates(probe.Naive, self._naive, self._startBucketSize))
+        # Aware-aware comparisons are done in UTC (unless both share a tzinfo, which the naive buckets cover)
+        if probe.UTC is not None:
+            candidates.update(self._candidates(probe.UTC, self._utc, self._startBucketSize))
+        candidates.update(self._candidates(probe.Hourless, self._hourless, self._hourlessBucketSize, offsets=(0, -self._halfHour, self._halfHour)))
+
+        # Only those in the window the sorted list would have been bisected to
+        window = _us(self.TimezoneErrorPeriod)
+        candidates = [x for x in candidates if probe.Naive - window <= -x.Position[0] <= probe.Naive + window]
+        candidates.sort(key=lambda x: x.Position)
+        for candidate in candidates:
+            if self._matches(act, candidate.Activity):
+                return candidate.Activity
+        return None
@@ -1,6 +1,8 @@
 from datetime import datetime
+from tapiriik.database import db
 from tapiriik.services.interchange import ActivityStatisticUnit
 from tapiriik.services.api import UserException
+from pymongo import ReplaceOne, UpdateOne, DeleteMany
 
 class ActivityRecord:
     def __init__(self, dbRec=None):
@@ -13,6 +15,7 @@ class ActivityRecord:
         self.Stationary = None
         self.Private = None
         self.UIDs = []
+        self.Key = None # Assigned by ActivityRecordStore when first written
         self.PresentOnServices = {}
         self.NotPresentOnServices = {}
         self.FailureCounts = {}
@@ -109,3 +112,79 @@ class ActivityServicePrescence:
             raise ValueError("Provided UserException %s is not a UserException" % userException)
         self.UserException = userException
 
+
+class ActivityRecordStore:
+    """ Activity records live in activity_record_entries, one document per record, keyed by UserID + Key.
+        Key is fixed when the record is first written (the lowest of its UIDs at the time), so records can be rewritten
+        or removed individually even as their UIDs change.
+        Previously, each user had a single activity_records document holding every record in an Activities array - those
+        are moved over by MigrateUser (as they're first loaded, or in bulk by activity_records_migrate.py).
+    """
+    PageSize = 250
+
+    def EnsureIndexes():
+        db.activity_record_entries.ensure_index([("UserID", 1), ("Key", 1)], unique=True)
+        db.activity_record_entries.ensure_index([("UserID", 1), ("StartTime", -1)])
+
+    def AssignKey(uids, taken_keys):
+        key = base = min(uids) if uids else "empty"
+        suffix = 0
+        while key in taken_keys:
+            # Only if records overlap - they're not meant to, but the sync core has tolerated it for a long time
+            suffix += 1
+            key = "%s-%d" % (base, suffix)
+        taken_keys.add(key)
+        return key
+
+    def Load(user_id):
+        """ All of the user's records, most recent first - the order the single-document layout was kept in """
+        ActivityRecordStore.MigrateUser(user_id)
+        return db.activity_record_entries.find({"UserID": user_id}).sort([("StartTime", -1), ("Key", 1)])
+
+    def Page(user_id, fields=None, offset=0, limit=None):
+        if not offset:
+            ActivityRecordStore.MigrateUser(user_id)
+        cursor = db.activity_record_entries.find({"UserID": user_id}, dict((x, 1) for x in fields) if fields else None).sort([("StartTime", -1), ("Key", 1)]).skip(offset)
+        return cursor.limit(limit if limit is not None else ActivityRecordStore.PageSize)
+
+    def Write(user_id, records, removed_keys=None):
+        """ records are (Key, document) pairs to replace - only those which have actually changed, ideally """
+        operations = [ReplaceOne({"UserID": user_id, "Key": key}, dict(record, UserID=user_id, Key=key), upsert=True) for key, record in records]
+        if removed_keys:
+            operations.append(DeleteMany({"UserID": user_id, "Key": {"$in": list(removed_keys)}}))
+        if operations:
+            db.activity_record_entries.bulk_write(operations, ordered=False)
+
+    def ClearFailureCounts(user_id, service_id):
+        ActivityRecordStore.MigrateUser(user_id)
+        db.activity_record_entries.update_many({"UserID": user_id, "FailureCounts." + service_id: {"$exists": True}}, {"$unset": {"FailureCounts." + service_id: ""}})
+
+    def TotalDistance(user_id):
+        """ In meters, or None if the user has no records at all """
+        ActivityRecordStore.MigrateUser(user_id)
+        result = list(db.activity_record_entries.aggregate([{"$match": {"UserID": user_id}}, {"$group": {"_id": None, "Distance": {"$sum": "$Distance"}, "Count": {"$sum": 1}}}]))
+        return result[0]["Distance"] if result and result[0]["Count"] else None
+
+    def Remove(user_id):
+        db.activity_record_entries.delete_many({"UserID": user_id})
+        db.activity_records.remove({"UserID": user_id})
+
+    def MigrateUser(user_id):
+        """ Moves a user's records out of the old single-document layout - safe to repeat, since keys are assigned the same way each time.
+            Only records not already in activity_record_entries are added, so a stale legacy document (left behind by a run that
+            didn't get as far as removing it) can't overwrite anything synced since.
+        """
+        legacy = db.activity_records.find_one({"UserID": user_id})
+        if not legacy:
+            return 0
+        taken_keys = set()
+        records = []
+        for record in legacy.get("Activities", []):
+            if "UIDs" not in record:
+                continue # Never loaded by the sync core either
+            record = dict(record, UIDs=sorted(record["UIDs"]))
+            records.append((ActivityRecordStore.AssignKey(record["UIDs"], taken_keys), record))
+        if records:
+            db.activity_record_entries.bulk_write([UpdateOne({"UserID": user_id, "Key": key}, {"$setOnInsert": record}, upsert=True) for key, record in records], ordered=False)
+        db.activity_records.remove({"_id": legacy["_id"]})
+        return len(records)
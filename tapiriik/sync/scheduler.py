@@ -0,0 +1,159 @@
+from tapiriik.database import db
+from tapiriik.settings import SYNC_SCHEDULER_BATCH_SIZE, SYNC_SCHEDULER_INTERVAL, SYNC_SCHEDULER_CONFIRM_TIMEOUT, SYNC_SCHEDULER_STATS_INTERVAL
+from pymongo.read_preferences import ReadPreference
+from datetime import datetime
+import kombu
+import socket
+import time
+import uuid
+
+class ConfirmedBatchPublisher:
+    """ Publishes a batch of messages on a channel in confirm mode, then waits once for the broker to confirm the lot.
+        (the shared mq connection has confirm_publish set, which waits out a round-trip after every single message)
+    """
+    def __init__(self, connection, exchange_name, confirm_timeout=SYNC_SCHEDULER_CONFIRM_TIMEOUT):
+        self._connection = connection
+        self._channel = connection.channel()
+        self._channel.confirm_select()
+        self._channel.events["basic_ack"].add(self._ack)
+        self._channel.events["basic_nack"].add(self._nack)
+        self._producer = kombu.Producer(self._channel, kombu.Exchange(exchange_name, type="direct"))
+        self.ConfirmTimeout = confirm_timeout
+        self._deliveryTag = 0
+        self._pending = {}
+        self._failed = []
+
+    def _settle(self, delivery_tag, multiple, failed):
+        for tag in ([x for x in self._pending if x <= delivery_tag] if multiple else [delivery_tag]):
+            key = self._pending.pop(tag, None)
+            if failed and key is not None:
+                self._failed.append(key)
+
+    def _ack(self, delivery_tag, multiple, *args):
+        self._settle(delivery_tag, multiple, failed=False)
+
+    def _nack(self, delivery_tag, multiple, *args):
+        self._settle(delivery_tag, multiple, failed=True)
+
+    def Publish(self, messages):
+        """ messages are (key, body, routing key) - returns the keys of those the broker didn't confirm in time """
+        self._failed = []
+        for key, body, routing_key in messages:
+            self._deliveryTag += 1
+            self._pending[self._deliveryTag] = key
+            self._producer.publish(body, routing_key=routing_key)
+        deadline = time.time() + self.ConfirmTimeout
+        while self._pending and time.time() < deadline:
+            try:
+                self._connection.drain_events(timeout=deadline - time.time())
+            except socket.timeout:
+                break
+        # Any confirmations that straggle in after this are for tags no longer pending, and are ignored
+        failed = self._failed + list(self._pending.values())
+        self._pending = {}
+        self._failed = []
+        return failed
+
+class SyncScheduler:
+    """ Moves due users (NextSynchronization <= now) into the sync queue, a bounded batch at a time.
+
+        Each batch is claimed with a single update tagged with a fresh QueuedGeneration, so any number of schedulers can run at
+        once - a user is only ever claimed by one of them, and the claimant publishes it. To keep them from fighting over the
+        same users, shard i of n takes every nth user (from the ith) of the n batches at the head of the due list. If a shard
+        stops, the users it would have taken stay at the head of the list and are soon dealt to the others.
+
+        Users whose messages the broker didn't confirm go back to being due, with their QueuedGeneration cleared. If one did
+        make it to the queue after all, it's discarded by the worker, since it no longer matches the user's generation.
+    """
+    _dueQuery = {"QueuedAt": {"$exists": False}}
+
+    def __init__(self, publisher, shard=0, shards=1, batch_size=SYNC_SCHEDULER_BATCH_SIZE, stats_interval=SYNC_SCHEDULER_STATS_INTERVAL):
+        assert 0 <= shard < shards
+        self._publisher = publisher
+        self.Shard = shard
+        self.Shards = shards
+        self.BatchSize = batch_size
+        self.StatsInterval = stats_interval
+        self._resetStats()
+
+    def EnsureIndexes():
+        db.users.ensure_index([("NextSynchronization", 1)], background=True)
+
+    def _resetStats(self):
+        self.Stats = {"Claimed": 0, "Contended": 0, "Unconfirmed": 0, "Batches": 0, "PublishTime": 0, "PublishTimeMax": 0}
+        self._statsSince = time.time()
+
+    def _candidates(self):
+        due_query = dict(SyncScheduler._dueQuery, NextSynchronization={"$lte": datetime.utcnow()})
+        window = list(db.users.with_options(read_preference=ReadPreference.PRIMARY).find(due_query, {"_id": True, "SynchronizationHostRestriction": True}).sort("NextSynchronization", 1).limit(self.BatchSize * self.Shards))
+        return window[self.Shard::self.Shards], len(window) == self.BatchSize * self.Shards
+
+    def _claim(self, candidates):
+        generation = str(uuid.uuid4())
+        queueing_at = datetime.utcnow()
+        ids = [x["_id"] for x in candidates]
+        result = db.users.update_many(dict(SyncScheduler._dueQuery, _id={"$in": ids}, NextSynchronization={"$lte": queueing_at}), {"$set": {"QueuedAt": queueing_at, "QueuedGeneration": generation}, "$unset": {"NextSynchronization": True}})
+        if result.modified_count != len(ids):
+            # Some were claimed by another scheduler (or rescheduled) in the meantime
+            claimed_ids = set(x["_id"] for x in db.users.find({"_id": {"$in": ids}, "QueuedGeneration": generation}, {"_id": True}))
+            candidates = [x for x in candidates if x["_id"] in claimed_ids]
+        return generation, candidates
+
+    def _release(self, generation, ids):
+        db.users.update_many({"_id": {"$in": ids}, "QueuedGeneration": generation, "QueuedAt": {"$exists": True}}, {"$set": {"NextSynchronization": datetime.utcnow()}, "$unset": {"QueuedAt": True, "QueuedGeneration": True}})
+
+    def ScheduleBatch(self):
+        """ Returns the number of users queued, and whether more were due than fit in the batch """
+        candidates, more_due = self._candidates()
+        if not candidates:
+            return 0, more_due
+        generation, claimed = self._claim(candidates)
+        self.Stats["Contended"] += len(candidates) - len(claimed)
+        if not claimed:
+            return 0, more_due
+
+        messages = [(user["_id"], {"user_id": str(user["_id"]), "generation": generation}, user.get("SynchronizationHostRestriction") or "") for user in claimed]
+        publish_start = time.time()
+        try:
+            unconfirmed = self._publisher.Publish(messages)
+        except:
+            self._release(generation, [x["_id"] for x in claimed])
+            raise
+        publish_time = time.time() - publish_start
+        if unconfirmed:
+            self._release(generation, unconfirmed)
+
+        self.Stats["Claimed"] += len(claimed) - len(unconfirmed)
+        self.Stats["Unconfirmed"] += len(unconfirmed)
+        self.Stats["Batches"] += 1
+        self.Stats["PublishTime"] += publish_time
+        self.Stats["PublishTimeMax"] = max(self.Stats["PublishTimeMax"], publish_time)
+        return len(claimed) - len(unconfirmed), more_due
+
+    def ReportStats(self):
+        elapsed = max(time.time() - self._statsSince, 0.001)
+        report = {
+            "Shard": self.Shard,
+            "Shards": self.Shards,
+            "Host": socket.gethostname(),
+            "Heartbeat": datetime.utcnow(),
+            "ClaimRate": self.Stats["Claimed"] / elapsed,
+            "Claimed": self.Stats["Claimed"],
+            "Contended": self.Stats["Contended"],
+            "Unconfirmed": self.Stats["Unconfirmed"],
+            "PublishLatency": self.Stats["PublishTime"] / self.Stats["Batches"] if self.Stats["Batches"] else None,
+            "PublishLatencyMax": self.Stats["PublishTimeMax"] if self.Stats["Batches"] else None,
+            "Interval": elapsed
+        }
+        db.sync_scheduler_stats.update({"_id": self.Shard}, {"$set": report}, upsert=True)
+        print("Shard %d: queued %d users (%.1f/sec), %d contended, %d unconfirmed, publish latency avg %s max %s at %s" % (self.Shard, report["Claimed"], report["ClaimRate"], report["Contended"], report["Unconfirmed"], report["PublishLatency"], report["PublishLatencyMax"], datetime.utcnow()))
+        self._resetStats()
+
+    def Run(self):
+        while True:
+            more_due = self.ScheduleBatch()[1]
+            if time.time() - self._statsSince >= self.StatsInterval:
+                self.ReportStats()
+            if not more_due:
+                # Caught up - otherwise, straight on to the next batch
+                time.sleep(SYNC_SCHEDULER_INTERVAL)
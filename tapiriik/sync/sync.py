@@ -1,23 +1,31 @@
 from tapiriik.database import db, cachedb, redis
 from tapiriik.messagequeue import mq
 from tapiriik.services import Service, ServiceRecord, APIExcludeActivity, ServiceException, ServiceExceptionScope, ServiceWarning, UserException, UserExceptionType
-from tapiriik.settings import USER_SYNC_LOGS, DISABLED_SERVICES, WITHDRAWN_SERVICES
-from .activity_record import ActivityRecord, ActivityServicePrescence
+from tapiriik.settings import DISABLED_SERVICES, WITHDRAWN_SERVICES, SYNC_LISTING_CONCURRENCY, SYNC_PIPELINE_WORKERS, SYNC_PIPELINE_PREFETCH
+from .activity_record import ActivityRecord, ActivityServicePrescence, ActivityRecordStore
+from .activity_matcher import ActivityMatcher
+from .transfer_pipeline import TransferPipeline
+from .write_buffer import SyncWriteBuffer
+from .task_logging import TaskLogContext, TaskLogRouter
+from .sync_log import SyncLog, SyncLogStore
+from tapiriik.services.synchronized_activities import SynchronizedActivityStore
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import os
 import io
 import socket
+import time
 import traceback
 import pprint
 import copy
 import random
 import logging
-import logging.handlers
 import pymongo
 import pytz
 import kombu
 import json
+import queue
 import bisect
 
 # Set this up separate from the logger used in this scope, so services logging messages are caught and logged into user's files.
@@ -33,6 +41,9 @@ if hasattr(sys.stdout, "buffer"):
     logging_console_handler.setFormatter(logging.Formatter('%(message)s'))
     _global_logger.addHandler(logging_console_handler)
 
+# Each sync task's user log gets the records logged on its behalf - see TaskLogContext
+_global_logger.addHandler(TaskLogRouter())
+
 logger = logging.getLogger("tapiriik.sync.worker")
 
 def _formatExc():
@@ -54,6 +65,9 @@ def _formatExc():
     finally:
         del exc_traceback, exc_value, exc_type
 
+def _formatPhaseTimes(times):
+    return ", ".join("%s %.2fs" % (phase, times[phase]) for phase in SynchronizationTask.Phases if phase in times)
+
 def _isWarning(exc):
     return issubclass(exc.__class__, ServiceWarning)
 
@@ -72,6 +86,22 @@ def _packUserException(userException):
     if userException:
         return {"Type": userException.Type, "Extra": userException.Extra, "InterventionRequired": userException.InterventionRequired, "ClearGroup": userException.ClearGroup}
 
+def _storedTimestamp(timestamp):
+    # As Mongo hands it back - naive UTC, to the millisecond - so records read back compare equal to what was written
+    if timestamp is None:
+        return None
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(pytz.utc).replace(tzinfo=None)
+    return timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
+
+def _comparableActivityRecord(record):
+    # The Processed timestamps are bumped whenever an activity's listed (or found missing again) - that alone isn't worth a write
+    comparable = dict(record)
+    for prescences in ("Prescence", "Abscence"):
+        if prescences in comparable:
+            comparable[prescences] = dict((svcId, dict((k, v) for k, v in presc.items() if k != "Processed")) for svcId, presc in comparable[prescences].items())
+    return comparable
+
 def _unpackUserException(raw):
     if not raw:
         return None
@@ -89,6 +119,7 @@ class Sync:
     SyncIntervalJitter = timedelta(minutes=5)
     MinimumSyncInterval = timedelta(seconds=30)
     MaximumIntervalBeforeExhaustiveSync = timedelta(days=14)  # Based on the general page size of 50 activites, this would be >3/day...
+    IdleHeartbeatInterval = 60  # Seconds - well inside the watchdog's timeout
 
     def ScheduleImmediateSync(user, exhaustive=None):
         if exhaustive is None:
@@ -110,10 +141,55 @@ class Sync:
         # Bind to worker-specific and general routing keys
         Sync._global_queue.bind_to(exchange="tapiriik-users", routing_key="")
         Sync._host_queue.bind_to(exchange="tapiriik-users", routing_key=socket.gethostname())
+        ActivityRecordStore.EnsureIndexes()
+        SynchronizedActivityStore.EnsureIndexes()
+        SyncLogStore.EnsureIndexes()
+
+    def PerformGlobalSync(heartbeat_callback=None, version=None, max_users=None, tasks=1, recycle_check=None):
+        """ Synchronizes users from the queue, up to tasks at once (each on its own thread, or inline if there's just the one).
+            Returns once max_users have been started or recycle_check() is true, and whatever's in progress has finished.
+            heartbeat_callback(state, user, slot) is called for each task slot - including idle ones, now and then.
+
+            Messages are only acked (or requeued) from this thread, as the channel isn't thread-safe. A failed task stops
+            the worker taking on any more, and its exception is raised once the others are done - its message is left
+            unacked, to be redelivered once the worker's gone, as it would be if the worker had crashed.
+        """
+        completed = queue.Queue()
+        free_slots = list(reversed(range(tasks)))
+        state = {"Started": 0, "Stopping": False, "Failure": None}
+        executor = ThreadPoolExecutor(max_workers=tasks) if tasks > 1 else None
+
+        def _run(body, message, slot):
+            slot_heartbeat = (lambda step, user=None: heartbeat_callback(step, user, slot)) if heartbeat_callback else None
+            try:
+                Sync._consumeSyncTask(body, slot_heartbeat, version)
+            except Exception:
+                logger.exception("Sync task failed")
+                completed.put((message, slot, sys.exc_info()))
+            else:
+                completed.put((message, slot, None))
 
-    def PerformGlobalSync(heartbeat_callback=None, version=None, max_users=None):
         def _callback(body, message):
-            Sync._consumeSyncTask(body, message, heartbeat_callback, version)
+            if state["Stopping"] or not free_slots:
+                # Prefetched after we'd decided to stop - another worker can have it
+                message.requeue()
+                return
+            state["Started"] += 1
+            if max_users is not None and state["Started"] >= max_users:
+                state["Stopping"] = True
+            slot = free_slots.pop()
+            if executor:
+                executor.submit(_run, body, message, slot)
+            else:
+                _run(body, message, slot)
+
+        def _settle(message, slot, exc_info):
+            free_slots.append(slot)
+            if exc_info:
+                state["Failure"] = state["Failure"] or exc_info
+                state["Stopping"] = True
+            else:
+                message.ack()
 
         Sync._consumer = kombu.Consumer(
             channel=Sync._channel,
@@ -122,28 +198,52 @@ class Sync:
             auto_declare=False
         )
 
-        Sync._consumer.qos(prefetch_count=1, apply_global=False)
+        Sync._consumer.qos(prefetch_count=tasks, apply_global=False)
 
         Sync._consumer.consume()
 
-        for _ in kombu.eventloop(mq, limit=max_users):
-            pass
+        last_idle_heartbeat = time.time()
+        try:
+            while not (state["Stopping"] and len(free_slots) == tasks):
+                if state["Stopping"] or not free_slots:
+                    # Nothing more to take on for now - wait for a task to finish
+                    try:
+                        _settle(*completed.get(timeout=1))
+                    except queue.Empty:
+                        pass
+                else:
+                    try:
+                        mq.drain_events(timeout=1)
+                    except socket.timeout:
+                        pass
+                while not completed.empty():
+                    _settle(*completed.get_nowait())
+                if not state["Stopping"] and recycle_check and recycle_check():
+                    state["Stopping"] = True
+                if heartbeat_callback and time.time() - last_idle_heartbeat > Sync.IdleHeartbeatInterval:
+                    for slot in free_slots:
+                        heartbeat_callback("ready", None, slot)
+                    last_idle_heartbeat = time.time()
+        finally:
+            if executor:
+                executor.shutdown(wait=True)
+
+        if state["Failure"]:
+            raise state["Failure"][1].with_traceback(state["Failure"][2])
 
-    def _consumeSyncTask(body, message, heartbeat_callback_direct, version):
+    def _consumeSyncTask(body, heartbeat_callback_direct, version):
         from tapiriik.auth import User
 
         user_id = body["user_id"]
         user = User.Get(user_id)
         if user is None:
             logger.warning("Could not find user %s - bailing" % user_id)
-            message.ack() # Otherwise the entire thing grinds to a halt
-            return
+            return # The message is still acked, otherwise the entire thing grinds to a halt
         if body["generation"] != user.get("QueuedGeneration", None):
             # QueuedGeneration being different means they've gone through sync_scheduler since this particular message was queued
             # So, discard this and wait for that message to surface
             # Should only happen when I manually requeue people
             logger.warning("Queue generation mismatch for %s - bailing" % user_id)
-            message.ack()
             return
 
         def heartbeat_callback(state):
@@ -166,9 +266,10 @@ class Sync:
             exhaustive = True
 
         result = None
+        sync_log = SyncLog(user["_id"])
         try:
             if not user.get("BlockedOnBadActivitiesAcknowledgement", False):
-                result = Sync.PerformUserSync(user, exhaustive, heartbeat_callback=heartbeat_callback)
+                result = Sync.PerformUserSync(user, exhaustive, heartbeat_callback=heartbeat_callback, sync_log=sync_log)
         finally:
             nextSync = None
             if User.HasActivePayment(user):
@@ -201,27 +302,28 @@ class Sync:
                 }, reschedule_update)
             reschedule_confirm_message = "User reschedule for %s returned %s" % (nextSync, scheduling_result)
 
-            # Tack this on the end of the log file since otherwise it's lost for good (blegh, but nicer than moving logging out of the sync task?)
-            user_log = open(USER_SYNC_LOGS + str(user["_id"]) + ".log", "a+")
-            user_log.write("\n%s\n" % reschedule_confirm_message)
-            user_log.close()
+            # Tack this on the end of the user's log, which is only saved now
+            sync_log.Write("\n%s" % reschedule_confirm_message)
+            sync_log.Save()
 
             logger.debug(reschedule_confirm_message)
             syncTime = (datetime.utcnow() - syncStart).total_seconds()
             db.sync_worker_stats.insert({"Timestamp": datetime.utcnow(), "Worker": os.getpid(), "Host": socket.gethostname(), "TimeTaken": syncTime})
 
-        message.ack()
-
-    def PerformUserSync(user, exhaustive=False, heartbeat_callback=None):
-        return SynchronizationTask(user).Run(exhaustive=exhaustive, heartbeat_callback=heartbeat_callback)
+    def PerformUserSync(user, exhaustive=False, heartbeat_callback=None, sync_log=None):
+        return SynchronizationTask(user, sync_log=sync_log).Run(exhaustive=exhaustive, heartbeat_callback=heartbeat_callback)
 
 
 class SynchronizationTask:
-    _logFormat = '[%(levelname)-8s] %(asctime)s (%(name)s:%(lineno)d) %(message)s'
-    _logDateFormat = '%Y-%m-%d %H:%M:%S'
+    # The parts of synchronizing each activity that get timed, for the log
+    Phases = ("download", "sanity", "normalize", "upload")
 
-    def __init__(self, user):
+    def __init__(self, user, sync_log=None):
+        """ If a sync_log is given, it's up to the caller to save it """
         self.user = user
+        self._syncLog = sync_log
+        self._synchronizedActivityUIDs = {}
+        self._lookedUpUIDs = set()
 
     def _lockUser(self):
         db.users.update({"_id": self.user["_id"]}, {"$set": {"SynchronizationWorker": os.getpid(), "SynchronizationHost": socket.gethostname(), "SynchronizationStartTime": datetime.utcnow()}})
@@ -240,20 +342,56 @@ class SynchronizationTask:
     def _loadServiceData(self):
         self._connectedServiceIds = [x["ID"] for x in self.user["ConnectedServices"]]
         self._serviceConnections = [ServiceRecord(x) for x in db.connections.find({"_id": {"$in": self._connectedServiceIds}})]
+        self._synchronizedActivityUIDs = {}
+        self._lookedUpUIDs = set()
+        for conn in self._serviceConnections:
+            if hasattr(conn, "SynchronizedActivities"):
+                # From before these moved to their own collection
+                SynchronizedActivityStore.MigrateConnection(conn._id, conn.SynchronizedActivities)
+                del conn.SynchronizedActivities
+
+    def _loadSynchronizedActivities(self):
+        # Only whether the activities listed this time around are on each connection is of any interest - not their entire history
+        # Called again after deferred listings (which can merge more UIDs into the activities) - only the new UIDs are looked up then
+        uids = set()
+        for activity in self._activities:
+            uids |= activity.UIDs
+        uids -= self._lookedUpUIDs
+        if not uids:
+            return
+        self._lookedUpUIDs |= uids
+        for conn_id, present in SynchronizedActivityStore.Lookup([x._id for x in self._serviceConnections], uids).items():
+            self._synchronizedActivityUIDs.setdefault(conn_id, set()).update(present)
+
+    def _synchronizedActivities(self, conn):
+        # The set of each connection's synchronized activity UIDs (that we know of - see _loadSynchronizedActivities)
+        if conn._id not in self._synchronizedActivityUIDs:
+            self._synchronizedActivityUIDs[conn._id] = set(conn.SynchronizedActivities) if hasattr(conn, "SynchronizedActivities") else set()
+        return self._synchronizedActivityUIDs[conn._id]
+
+    def _addSynchronizedActivities(self, conn_ids, uids):
+        for conn in self._serviceConnections:
+            if conn._id in conn_ids:
+                self._synchronizedActivities(conn).update(uids)
+
+    def _timePhase(self, phase, start):
+        elapsed = time.time() - start
+        self._activityPhaseTimes[phase] = self._activityPhaseTimes.get(phase, 0) + elapsed
+        self._phaseTimes[phase] = self._phaseTimes.get(phase, 0) + elapsed
 
     def _updateSyncProgress(self, step, progress):
         db.users.update({"_id": self.user["_id"]}, {"$set": {"SynchronizationProgress": progress, "SynchronizationStep": step}})
 
     def _initializeUserLogging(self):
-        self._logging_file_handler = logging.handlers.RotatingFileHandler(USER_SYNC_LOGS + str(self.user["_id"]) + ".log", maxBytes=0, backupCount=5, encoding="utf-8")
-        self._logging_file_handler.setFormatter(logging.Formatter(self._logFormat, self._logDateFormat))
-        self._logging_file_handler.doRollover()
-        _global_logger.addHandler(self._logging_file_handler)
+        self._ownsSyncLog = self._syncLog is None
+        if self._ownsSyncLog:
+            self._syncLog = SyncLog(self.user["_id"])
+        self._previousLogHandler = TaskLogContext.Set(self._syncLog)
 
     def _closeUserLogging(self):
-        _global_logger.removeHandler(self._logging_file_handler)
-        self._logging_file_handler.flush()
-        self._logging_file_handler.close()
+        TaskLogContext.Set(self._previousLogHandler)
+        if self._ownsSyncLog:
+            self._syncLog.Save()
 
     def _loadExtendedAuthData(self):
         self._extendedAuthDetails = list(cachedb.extendedAuthDetails.find({"ID": {"$in": self._connectedServiceIds}}))
@@ -323,70 +461,95 @@ class SynchronizationTask:
                     "Exception": _packUserException(presc.UserException)
                 }) for svcId, presc in prescences.items()])
 
-        self._activityRecords.sort(key=lambda x: x.StartTime.replace(tzinfo=None), reverse=True)
-        composed_records = [
-            {
-                "StartTime": x.StartTime,
-                "EndTime": x.EndTime,
+        changed_records = []
+        for x in self._activityRecords:
+            if not x.Touched:
+                continue # Can't have changed
+            composed_record = {
+                "StartTime": _storedTimestamp(x.StartTime),
+                "EndTime": _storedTimestamp(x.EndTime),
                 "Type": x.Type,
                 "Name": x.Name,
                 "Notes": x.Notes,
                 "Private": x.Private,
                 "Stationary": x.Stationary,
                 "Distance": x.Distance,
-                "UIDs": list(x.UIDs),
+                "UIDs": sorted(x.UIDs),
                 "Prescence": _activityPrescences(x.PresentOnServices),
                 "Abscence": _activityPrescences(x.NotPresentOnServices),
                 "FailureCounts": x.FailureCounts
             }
-            for x in self._activityRecords
-        ]
+            if x.Key is None:
+                x.Key = ActivityRecordStore.AssignKey(x.UIDs, self._activityRecordKeys)
+            elif x.Key in self._persistedActivityRecords and _comparableActivityRecord(composed_record) == _comparableActivityRecord(self._persistedActivityRecords[x.Key]):
+                continue
+            changed_records.append((x.Key, composed_record))
 
-        db.activity_records.update(
-            {"UserID": self.user["_id"]},
-            {
-                "$set": {
-                    "UserID": self.user["_id"],
-                    "Activities": composed_records
-                }
-            },
-            upsert=True
-        )
+        logger.debug("Writing %d of %d activity records, removing %d" % (len(changed_records), len(self._activityRecords), len(self._removedActivityRecordKeys)))
+        ActivityRecordStore.Write(self.user["_id"], changed_records, self._removedActivityRecordKeys)
 
     def _initializeActivityRecords(self):
-        raw_records = db.activity_records.find_one({"UserID": self.user["_id"]})
         self._activityRecords = []
-        if not raw_records:
-            return
-        else:
-            raw_records = raw_records["Activities"]
-            for raw_record in raw_records:
-                if "UIDs" not in raw_record:
-                    continue # From the few days where this was rolled out without this key...
-                rec = ActivityRecord(raw_record)
-                rec.UIDs = set(rec.UIDs)
-                # Did I mention I should really start using an ORM-type deal any day now?
-                for svc, absent in rec.Abscence.items():
-                    rec.NotPresentOnServices[svc] = ActivityServicePrescence(absent["Processed"], absent["Synchronized"], _unpackUserException(absent["Exception"]))
-                for svc, present in rec.Prescence.items():
-                    rec.PresentOnServices[svc] = ActivityServicePrescence(present["Processed"], present["Synchronized"], _unpackUserException(present["Exception"]))
-                del rec.Prescence
-                del rec.Abscence
-                rec.Touched = False
-                self._activityRecords.append(rec)
+        self._activityRecordIndex = {}
+        self._activityRecordPositions = {}
+        self._activityRecordKeys = set()
+        self._persistedActivityRecords = {} # Key -> the document as loaded, to tell which need writing back
+        self._removedActivityRecordKeys = []
+        for raw_record in ActivityRecordStore.Load(self.user["_id"]):
+            del raw_record["_id"]
+            del raw_record["UserID"]
+            self._activityRecordKeys.add(raw_record["Key"])
+            self._persistedActivityRecords[raw_record["Key"]] = dict((k, v) for k, v in raw_record.items() if k != "Key")
+            if "UIDs" not in raw_record:
+                # From the few days where this was rolled out without this key...
+                self._removedActivityRecordKeys.append(raw_record["Key"])
+                continue
+            rec = ActivityRecord(raw_record)
+            rec.UIDs = set(rec.UIDs)
+            # Did I mention I should really start using an ORM-type deal any day now?
+            for svc, absent in rec.Abscence.items():
+                rec.NotPresentOnServices[svc] = ActivityServicePrescence(absent["Processed"], absent["Synchronized"], _unpackUserException(absent["Exception"]))
+            for svc, present in rec.Prescence.items():
+                rec.PresentOnServices[svc] = ActivityServicePrescence(present["Processed"], present["Synchronized"], _unpackUserException(present["Exception"]))
+            del rec.Prescence
+            del rec.Abscence
+            rec.Touched = False
+            self._activityRecords.append(rec)
+            self._indexActivityRecord(rec, len(self._activityRecords) - 1)
+
+    def _indexActivityRecord(self, record, position):
+        # UID -> [(position in _activityRecords, record)] - entries go stale if a record's UIDs change, so matches are re-checked
+        self._activityRecordPositions[id(record)] = position
+        for uid in record.UIDs:
+            entries = self._activityRecordIndex.setdefault(uid, [])
+            if not any(x[1] is record for x in entries):
+                entries.append((position, record))
+
+    def _reindexActivityRecord(self, record):
+        # After SetActivity, which may have brought in new UIDs
+        if id(record) in self._activityRecordPositions:
+            self._indexActivityRecord(record, self._activityRecordPositions[id(record)])
 
     def _findOrCreateActivityRecord(self, activity):
-        for record in self._activityRecords:
-            if record.UIDs & activity.UIDs:
-                record.Touched = True
-                return record
+        # The first record (in _activityRecords order) sharing any UID with the activity
+        candidates = [x for uid in activity.UIDs for x in self._activityRecordIndex.get(uid, []) if x[1].UIDs & activity.UIDs]
+        if candidates:
+            record = min(candidates, key=lambda x: x[0])[1]
+            record.Touched = True
+            return record
         record = ActivityRecord.FromActivity(activity)
         record.Touched = True
         self._activityRecords.append(record)
+        self._indexActivityRecord(record, len(self._activityRecords) - 1)
         return record
 
     def _dropUntouchedActivityRecords(self):
+        self._removedActivityRecordKeys += [x.Key for x in self._activityRecords if not x.Touched and x.Key is not None]
         self._activityRecords[:] = [x for x in self._activityRecords if x.Touched]
+        self._activityRecordIndex = {}
+        self._activityRecordPositions = {}
+        for position, record in enumerate(self._activityRecords):
+            self._indexActivityRecord(record, position)
 
     def _persistServiceTrigger(self, serviceRecord):
         self._persistTriggerServices[serviceRecord._id] = True
@@ -412,7 +575,7 @@ class SynchronizationTask:
             if conn._id in activity.ServiceDataCollection:
                 # The activity record is updated earlier for these, blegh.
                 continue
-            elif hasattr(conn, "SynchronizedActivities") and len([x for x in activity.UIDs if x in conn.SynchronizedActivities]):
+            elif not self._synchronizedActivities(conn).isdisjoint(activity.UIDs):
                 continue
             elif activity.Type not in conn.Service.SupportedActivities:
                 logger.debug("\t...%s doesn't support type %s" % (conn.Service.ID, activity.Type))
@@ -440,12 +603,15 @@ class SynchronizationTask:
                 return a.replace(tzinfo=knownTz)
             return a
 
+    def _activityMatcher(self):
+        # Rebuilt whenever self._activities is replaced wholesale
+        if not hasattr(self, "_matcher") or self._matcher.Source is not self._activities:
+            self._matcher = ActivityMatcher(self._activities)
+        return self._matcher
+
     def _accumulateActivities(self, conn, svcActivities, no_add=False):
-        # Yep, abs() works on timedeltas
-        activityStartLeeway = timedelta(minutes=3)
-        activityStartTZOffsetLeeway = timedelta(minutes=1)
-        timezoneErrorPeriod = timedelta(hours=38)
         from tapiriik.services.interchange import ActivityType
+        matcher = self._activityMatcher()
         for act in svcActivities:
             act.UIDs = set([act.UID])
             if not hasattr(act, "ServiceDataCollection"):
@@ -458,59 +624,16 @@ class SynchronizationTask:
             if act.TZ and not hasattr(act.TZ, "localize"):
                 raise ValueError("Got activity with TZ type " + str(type(act.TZ)) + " instead of a pytz timezone")
             # Used to ensureTZ() right here - doubt it's needed any more?
-            # Binsearch to find which activities actually need individual attention.
-            # Otherwise it's O(mn^2).
-            # self._activities is sorted most recent first
-            relevantActivitiesStart = bisect.bisect_left(self._activities, act.StartTime + timezoneErrorPeriod)
-            relevantActivitiesEnd = bisect.bisect_right(self._activities, act.StartTime - timezoneErrorPeriod, lo=relevantActivitiesStart)
-            extantActIter = (
-                              x for x in (self._activities[idx] for idx in range(relevantActivitiesStart, relevantActivitiesEnd)) if
-                              (
-                                  # Identical
-                                  x.UID == act.UID
-                                  or
-                                  # Check to see if the self._activities are reasonably close together to be considered duplicate
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   (act.StartTime.tzinfo is not None) == (x.StartTime.tzinfo is not None) and
-                                   abs(act.StartTime-x.StartTime) < activityStartLeeway
-                                  )
-                                  or
-                                  # Try comparing the time as if it were TZ-aware and in the expected TZ (this won't actually change the value of the times being compared)
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   (act.StartTime.tzinfo is not None) != (x.StartTime.tzinfo is not None) and
-                                   abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < activityStartLeeway
-                                  )
-                                  or
-                                  # Sometimes wacky stuff happens and we get two activities with the same mm:ss but different hh, because of a TZ issue somewhere along the line.
-                                  # So, we check for any activities +/- 14, wait, 38 hours that have the same minutes and seconds values.
-                                  #  (14 hours because Kiribati, and later, 38 hours because of some really terrible import code that existed on a service that shall not be named).
-                                  # There's a very low chance that two activities in this period would intersect and be merged together.
-                                  # But, given the fact that most users have maybe 0.05 activities per this period, it's an acceptable tradeoff.
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < timezoneErrorPeriod and
-                                   abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) < activityStartTZOffsetLeeway
-                                   )
-                                  or
-                                  # Similarly, for half-hour time zones (there are a handful of quarter-hour ones, but I've got to draw a line somewhere, even if I revise it several times)
-                                  (x.StartTime is not None and
-                                   act.StartTime is not None and
-                                   abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < timezoneErrorPeriod and
-                                   abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) > timedelta(minutes=30) - (activityStartTZOffsetLeeway / 2) and
-                                   abs(act.StartTime.replace(tzinfo=None).replace(hour=0) - x.StartTime.replace(tzinfo=None).replace(hour=0)) < timedelta(minutes=30) + (activityStartTZOffsetLeeway / 2)
-                                   )
-                               )
-                                and
-                                # Prevents closely-spaced activities of known different type from being lumped together - esp. important for manually-enetered ones
-                                (x.Type == ActivityType.Other or act.Type == ActivityType.Other or x.Type == act.Type or ActivityType.AreVariants([act.Type, x.Type]))
-                              )
-
-            try:
-                existingActivity = next(extantActIter)
-            except StopIteration:
-                existingActivity = None
+            # We look for an existing activity that's...
+            #  - identical (same UID)
+            #  - within 3 minutes of this one (comparing naive times if only one is TZ-aware)
+            #  - within 38 hours, with the same mm:ss or a half-hour offset (TZ errors somewhere along the line)
+            #    (14 hours because Kiribati, and later, 38 hours because of some really terrible import code that existed on a service that shall not be named).
+            #    There's a very low chance that two activities in this period would intersect and be merged together.
+            #    But, given the fact that most users have maybe 0.05 activities per this period, it's an acceptable tradeoff.
+            # ...and not of a known different type.
+            # ActivityMatcher does the legwork (it used to be a linear scan over the window).
+            existingActivity = matcher.Find(act)
 
             if existingActivity:
                 # we don't merge the exclude values here, since at this stage the services have the option of just not returning those activities
@@ -549,9 +672,11 @@ class SynchronizationTask:
 
                 existingActivity.UIDs |= act.UIDs  # I think this is merited
                 act.UIDs = existingActivity.UIDs  # stop the circular inclusion, not that it matters
+                matcher.Update(existingActivity) # StartTime and UID may have changed
                 continue
             if not no_add:
                 bisect.insort_left(self._activities, act)
+                matcher.Add(act)
 
     def _determineEligibleRecipientServices(self, activity, recipientServices):
         from tapiriik.auth import User
@@ -634,6 +759,11 @@ class SynchronizationTask:
                 conn.ExtendedAuthorization = extAuthDetails[0]
 
     def _downloadActivityList(self, conn, exhaustive, no_add=False):
+        if not self._checkActivityListEligibility(conn, exhaustive):
+            return
+        self._mergeActivityList(conn, self._retrieveActivityList(conn, exhaustive), no_add=no_add)
+
+    def _checkActivityListEligibility(self, conn, exhaustive):
         svc = conn.Service
         # Bail out as appropriate for the entire account (_syncErrors contains only blocking errors at this point)
         if [x for x in self._syncErrors[conn._id] if x["Scope"] == ServiceExceptionScope.Account]:
@@ -643,31 +773,38 @@ class SynchronizationTask:
         if [x for x in self._syncErrors[conn._id] if x["Scope"] == ServiceExceptionScope.Service]:
             logger.info("Service %s is blocked:" % conn.Service.ID)
             self._excludeService(conn, _unpackUserException([x for x in self._syncErrors[conn._id] if x["Scope"] == ServiceExceptionScope.Service][0]))
-            return
+            return False
 
         if svc.ID in DISABLED_SERVICES or svc.ID in WITHDRAWN_SERVICES:
             logger.info("Service %s is widthdrawn" % conn.Service.ID)
             self._excludeService(conn, UserException(UserExceptionType.Other))
-            return
+            return False
 
         if exhaustive and not svc.SupportsExhaustiveListing and not self._activities:
             # If we get to this point, we must already have activity listings from another service.
             logger.info("Account does not contain any services supporting exhaustive activity listing")
             self._excludeService(conn, UserException(UserExceptionType.Other))
-            return
+            return False
 
         if svc.RequiresExtendedAuthorizationDetails:
             if not conn.ExtendedAuthorization:
                 logger.info("No extended auth details for " + svc.ID)
                 self._excludeService(conn, UserException(UserExceptionType.MissingCredentials))
-                return
+                return False
+        return True
 
+    def _retrieveActivityList(self, conn, exhaustive):
+        # This may run on a listing thread (see _downloadActivityListsConcurrently), so it mustn't modify anything but the result.
+        # (it only reads self._activities during exhaustive syncs, which are never listed concurrently)
+        svc = conn.Service
+        result = {"Activities": [], "Exclusions": [], "Error": None, "Proceed": True}
+        listStart = time.time()
         try:
             logger.info("\tRetrieving list from " + svc.ID)
             if not exhaustive or not self._activities:
-                svcActivities, svcExclusions = svc.DownloadActivityList(conn, exhaustive)
+                result["Activities"], result["Exclusions"] = svc.DownloadActivityList(conn, exhaustive)
             else:
-                svcActivities, svcExclusions = svc.DownloadActivityList(conn, min((x.StartTime.replace(tzinfo=None) for x in self._activities)))
+                result["Activities"], result["Exclusions"] = svc.DownloadActivityList(conn, min((x.StartTime.replace(tzinfo=None) for x in self._activities)))
         except (ServiceException, ServiceWarning) as e:
             # Special-case rate limiting errors thrown during listing
             # Otherwise, things will melt down when the limit is reached
@@ -681,16 +818,107 @@ class SynchronizationTask:
 
             if e.UserException and e.UserException.Type == UserExceptionType.RateLimited:
                 e.TriggerExhaustive = conn._id in self._hasTransientSyncErrors and self._hasTransientSyncErrors[conn._id]
-            self._syncErrors[conn._id].append(_packServiceException(SyncStep.List, e))
-            self._excludeService(conn, e.UserException)
-            if not _isWarning(e):
-                return
+            result["Error"] = _packServiceException(SyncStep.List, e)
+            result["UserException"] = e.UserException
+            result["Proceed"] = _isWarning(e)
         except Exception as e:
-            self._syncErrors[conn._id].append(_packException(SyncStep.List))
-            self._excludeService(conn, UserException(UserExceptionType.ListingError))
-            return
-        self._accumulateExclusions(conn, svcExclusions)
-        self._accumulateActivities(conn, svcActivities, no_add=no_add)
+            result["Error"] = _packException(SyncStep.List)
+            result["UserException"] = UserException(UserExceptionType.ListingError)
+            result["Proceed"] = False
+        result["Duration"] = time.time() - listStart
+        return result
+
+    def _downloadDeferredActivityLists(self, connections, exhaustive):
+        has_deferred = False
+        for conn in connections:
+            if conn._id in self._deferredServices:
+                logger.info("Doing deferred list from %s" % conn.Service.ID)
+                # no_add since...
+                #  a) we're iterating over the list it'd be adding to, and who knows what will happen then
+                #  b) for the current use of deferred services, we don't care about new activities
+                self._downloadActivityList(conn, exhaustive, no_add=True)
+                self._deferredServices.remove(conn._id)
+                has_deferred = True
+        if has_deferred:
+            # The listing may have merged more UIDs into the activities, which other connections might have them under
+            self._loadSynchronizedActivities()
+        return has_deferred
+
+    def _mergeActivityList(self, conn, result, no_add=False):
+        logger.info("\tListed %d activities from %s in %.2fs" % (len(result["Activities"]), conn.Service.ID, result["Duration"]))
+        if result["Error"]:
+            self._syncErrors[conn._id].append(result["Error"])
+            self._excludeService(conn, result["UserException"])
+            if not result["Proceed"]:
+                return
+        self._accumulateExclusions(conn, result["Exclusions"])
+        self._accumulateActivities(conn, result["Activities"], no_add=no_add)
+
+    def _prepareActivityListing(self, conn, exhaustive):
+        # If we're not going to be doing anything anyways, stop now
+        if len(self._serviceConnections) - len(self._excludedServices) <= 1:
+            raise SynchronizationCompleteException()
+
+        self._primeExtendedAuthDetails(conn)
+
+        logger.info("Ensuring partial sync poll subscription")
+        self._ensurePartialSyncPollingSubscription(conn)
+
+        if not exhaustive and conn.Service.PartialSyncRequiresTrigger and "TriggerPartialSync" not in conn.__dict__ and not conn.Service.ShouldForcePartialSyncTrigger(conn):
+            logger.info("Service %s has not been triggered" % conn.Service.ID)
+            self._deferredServices.append(conn._id)
+            return False
+
+        if not conn.Service.SuppliesActivities:
+            logger.info("Service %s does not supply activities - deferring listing till first upload" % conn.Service.ID)
+            self._deferredServices.append(conn._id)
+            return False
+        return True
+
+    def _downloadActivityListsConcurrently(self, connections, heartbeat_callback=None):
+        # Partial listings don't depend on one another, so they're retrieved in parallel, then merged in the same order they'd have been listed sequentially.
+        # The service exclusions a sequential run would've made before each merge are replayed as well, so SynchronizationCompleteException fires at the same point.
+        batch = []
+        with ThreadPoolExecutor(max_workers=SYNC_LISTING_CONCURRENCY) as executor:
+            try:
+                for conn in connections:
+                    if not self._prepareActivityListing(conn, False):
+                        continue
+
+                    if heartbeat_callback:
+                        heartbeat_callback(SyncStep.List)
+
+                    self._updateSyncProgress(SyncStep.List, conn.Service.ID)
+                    wasExcluded = self._isServiceExcluded(conn)
+                    if not self._checkActivityListEligibility(conn, False):
+                        if not wasExcluded and self._isServiceExcluded(conn):
+                            batch.append((conn, None))
+                        continue
+                    batch.append((conn, executor.submit(TaskLogContext.Bind(self._retrieveActivityList), conn, False)))
+            except SynchronizationCompleteException:
+                self._mergeConcurrentActivityLists(batch, heartbeat_callback)
+                raise
+            self._mergeConcurrentActivityLists(batch, heartbeat_callback)
+
+    def _mergeConcurrentActivityLists(self, batch, heartbeat_callback=None):
+        # Exclusions made while checking eligibility ahead of time, which the sequential run wouldn't have seen yet
+        prematureExclusions = set(conn._id for conn, future in batch if future is None)
+        try:
+            for conn, future in batch:
+                if future is None:
+                    prematureExclusions.discard(conn._id)
+                    continue
+                if len(self._serviceConnections) - (len(self._excludedServices) - len(prematureExclusions)) <= 1:
+                    raise SynchronizationCompleteException()
+
+                if heartbeat_callback:
+                    heartbeat_callback(SyncStep.List)
+
+                self._mergeActivityList(conn, future.result())
+        finally:
+            for conn, future in batch:
+                if future is not None:
+                    future.cancel()
 
     def _estimateFallbackTZ(self, activities):
         from collections import Counter
@@ -718,31 +946,24 @@ class SynchronizationTask:
         updateServicesWithExistingActivity = False
         for serviceWithExistingActivityId in activity.ServiceDataCollection.keys():
             serviceWithExistingActivity = [x for x in self._serviceConnections if x._id == serviceWithExistingActivityId][0]
-            if not hasattr(serviceWithExistingActivity, "SynchronizedActivities") or not (activity.UIDs <= set(serviceWithExistingActivity.SynchronizedActivities)):
+            if not (activity.UIDs <= self._synchronizedActivities(serviceWithExistingActivity)):
                 updateServicesWithExistingActivity = True
                 break
 
         if updateServicesWithExistingActivity:
             logger.debug("\t\tUpdating SynchronizedActivities")
-            try:
-                db.connections.update({"_id": {"$in": list(activity.ServiceDataCollection.keys())}},
-                                      {"$addToSet": {"SynchronizedActivities": {"$each": list(activity.UIDs)}}},
-                                      multi=True)
-            except pymongo.errors.WriteError as e:
-                if e.code == 17419: # Update makes document too large.
-                    # Throw them all out - exhaustive sync will recover.
-                    # I should probably check that this is actually due to transient issues - otherwise it'll keep happening.
-                    db.connections.update({"_id": {"$in": list(activity.ServiceDataCollection.keys())}}, {"$unset": {"SynchronizedActivities": ""}})
-                    self._sync_result.ForceExhaustive = True
-                else:
-                    raise
+            self._writeBuffer.AddSynchronizedActivities(activity.ServiceDataCollection.keys(), activity.UIDs)
+            self._addSynchronizedActivities(activity.ServiceDataCollection.keys(), activity.UIDs)
+
+    def _flushWriteBuffer(self):
+        self._writeBuffer.Flush()
 
     def _updateActivityRecordInitialPrescence(self, activity):
         for connWithExistingActivityId in activity.ServiceDataCollection.keys():
             connWithExistingActivity = [x for x in self._serviceConnections if x._id == connWithExistingActivityId][0]
             activity.Record.MarkAsPresentOn(connWithExistingActivity)
         for conn in self._serviceConnections:
-            if hasattr(conn, "SynchronizedActivities") and len([x for x in activity.UIDs if x in conn.SynchronizedActivities]):
+            if not self._synchronizedActivities(conn).isdisjoint(activity.UIDs):
                 activity.Record.MarkAsPresentOn(conn)
 
     def _syncActivityRedisKey(user):
@@ -750,19 +971,122 @@ class SynchronizationTask:
 
     def _pushRecentSyncActivity(self, activity, destinations):
         key = SynchronizationTask._syncActivityRedisKey(self.user)
-        redis.lpush(key, json.dumps({"Name": activity.Name, "StartTime": activity.StartTime.isoformat(), "Type": activity.Type, "Timestamp": datetime.utcnow().isoformat(), "Destinations": destinations}))
-        redis.ltrim(key, 0, 4) # Only keep 5
+        self._writeBuffer.PushRecentActivity(key, {"Name": activity.Name, "StartTime": activity.StartTime.isoformat(), "Type": activity.Type, "Timestamp": datetime.utcnow().isoformat(), "Destinations": destinations}, keep=5)
 
     def RecentSyncActivity(user):
         return [json.loads(x.decode("UTF-8")) for x in redis.lrange(SynchronizationTask._syncActivityRedisKey(user), 0, 4)]
 
-    def _downloadActivity(self, activity):
-        act = None
+    def _timeSinceActivityEnded(self, activity):
+        endtime = activity.EndTime
+        tz = endtime.tzinfo
+        if not tz and activity.FallbackTZ:
+            tz = activity.FallbackTZ
+            endtime = tz.localize(endtime)
+
+        if not (tz and endtime):
+            return None
+        time_past = (datetime.utcnow() - endtime.astimezone(pytz.utc).replace(tzinfo=None))
+        # I believe astimezone(utc) is scrubbing the DST away - put it back here.
+        # We must try this twice because not all of our TZ objects are pytz for... some reason.
+        # And, thus, dst() may not accept is_dst.
+
+        try:
+            dst_offset = tz.dst(endtime.replace(tzinfo=None))
+        except pytz.AmbiguousTimeError:
+            dst_offset = tz.dst(endtime.replace(tzinfo=None), is_dst=False)
+
+        if dst_offset:
+            time_past += dst_offset
+        return time_past
+
+    def _downloadSources(self, activity):
         actAvailableFromSvcIds = activity.ServiceDataCollection.keys()
         actAvailableFromSvcs = [[x for x in self._serviceConnections if x._id == dlSvcRecId][0] for dlSvcRecId in actAvailableFromSvcIds]
 
-        servicePriorityList = Service.PreferredDownloadPriorityList()
-        actAvailableFromSvcs.sort(key=lambda x: servicePriorityList.index(x.Service))
+        servicePriorityRanks = Service.PreferredDownloadPriorityRanks()
+        actAvailableFromSvcs.sort(key=lambda x: servicePriorityRanks[x.Service.ID])
+        return actAvailableFromSvcs
+
+    def _downloadWorkingCopy(self, activity, dlSvcRecord):
+        workingCopy = copy.copy(activity)  # we can hope
+        # Load in the service data in the same place they left it.
+        workingCopy.ServiceData = workingCopy.ServiceDataCollection[dlSvcRecord._id] if dlSvcRecord._id in workingCopy.ServiceDataCollection else None
+        return workingCopy
+
+    def _predictDownloadSource(self, activity):
+        # A side-effect-free guess at whether the sync loop will download this activity, and from where.
+        # Guessing wrong only costs a wasted download - the loop still makes every decision itself.
+        if activity.Private:
+            return None
+        if self._user_config["sync_skip_before"] and activity.StartTime.replace(tzinfo=None) < self._user_config["sync_skip_before"]:
+            return None
+        if self._user_config["sync_upload_delay"] and activity.EndTime:
+            time_past = self._timeSinceActivityEnded(activity)
+            if time_past is not None and time_past < timedelta(seconds=self._user_config["sync_upload_delay"]):
+                return None
+        if not [conn for conn in self._serviceConnections if
+                conn.Service.ReceivesActivities and
+                conn._id not in activity.ServiceDataCollection and
+                self._synchronizedActivities(conn).isdisjoint(activity.UIDs) and
+                activity.Type in conn.Service.SupportedActivities and
+                not self._isServiceExcluded(conn)]:
+            return None
+        for dlSvcRecord in self._downloadSources(activity):
+            if dlSvcRecord.Service.SuppliesActivities and activity.UID not in self._syncExclusions[dlSvcRecord._id] and not self._isServiceExcluded(dlSvcRecord):
+                return dlSvcRecord
+        return None
+
+    def _prefetchDownloads(self, activities):
+        if not self._transferPipeline:
+            return
+        for activity in activities:
+            if id(activity) in self._prefetchedDownloads:
+                continue
+            dlSvcRecord = self._predictDownloadSource(activity)
+            if dlSvcRecord is None:
+                self._prefetchedDownloads[id(activity)] = None
+                continue
+            workingCopy = self._downloadWorkingCopy(activity, dlSvcRecord)
+            download = self._transferPipeline.Submit(dlSvcRecord.Service, dlSvcRecord.Service.DownloadActivity, dlSvcRecord, workingCopy)
+            self._prefetchedDownloads[id(activity)] = (dlSvcRecord, workingCopy, download)
+
+    def _takePrefetchedDownload(self, activity, dlSvcRecord):
+        prefetched = self._prefetchedDownloads.get(id(activity)) if self._transferPipeline else None
+        if prefetched and prefetched[0] is dlSvcRecord:
+            del self._prefetchedDownloads[id(activity)]
+            return prefetched[1], prefetched[2]
+        return self._downloadWorkingCopy(activity, dlSvcRecord), None
+
+    def _discardPrefetchedDownload(self, activity):
+        prefetched = self._prefetchedDownloads.pop(id(activity), None)
+        if prefetched:
+            prefetched[2].cancel()
+
+    def _startUploads(self, activity, destinationSvcRecords):
+        # One destination gains nothing from going through the pool - it's uploaded inline, by way of _transfer
+        if not self._transferPipeline or len(destinationSvcRecords) < 2:
+            return {}
+        return dict((destinationSvcRecord._id, self._transferPipeline.Submit(destinationSvcRecord.Service, destinationSvcRecord.Service.UploadActivity, destinationSvcRecord, activity)) for destinationSvcRecord in destinationSvcRecords)
+
+    def _transfer(self, svc, fn, *args):
+        # Inline downloads/uploads still take one of the service's pipeline slots, so they count against its concurrency along with anything prefetched
+        if not self._transferPipeline:
+            return fn(*args)
+        return self._transferPipeline.Run(svc, fn, *args)
+
+    def _shutdownTransferPipeline(self):
+        if not self._transferPipeline:
+            return
+        for activityId in list(self._prefetchedDownloads.keys()):
+            prefetched = self._prefetchedDownloads.pop(activityId)
+            if prefetched:
+                prefetched[2].cancel()
+        self._transferPipeline.Shutdown()
+        self._transferPipeline = None
+
+    def _downloadActivity(self, activity):
+        act = None
+        actAvailableFromSvcs = self._downloadSources(activity)
 
         # TODO: redo this, it was completely broken:
         # Prefer retrieving the activity from its original source.
@@ -789,11 +1113,14 @@ class SynchronizationTask:
                 logger.info("\t\t...download retry count exceeded")
                 continue
 
-            workingCopy = copy.copy(activity)  # we can hope
-            # Load in the service data in the same place they left it.
-            workingCopy.ServiceData = workingCopy.ServiceDataCollection[dlSvcRecord._id] if dlSvcRecord._id in workingCopy.ServiceDataCollection else None
+            # The download may already be under way (or done) in the transfer pipeline
+            workingCopy, prefetchedDownload = self._takePrefetchedDownload(activity, dlSvcRecord)
+            phaseStart = time.time()
             try:
-                workingCopy = dlSvc.DownloadActivity(dlSvcRecord, workingCopy)
+                if prefetchedDownload:
+                    workingCopy = prefetchedDownload.result()
+                else:
+                    workingCopy = self._transfer(dlSvc, dlSvc.DownloadActivity, dlSvcRecord, workingCopy)
             except (ServiceException, ServiceWarning) as e:
                 if not _isWarning(e):
                     # Persist the exception if we just exceeded the failure count
@@ -828,6 +1155,8 @@ class SynchronizationTask:
                 self._syncErrors[dlSvcRecord._id].append(packed_exc)
                 activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.DownloadError))
                 continue
+            finally:
+                self._timePhase("download", phaseStart)
 
             activity.Record.ResetFailureCount(dlSvcRecord)
 
@@ -835,6 +1164,7 @@ class SynchronizationTask:
                 logger.info("\t\t...is private and restricted from sync")  # Sync exclusion instead?
                 activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.Private))
                 continue
+            phaseStart = time.time()
             try:
                 workingCopy.CheckSanity()
             except:
@@ -846,14 +1176,18 @@ class SynchronizationTask:
                 act = workingCopy
                 act.SourceConnection = dlSvcRecord
                 break  # succesfully got the activity + passed sanity checks, can stop now
+            finally:
+                self._timePhase("sanity", phaseStart)
         # If nothing was downloaded at this point, the activity record will show the most recent error - which is fine enough, since only one service is needed to get the activity.
         return act, dlSvc
 
-    def _uploadActivity(self, activity, destinationServiceRec):
+    def _uploadActivity(self, activity, destinationServiceRec, pendingUpload=None):
         destSvc = destinationServiceRec.Service
 
         try:
-            return destSvc.UploadActivity(destinationServiceRec, activity)
+            if pendingUpload:
+                return pendingUpload.result()
+            return self._transfer(destSvc, destSvc.UploadActivity, destinationServiceRec, activity)
         except (ServiceException, ServiceWarning) as e:
             if not _isWarning(e):
                 activity.Record.IncrementFailureCount(destinationServiceRec)
@@ -885,7 +1219,7 @@ class SynchronizationTask:
 
     def Run(self, exhaustive=False, null_next_sync_on_unlock=False, heartbeat_callback=None):
         from tapiriik.auth import User
-        from tapiriik.services.interchange import ActivityStatisticUnit
+        from tapiriik.services.interchange import ActivityStatisticUnit, TimestampSanityError
 
         if len(self.user["ConnectedServices"]) <= 1:
             return # Done and done!
@@ -913,7 +1247,12 @@ class SynchronizationTask:
         self._activities = []
         self._excludedServices = {}
         self._deferredServices = []
+        self._transferPipeline = None
+        self._prefetchedDownloads = {}
         self._persistTriggerServices = {}
+        self._writeBuffer = SyncWriteBuffer()
+        self._phaseTimes = {}
+        self._activityPhaseTimes = {}
 
         self._initializePersistedSyncErrorsAndExclusions()
 
@@ -924,45 +1263,41 @@ class SynchronizationTask:
                 # Sort services that don't support exhaustive listing last.
                 # That way, we can provide them with the proper bounds for listing based
                 # on activities from other services.
-                for conn in sorted(self._serviceConnections,
+                listingConnections = sorted(self._serviceConnections,
                                    key=lambda x: x.Service.SupportsExhaustiveListing,
-                                   reverse=True):
-                    # If we're not going to be doing anything anyways, stop now
-                    if len(self._serviceConnections) - len(self._excludedServices) <= 1:
-                        raise SynchronizationCompleteException()
-
-                    self._primeExtendedAuthDetails(conn)
-
-                    logger.info("Ensuring partial sync poll subscription")
-                    self._ensurePartialSyncPollingSubscription(conn)
-
-                    if not exhaustive and conn.Service.PartialSyncRequiresTrigger and "TriggerPartialSync" not in conn.__dict__ and not conn.Service.ShouldForcePartialSyncTrigger(conn):
-                        logger.info("Service %s has not been triggered" % conn.Service.ID)
-                        self._deferredServices.append(conn._id)
-                        continue
-
-                    if not conn.Service.SuppliesActivities:
-                        logger.info("Service %s does not supply activities - deferring listing till first upload" % conn.Service.ID)
-                        self._deferredServices.append(conn._id)
-                        continue
+                                   reverse=True)
+                # Exhaustive listings are bounded by what's already been listed, so they're always done one at a time.
+                if SYNC_LISTING_CONCURRENCY > 1 and not exhaustive:
+                    self._downloadActivityListsConcurrently(listingConnections, heartbeat_callback)
+                else:
+                    for conn in listingConnections:
+                        if not self._prepareActivityListing(conn, exhaustive):
+                            continue
 
-                    if heartbeat_callback:
-                        heartbeat_callback(SyncStep.List)
+                        if heartbeat_callback:
+                            heartbeat_callback(SyncStep.List)
 
-                    self._updateSyncProgress(SyncStep.List, conn.Service.ID)
-                    self._downloadActivityList(conn, exhaustive)
+                        self._updateSyncProgress(SyncStep.List, conn.Service.ID)
+                        self._downloadActivityList(conn, exhaustive)
 
                 self._applyFallbackTZ()
 
                 # Makes reading the logs much easier.
                 self._activities = sorted(self._activities, key=lambda v: v.StartTime.replace(tzinfo=None), reverse=True)
 
+                self._loadSynchronizedActivities()
+
                 totalActivities = len(self._activities)
                 processedActivities = 0
 
-                for activity in self._activities:
+                self._transferPipeline = TransferPipeline(SYNC_PIPELINE_WORKERS) if SYNC_PIPELINE_WORKERS > 0 else None
+
+                for activityIndex, activity in enumerate(self._activities):
+                    # Get the next few downloads going while this one's handled
+                    self._prefetchDownloads(self._activities[activityIndex:activityIndex + 1 + SYNC_PIPELINE_PREFETCH])
                     logger.info(str(activity) + " " + str(activity.UID[:3]) + " from " + str([[y.Service.ID for y in self._serviceConnections if y._id == x][0] for x in activity.ServiceDataCollection.keys()]))
                     logger.info(" Name: %s Notes: %s Distance: %s%s" % (activity.Name[:15] if activity.Name else "", activity.Notes[:15] if activity.Notes else "", activity.Stats.Distance.Value, activity.Stats.Distance.Units))
+                    self._activityPhaseTimes = {}
                     try:
                         activity.Record = self._findOrCreateActivityRecord(activity) # Make it a member of the activity, to avoid passing it around as a seperate parameter everywhere.
 
@@ -974,26 +1309,8 @@ class SynchronizationTask:
 
                         # Check if this is too soon to synchronize
                         if self._user_config["sync_upload_delay"]:
-                            endtime = activity.EndTime
-                            tz = endtime.tzinfo
-                            if not tz and activity.FallbackTZ:
-                                tz = activity.FallbackTZ
-                                endtime = tz.localize(endtime)
-
-                            if tz and endtime: # We can't really know for sure otherwise
-                                time_past = (datetime.utcnow() - endtime.astimezone(pytz.utc).replace(tzinfo=None))
-                                 # I believe astimezone(utc) is scrubbing the DST away - put it back here.
-                                 # We must try this twice because not all of our TZ objects are pytz for... some reason.
-                                 # And, thus, dst() may not accept is_dst.
-
-                                try:
-                                    dst_offset = tz.dst(endtime.replace(tzinfo=None))
-                                except pytz.AmbiguousTimeError:
-                                    dst_offset = tz.dst(endtime.replace(tzinfo=None), is_dst=False)
-
-                                if dst_offset:
-                                    time_past += dst_offset
-
+                            time_past = self._timeSinceActivityEnded(activity)
+                            if time_past is not None: # We can't really know for sure otherwise
                                 time_remaining = timedelta(seconds=self._user_config["sync_upload_delay"]) - time_past
                                 logger.debug(" %s since upload" % time_past)
                                 if time_remaining > timedelta(0):
@@ -1046,20 +1363,9 @@ class SynchronizationTask:
                                 totalActivities -= 1  # Again, doesn't really count.
                                 raise ActivityShouldNotSynchronizeException()
 
-                            has_deferred = False
-                            for conn in eligibleServices:
-                                if conn._id in self._deferredServices:
-                                    logger.info("Doing deferred list from %s" % conn.Service.ID)
-                                    # no_add since...
-                                    #  a) we're iterating over the list it'd be adding to, and who knows what will happen then
-                                    #  b) for the current use of deferred services, we don't care about new activities
-                                    self._downloadActivityList(conn, exhaustive, no_add=True)
-                                    self._deferredServices.remove(conn._id)
-                                    has_deferred = True
-
                             # If we had deferred listing activities from a service, we have to repeat this loop to consider the new info
                             # Otherwise, once was enough
-                            if not has_deferred:
+                            if not self._downloadDeferredActivityLists(eligibleServices, exhaustive):
                                 break
 
 
@@ -1087,10 +1393,17 @@ class SynchronizationTask:
                             raise ActivityShouldNotSynchronizeException()
 
                         full_activity.CleanStats()
-                        full_activity.CleanWaypoints()
 
+                        # Cleans up the waypoints, determines the TZ, and checks the timestamps against it - all in one go
+                        phaseStart = time.time()
                         try:
-                            full_activity.EnsureTZ()
+                            full_activity.Normalize()
+                        except TimestampSanityError as e:
+                            logger.debug("\tDetermined TZ %s" % full_activity.TZ)
+                            logger.warning("\t\t...failed timestamp sanity check - %s" % e)
+                            # self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Timestamp sanity check failed", activity=full_activity, permanent=True))
+                            # activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.SanityError))
+                            # raise ActivityShouldNotSynchronizeException()
                         except Exception as e:
                             logger.error("\tCould not determine TZ %s" % e)
                             self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Could not determine TZ", activity=full_activity, permanent=False))
@@ -1098,24 +1411,18 @@ class SynchronizationTask:
                             raise ActivityShouldNotSynchronizeException()
                         else:
                             logger.debug("\tDetermined TZ %s" % full_activity.TZ)
-
-                        try:
-                            full_activity.CheckTimestampSanity()
-                        except ValueError as e:
-                            logger.warning("\t\t...failed timestamp sanity check - %s" % e)
-                            # self._accumulateExclusions(full_activity.SourceConnection, APIExcludeActivity("Timestamp sanity check failed", activity=full_activity, permanent=True))
-                            # activity.Record.MarkAsNotPresentOtherwise(UserException(UserExceptionType.SanityError))
-                            # raise ActivityShouldNotSynchronizeException()
+                        finally:
+                            self._timePhase("normalize", phaseStart)
 
                         activity.Record.SetActivity(activity) # Update with whatever more accurate information we may have.
+                        self._reindexActivityRecord(activity.Record)
 
                         full_activity.Record = activity.Record # Some services don't return the same object, so this gets lost, which is meh, but...
 
                         successful_destination_service_ids = []
 
+                        uploadDestinations = []
                         for destinationSvcRecord in eligibleServices:
-                            if heartbeat_callback:
-                                heartbeat_callback(SyncStep.Upload)
                             destSvc = destinationSvcRecord.Service
                             if not destSvc.ReceivesStationaryActivities and full_activity.Stationary:
                                 logger.info("\t\t...marked as stationary during download")
@@ -1126,11 +1433,21 @@ class SynchronizationTask:
                                     logger.info("\t\t...marked as non-GPS during download")
                                     activity.Record.MarkAsNotPresentOn(destinationSvcRecord, UserException(UserExceptionType.NonGPSUnsupported))
                                     continue
+                            uploadDestinations.append(destinationSvcRecord)
+
+                        # With the transfer pipeline, these all upload at once - the results are still handled in order
+                        phaseStart = time.time()
+                        pendingUploads = self._startUploads(full_activity, uploadDestinations)
+
+                        for destinationSvcRecord in uploadDestinations:
+                            if heartbeat_callback:
+                                heartbeat_callback(SyncStep.Upload)
+                            destSvc = destinationSvcRecord.Service
 
                             uploaded_external_id = None
                             logger.info("\t  Uploading to " + destSvc.ID)
                             try:
-                                uploaded_external_id = self._uploadActivity(full_activity, destinationSvcRecord)
+                                uploaded_external_id = self._uploadActivity(full_activity, destinationSvcRecord, pendingUploads.get(destinationSvcRecord._id))
                             except UploadException:
                                 continue # At this point it's already been added to the error collection, so we can just bail.
                             logger.info("\t  Uploaded")
@@ -1140,13 +1457,19 @@ class SynchronizationTask:
 
                             if uploaded_external_id:
                                 # record external ID, for posterity (and later debugging)
-                                db.uploaded_activities.insert({"ExternalID": uploaded_external_id, "Service": destSvc.ID, "UserExternalID": destinationSvcRecord.ExternalID, "Timestamp": datetime.utcnow()})
-                            # flag as successful
-                            db.connections.update({"_id": destinationSvcRecord._id},
-                                                  {"$addToSet": {"SynchronizedActivities": {"$each": list(activity.UIDs)}}})
-
-                            db.sync_stats.update({"ActivityID": activity.UID}, {"$addToSet": {"DestinationServices": destSvc.ID, "SourceServices": activitySource.ID}, "$set": {"Distance": activity.Stats.Distance.asUnits(ActivityStatisticUnit.Meters).Value, "Timestamp": datetime.utcnow()}}, upsert=True)
-
+                                self._writeBuffer.RecordUpload({"ExternalID": uploaded_external_id, "Service": destSvc.ID, "UserExternalID": destinationSvcRecord.ExternalID, "Timestamp": datetime.utcnow()})
+                            # flag as successful - written (along with the rest of the buffer) before the next upload's result is handled
+                            self._writeBuffer.AddSynchronizedActivities([destinationSvcRecord._id], activity.UIDs, upload=True)
+                            self._addSynchronizedActivities([destinationSvcRecord._id], activity.UIDs)
+
+                            self._writeBuffer.RecordSyncStats(activity.UID, destSvc.ID, activitySource.ID, activity.Stats.Distance.convertedValue(ActivityStatisticUnit.Meters))
+                            # So a worker killed before the next destination's result comes in doesn't lose the record of this one
+                            # Uploaded inline, that's before the next upload starts - but when _startUploads has handed them all to the
+                            # pipeline, the rest are already under way (or done), so they may still be uploaded again after a crash
+                            self._flushWriteBuffer()
+
+                        if uploadDestinations:
+                            self._timePhase("upload", phaseStart)
                         if len(successful_destination_service_ids):
                             self._pushRecentSyncActivity(full_activity, successful_destination_service_ids)
                         del full_activity
@@ -1154,11 +1477,22 @@ class SynchronizationTask:
                     except ActivityShouldNotSynchronizeException:
                         continue
                     finally:
+                        if self._activityPhaseTimes:
+                            logger.info("\t\tTook %s" % _formatPhaseTimes(self._activityPhaseTimes))
+                        self._discardPrefetchedDownload(activity)
                         del activity
+                        if self._writeBuffer.Due:
+                            self._flushWriteBuffer()
 
             except SynchronizationCompleteException:
                 # This gets thrown when there is obviously nothing left to do - but we still need to clean things up.
                 logger.info("SynchronizationCompleteException thrown")
+            finally:
+                self._shutdownTransferPipeline()
+                self._flushWriteBuffer()
+
+            if self._phaseTimes:
+                logger.info("Time spent synchronizing activities: %s" % _formatPhaseTimes(self._phaseTimes))
 
             logger.info("Writing back service data")
             self._writeBackSyncErrorsAndExclusions()
@@ -0,0 +1,97 @@
+from tapiriik.database import db
+from tapiriik.settings import SYNC_LOG_LIFETIME, SYNC_LOG_MAX_SIZE
+from bson.binary import Binary
+from datetime import datetime
+import collections
+import logging
+import os
+import socket
+import zlib
+
+class SyncLog(logging.Handler):
+    """ Collects a sync's user log in memory, to be written to sync_logs (compressed) in one go once it's done.
+
+        Past MaxSize characters, the middle of the log is dropped - the start and the most recent half are kept.
+    """
+    LogFormat = '[%(levelname)-8s] %(asctime)s (%(name)s:%(lineno)d) %(message)s'
+    LogDateFormat = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, user_id, max_size=SYNC_LOG_MAX_SIZE):
+        super().__init__()
+        self.setFormatter(logging.Formatter(self.LogFormat, self.LogDateFormat))
+        self.UserID = user_id
+        self.Started = datetime.utcnow()
+        self.MaxSize = max_size
+        self._head = []
+        self._headSize = 0
+        self._tail = collections.deque()
+        self._tailSize = 0
+        self._omitted = 0
+
+    def emit(self, record):
+        try:
+            self.Write(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+    def Write(self, text):
+        size = len(text) + 1
+        self.acquire()
+        try:
+            if not self._tail and self._headSize + size <= self.MaxSize // 2:
+                self._head.append(text)
+                self._headSize += size
+                return
+            self._tail.append(text)
+            self._tailSize += size
+            while self._tailSize > self.MaxSize // 2 and len(self._tail) > 1:
+                self._tailSize -= len(self._tail.popleft()) + 1
+                self._omitted += 1
+        finally:
+            self.release()
+
+    def Text(self):
+        self.acquire()
+        try:
+            lines = list(self._head)
+            if self._omitted:
+                lines.append("... %d lines omitted ..." % self._omitted)
+            lines += self._tail
+            return "\n".join(lines) + "\n" if lines else ""
+        finally:
+            self.release()
+
+    def Save(self):
+        SyncLogStore.Save(self)
+
+class SyncLogStore:
+    """ Finished sync logs, one document per sync in sync_logs - they expire after SYNC_LOG_LIFETIME """
+
+    def EnsureIndexes():
+        db.sync_logs.ensure_index([("UserID", 1), ("Timestamp", -1)])
+        db.sync_logs.ensure_index("Finished", expireAfterSeconds=int(SYNC_LOG_LIFETIME.total_seconds()))
+
+    def Save(log):
+        text = log.Text()
+        if not text:
+            return
+        encoded = text.encode("utf-8")
+        db.sync_logs.insert({
+            "UserID": log.UserID,
+            "Timestamp": log.Started,
+            "Finished": datetime.utcnow(),
+            "Host": socket.gethostname(),
+            "Worker": os.getpid(),
+            "Size": len(encoded),
+            "Log": Binary(zlib.compress(encoded))
+        })
+
+    def List(user_id, limit=10):
+        """ The most recent first, without their contents """
+        return list(db.sync_logs.find({"UserID": user_id}, {"Log": False}).sort("Timestamp", -1).limit(limit))
+
+    def Read(user_id, log_id):
+        log = db.sync_logs.find_one({"_id": log_id, "UserID": user_id})
+        if not log:
+            return None
+        return zlib.decompress(log["Log"]).decode("utf-8")
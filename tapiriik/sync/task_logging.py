@@ -0,0 +1,38 @@
+import logging
+import threading
+
+class TaskLogContext:
+    """ Which sync task's log handler records logged on the current thread belong to.
+
+        A single TaskLogRouter sits on the tapiriik logger and hands each record to the handler of the task running on the
+        thread that logged it, so several tasks can run in one process without their user logs bleeding into one another.
+        Work a task hands off to other threads (concurrent listing, the transfer pipeline) has to carry the context along,
+        with Bind.
+    """
+    _local = threading.local()
+
+    def Current():
+        return getattr(TaskLogContext._local, "handler", None)
+
+    def Set(handler):
+        """ Returns the handler that was in place, to be restored once the task is done """
+        previous = TaskLogContext.Current()
+        TaskLogContext._local.handler = handler
+        return previous
+
+    def Bind(fn):
+        """ Wraps fn to log to the calling thread's task, whichever thread it ends up running on """
+        handler = TaskLogContext.Current()
+        def run(*args, **kwargs):
+            previous = TaskLogContext.Set(handler)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                TaskLogContext.Set(previous)
+        return run
+
+class TaskLogRouter(logging.Handler):
+    def emit(self, record):
+        handler = TaskLogContext.Current()
+        if handler is not None:
+            handler.handle(record)
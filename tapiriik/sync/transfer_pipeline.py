@@ -0,0 +1,91 @@
+from .task_logging import TaskLogContext
+from concurrent.futures import ThreadPoolExecutor, Future
+import collections
+import threading
+
+class _ServiceQueue:
+    def __init__(self, limit):
+        self.Limit = limit
+        self.Running = 0
+        self.Waiting = 0 # Inline calls (see Run) waiting for a slot
+        self.Pending = collections.deque() # (future, fn, args) not yet handed to the pool
+
+class TransferPipeline:
+    """ Runs service downloads and uploads for a synchronization on a shared pool of threads.
+
+        Each service has at most PipelineConcurrency of its calls in flight at once - whether they were submitted to
+        the pool or made inline through Run - so requests to any one service are paced exactly as they would be inline
+        (through its own _rate_limit or GlobalRateLimits), while calls to different services overlap. Calls beyond a
+        service's limit wait in its own queue, not on a pool thread, so a slow service can't hold up the others.
+        Only the network calls happen here - their results are handed back to the sync loop, which does all the
+        bookkeeping in the same order as ever.
+    """
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._queues = {}
+        self._lock = threading.Condition()
+
+    def _queue(self, svc):
+        # Call with the lock held
+        if svc.ID not in self._queues:
+            self._queues[svc.ID] = _ServiceQueue(max(1, svc.PipelineConcurrency))
+        return self._queues[svc.ID]
+
+    def _dispatch(self, queue):
+        # Call with the lock held - hands the service's queued calls to the pool while it has slots free
+        # (inline calls waiting on the sync loop get the next free slot first)
+        while queue.Running < queue.Limit and queue.Pending and not queue.Waiting:
+            future, fn, args = queue.Pending.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue # Cancelled while it was queued
+            queue.Running += 1
+            self._executor.submit(self._runQueued, queue, future, fn, args)
+
+    def _runQueued(self, queue, future, fn, args):
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            self._release(queue)
+
+    def _release(self, queue):
+        with self._lock:
+            queue.Running -= 1
+            self._dispatch(queue)
+            self._lock.notify_all()
+
+    def Submit(self, svc, fn, *args):
+        """ Queues fn(*args) to run on the pool as soon as svc has a slot free - returns a Future """
+        future = Future()
+        with self._lock:
+            queue = self._queue(svc)
+            queue.Pending.append((future, TaskLogContext.Bind(fn), args))
+            self._dispatch(queue)
+        return future
+
+    def Run(self, svc, fn, *args):
+        """ Runs fn(*args) on this thread, once svc has a slot free """
+        with self._lock:
+            queue = self._queue(svc)
+            queue.Waiting += 1
+            try:
+                while queue.Running >= queue.Limit:
+                    self._lock.wait()
+            finally:
+                queue.Waiting -= 1
+            queue.Running += 1
+            self._dispatch(queue) # Anything queued behind this call that still fits
+        try:
+            return fn(*args)
+        finally:
+            self._release(queue)
+
+    def Shutdown(self):
+        # Anything still queued has been cancelled by the caller - this waits out whatever was already running
+        with self._lock:
+            for queue in self._queues.values():
+                for future, fn, args in queue.Pending:
+                    future.cancel()
+                queue.Pending.clear()
+        self._executor.shutdown(wait=True)
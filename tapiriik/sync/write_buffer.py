@@ -0,0 +1,83 @@
+from tapiriik.database import db, redis
+from tapiriik.services.synchronized_activities import SynchronizedActivityStore
+from tapiriik.settings import SYNC_WRITE_BUFFER_SIZE, SYNC_WRITE_BUFFER_INTERVAL
+from pymongo import UpdateOne, InsertOne
+from datetime import datetime
+import json
+import time
+
+class SyncWriteBuffer:
+    """ Holds a sync task's bookkeeping writes (synchronized_activities, sync_stats, uploaded_activities and the recent activity list)
+        so they go out as a handful of bulk writes rather than a few round-trips per activity.
+
+        Crash safety: writes that record an upload which has already happened (the destination's synchronized_activities and the
+        uploaded_activities entry) make the buffer Due immediately, and the task flushes straight after each destination's bookkeeping,
+        before the next upload is handled. So a worker killed mid-sync can lose no more than it could before - the upload in flight.
+        Everything else is write-behind, flushed once MaxPending writes or MaxAge seconds have built up, and when the task ends (or
+        fails). Losing those to a crash costs little: synchronized_activities entries for listed activities are re-added at the next
+        listing, and the rest is statistics and the recent-activity list.
+    """
+    def __init__(self, max_pending=SYNC_WRITE_BUFFER_SIZE, max_age=SYNC_WRITE_BUFFER_INTERVAL):
+        self.MaxPending = max_pending
+        self.MaxAge = max_age
+        self._reset()
+
+    def _reset(self):
+        self._synchronizedActivities = {}
+        self._syncStats = {}
+        self._uploads = []
+        self._recentActivity = {}
+        self._pending = 0
+        self._pendingSince = None
+        self._hasUploads = False
+
+    def _add(self, upload=False):
+        if not self._pending:
+            self._pendingSince = time.time()
+        self._pending += 1
+        self._hasUploads = self._hasUploads or upload
+
+    def AddSynchronizedActivities(self, connection_ids, uids, upload=False):
+        for connection_id in connection_ids:
+            self._synchronizedActivities.setdefault(connection_id, set()).update(uids)
+        self._add(upload)
+
+    def RecordSyncStats(self, activity_uid, destination, source, distance):
+        stats = self._syncStats.setdefault(activity_uid, {"DestinationServices": set(), "SourceServices": set()})
+        stats["DestinationServices"].add(destination)
+        stats["SourceServices"].add(source)
+        stats["Distance"] = distance
+        stats["Timestamp"] = datetime.utcnow()
+        self._add()
+
+    def RecordUpload(self, record):
+        self._uploads.append(record)
+        self._add(upload=True)
+
+    def PushRecentActivity(self, key, entry, keep):
+        self._recentActivity.setdefault(key, ([], keep))[0].append(json.dumps(entry))
+        self._add()
+
+    @property
+    def Due(self):
+        return self._hasUploads or self._pending >= self.MaxPending or (self._pending and time.time() - self._pendingSince >= self.MaxAge)
+
+    def Flush(self):
+        if not self._pending:
+            return
+        if self._synchronizedActivities:
+            db.synchronized_activities.bulk_write([operation for connection_id, uids in self._synchronizedActivities.items() for operation in SynchronizedActivityStore.Operations(connection_id, uids)], ordered=False)
+        if self._uploads:
+            db.uploaded_activities.bulk_write([InsertOne(x) for x in self._uploads], ordered=False)
+        if self._syncStats:
+            db.sync_stats.bulk_write([UpdateOne({"ActivityID": activity_uid}, {
+                "$addToSet": {"DestinationServices": {"$each": list(stats["DestinationServices"])}, "SourceServices": {"$each": list(stats["SourceServices"])}},
+                "$set": {"Distance": stats["Distance"], "Timestamp": stats["Timestamp"]}
+            }, upsert=True) for activity_uid, stats in self._syncStats.items()], ordered=False)
+        if self._recentActivity:
+            pipeline = redis.pipeline()
+            for key, (entries, keep) in self._recentActivity.items():
+                pipeline.lpush(key, *entries)
+                pipeline.ltrim(key, 0, keep - 1)
+            pipeline.execute()
+        self._reset()
@@ -1,4 +1,9 @@
 from .sync import *
 from .interchange import *
 from .gpx import *
+from .tcx import *
+from .fit import *
 from .statistics import *
+from .ratelimiting import *
+from .http_sessions import *
+from .tz import *
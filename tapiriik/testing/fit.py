@@ -0,0 +1,151 @@
+from tapiriik.testing.testtools import TestTools, TapiriikTestCase
+from tapiriik.services.fit import FITIO
+from tapiriik.services.interchange import WaypointType, ActivityType
+import struct
+
+
+class FITTests(TapiriikTestCase):
+    def _random_activity(self, actType=ActivityType.Other):
+        svcA, other = TestTools.create_mock_services()
+        svcA.SupportsHR = svcA.SupportsCadence = svcA.SupportsPower = svcA.SupportsTemp = True
+        while True:
+            act = TestTools.create_random_activity(svcA, actType=actType, tz=True)
+            # The first waypoint is always read back as the start, and a pause there would leave the next one looking like a resume
+            if act.GetFlatWaypoints()[0].Type == WaypointType.Start:
+                act.GetFlatWaypoints()[-1].Type = WaypointType.End
+                return act
+
+    def assertFITWaypointsEqual(self, wpa, wpb):
+        self.assertEqual(wpa.Timestamp, wpb.Timestamp)
+        self.assertEqual(wpa.Type, wpb.Type)
+        # Positions are stored as semicircles, altitudes in 0.2m increments
+        self.assertAlmostEqual(wpa.Location.Latitude, wpb.Location.Latitude, places=6)
+        self.assertAlmostEqual(wpa.Location.Longitude, wpb.Location.Longitude, places=6)
+        self.assertAlmostEqual(wpa.Location.Altitude, wpb.Location.Altitude, delta=0.1)
+        self.assertEqual(wpa.HR, wpb.HR)
+        self.assertEqual(wpa.Cadence, wpb.Cadence)
+        self.assertEqual(wpa.RunCadence, wpb.RunCadence)
+        self.assertEqual(wpa.Power, wpb.Power)
+        self.assertEqual(wpa.Temp, wpb.Temp)
+
+    def test_constant_representation(self):
+        ''' ensures that fit import/export is symetric '''
+        act = self._random_activity()
+        act2 = FITIO.Parse(FITIO.Dump(act))
+        act2.TZ = act.TZ
+        act2.AdjustTZ()
+        act2.CalculateUID()
+
+        self.assertEqual(act2.StartTime, act.StartTime)
+        self.assertEqual(act2.EndTime, act.EndTime)
+        self.assertEqual(len(act2.Laps), len(act.Laps))
+        for la, lb in zip(act2.Laps, act.Laps):
+            self.assertEqual(la.StartTime, lb.StartTime)
+            self.assertEqual(la.EndTime, lb.EndTime)
+            self.assertEqual(len(la.Waypoints), len(lb.Waypoints))
+            for wpa, wpb in zip(la.Waypoints, lb.Waypoints):
+                self.assertFITWaypointsEqual(wpa, wpb)
+        self.assertTrue(act2.GPS)
+        self.assertEqual(act2.UID, act.UID)
+
+    def test_run_cadence(self):
+        act = self._random_activity(ActivityType.Running)
+        for wp in act.GetFlatWaypoints():
+            wp.RunCadence, wp.Cadence = wp.Cadence, None
+        act2 = FITIO.Parse(FITIO.Dump(act))
+
+        self.assertEqual(act2.Type, ActivityType.Running)
+        for wpa, wpb in zip(act2.GetFlatWaypoints(), act.GetFlatWaypoints()):
+            self.assertFITWaypointsEqual(wpa, wpb)
+
+    def test_compressed_timestamps(self):
+        act = self._random_activity()
+        mid = FITIO.Dump(act)
+
+        # Rewrite every record after the first to use a compressed timestamp header, as devices do
+        # ...by redefining the record's local message type without its timestamp field
+        data = mid[mid[0]:-2]
+        out = bytearray()
+        definitions = {}
+        compressing = None
+        offset = 0
+        while offset < len(data):
+            header = data[offset]
+            local_no = header & 0xF
+            if header & 0x40:
+                field_count = data[offset + 5]
+                fields = [data[offset + 6 + x * 3:offset + 9 + x * 3] for x in range(field_count)]
+                definitions[local_no] = (struct.unpack_from("<H", data, offset + 3)[0], fields)
+                out += data[offset:offset + 6 + field_count * 3]
+                offset += 6 + field_count * 3
+                continue
+            global_no, fields = definitions[local_no]
+            message = data[offset:offset + 1 + sum(x[1] for x in fields)]
+            offset += len(message)
+            if global_no != 20:
+                out += message
+                continue
+            ts_offset = 1 + sum(x[1] for x in fields[:[x[0] for x in fields].index(253)])
+            if compressing is None:
+                out += message
+                compressing = local_no
+                self.assertLess(local_no, 4)
+                out += bytes([0x40 | local_no, 0, 0, 20, 0, field_count - 1]) + b"".join(x for x in fields if x[0] != 253)
+                continue
+            self.assertEqual(local_no, compressing)
+            timestamp = struct.unpack_from("<I", message, ts_offset)[0]
+            out += bytes([0x80 | (local_no << 5) | (timestamp & 0x1F)]) + message[1:ts_offset] + message[ts_offset + 4:]
+
+        act2 = FITIO.Parse(FITIO._generateHeader(len(out)) + bytes(out) + b"\0\0")
+        self.assertEqual([wp.Timestamp for wp in act2.GetFlatWaypoints()], [wp.Timestamp for wp in act.GetFlatWaypoints()])
+
+    def test_corrupt(self):
+        act = self._random_activity()
+        mid = FITIO.Dump(act)
+        self.assertRaises(ValueError, FITIO.Parse, b"not a fit file")
+        self.assertRaises(ValueError, FITIO.Parse, mid[:len(mid) // 2])
+
+    def test_crc(self):
+        # CRC-16/ARC check value
+        self.assertEqual(FITIO._calculateCRC(b"123456789"), 0xBB3D)
+        mid = FITIO.Dump(self._random_activity())
+        self.assertEqual(FITIO._calculateCRC(mid), 0) # The trailing CRC zeroes it out
+
+    def test_dump_cache(self):
+        act = self._random_activity()
+        while len(act.Laps) < 2: # So there's a lap to drop below
+            act = self._random_activity()
+        mid = FITIO.Dump(act)
+        self.assertIs(FITIO.Dump(act), mid)
+        self.assertIsNot(FITIO.Dump(act, drop_pauses=True), mid)
+
+        act.Laps = act.Laps[:1]
+        act.EndTime = act.Laps[0].EndTime
+        self.assertNotEqual(FITIO.Dump(act), mid)
+        self.assertEqual(FITIO.Parse(FITIO.Dump(act)).CountTotalWaypoints(), act.CountTotalWaypoints())
+
+        # The lap's waypoints swapped out for fewer
+        mid = FITIO.Dump(act)
+        act.Laps[0].Waypoints = act.Laps[0].Waypoints[:-1]
+        self.assertNotEqual(FITIO.Dump(act), mid)
+
+    def test_dump_cache_concurrent(self):
+        import threading
+        act = self._random_activity()
+        encodes = []
+        original_encode = FITIO._encode
+        def countingEncode(act, drop_pauses):
+            encodes.append(drop_pauses)
+            return original_encode(act, drop_pauses)
+        FITIO._encode = countingEncode
+        try:
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(FITIO.Dump(act))) for x in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            FITIO._encode = original_encode
+        self.assertEqual(encodes, [False])
+        self.assertTrue(all(x is results[0] for x in results))
@@ -1,5 +1,6 @@
 from tapiriik.testing.testtools import TestTools, TapiriikTestCase
-from tapiriik.services.gpx import GPXIO
+from tapiriik.services.gpx import GPXIO, _parseTimestamp
+import dateutil.parser
 
 
 class GPXTests(TapiriikTestCase):
@@ -19,3 +20,12 @@ class GPXTests(TapiriikTestCase):
         act.Stats.Distance = act2.Stats.Distance = None  # same here
 
         self.assertActivitiesEqual(act2, act)
+
+    def test_timestamp_fast_path(self):
+        ''' ensures the ISO 8601 fast path agrees with dateutil '''
+        for timestamp in ["2014-01-01T12:00:00Z", "2014-01-01T12:00:00.123Z", "2014-01-01T12:00:00.1234567Z", "2014-01-01T12:00:00+00:00",
+                          "2014-01-01T12:00:00-05:30", "2014-01-01T12:00:00+0200", "2014-01-01T12:00:00", "2014-01-01 12:00:00Z"]:
+            expected = dateutil.parser.parse(timestamp)
+            actual = _parseTimestamp(timestamp)
+            self.assertEqual(actual, expected)
+            self.assertEqual(actual.utcoffset(), expected.utcoffset())
@@ -0,0 +1,57 @@
+from tapiriik.testing.testtools import TapiriikTestCase
+
+from tapiriik.services.http_sessions import HTTPSessions
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import pickle
+import socketserver
+import threading
+import uuid
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b"ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Set-Cookie", "session=%s" % uuid.uuid4())
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class HTTPSessionTests(TapiriikTestCase):
+    def setUp(self):
+        self.server = _Server(("127.0.0.1", 0), _KeepAliveHandler)
+        self.url = "http://127.0.0.1:%d/" % self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reuse(self):
+        service_id = "test-%s" % uuid.uuid4()
+        for x in range(3):
+            self.assertEqual(HTTPSessions.Get(service_id).get(self.url).text, "ok")
+        # New sessions draw on the same pool...
+        session = HTTPSessions.New(service_id)
+        session.get(self.url)
+        session.close()
+        # ...even once they've been through the session cache
+        pickle.loads(pickle.dumps(session)).get(self.url)
+        self.assertEqual(HTTPSessions.Stats()[service_id], {"Requests": 5, "NewConnections": 1, "Reused": 4})
+
+    def test_cookies(self):
+        service_id = "test-%s" % uuid.uuid4()
+        HTTPSessions.Get(service_id).get(self.url)
+        self.assertEqual(len(HTTPSessions.Get(service_id).cookies), 0)
+        session = HTTPSessions.New(service_id)
+        session.get(self.url)
+        self.assertEqual(len(session.cookies), 1)
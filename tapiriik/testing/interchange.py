@@ -1,9 +1,16 @@
 from tapiriik.testing.testtools import TestTools, TapiriikTestCase
 
 from tapiriik.services import Service
-from tapiriik.services.interchange import Activity, ActivityType
+from tapiriik.services.interchange import Activity, ActivityType, ActivityStatisticUnit, Lap, Location, Waypoint, WaypointColumns, WaypointType, TimestampSanityError
+from tapiriik.services.tcx import TCXIO
+from tapiriik.services.stream_sampling import StreamSampler
+import tapiriik.services.tcx
+import tapiriik.services.interchange
 
 from datetime import datetime, timedelta
+import copy
+import pytz
+import random
 
 
 class InterchangeTests(TapiriikTestCase):
@@ -63,3 +70,218 @@ class InterchangeTests(TapiriikTestCase):
 
         # Normal w/ Other + None
         self.assertEqual(ActivityType.PickMostSpecific([ActivityType.Other, ActivityType.Cycling, None, ActivityType.MountainBiking]), ActivityType.MountainBiking)
+
+
+class WaypointColumnsTests(TapiriikTestCase):
+    def _random_activity(self, naive=False):
+        svcA, other = TestTools.create_mock_services()
+        svcA.SupportsHR = svcA.SupportsCadence = svcA.SupportsPower = svcA.SupportsTemp = svcA.SupportsCalories = True
+        act = TestTools.create_random_activity(svcA, tz=True)
+        if naive:
+            act.StartTime = act.StartTime.replace(tzinfo=None)
+            act.EndTime = act.EndTime.replace(tzinfo=None)
+            for lap in act.Laps:
+                lap.StartTime = lap.StartTime.replace(tzinfo=None)
+                lap.EndTime = lap.EndTime.replace(tzinfo=None)
+                for wp in lap.Waypoints:
+                    wp.Timestamp = wp.Timestamp.replace(tzinfo=None)
+        return act
+
+    def test_round_trip(self):
+        act = self._random_activity()
+        wps = act.GetFlatWaypoints()
+        wps[1].Location = None
+        wps[2].Location.Altitude = None
+        wps[2].Distance = 12.5
+        for lap in act.Laps:
+            columns = WaypointColumns(lap.Waypoints)
+            self.assertEqual(len(columns), len(lap.Waypoints))
+            self.assertEqual(list(columns.Snapshots()), lap.Waypoints)
+            self.assertEqual(list(columns), lap.Waypoints)
+            self.assertEqual(columns[-1], lap.Waypoints[-1])
+            self.assertEqual(columns[1:-1], lap.Waypoints[1:-1])
+
+    def test_views_write_through(self):
+        start = datetime(2014, 1, 2, 3, 4, 5)
+        columns = WaypointColumns([Waypoint(start), Waypoint(start + timedelta(seconds=10), location=Location(1, 2, 3), hr=150)])
+        wp = columns[0]
+        wp.HR = 140
+        wp.Type = WaypointType.Pause
+        wp.Location = Location(10, 20, None)
+        wp.Timestamp = start + timedelta(seconds=1)
+        columns[1].Location.Altitude = 30
+        columns[1].HR = None
+
+        self.assertEqual(columns[0], Waypoint(start + timedelta(seconds=1), WaypointType.Pause, Location(10, 20, None), hr=140))
+        self.assertEqual(columns[1], Waypoint(start + timedelta(seconds=10), location=Location(1, 2, 30)))
+        columns[1] = Waypoint(start)
+        self.assertEqual(list(columns.Snapshots())[1], Waypoint(start))
+        self.assertRaises(IndexError, lambda: columns[2])
+
+    def test_timezones(self):
+        # Columns should end up with the same timestamps as lists after DefineTZ/AdjustTZ
+        act = self._random_activity(naive=True)
+        columnAct = Activity(startTime=act.StartTime, endTime=act.EndTime)
+        columnAct.Laps = [Lap(startTime=lap.StartTime, endTime=lap.EndTime, waypointList=WaypointColumns(lap.Waypoints)) for lap in act.Laps]
+        for target in (act, columnAct):
+            target.TZ = pytz.timezone("America/Toronto")
+            target.DefineTZ()
+        self.assertEqual(list(columnAct.ReadFlatWaypoints()), act.GetFlatWaypoints())
+        self.assertEqual([x.Timestamp.utcoffset() for x in columnAct.GetFlatWaypoints()], [x.Timestamp.utcoffset() for x in act.GetFlatWaypoints()])
+
+        for target in (act, columnAct):
+            target.TZ = pytz.timezone("Asia/Kolkata")
+            target.AdjustTZ()
+        self.assertEqual(columnAct.GetFlatWaypoints(), act.GetFlatWaypoints())
+        self.assertEqual([x.Timestamp.utcoffset() for x in columnAct.GetFlatWaypoints()], [x.Timestamp.utcoffset() for x in act.GetFlatWaypoints()])
+
+    def test_parse_into_columns(self):
+        svcA, other = TestTools.create_mock_services()
+        svcA.SupportsHR = svcA.SupportsCadence = svcA.SupportsPower = True
+        act = TestTools.create_random_activity(svcA, tz=True, withPauses=False)
+        for lap in act.Laps:
+            lap.Stats.Distance.Value = 1000
+        tcx = bytes(TCXIO.Dump(act), "UTF-8")
+
+        listAct = TCXIO.Parse(tcx)
+        tapiriik.services.tcx.WAYPOINT_COLUMNS = True
+        try:
+            columnAct = TCXIO.Parse(tcx)
+        finally:
+            tapiriik.services.tcx.WAYPOINT_COLUMNS = False
+        self.assertTrue(all(isinstance(lap.Waypoints, WaypointColumns) for lap in columnAct.Laps))
+        self.assertLapsListsEqual(columnAct.Laps, listAct.Laps)
+        self.assertEqual(TCXIO.Dump(columnAct), TCXIO.Dump(listAct))
+
+class ActivityNormalizationTests(TapiriikTestCase):
+    _random_activity = WaypointColumnsTests._random_activity
+
+    def _dirty_activity(self, naive=False, columns=False):
+        act = self._random_activity(naive=naive)
+        act.Stats.HR.Average = 1
+        act.Stats.Distance.Value = -5
+        act.Laps[0].Stats.Energy.Value = 0
+        wps = act.GetFlatWaypoints()
+        wps[1].HR = -10
+        wps[2].Power = -1
+        wps[-1].Distance = -100
+        if columns:
+            for lap in act.Laps:
+                lap.Waypoints = WaypointColumns(lap.Waypoints)
+        return act
+
+    def _sanity_error(self, fn):
+        try:
+            fn()
+        except TimestampSanityError as e:
+            return str(e)
+
+    def test_normalize(self):
+        # Should come out the same as the separate passes it replaces
+        for tz in (pytz.timezone("Asia/Kolkata"), pytz.FixedOffset(-300)):
+            for naive in (True, False):
+                for columns in (False, True):
+                    act = self._dirty_activity(naive=naive, columns=columns)
+                    act.TZ = tz
+                    expected = copy.deepcopy(act)
+                    expected.CleanStats()
+                    expected.CleanWaypoints()
+                    expected.EnsureTZ()
+                    # (DST-aware zones never pass, as each timestamp gets the tzinfo for its own UTC offset)
+                    act.CleanStats()
+                    self.assertEqual(self._sanity_error(act.Normalize), self._sanity_error(expected.CheckTimestampSanity))
+
+                    self.assertEqual(act.GetFlatWaypoints(), expected.GetFlatWaypoints())
+                    self.assertEqual([x.Timestamp.utcoffset() for x in act.GetFlatWaypoints()], [x.Timestamp.utcoffset() for x in expected.GetFlatWaypoints()])
+                    self.assertEqual((act.StartTime.utcoffset(), act.EndTime.utcoffset()), (expected.StartTime.utcoffset(), expected.EndTime.utcoffset()))
+                    self.assertEqual(act.UID, expected.UID)
+                    self.assertEqual(act.Stats, expected.Stats)
+                    self.assertIsNone(act.Stats.HR.Average)
+                    self.assertIsNone(act.Stats.Distance.Value)
+                    self.assertEqual(act.Laps[0].Stats, expected.Laps[0].Stats)
+                    self.assertEqual(act.GetFlatWaypoints()[1].HR, 0)
+                    self.assertEqual(act.GetFlatWaypoints()[-1].Distance, 0)
+
+    def test_normalize_errors(self):
+        act = self._random_activity(naive=True)
+        act.TZ = pytz.FixedOffset(-300)
+        act.Laps[-1].Waypoints[-1].Timestamp = act.EndTime + timedelta(hours=1)
+        expected = copy.deepcopy(act)
+        expected.EnsureTZ()
+        with self.assertRaises(TimestampSanityError) as expected_error:
+            expected.CheckTimestampSanity()
+        with self.assertRaises(TimestampSanityError) as error:
+            act.Normalize()
+        self.assertEqual(str(error.exception), str(expected_error.exception))
+        self.assertEqual(str(error.exception), "Waypoint occurs too far after lap")
+        # ...but the waypoints are all in the TZ regardless
+        self.assertEqual(act.GetFlatWaypoints(), expected.GetFlatWaypoints())
+
+        # Problems finding a TZ aren't sanity check failures
+        act = self._random_activity(naive=True)
+        act.TZ = None
+        for wp in act.GetFlatWaypoints():
+            wp.Location = None
+        with self.assertRaises(Exception) as error:
+            act.Normalize()
+        self.assertNotIsInstance(error.exception, TimestampSanityError)
+
+    def test_localizer(self):
+        # Should give what localize() does, right up to (and through) DST transitions
+        rng = random.Random(42)
+        for zone in ("America/Toronto", "Europe/London", "Australia/Lord_Howe", "Asia/Kolkata", "UTC"):
+            tz = pytz.timezone(zone)
+            localize = tapiriik.services.interchange._localizer(tz)
+            timestamp = datetime(2014, 1, 1)
+            while timestamp < datetime(2016, 1, 1):
+                timestamp += timedelta(seconds=rng.choice([1, 60, 1800, 3600 * 6, 86400 * 3]))
+                expected = tz.localize(timestamp)
+                localized = localize(timestamp)
+                self.assertEqual(localized, expected)
+                self.assertIs(localized.tzinfo, expected.tzinfo)
+
+    def test_localizer_dst_gap(self):
+        # 02:30 doesn't exist on the day the clocks go forward - whatever localize() makes of it mustn't stick for the summer
+        tz = pytz.timezone("America/New_York")
+        localize = tapiriik.services.interchange._localizer(tz)
+        for timestamp in (datetime(2024, 3, 10, 2, 30), datetime(2024, 6, 1, 12), datetime(2024, 3, 10, 3, 30), datetime(2024, 11, 3, 1, 30), datetime(2024, 12, 1, 12)):
+            expected = tz.localize(timestamp)
+            localized = localize(timestamp)
+            self.assertEqual(localized, expected)
+            self.assertIs(localized.tzinfo, expected.tzinfo)
+
+class StreamSamplerTests(TapiriikTestCase):
+    streams = {
+        "hr": [(0, 100), (2, 110), (2, 111), (5, 120)],
+        "path": [(1, "a"), (2, "b"), (6, "c")],
+        "cadence": [(3, None), (4, 80)]
+    }
+    expected = [
+        (0, (100, None, None)),
+        (1, (100, "a", None)),
+        (2, (110, "b", None)),
+        (2, (111, "b", None)), # Each sample is kept, even at the same offset
+        (3, (111, "b", None)),
+        (4, (111, "b", 80)),
+        (5, (120, "b", 80)),
+        (6, (120, "c", 80))
+    ]
+
+    def test_sample(self):
+        self.assertEqual(list(StreamSampler.Sample(self.streams, ("hr", "path", "cadence"))), self.expected)
+        # Streams can be generators, or missing entirely
+        streams = {k: (x for x in v) for k, v in self.streams.items()}
+        self.assertEqual([values for offset, values in StreamSampler.Sample(streams, ("path", "speed"))][-1], ("c", None))
+
+    def test_columns(self):
+        offsets, columns = StreamSampler.SampleColumns(self.streams, ("hr", "path", "cadence"))
+        self.assertEqual(offsets, [x[0] for x in self.expected])
+        self.assertEqual(columns["path"], [x[1][1] for x in self.expected])
+
+    def test_callback(self):
+        calls = []
+        StreamSampler.SampleWithCallback(lambda offset, **kwargs: calls.append((offset, kwargs)), self.streams)
+        self.assertEqual(len(calls), len(self.expected))
+        # Streams are only passed once they've started (even if their value is None)
+        self.assertEqual(calls[0], (0, {"hr": 100}))
+        self.assertEqual(calls[4], (3, {"hr": 111, "path": "b", "cadence": None}))
@@ -0,0 +1,129 @@
+from tapiriik.testing.testtools import TapiriikTestCase
+
+from tapiriik.services.ratelimiting import RateLimit, RateLimitExceededException
+from tapiriik.services.pacing import Pacer, PacingScope
+import tapiriik.services.ratelimiting as ratelimiting
+import tapiriik.services.pacing as pacing
+from tapiriik.database import redis, ratelimit as rl_db
+from tapiriik import settings
+from datetime import timedelta
+import socket
+import threading
+import unittest
+import uuid
+
+def _redis_available():
+    try:
+        return redis is not None and redis.ping()
+    except Exception:
+        return False
+
+class RateLimitTests(TapiriikTestCase):
+
+    @unittest.skipUnless(_redis_available(), "requires Redis")
+    def test_token_bucket(self):
+        key = "test-%s" % uuid.uuid4()
+        limits = [(timedelta(seconds=100), 50), (timedelta(hours=1), 1000)]
+        # The 100s limit's bucket holds 5 (10%), refilling at 45/100s
+        for x in range(5):
+            self.assertEqual(RateLimit.Acquire(key, limits), 0)
+        retry_after = RateLimit.Acquire(key, limits)
+        self.assertTrue(0 < retry_after <= 100 / 45)
+        # ...and nothing is taken from any of the buckets when one comes up short
+        self.assertTrue(RateLimit.Acquire(key, limits, tokens=3) > retry_after)
+
+        with self.assertRaises(RateLimitExceededException) as cm:
+            RateLimit.Limit(key, limits)
+        self.assertTrue(0 < cm.exception.RetryAfter <= 100 / 45)
+        RateLimit.Limit(key, limits, max_wait=5)
+
+        with self.assertRaises(ValueError):
+            RateLimit.Acquire(key, limits, tokens=6)
+
+    def test_window_fallback(self):
+        key = "test-%s" % uuid.uuid4()
+        limits = [(timedelta(hours=1), 3)]
+        RateLimit.Refresh(key, limits)
+        real_redis = ratelimiting.redis
+        ratelimiting.redis = None
+        try:
+            for x in range(4):
+                RateLimit.Limit(key, limits)
+            with self.assertRaises(RateLimitExceededException) as cm:
+                RateLimit.Limit(key, limits)
+            self.assertTrue(0 <= cm.exception.RetryAfter <= 3600)
+            self.assertEqual(rl_db.limits.find_one({"Key": key})["Count"], 4)
+            # No limits, nothing to check
+            RateLimit.Limit(key, [])
+        finally:
+            ratelimiting.redis = real_redis
+
+class PacingTests(TapiriikTestCase):
+
+    def _check_spacing(self):
+        service_id = "test-%s" % uuid.uuid4()
+        requests = [(PacingScope.Global, 20), (PacingScope.Account, 10)]
+        waits = []
+        def reserve(account):
+            waits.append((account, Pacer.Reserve(service_id, requests, account=account)))
+        threads = [threading.Thread(target=reserve, args=(account,)) for account in ["a"] * 4 + ["b"] * 4]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Every request gets its own slot, 1/20s apart globally...
+        # (waits are from whenever each caller read the clock, so allow for a little jitter between that and its reservation)
+        slots = sorted(wait for account, wait in waits)
+        self.assertTrue(slots[0] <= 0.05)
+        for earlier, later in zip(slots, slots[1:]):
+            self.assertTrue(later - earlier >= 0.035, slots)
+        # ...and 1/10s apart for the same account
+        for account in ("a", "b"):
+            slots = sorted(wait for x, wait in waits if x == account)
+            for earlier, later in zip(slots, slots[1:]):
+                self.assertTrue(later - earlier >= 0.085, slots)
+        # Without an account, only the global pacing applies
+        self.assertTrue(Pacer.Reserve(service_id, requests) > slots[-1])
+        return service_id
+
+    @unittest.skipUnless(_redis_available(), "requires Redis")
+    def test_shared_pacing(self):
+        service_id = self._check_spacing()
+        stats = Pacer.Stats(service_id)
+        self.assertEqual(stats["pacing:%s:global" % service_id]["Requests"], 9)
+        self.assertEqual(stats["pacing:%s:account" % service_id]["Requests"], 8)
+        self.assertTrue(stats["pacing:%s:global" % service_id]["MaxWait"] >= 0.4)
+        # The stats are let go of once the service isn't being used
+        self.assertTrue(0 < redis.ttl("pacing:%s:account:stats" % service_id) <= Pacer.StatsTTL)
+
+    def test_local_pacing(self):
+        real_redis = pacing.redis
+        pacing.redis = None
+        try:
+            self._check_spacing()
+        finally:
+            pacing.redis = real_redis
+
+    def test_unreachable_redis(self):
+        from redis.exceptions import ConnectionError as RedisConnectionError
+        class UnreachableRedis:
+            def register_script(self, script):
+                raise RedisConnectionError("Connection refused")
+        real_redis, real_script = pacing.redis, Pacer._reserveScript
+        pacing.redis, Pacer._reserveScript = UnreachableRedis(), None
+        try:
+            self._check_spacing()
+        finally:
+            pacing.redis, Pacer._reserveScript = real_redis, real_script
+
+    def test_source_address_key(self):
+        real_source_addr = settings.HTTP_SOURCE_ADDR
+        try:
+            settings.HTTP_SOURCE_ADDR = "10.0.0.2"
+            self.assertEqual(Pacer._key("svc", PacingScope.SourceAddress), "pacing:svc:source:10.0.0.2")
+            # Wildcards, or the unresolved list outside the workers, go by the host instead of sharing one key
+            for source_addr in ["0.0.0.0", "::", ["10.0.0.2", "10.0.0.3"]]:
+                settings.HTTP_SOURCE_ADDR = source_addr
+                self.assertEqual(Pacer._key("svc", PacingScope.SourceAddress), "pacing:svc:source:%s" % socket.gethostname())
+        finally:
+            settings.HTTP_SOURCE_ADDR = real_source_addr
@@ -1,6 +1,11 @@
 from tapiriik.testing.testtools import TapiriikTestCase
 
-from tapiriik.services.interchange import ActivityStatistic, ActivityStatisticUnit
+from tapiriik.services.interchange import ActivityStatistic, ActivityStatisticUnit, Activity, Lap, Waypoint, WaypointType, WaypointColumns, Location
+from tapiriik.services.statistic_calculator import ActivityStatisticCalculator
+from tapiriik.services.auto_pause import AutoPauseCalculator
+from datetime import datetime, timedelta
+import math
+import random
 
 
 class StatisticTests(TapiriikTestCase):
@@ -67,6 +72,20 @@ class StatisticTests(TapiriikTestCase):
         stat = ActivityStatistic(ActivityStatisticUnit.KilometersPerHour, value=100)
         self.assertEqual(stat.asUnits(ActivityStatisticUnit.KilometersPerHour).Value, 100)
 
+    def test_unitconv_converted_value(self):
+        stat = ActivityStatistic(ActivityStatisticUnit.MilesPerHour, value=10, max=20)
+        for units in (ActivityStatisticUnit.MilesPerHour, ActivityStatisticUnit.KilometersPerHour, ActivityStatisticUnit.MetersPerSecond, ActivityStatisticUnit.MinutesPerKilometer, ActivityStatisticUnit.HundredYardsPerHour):
+            converted = stat.asUnits(units)
+            self.assertEqual(stat.convertedValue(units), converted.Value)
+            self.assertEqual(stat.convertedValue(units, "Max"), converted.Max)
+            self.assertIsNone(stat.convertedValue(units, "Min"))
+            if units != ActivityStatisticUnit.MilesPerHour:
+                self.assertEqual(ActivityStatistic.convertValue(10, ActivityStatisticUnit.MilesPerHour, units), converted.Value)
+        self.assertIn((ActivityStatisticUnit.MilesPerHour, ActivityStatisticUnit.MinutesPerKilometer), ActivityStatistic._conversionStepCache)
+        self.assertRaises(ValueError, stat.convertedValue, ActivityStatisticUnit.Meters)
+        # Nothing to convert, so nothing to fail on
+        self.assertIsNone(ActivityStatistic(ActivityStatisticUnit.MilesPerHour).asUnits(ActivityStatisticUnit.Meters).Value)
+
     def test_stat_coalesce(self):
         stat1 = ActivityStatistic(ActivityStatisticUnit.Meters, value=1)
         stat2 = ActivityStatistic(ActivityStatisticUnit.Meters, value=2)
@@ -181,3 +200,261 @@ class StatisticTests(TapiriikTestCase):
         self.assertEqual(stat1.Value, 2)
         self.assertEqual(stat1.Max, 2)
         self.assertEqual(stat1.Gain, 3)
+
+
+# The one-metric-at-a-time calculations ActivityStatisticCalculator used to do, to check it against
+def _reference_distance(waypoints):
+    dist = 0
+    altHold = None
+    lastTimestamp = lastLoc = None
+    for wp in waypoints:
+        timeDelta = wp.Timestamp - lastTimestamp if lastTimestamp else None
+        lastTimestamp = wp.Timestamp
+        if wp.Type == WaypointType.Pause or (timeDelta and timeDelta > ActivityStatisticCalculator.ImplicitPauseTime):
+            lastLoc = None
+            continue
+        loc = wp.Location
+        if loc is None or loc.Longitude is None or loc.Latitude is None:
+            continue
+        if loc and lastLoc:
+            altHold = lastLoc.Altitude if lastLoc.Altitude is not None else altHold
+            latRads = loc.Latitude * math.pi / 180
+            meters_lat_degree = 1000 * 111.13292 + 1.175 * math.cos(4 * latRads) - 559.82 * math.cos(2 * latRads)
+            meters_lon_degree = 1000 * 111.41284 * math.cos(latRads) - 93.5 * math.cos(3 * latRads)
+            dx = (loc.Longitude - lastLoc.Longitude) * meters_lon_degree
+            dy = (loc.Latitude - lastLoc.Latitude) * meters_lat_degree
+            dz = loc.Altitude - altHold if loc.Altitude is not None and altHold is not None else 0
+            dist += math.sqrt(dx ** 2 + dy ** 2 + dz ** 2)
+        lastLoc = loc
+    return dist
+
+def _reference_timer_time(waypoints):
+    duration = timedelta(0)
+    lastTimestamp = None
+    for wpt in waypoints:
+        delta = wpt.Timestamp - lastTimestamp if lastTimestamp else None
+        lastTimestamp = wpt.Timestamp
+        if wpt.Type is WaypointType.Pause:
+            lastTimestamp = None
+        elif delta and delta > ActivityStatisticCalculator.ImplicitPauseTime:
+            delta = None
+        if delta:
+            duration += delta
+    return duration
+
+def _reference_hr(waypoints):
+    hrs = [wp.HR for wp in waypoints if wp.HR]
+    return (sum(hrs) / len(hrs), max(hrs)) if hrs else (None, None)
+
+def _random_activity(rng, laps=3, points=200, columns=False):
+    act = Activity()
+    timestamp = datetime(2015, 6, 1, 7, 30)
+    lat, lon, alt = 45.0 + rng.random(), -75.0 + rng.random(), 100.0
+    for lap_idx in range(laps):
+        waypoints = []
+        for x in range(points):
+            # Mostly a second apart, with the odd implicit pause
+            timestamp += timedelta(seconds=rng.choice([1, 1, 1, 2, 5]) if rng.random() > 0.01 else 120)
+            lat += (rng.random() - 0.5) / 5000
+            lon += (rng.random() - 0.5) / 5000
+            alt += rng.random() - 0.5
+            location = None
+            if rng.random() > 0.05:
+                location = Location(lat, lon, alt if rng.random() > 0.1 else None)
+            wp_type = WaypointType.Pause if rng.random() < 0.02 else WaypointType.Regular
+            hr = rng.choice([None, 0, rng.randint(80, 190), rng.randint(80, 190)])
+            waypoints.append(Waypoint(timestamp, ptType=wp_type, location=location, hr=hr, cadence=rng.randint(0, 100), power=rng.choice([None, rng.randint(0, 400)])))
+        act.Laps.append(Lap(waypointList=WaypointColumns(waypoints) if columns else waypoints))
+    return act
+
+class StatisticCalculatorTests(TapiriikTestCase):
+
+    def test_matches_scalar(self):
+        rng = random.Random(1234)
+        for columns in (False, True):
+            for x in range(5):
+                act = _random_activity(rng, columns=columns)
+                waypoints = act.ReadFlatWaypoints()
+                stats = ActivityStatisticCalculator.Calculate(act)
+                self.assertAlmostEqual(stats.Distance.Value, _reference_distance(waypoints), places=6)
+                self.assertAlmostEqual(stats.TimerTime.Value, _reference_timer_time(waypoints).total_seconds(), places=6)
+                ref_avg_hr, ref_max_hr = _reference_hr(waypoints)
+                self.assertAlmostEqual(stats.HR.Average, ref_avg_hr, places=6)
+                self.assertEqual(stats.HR.Max, ref_max_hr)
+                self.assertEqual(stats.Cadence.Max, max(wp.Cadence for wp in waypoints))
+                self.assertTrue(0 < stats.MovingTime.Value <= stats.TimerTime.Value)
+
+                self.assertAlmostEqual(ActivityStatisticCalculator.CalculateDistance(act), _reference_distance(waypoints), places=6)
+                self.assertEqual(ActivityStatisticCalculator.CalculateTimerTime(act), _reference_timer_time(waypoints))
+                self.assertEqual(ActivityStatisticCalculator.CalculateAverageMaxHR(act)[1], ref_max_hr)
+
+                # Ranges, by waypoint...
+                start, end = 50, 450
+                self.assertAlmostEqual(ActivityStatisticCalculator.CalculateDistance(act, waypoints[start], waypoints[end]), _reference_distance(waypoints[start:end + 1]), places=6)
+                self.assertEqual(ActivityStatisticCalculator.CalculateTimerTime(act, waypoints[start], waypoints[end]), _reference_timer_time(waypoints[start:end + 1]))
+                # ...and by lap
+                lap_stats = ActivityStatisticCalculator.CalculateLaps(act)
+                self.assertEqual(len(lap_stats), len(act.Laps))
+                for lap, lap_stat in zip(act.Laps, lap_stats):
+                    lap_waypoints = list(lap.ReadWaypoints())
+                    self.assertAlmostEqual(lap_stat.Distance.Value, _reference_distance(lap_waypoints), places=6)
+                    self.assertAlmostEqual(lap_stat.TimerTime.Value, _reference_timer_time(lap_waypoints).total_seconds(), places=6)
+
+    def test_distance_mixed_laps(self):
+        rng = random.Random(4321)
+        act = _random_activity(rng, laps=4)
+        for lap in act.Laps[1::2]:
+            lap.Waypoints = WaypointColumns(lap.Waypoints)
+        waypoints = act.ReadFlatWaypoints()
+        self.assertAlmostEqual(ActivityStatisticCalculator.CalculateDistance(act), _reference_distance(waypoints), places=6)
+        self.assertAlmostEqual(ActivityStatisticCalculator.CalculateDistance(act), ActivityStatisticCalculator.Calculate(act).Distance.Value, places=6)
+        self.assertAlmostEqual(ActivityStatisticCalculator.CalculateDistance(act, waypoints[150], waypoints[650]), _reference_distance(waypoints[150:651]), places=6)
+        self.assertEqual(ActivityStatisticCalculator.CalculateDistance(Activity()), 0)
+
+    def test_elevation_moving_time(self):
+        start = datetime(2015, 6, 1, 7, 30)
+        waypoints = [
+            Waypoint(start, location=Location(45, -75, 100)),
+            Waypoint(start + timedelta(seconds=10), location=Location(45.001, -75, 110)), # ~111m
+            Waypoint(start + timedelta(seconds=20), location=Location(45.001, -75, 108)), # Standing still
+            Waypoint(start + timedelta(seconds=30), location=Location(45.001, -75, 110), hr=0),
+            Waypoint(start + timedelta(seconds=40), location=Location(45.002, -75, None), hr=150),
+        ]
+        stats = ActivityStatisticCalculator.Calculate(Activity(lapList=[Lap(waypointList=waypoints)]))
+        self.assertEqual(stats.TimerTime.Value, 40)
+        self.assertEqual(stats.MovingTime.Value, 20)
+        self.assertEqual(stats.Elevation.Gain, 12)
+        self.assertEqual(stats.Elevation.Loss, 2)
+        self.assertEqual((stats.Elevation.Min, stats.Elevation.Max), (100, 110))
+        self.assertEqual((stats.HR.Average, stats.HR.Max), (150, 150))
+        self.assertIsNone(stats.Power.Average)
+        self.assertAlmostEqual(stats.Speed.Average, stats.Distance.Value / 20 * 3.6)
+
+    def test_timer_time_errors(self):
+        start = datetime(2015, 6, 1, 7, 30)
+        act = Activity(lapList=[Lap(waypointList=[Waypoint(start), Waypoint(start + timedelta(seconds=1))])])
+        with self.assertRaises(ValueError):
+            ActivityStatisticCalculator.CalculateTimerTime(act)
+        act.Laps[0].Waypoints.append(Waypoint(start + timedelta(hours=1)))
+        act.Laps[0].Waypoints[1].Timestamp = start
+        act.Laps[0].Waypoints[2].Timestamp = start
+        with self.assertRaises(ValueError):
+            ActivityStatisticCalculator.CalculateTimerTime(act)
+
+
+# The two-pass, sort-everything AutoPauseCalculator.calculate that waypoint_types replaced
+def _reference_auto_pause(waypoints, target_duration):
+    def pairwise(gen):
+        return zip(gen, gen[1:])
+
+    inter_wp_times = []
+    inter_wp_distances_with_times = []
+    delta_t_frequencies = {}
+    for wp_a, wp_b in pairwise(waypoints):
+        delta_t = (wp_b.Timestamp - wp_a.Timestamp).total_seconds()
+        delta_t_frequencies[round(delta_t)] = delta_t_frequencies.get(round(delta_t), 0) + 1
+        inter_wp_times.append(delta_t)
+        if wp_a.Location and wp_b.Location and wp_a.Location.Latitude is not None and wp_b.Location.Latitude is not None:
+            inter_wp_distances_with_times.append(((wp_a.Location.Latitude - wp_b.Location.Latitude) ** 2 + (wp_a.Location.Longitude - wp_b.Location.Longitude) ** 2, delta_t))
+    inter_wp_times.sort(reverse=True)
+    inter_wp_distances_with_times.sort(key=lambda x: x[0])
+    delta_t_mode = sorted(delta_t_frequencies.items(), key=lambda x: x[1])[-1][0]
+    elapsed_duration = (waypoints[-1].Timestamp - waypoints[0].Timestamp).total_seconds()
+
+    recovered_duration = 0
+    auto_pause_time_threshold = None
+    for new_thresh in inter_wp_times:
+        if elapsed_duration - recovered_duration <= target_duration or new_thresh <= delta_t_mode * 2:
+            break
+        auto_pause_time_threshold = new_thresh
+        recovered_duration += auto_pause_time_threshold
+    auto_pause_dist_threshold = None
+    for delta_d, delta_t in inter_wp_distances_with_times:
+        if elapsed_duration - recovered_duration <= target_duration:
+            break
+        auto_pause_dist_threshold = delta_d
+        recovered_duration += delta_t
+
+    types = []
+    in_pause = False
+    for wp_a, wp_b in pairwise(waypoints):
+        delta_t = (wp_b.Timestamp - wp_a.Timestamp).total_seconds()
+        delta_d = None
+        if wp_a.Location and wp_b.Location and wp_a.Location.Latitude is not None and wp_b.Location.Latitude is not None:
+            delta_d = (wp_a.Location.Latitude - wp_b.Location.Latitude) ** 2 + (wp_a.Location.Longitude - wp_b.Location.Longitude) ** 2
+        if ((auto_pause_time_threshold is not None and delta_t > auto_pause_time_threshold) or (auto_pause_dist_threshold is not None and delta_d is not None and delta_d < auto_pause_dist_threshold)) and recovered_duration > 0:
+            recovered_duration -= delta_t
+            types.append(WaypointType.Pause)
+            in_pause = True
+        else:
+            types.append(WaypointType.Resume if in_pause else WaypointType.Regular)
+            in_pause = False
+    types.append(WaypointType.Resume if in_pause else WaypointType.Regular)
+    return types
+
+def _recorded_waypoints(rng, points=2000):
+    # Something like a recording off a watch: a fix every second or so, with GPS dropouts, stops at lights, and the odd
+    # stretch where the recording was paused - and no explicit pauses, since that's when auto-pause kicks in
+    waypoints = []
+    timestamp = datetime(2015, 6, 1, 7, 30)
+    lat, lon = 45.0 + rng.random(), -75.0 + rng.random()
+    stopped = 0
+    for x in range(points):
+        if rng.random() < 0.003:
+            timestamp += timedelta(seconds=rng.randint(60, 900))
+        else:
+            timestamp += timedelta(seconds=rng.choice([1, 1, 1, 1, 2]))
+        if stopped:
+            # (GPS never quite holds still)
+            stopped -= 1
+            lat += (rng.random() - 0.5) / 1000000
+            lon += (rng.random() - 0.5) / 1000000
+        else:
+            if rng.random() < 0.01:
+                stopped = rng.randint(5, 60)
+            lat += (rng.random() - 0.3) / 20000
+            lon += (rng.random() - 0.3) / 20000
+        location = Location(lat, lon, 100) if rng.random() > 0.02 else None
+        waypoints.append(Waypoint(timestamp, location=location))
+    return waypoints
+
+class AutoPauseTests(TapiriikTestCase):
+
+    def test_matches_reference(self):
+        rng = random.Random(4321)
+        for x in range(20):
+            waypoints = _recorded_waypoints(rng)
+            elapsed = (waypoints[-1].Timestamp - waypoints[0].Timestamp).total_seconds()
+            for target in (elapsed, elapsed * 0.9, elapsed * 0.6, elapsed * 0.3, timedelta(seconds=elapsed * 0.75)):
+                expected = _reference_auto_pause(waypoints, target if type(target) is float else target.total_seconds())
+                self.assertEqual(list(AutoPauseCalculator.waypoint_types(waypoints, target)), expected)
+                self.assertEqual(list(AutoPauseCalculator.calculate(waypoints, target)), expected)
+
+    def test_pauses(self):
+        start = datetime(2015, 6, 1, 7, 30)
+        waypoints = [Waypoint(start + timedelta(seconds=x), location=Location(45 + x / 10000, -75, None)) for x in range(10)]
+        # A 10 minute gap (paused on the watch), then half a minute slowly coming to a stop...
+        waypoints += [Waypoint(start + timedelta(seconds=600 + x), location=Location(45.001 + x * x / 100000000, -75, None)) for x in range(30)]
+        # ...and a 5 minute gap
+        waypoints += [Waypoint(start + timedelta(seconds=930 + x), location=Location(45.002 + x / 10000, -75, None)) for x in range(10)]
+        types = list(AutoPauseCalculator.calculate(waypoints, 30))
+        self.assertEqual(len(types), len(waypoints))
+        self.assertEqual(types[:9], [WaypointType.Regular] * 9)
+        # The thresholds are the last interval they had to take in to hit the target - so the 5 minute gap itself isn't paused,
+        # and nor is the fastest of the slow intervals
+        self.assertEqual(types[9:26], [WaypointType.Pause] * 17)
+        self.assertEqual(types[26], WaypointType.Resume)
+        self.assertEqual(types[27:], [WaypointType.Regular] * 23)
+        # Already short enough
+        self.assertEqual(list(AutoPauseCalculator.calculate(waypoints, timedelta(hours=1))), [WaypointType.Regular] * len(waypoints))
+
+    def test_stationary(self):
+        # No movement at all to tell pauses apart by
+        start = datetime(2015, 6, 1, 7, 30)
+        waypoints = [Waypoint(start + timedelta(seconds=x), location=Location(45, -75, None)) for x in range(60)]
+        with self.assertRaises(ValueError):
+            AutoPauseCalculator.waypoint_types(waypoints, 20)
+
+    def test_few_waypoints(self):
+        self.assertEqual(list(AutoPauseCalculator.calculate([], 10)), [])
+        self.assertEqual(list(AutoPauseCalculator.calculate([Waypoint(datetime(2015, 6, 1, 7, 30))], 10)), [WaypointType.Regular])
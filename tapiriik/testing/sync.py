@@ -1,7 +1,8 @@
 from tapiriik.testing.testtools import TestTools, TapiriikTestCase
 
 from tapiriik.sync import SynchronizationTask
-from tapiriik.sync.activity_record import ActivityRecord
+from tapiriik.sync.activity_record import ActivityRecord, ActivityRecordStore
+from tapiriik.database import db
 from tapiriik.services import UserException, UserExceptionType
 from tapiriik.services.api import APIExcludeActivity
 from tapiriik.services.interchange import Activity, ActivityType
@@ -604,3 +605,485 @@ class SyncTests(TapiriikTestCase):
         eligible = s._determineEligibleRecipientServices(act, recipientServices)
         self.assertTrue(recA in eligible)
         self.assertTrue(recB in eligible)
+
+    def test_activity_matcher_window_parity(self):
+        ''' ensure the bucketed matcher picks the same duplicate the original sorted-window scan would have '''
+        import bisect
+        import random
+        from tapiriik.sync.activity_matcher import ActivityMatcher
+
+        def window_scan(activities, act):
+            # The pre-ActivityMatcher approach - bisect to +/- 38 hours, then test everything in between
+            act_naive = act.StartTime.replace(tzinfo=None)
+            fake = Activity()
+            fake.StartTime = act_naive - ActivityMatcher.TimezoneErrorPeriod
+            right = bisect.bisect_right(activities, fake)
+            fake.StartTime = act_naive + ActivityMatcher.TimezoneErrorPeriod
+            left = bisect.bisect_left(activities, fake)
+            for x in activities[left:right]:
+                if reference._matches(act, x):
+                    return x
+            return None
+
+        reference = ActivityMatcher([])
+        rng = random.Random(42)
+        tz = pytz.timezone("America/Denver")
+        types = [ActivityType.Running, ActivityType.Cycling, ActivityType.MountainBiking, ActivityType.Other]
+        base = datetime(2015, 3, 1)
+        sorted_activities = []
+        matcher = ActivityMatcher([])
+        for i in range(600):
+            act = Activity()
+            start = base + timedelta(minutes=rng.randint(0, 60 * 24 * 20), seconds=rng.choice([0, 0, 30, 59]))
+            start += rng.choice([timedelta(0), timedelta(0), timedelta(hours=rng.randint(-7, 7)), timedelta(minutes=30), timedelta(seconds=rng.randint(-200, 200))])
+            act.StartTime = tz.localize(start) if rng.random() < 0.5 else start
+            act.Type = rng.choice(types)
+            act.CalculateUID()
+            expected = window_scan(sorted_activities, act)
+            self.assertIs(matcher.Find(act), expected)
+            if expected is None:
+                bisect.insort_left(sorted_activities, act)
+                matcher.Add(act)
+
+    def test_concurrent_listing_merge_order(self):
+        ''' ensure that concurrently-retrieved activity lists are merged in the order they'd have been listed sequentially '''
+        import time
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        recB = TestTools.create_mock_svc_record(svcB)
+        actA = TestTools.create_blank_activity(svcA, record=recA)
+        actA.Name = "From A"
+        actB = TestTools.create_blank_activity(svcB, record=recB)
+        actB.StartTime = actA.StartTime
+        actB.Name = "From B"
+        actB.CalculateUID()
+
+        def slowListing(svcRecord, exhaustive):
+            time.sleep(0.2)
+            return [copy.deepcopy(actA)], []
+        svcA.DownloadActivityList = slowListing
+        svcB.DownloadActivityList = lambda svcRecord, exhaustive: ([copy.deepcopy(actB)], [])
+
+        s = SynchronizationTask(TestTools.create_mock_user())
+        s._serviceConnections = [recA, recB]
+        s._activities = []
+        s._excludedServices = {}
+        s._deferredServices = []
+        s._hasTransientSyncErrors = {}
+        s._syncErrors = {recA._id: [], recB._id: []}
+        s._syncExclusions = {recA._id: {}, recB._id: {}}
+        s._downloadActivityListsConcurrently([recA, recB])
+
+        self.assertEqual(len(s._activities), 1)
+        self.assertEqual(s._activities[0].Name, actA.Name)  # A finished listing last, but was first in line
+        self.assertTrue(recA._id in s._activities[0].ServiceDataCollection)
+        self.assertTrue(recB._id in s._activities[0].ServiceDataCollection)
+
+    def test_activity_record_index(self):
+        ''' ensure indexed activity record lookup finds the same record a scan over all of them would '''
+        import random
+        svcA, svcB = TestTools.create_mock_services()
+        history = TestTools.create_activity_history(5000)
+        rng = random.Random(7)
+
+        s = SynchronizationTask(None)
+        s._activityRecords = []
+        s._activityRecordIndex = {}
+        s._activityRecordPositions = {}
+        for act in history:
+            record = ActivityRecord.FromActivity(act)
+            record.UIDs = set(act.UIDs)
+            if rng.random() < 0.1:
+                record.UIDs.add(rng.choice(history).UID)  # some records overlap
+            s._activityRecords.append(record)
+            s._indexActivityRecord(record, len(s._activityRecords) - 1)
+
+        for idx in range(500):
+            act = rng.choice(history)
+            probe = Activity()
+            probe.StartTime = act.StartTime
+            probe.UIDs = set([act.UID, rng.choice(history).UID]) if rng.random() < 0.5 else set([act.UID])
+            expected = [x for x in s._activityRecords if x.UIDs & probe.UIDs][0]
+            self.assertIs(s._findOrCreateActivityRecord(probe), expected)
+
+        fresh = TestTools.create_activity_history(1)[0]
+        fresh.StartTime += timedelta(days=1)
+        fresh.CalculateUID()
+        fresh.UIDs = set([fresh.UID])
+        record = s._findOrCreateActivityRecord(fresh)
+        self.assertIs(s._activityRecords[-1], record)
+        self.assertIs(s._findOrCreateActivityRecord(fresh), record)
+
+        # A record picking up new UIDs when updated from its activity
+        fresh.UIDs = set([fresh.UID, "new-uid"])
+        record.SetActivity(fresh)
+        s._reindexActivityRecord(record)
+        probe = Activity()
+        probe.UIDs = set(["new-uid"])
+        self.assertIs(s._findOrCreateActivityRecord(probe), record)
+
+    def test_synchronized_activities_lookup(self):
+        ''' ensure recipients are decided the same way against long SynchronizedActivities lists, and uploads are accounted for '''
+        svcA, svcB = TestTools.create_mock_services()
+        svcB.SupportedActivities = svcA.SupportedActivities
+        recA = TestTools.create_mock_svc_record(svcA)
+        recB = TestTools.create_mock_svc_record(svcB)
+        recB._id = recA._id + "B"
+        history = TestTools.create_activity_history(10000, svcA, record=recA)
+        recB.SynchronizedActivities = [x.UID for x in history[::2]]
+        for act in history:
+            act.Type = svcA.SupportedActivities[0]
+            act.Record = ActivityRecord.FromActivity(act)
+
+        s = SynchronizationTask(None)
+        s._serviceConnections = [recA, recB]
+        for idx, act in enumerate(history):
+            self.assertEqual(s._determineRecipientServices(act), [] if idx % 2 == 0 else [recB])
+
+        s._addSynchronizedActivities([recB._id], history[1].UIDs)
+        self.assertEqual(s._determineRecipientServices(history[1]), [])
+
+    def test_synchronized_activities_deferred_listing(self):
+        ''' ensure UIDs merged in by a deferred listing are looked up too, so connections with the activity under one of them aren't sent it again '''
+        from tapiriik.services.synchronized_activities import SynchronizedActivityStore
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        recB = TestTools.create_mock_svc_record(svcB)
+        recC = TestTools.create_mock_svc_record(svcB)
+        recA._id, recB._id, recC._id = "deferred-A", "deferred-B", "deferred-C"
+        actA = TestTools.create_blank_activity(svcA, svcB.SupportedActivities[0], record=recA)
+        actB = TestTools.create_blank_activity(svcB, svcB.SupportedActivities[0], record=recB)
+        actA.StartTime = datetime(2011, 12, 13, 14, 15, 16)
+        actB.StartTime = actA.StartTime + timedelta(seconds=1)
+        actA.CalculateUID()
+        actB.CalculateUID()
+        self.assertNotEqual(actA.UID, actB.UID)
+        SynchronizedActivityStore.Add(recC._id, [actB.UID])
+
+        s = SynchronizationTask(None)
+        s._serviceConnections = [recA, recB, recC]
+        s._deferredServices = [recB._id]
+        s._downloadActivityList = lambda conn, exhaustive, no_add=False: s._accumulateActivities(conn, [actB], no_add=no_add)
+        s._activities = []
+        s._accumulateActivities(recA, [actA])
+        s._loadSynchronizedActivities()
+        self.assertEqual(s._determineRecipientServices(actA), [recB, recC])
+
+        self.assertTrue(s._downloadDeferredActivityLists([recB, recC], False))
+        self.assertEqual(actA.UIDs, set([actA.UID, actB.UID]))
+        self.assertEqual(s._determineRecipientServices(actA), [])
+        self.assertFalse(s._downloadDeferredActivityLists([recB, recC], False))
+
+    def test_activity_record_persistence(self):
+        ''' ensure activity records migrate from the single-document layout, and only changed records are written back '''
+        user = TestTools.create_mock_user()
+        user["_id"] = "records-" + user["_id"]
+        history = TestTools.create_activity_history(20)
+        legacy = []
+        for act in history:
+            legacy.append({"StartTime": act.StartTime, "EndTime": act.EndTime, "Type": act.Type, "Name": act.Name, "Notes": None, "Private": False, "Stationary": False,
+                           "Distance": 1000, "UIDs": list(act.UIDs), "Prescence": {}, "Abscence": {}, "FailureCounts": {"mockA": 1}})
+        legacy.append({"StartTime": history[0].StartTime})  # No UIDs, gets dropped
+        db.activity_records.insert({"UserID": user["_id"], "Activities": legacy})
+
+        s = SynchronizationTask(user)
+        s._initializeActivityRecords()
+        self.assertIsNone(db.activity_records.find_one({"UserID": user["_id"]}))
+        self.assertEqual([x.UIDs for x in s._activityRecords], [x.UIDs for x in history])
+        self.assertEqual(ActivityRecordStore.TotalDistance(user["_id"]), 20 * 1000)
+
+        written = []
+        original_write = ActivityRecordStore.Write
+        def recordingWrite(user_id, records, removed_keys=None):
+            written.append(([x[0] for x in records], list(removed_keys or [])))
+            original_write(user_id, records, removed_keys)
+        ActivityRecordStore.Write = recordingWrite
+        try:
+            # Touched but unchanged (though with the times as an activity would set them - local, and to the microsecond), changed, and new
+            unchanged = s._findOrCreateActivityRecord(history[1])
+            unchanged.StartTime = pytz.utc.localize(unchanged.StartTime).astimezone(pytz.timezone("America/Toronto"))
+            unchanged.EndTime = unchanged.EndTime.replace(microsecond=250)
+            s._findOrCreateActivityRecord(history[2]).Name = "Renamed"
+            fresh = TestTools.create_activity_history(1)[0]
+            fresh.StartTime += timedelta(days=1)
+            fresh.CalculateUID()
+            fresh.UIDs = set([fresh.UID])
+            s._findOrCreateActivityRecord(fresh)
+            s._dropUntouchedActivityRecords()
+            s._writeBackActivityRecords()
+        finally:
+            ActivityRecordStore.Write = original_write
+
+        self.assertEqual(sorted(written[0][0]), sorted([history[2].UID, fresh.UID]))
+        self.assertEqual(len(written[0][1]), 18)
+        stored = list(ActivityRecordStore.Page(user["_id"], ["Name", "UIDs"]))
+        self.assertEqual([x["UIDs"] for x in stored], [[fresh.UID], [history[1].UID], [history[2].UID]])
+        self.assertEqual(stored[2]["Name"], "Renamed")
+
+        # A legacy document turning up again doesn't roll back what's been written since
+        db.activity_records.insert({"UserID": user["_id"], "Activities": [dict(legacy[2], Name="Stale")]})
+        self.assertEqual(ActivityRecordStore.MigrateUser(user["_id"]), 1)
+        self.assertEqual([x["Name"] for x in ActivityRecordStore.Page(user["_id"], ["Name"])][2], "Renamed")
+
+        ActivityRecordStore.ClearFailureCounts(user["_id"], "mockA")
+        self.assertEqual([x["FailureCounts"] for x in ActivityRecordStore.Page(user["_id"], ["FailureCounts"]) ], [{}, {}, {}])
+        ActivityRecordStore.Remove(user["_id"])
+        self.assertEqual(ActivityRecordStore.TotalDistance(user["_id"]), None)
+
+    def test_activity_record_resync_unchanged(self):
+        ''' ensure activities listed again, with nothing new about them, don't have their records rewritten '''
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        user = TestTools.create_mock_user()
+        user["_id"] = "resync-" + user["_id"]
+        history = TestTools.create_activity_history(10, svcA, record=recA)
+
+        written = []
+        original_write = ActivityRecordStore.Write
+        def recordingWrite(user_id, records, removed_keys=None):
+            written.append((len(records), len(removed_keys or [])))
+            original_write(user_id, records, removed_keys)
+        ActivityRecordStore.Write = recordingWrite
+        try:
+            for x in range(2):
+                s = SynchronizationTask(user)
+                s._serviceConnections = [recA]
+                s._initializeActivityRecords()
+                for act in history:
+                    act.Record = s._findOrCreateActivityRecord(act)
+                    s._updateActivityRecordInitialPrescence(act)
+                s._dropUntouchedActivityRecords()
+                s._writeBackActivityRecords()
+        finally:
+            ActivityRecordStore.Write = original_write
+
+        self.assertEqual(written, [(10, 0), (0, 0)])
+        ActivityRecordStore.Remove(user["_id"])
+
+    def test_write_buffer(self):
+        ''' ensure buffered bookkeeping writes coalesce, and uploads make the buffer due straight away '''
+        from tapiriik.sync.write_buffer import SyncWriteBuffer
+        from tapiriik.services.synchronized_activities import SynchronizedActivityStore
+        connA = {"_id": "write-buffer-A"}
+        connB = {"_id": "write-buffer-B"}
+        SynchronizedActivityStore.Add(connA["_id"], ["existing"])
+
+        buffer = SyncWriteBuffer(max_pending=3, max_age=3600)
+        buffer.AddSynchronizedActivities([connA["_id"], connB["_id"]], set(["uid1"]))
+        buffer.AddSynchronizedActivities([connA["_id"]], set(["uid2", "existing"]))
+        self.assertFalse(buffer.Due)
+        buffer.RecordSyncStats("write-buffer-uid", "mockB", "mockA", 1000)
+        self.assertTrue(buffer.Due)
+        buffer.Flush()
+        self.assertFalse(buffer.Due)
+        present = SynchronizedActivityStore.Lookup([connA["_id"], connB["_id"]], ["existing", "uid1", "uid2", "uid3"])
+        self.assertEqual(present, {connA["_id"]: set(["existing", "uid1", "uid2"]), connB["_id"]: set(["uid1"])})
+
+        buffer.AddSynchronizedActivities([connB["_id"]], set(["uid3"]), upload=True)
+        self.assertTrue(buffer.Due)
+        buffer.RecordSyncStats("write-buffer-uid", "mockC", "mockA", 1000)
+        buffer.Flush()
+        self.assertEqual(sorted(db.sync_stats.find_one({"ActivityID": "write-buffer-uid"})["DestinationServices"]), ["mockB", "mockC"])
+
+    def test_synchronized_activities_migration(self):
+        ''' ensure SynchronizedActivities arrays move out of connections, and only the listed activities are looked up '''
+        from tapiriik.services.synchronized_activities import SynchronizedActivityStore
+        svcA, svcB = TestTools.create_mock_services()
+        history = TestTools.create_activity_history(50)
+        connA = {"_id": "migrate-A", "Service": svcA.ID, "SynchronizedActivities": [x.UID for x in history]}
+        connB = {"_id": "migrate-B", "Service": svcB.ID, "SynchronizedActivities": [x.UID for x in history[::2]]}
+        db.connections.insert(connA)
+        db.connections.insert(connB)
+        user = {"_id": "migrate-user", "ConnectedServices": [{"ID": connA["_id"]}, {"ID": connB["_id"]}]}
+
+        s = SynchronizationTask(user)
+        s._loadServiceData()
+        self.assertFalse("SynchronizedActivities" in db.connections.find_one({"_id": connA["_id"]}))
+        self.assertEqual(SynchronizedActivityStore.Count(connA["_id"]), 50)
+        self.assertEqual(SynchronizedActivityStore.Count(connB["_id"]), 25)
+        self.assertEqual(SynchronizedActivityStore.MigrateConnection(connB["_id"], connB["SynchronizedActivities"]), 25)  # Repeats are harmless
+        self.assertEqual(SynchronizedActivityStore.Count(connB["_id"]), 25)
+
+        s._activities = history[:3]
+        s._loadSynchronizedActivities()
+        recA, recB = sorted(s._serviceConnections, key=lambda x: x._id)
+        self.assertEqual(s._synchronizedActivities(recA), set(x.UID for x in history[:3]))
+        self.assertEqual(s._synchronizedActivities(recB), set([history[0].UID, history[2].UID]))
+
+    def test_scheduler_shards(self):
+        ''' ensure scheduler shards queue each due user exactly once, and put back those the broker didn't confirm '''
+        from tapiriik.sync.scheduler import SyncScheduler
+
+        class RecordingPublisher:
+            def __init__(self, reject):
+                self.Messages = []
+                self.Reject = reject
+
+            def Publish(self, messages):
+                self.Messages += messages
+                return [key for key, body, routing_key in messages if key in self.Reject]
+
+        now = datetime.utcnow()
+        due = ["sched-due-%d" % x for x in range(25)]
+        for idx, user_id in enumerate(due):
+            db.users.insert({"_id": user_id, "NextSynchronization": now - timedelta(minutes=idx), "SynchronizationHostRestriction": "host-a" if idx == 3 else None})
+        db.users.insert({"_id": "sched-later", "NextSynchronization": now + timedelta(hours=1)})
+        db.users.insert({"_id": "sched-queued", "NextSynchronization": now - timedelta(hours=1), "QueuedAt": now})
+
+        rejected = set(["sched-due-7"])
+        publishers = [RecordingPublisher(reject=rejected), RecordingPublisher(reject=rejected)]
+        shards = [SyncScheduler(publisher, shard=idx, shards=2, batch_size=5) for idx, publisher in enumerate(publishers)]
+        queued, more_due = shards[1].ScheduleBatch()
+        self.assertEqual((queued, more_due), (5, True))
+        # The most overdue are queued first
+        self.assertEqual([x[0] for x in publishers[1].Messages], ["sched-due-23", "sched-due-21", "sched-due-19", "sched-due-17", "sched-due-15"])
+        while any(queued or more_due for queued, more_due in [x.ScheduleBatch() for x in shards]):
+            pass
+
+        published = [x[0] for x in publishers[0].Messages + publishers[1].Messages]
+        self.assertEqual(sorted(set(published)), sorted(due))
+        self.assertEqual(len(published) - published.count("sched-due-7"), 24)
+        self.assertEqual(shards[0].Stats["Unconfirmed"] + shards[1].Stats["Unconfirmed"], published.count("sched-due-7"))
+        self.assertEqual(shards[0].Stats["Claimed"] + shards[1].Stats["Claimed"], 24)
+        for key, body, routing_key in publishers[0].Messages + publishers[1].Messages:
+            user = db.users.find_one({"_id": key})
+            self.assertEqual(routing_key, "host-a" if key == "sched-due-3" else "")
+            if key == "sched-due-7":
+                # Released without its generation, so a message that got through after all is discarded by the worker
+                self.assertFalse("QueuedAt" in user)
+                self.assertFalse("QueuedGeneration" in user)
+                self.assertIsNotNone(user["NextSynchronization"])
+            else:
+                self.assertEqual(body, {"user_id": key, "generation": user["QueuedGeneration"]})
+                self.assertFalse("NextSynchronization" in user)
+        self.assertFalse("QueuedGeneration" in db.users.find_one({"_id": "sched-later"}))
+        self.assertFalse("QueuedGeneration" in db.users.find_one({"_id": "sched-queued"}))
+
+        # ...and once the broker comes around, the unconfirmed user goes out again under a new generation
+        rejected.clear()
+        self.assertEqual(shards[0].ScheduleBatch(), (1, False))
+        self.assertEqual(publishers[0].Messages[-1][1]["generation"], db.users.find_one({"_id": "sched-due-7"})["QueuedGeneration"])
+
+    def test_task_log_context(self):
+        ''' ensure concurrent sync tasks each log only their own records - including those logged by threads they hand work to '''
+        import logging
+        import threading
+        from tapiriik.sync.task_logging import TaskLogContext
+        from tapiriik.sync.transfer_pipeline import TransferPipeline
+        svcA, svcB = TestTools.create_mock_services()
+        task_logger = logging.getLogger("tapiriik.testing.task")
+        pipeline = TransferPipeline(4)
+
+        class ListHandler(logging.Handler):
+            def __init__(self):
+                super().__init__()
+                self.Messages = []
+
+            def emit(self, record):
+                self.Messages.append(record.getMessage())
+
+        handlers = [ListHandler(), ListHandler()]
+        barrier = threading.Barrier(2)
+
+        def task(idx):
+            previous = TaskLogContext.Set(handlers[idx])
+            barrier.wait()
+            task_logger.info("task %d" % idx)
+            pipeline.Submit(svcA, task_logger.info, "task %d pipeline" % idx).result()
+            TaskLogContext.Set(previous)
+
+        threads = [threading.Thread(target=task, args=(idx,)) for idx in range(2)]
+        [x.start() for x in threads]
+        [x.join() for x in threads]
+        pipeline.Shutdown()
+        task_logger.info("no task")
+
+        self.assertEqual(handlers[0].Messages, ["task 0", "task 0 pipeline"])
+        self.assertEqual(handlers[1].Messages, ["task 1", "task 1 pipeline"])
+        self.assertIsNone(TaskLogContext.Current())
+
+    def test_sync_log(self):
+        ''' ensure sync logs are kept in memory until saved, bounded by dropping the middle, and can be read back '''
+        import logging
+        from bson.objectid import ObjectId
+        from tapiriik.sync.sync_log import SyncLog, SyncLogStore
+        from tapiriik.sync.task_logging import TaskLogContext
+        user_id = ObjectId()
+        sync_log = SyncLog(user_id, max_size=300)
+        previous = TaskLogContext.Set(sync_log)
+        logging.getLogger("tapiriik.testing.synclog").info("first")
+        TaskLogContext.Set(previous)
+        for idx in range(50):
+            sync_log.Write("line %d" % idx)
+        self.assertEqual(SyncLogStore.List(user_id), [])
+
+        sync_log.Save()
+        logs = SyncLogStore.List(user_id)
+        self.assertEqual(len(logs), 1)
+        self.assertFalse("Log" in logs[0])
+        text = SyncLogStore.Read(user_id, logs[0]["_id"])
+        self.assertEqual(text, sync_log.Text())
+        lines = text.splitlines()
+        self.assertTrue(lines[0].endswith("first"))
+        self.assertEqual(lines[-1], "line 49")
+        self.assertTrue(any(x.startswith("... ") and x.endswith(" lines omitted ...") for x in lines))
+        self.assertTrue(len(text) <= 300 + len("... 50 lines omitted ...\n"))
+        self.assertIsNone(SyncLogStore.Read(ObjectId(), logs[0]["_id"]))
+
+    def test_transfer_pipeline_service_concurrency(self):
+        ''' ensure the transfer pipeline never has more of a service's calls in flight than it allows '''
+        import threading
+        import time
+        from tapiriik.sync.transfer_pipeline import TransferPipeline
+        svcA, svcB = TestTools.create_mock_services()
+        svcB.PipelineConcurrency = 2
+        inFlight = {svcA.ID: 0, svcB.ID: 0}
+        maxInFlight = {svcA.ID: 0, svcB.ID: 0}
+        lock = threading.Lock()
+
+        def transfer(svc):
+            with lock:
+                inFlight[svc.ID] += 1
+                maxInFlight[svc.ID] = max(maxInFlight[svc.ID], inFlight[svc.ID])
+            time.sleep(0.05)
+            with lock:
+                inFlight[svc.ID] -= 1
+            return svc.ID
+
+        pipeline = TransferPipeline(6)
+        transfers = [pipeline.Submit(svc, transfer, svc) for svc in [svcA, svcB] * 3]
+        self.assertEqual([x.result() for x in transfers], [svcA.ID, svcB.ID] * 3)
+        pipeline.Shutdown()
+
+        self.assertEqual(maxInFlight[svcA.ID], 1)
+        self.assertEqual(maxInFlight[svcB.ID], 2)
+
+        # Inline calls count against the service's limit too
+        inFlight = {svcA.ID: 0, svcB.ID: 0}
+        maxInFlight = {svcA.ID: 0, svcB.ID: 0}
+        pipeline = TransferPipeline(6)
+        transfers = [pipeline.Submit(svcA, transfer, svcA) for x in range(2)]
+        self.assertEqual(pipeline.Run(svcA, transfer, svcA), svcA.ID)
+        self.assertEqual([x.result() for x in transfers], [svcA.ID] * 2)
+        pipeline.Shutdown()
+        self.assertEqual(maxInFlight[svcA.ID], 1)
+
+    def test_transfer_pipeline_no_starvation(self):
+        ''' ensure a service waiting on its own calls doesn't hold up the pool for the others '''
+        import threading
+        from tapiriik.sync.transfer_pipeline import TransferPipeline
+        svcA, svcB = TestTools.create_mock_services()
+        svcA.PipelineConcurrency = svcB.PipelineConcurrency = 1
+        release = threading.Event()
+
+        pipeline = TransferPipeline(2)
+        blocked = [pipeline.Submit(svcA, release.wait, 5) for x in range(3)]
+        try:
+            # Only one of svcA's calls holds a thread, so the other is free for svcB
+            self.assertEqual(pipeline.Submit(svcB, lambda: svcB.ID).result(timeout=5), svcB.ID)
+            self.assertEqual(pipeline.Run(svcB, lambda: svcB.ID), svcB.ID)
+            self.assertFalse(any(x.done() for x in blocked))
+        finally:
+            release.set()
+        self.assertTrue(all(x.result() for x in blocked))
+        pipeline.Shutdown()
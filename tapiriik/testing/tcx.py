@@ -0,0 +1,56 @@
+from tapiriik.testing.testtools import TestTools, TapiriikTestCase
+from tapiriik.services.tcx import TCXIO
+from tapiriik.services.interchange import Activity, ActivityStatistic, ActivityStatisticUnit, ActivityType, Lap, Location, Waypoint, WaypointType
+from datetime import datetime, timedelta
+import pytz
+
+
+class TCXTests(TapiriikTestCase):
+    def _random_tcx(self):
+        svcA, other = TestTools.create_mock_services()
+        svcA.SupportsHR = svcA.SupportsCadence = svcA.SupportsPower = True
+        act = TestTools.create_random_activity(svcA, tz=True, withPauses=False)
+        for lap in act.Laps:
+            lap.Stats.Distance = ActivityStatistic(ActivityStatisticUnit.Meters, value=1000)  # Required by the parser
+        return act, TCXIO.Dump(act)
+
+    def _fixed_tcx(self):
+        # Everything as TCX can represent it exactly - in particular, each lap ends on its last waypoint
+        tz = pytz.timezone("America/Atikokan")
+        act = Activity(actType=ActivityType.Running, tz=tz)
+        timestamp = tz.localize(datetime(2011, 12, 13, 14, 15, 16))
+        for lap_idx in range(3):
+            lap = Lap(startTime=timestamp)
+            lap.Stats.Distance = ActivityStatistic(ActivityStatisticUnit.Meters, value=1000)  # Required by the parser
+            for idx in range(40):
+                wp = Waypoint(timestamp, location=Location(45 + idx * 0.0001, -75 - lap_idx * 0.001, 100 + idx), hr=float(120 + idx), power=float(200 + lap_idx), cadence=float(80 + idx % 5))
+                lap.Waypoints.append(wp)
+                timestamp += timedelta(seconds=10)
+            lap.EndTime = lap.Waypoints[-1].Timestamp
+            act.Laps.append(lap)
+        act.Laps[0].Waypoints[0].Type = WaypointType.Start
+        act.Laps[-1].Waypoints[-1].Type = WaypointType.End
+        act.StartTime = act.Laps[0].StartTime
+        act.EndTime = act.Laps[-1].EndTime
+        return act, TCXIO.Dump(act)
+
+    def test_constant_representation(self):
+        ''' ensures that tcx import/export is symetric '''
+        act, mid = self._fixed_tcx()
+
+        act2 = TCXIO.Parse(bytes(mid, "UTF-8"))
+        act2.TZ = act.TZ
+        act2.AdjustTZ()
+
+        self.assertLapsListsEqual(act2.Laps, act.Laps)
+        self.assertEqual(act2.StartTime, act.StartTime)
+        self.assertEqual(act2.EndTime, act.EndTime)
+
+    def test_lap_errors_precede_trackpoint_errors(self):
+        ''' ensures the streaming parser reports the same problem a tree walk would find first '''
+        act, mid = self._random_tcx()
+        mid = mid.replace("<Time>", "<Tyme>", 1).replace("</Time>", "</Tyme>", 1)
+        self.assertRaisesRegex(ValueError, "Trackpoint without timestamp", TCXIO.Parse, bytes(mid, "UTF-8"))
+
+        mid = mid.replace("<TotalTimeSeconds>", "<TotalTimeSecondz>", 1).replace("</TotalTimeSeconds>", "</TotalTimeSecondz>", 1)
+        self.assertRaisesRegex(ValueError, "Missing lap TotalTimeSeconds", TCXIO.Parse, bytes(mid, "UTF-8"))
@@ -165,6 +165,19 @@ class TestTools:
 
         return act
 
+    def create_activity_history(count, svc=None, record=None):
+        ''' creates a long run of blank activities (one every 8 hours, most recent first), as a heavy user's sync history would have '''
+        activities = []
+        start = datetime(2015, 6, 1, 7, 30)
+        for idx in range(count):
+            act = TestTools.create_blank_activity(svc, record=record)
+            act.StartTime = start - timedelta(hours=8 * idx)
+            act.EndTime = act.StartTime + timedelta(minutes=45)
+            act.CalculateUID()
+            act.UIDs = set([act.UID])
+            activities.append(act)
+        return activities
+
     def create_mock_service(id):
         mock = MockServiceA()
         mock.ID = id
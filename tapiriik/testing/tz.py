@@ -0,0 +1,168 @@
+from tapiriik.testing.testtools import TapiriikTestCase
+
+from tapiriik.database import cachedb
+from tapiriik.settings import MONGO_HOST, MONGO_CLIENT_OPTIONS
+from tapiriik.database.tz import TZCache
+from tapiriik.database.tz_index import TZIndex
+import tapiriik.database.tz as tz
+import os
+import shutil
+from pymongo import MongoClient
+import tempfile
+import unittest
+
+def _mongo_available():
+    # With a client of its own, so it doesn't wait out the shared connection's (much longer) server selection timeout
+    try:
+        client = MongoClient(host=MONGO_HOST, **dict(MONGO_CLIENT_OPTIONS, serverSelectionTimeoutMS=1000))
+        try:
+            return client.admin.command("ping")["ok"]
+        finally:
+            client.close()
+    except Exception:
+        return False
+
+def _box(min_lng, min_lat, max_lng, max_lat):
+    return [[min_lng, min_lat], [max_lng, min_lat], [max_lng, max_lat], [min_lng, max_lat], [min_lng, min_lat]]
+
+# Test/Outer has a hole, partly filled by Test/Island - the rest of the hole belongs to neither
+# Test/East runs up to (but not over) the antimeridian, with Test/Split on both sides of it
+_BOUNDARIES = [
+    ("Test/Outer", {"type": "Polygon", "coordinates": [_box(10, 40, 20, 50), _box(14, 44, 16, 46)]}),
+    ("Test/Island", {"type": "Polygon", "coordinates": [_box(14.5, 44.5, 15.5, 45.5)]}),
+    ("Test/East", {"type": "Polygon", "coordinates": [_box(170, -20, 179.5, -10)]}),
+    ("Test/Split", {"type": "MultiPolygon", "coordinates": [[_box(175, 30, 180, 35)], [_box(-180, 30, -175, 35)]]}),
+    ("Test/Outer", {"type": "Polygon", "coordinates": [_box(-60, -10, -50, 0)]}),
+]
+
+class TZIndexTests(TapiriikTestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, "tz.idx")
+        TZIndex.Build(self._path, _BOUNDARIES)
+        self.index = TZIndex(self._path)
+
+    def tearDown(self):
+        self.index.Close()
+        shutil.rmtree(self._dir)
+
+    def test_build(self):
+        # Each TZID once, however many polygons it has
+        self.assertEqual(self.index.TZIDs, ["Test/Outer", "Test/Island", "Test/East", "Test/Split"])
+        self.assertEqual(len(self.index._PolyTZ), 6)
+        self.assertEqual(self.index.Intersecting(-5, -55), "Test/Outer")
+        # Nothing was built over the empty grid cells
+        self.assertIsNone(self.index.Intersecting(0, 0))
+
+        not_an_index = os.path.join(self._dir, "not.idx")
+        with open(not_an_index, "wb") as f:
+            f.write(b"\0" * 64)
+        with self.assertRaises(ValueError):
+            TZIndex(not_an_index)
+
+    def test_intersecting_holes(self):
+        self.assertEqual(self.index.Intersecting(42, 12), "Test/Outer")
+        self.assertEqual(self.index.Intersecting(45, 15), "Test/Island")
+        # In Test/Outer's hole, but not on Test/Island
+        self.assertIsNone(self.index.Intersecting(45.8, 14.2))
+        # ...nearer Test/Island than the hole's edge
+        self.assertEqual(self.index.Nearest(45.6, 15, 200000), "Test/Island")
+        self.assertEqual(self.index.Nearest(45.9, 15, 200000), "Test/Outer")
+        self.assertIsNone(self.index.Intersecting(55, 15))
+
+    def test_nearest_antimeridian(self):
+        # ~75km east of Test/East, over the antimeridian
+        self.assertEqual(self.index.Nearest(-15, -179.8, 200000), "Test/East")
+        self.assertIsNone(self.index.Nearest(-15, -179.8, 50000))
+        # Either side of the antimeridian in Test/Split
+        self.assertEqual(self.index.Intersecting(32, 179.9), "Test/Split")
+        self.assertEqual(self.index.Intersecting(32, -179.9), "Test/Split")
+        self.assertEqual(self.index.Nearest(36, -179.9, 200000), "Test/Split")
+        self.assertIsNone(self.index.Nearest(60, -179.9, 200000))
+
+class TZCacheTests(TapiriikTestCase):
+
+    # Out at sea, a cell apart - nothing else looks these up
+    _points = [(-40.5 + x * 0.01, -120.5) for x in range(4)]
+
+    @classmethod
+    def setUpClass(cls):
+        # Checked here rather than when the module's imported, so only these tests wait on it
+        if not _mongo_available():
+            raise unittest.SkipTest("requires Mongo")
+
+    def setUp(self):
+        self._lookups = []
+        def countingLookup(lat, lng):
+            self._lookups.append((lat, lng))
+            return "Test/Zone"
+        self._realLookup, self._realLocalSize = tz.TZLookup, tz.TZ_CACHE_LOCAL_SIZE
+        tz.TZLookup = countingLookup
+        self._clear()
+
+    def tearDown(self):
+        tz.TZLookup, tz.TZ_CACHE_LOCAL_SIZE = self._realLookup, self._realLocalSize
+        self._clear()
+
+    def _clear(self):
+        TZCache.Clear()
+        cachedb.tz_cache.delete_many({"Cell": {"$in": [TZCache.CellKey(lat, lng) for lat, lng in self._points]}})
+
+    def _statsSince(self, before):
+        after = TZCache.Stats()
+        return dict((key, after[key] - before[key]) for key in ("LocalHits", "DBHits", "Misses"))
+
+    def test_cell_quantization(self):
+        self.assertEqual(TZCache.CellKey(45.0, -75.0), "4500:-7500")
+        # Anything within half a cell shares it
+        self.assertEqual(TZCache.CellKey(45.004, -74.996), "4500:-7500")
+        self.assertEqual(TZCache.CellKey(45.006, -75.0), "4501:-7500")
+        self.assertEqual(TZCache.CellKey(-0.004, 0.004), "0:0")
+        self.assertEqual(TZCache.CellKey(-33.87, 151.21), "-3387:15121")
+
+        # ...so nearby points are looked up once
+        lat, lng = self._points[0]
+        before = TZCache.Stats()
+        self.assertEqual(TZCache.Lookup(lat, lng), "Test/Zone")
+        self.assertEqual(TZCache.Lookup(lat + 0.003, lng - 0.003), "Test/Zone")
+        self.assertEqual(self._lookups, [(lat, lng)])
+        self.assertEqual(self._statsSince(before), {"LocalHits": 1, "DBHits": 0, "Misses": 1})
+
+    def test_lru_eviction(self):
+        tz.TZ_CACHE_LOCAL_SIZE = 2
+        a, b, c, d = self._points
+        for point in (a, b, c):
+            TZCache.Lookup(*point)
+        self.assertEqual(TZCache.Stats()["LocalSize"], 2)
+
+        before = TZCache.Stats()
+        TZCache.Lookup(*c) # Still held locally
+        self.assertEqual(self._statsSince(before), {"LocalHits": 1, "DBHits": 0, "Misses": 0})
+        TZCache.Lookup(*a) # Evicted, so it comes from the tz_cache collection instead (and evicts b)
+        self.assertEqual(self._statsSince(before), {"LocalHits": 1, "DBHits": 1, "Misses": 0})
+        TZCache.Lookup(*c) # Most recently used before a, so it's kept...
+        TZCache.Lookup(*d) # ...and a goes instead
+        TZCache.Lookup(*c)
+        TZCache.Lookup(*b)
+        self.assertEqual(self._statsSince(before), {"LocalHits": 3, "DBHits": 2, "Misses": 1})
+        self.assertEqual(len(self._lookups), 4)
+
+    def test_read_through(self):
+        a, b = self._points[:2]
+        TZCache.Lookup(*a)
+        stored = cachedb.tz_cache.find_one({"Cell": TZCache.CellKey(*a)})
+        self.assertEqual((stored["TZ"], stored["Latitude"], stored["Longitude"]), ("Test/Zone", a[0], a[1]))
+        self.assertTrue("Timestamp" in stored)
+
+        # Another worker's lookups are read from the collection, rather than looked up again
+        cachedb.tz_cache.insert_one({"Cell": TZCache.CellKey(*b), "TZ": "Test/Elsewhere"})
+        TZCache.Clear()
+        before = TZCache.Stats()
+        self.assertEqual(TZCache.Lookup(*a), "Test/Zone")
+        self.assertEqual(TZCache.Lookup(*b), "Test/Elsewhere")
+        self.assertEqual(self._lookups, [a])
+        self.assertEqual(self._statsSince(before), {"LocalHits": 0, "DBHits": 2, "Misses": 0})
+        # ...and held locally after that
+        self.assertEqual(TZCache.Lookup(*b), "Test/Elsewhere")
+        self.assertEqual(self._statsSince(before), {"LocalHits": 1, "DBHits": 2, "Misses": 0})
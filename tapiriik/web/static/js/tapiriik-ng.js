@@ -46,11 +46,15 @@ function ActivitiesController($scope, $http) {
   };
 
   $scope.loading = true; // Will change if I ever add scroll-based pagination...
+  $scope.activities = [];
 
-  var loadActivities = function(pageStartDate) {
-    $http.get("/activities/fetch" + window.location.search)
+  var loadActivities = function(offset) {
+    $http.get("/activities/fetch" + (window.location.search ? window.location.search + "&" : "?") + "offset=" + offset)
     .success(function(activities) {
-      $scope.loading = false;
+      if (!activities.length) {
+        $scope.loading = false;
+        return;
+      }
       for (var actidx in activities){
         var activity = activities[actidx];
         // Convert dict to an array sorted by the display order.
@@ -74,11 +78,12 @@ function ActivitiesController($scope, $http) {
         activity.FullySynchronized = fully_synchronized;
         activity.Prescence = sorted_prescences;
       }
-      $scope.activities = activities;
+      $scope.activities = $scope.activities.concat(activities);
+      loadActivities(offset + activities.length);
     });
   };
 
-  loadActivities();
+  loadActivities(0);
 }
 
 function SyncSettingsController($scope, $http, $window){
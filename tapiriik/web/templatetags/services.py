@@ -1,5 +1,6 @@
 from django import template
 from tapiriik.services import Service, ServiceRecord
+from tapiriik.services.synchronized_activities import SynchronizedActivityStore
 from tapiriik.database import db
 register = template.Library()
 
@@ -19,3 +20,8 @@ def exceptSvc(value):
 @register.filter(name="svc_populate_conns")
 def fullRecords(conns):
     return [ServiceRecord(x) for x in db.connections.find({"_id": {"$in": [x["ID"] for x in conns]}})]
+
+
+@register.filter(name="svc_synced_activity_count")
+def syncedActivityCount(conn):
+    return SynchronizedActivityStore.Count(conn._id) + len(getattr(conn, "SynchronizedActivities", []))
@@ -1,6 +1,6 @@
 from django.shortcuts import render, redirect
 from django.http import HttpResponse
-from tapiriik.database import db
+from tapiriik.sync.activity_record import ActivityRecordStore
 from tapiriik.settings import WITHDRAWN_SERVICES
 import json
 import datetime
@@ -15,21 +15,24 @@ def activities_fetch_json(req):
         return HttpResponse(status=403)
 
     retrieve_fields = [
-        "Activities.Prescence",
-        "Activities.Abscence",
-        "Activities.Type",
-        "Activities.Name",
-        "Activities.StartTime",
-        "Activities.EndTime",
-        "Activities.Private",
-        "Activities.Stationary",
-        "Activities.FailureCounts"
+        "Prescence",
+        "Abscence",
+        "Type",
+        "Name",
+        "StartTime",
+        "EndTime",
+        "Private",
+        "Stationary",
+        "FailureCounts"
     ]
-    activityRecords = db.activity_records.find_one({"UserID": req.user["_id"]}, dict([(x, 1) for x in retrieve_fields]))
-    if not activityRecords:
-        return HttpResponse("[]", content_type="application/json")
+    # Most recent first, a page at a time - the dashboard keeps asking for the next offset until it gets an empty page
+    try:
+        offset = max(0, int(req.GET.get("offset", 0)))
+    except ValueError:
+        return HttpResponse(status=400)
     cleanedRecords = []
-    for activity in activityRecords["Activities"]:
+    for activity in ActivityRecordStore.Page(req.user["_id"], retrieve_fields, offset=offset):
+        del activity["_id"]
         # Strip down the record since most of this info isn't displayed
         for presence in activity["Prescence"]:
             del activity["Prescence"][presence]["Exception"]
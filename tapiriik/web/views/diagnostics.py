@@ -1,8 +1,12 @@
 from django.shortcuts import render, redirect
-from django.http import HttpResponse
+from django.http import HttpResponse, Http404
 from tapiriik.settings import DIAG_AUTH_TOTP_SECRET, DIAG_AUTH_PASSWORD, SITE_VER
 from tapiriik.database import db
 from tapiriik.sync import Sync
+from tapiriik.sync.activity_record import ActivityRecordStore
+from tapiriik.sync.sync_log import SyncLogStore
+from tapiriik.services.synchronized_activities import SynchronizedActivityStore
+from tapiriik.services.pacing import Pacer
 from tapiriik.auth import TOTP, DiagnosticsUser, User
 from bson.objectid import ObjectId
 import hashlib
@@ -68,6 +72,12 @@ def diag_queue_dashboard(req):
     context["stalledWorkers"] = [x for x in context["allWorkers"] if x["Heartbeat"] < datetime.utcnow() - stall_timeout]
     context["stalledWorkerPIDs"] = [x["Process"] for x in context["stalledWorkers"]]
 
+    from tapiriik.services import Service
+    context["requestPacing"] = []
+    for svc in Service.List():
+        if svc.RequestPacing:
+            context["requestPacing"] += sorted(Pacer.Stats(svc.ID).items())
+
     delta = False
     if "deleteStalledWorker" in req.POST:
         db.sync_workers.remove({"Process": int(req.POST["pid"])})
@@ -179,13 +189,11 @@ def diag_user(req, user):
         except:
             pass
     elif "svc_marksync" in req.POST:
-        db.connections.update({"_id": ObjectId(req.POST["id"])},
-                              {"$addToSet": {"SynchronizedActivities": req.POST["uid"]}},
-                              multi=False)
+        SynchronizedActivityStore.Add(ObjectId(req.POST["id"]), [req.POST["uid"]])
     elif "svc_clearexc" in req.POST:
         db.connections.update({"_id": ObjectId(req.POST["id"])}, {"$unset": {"ExcludedActivities": 1}})
     elif "svc_clearacts" in req.POST:
-        db.connections.update({"_id": ObjectId(req.POST["id"])}, {"$unset": {"SynchronizedActivities": 1}})
+        SynchronizedActivityStore.Clear(ObjectId(req.POST["id"]))
         Sync.SetNextSyncIsExhaustive(userRec, True)
     elif "svc_toggle_poll_sub" in req.POST:
         from tapiriik.services import Service
@@ -199,17 +207,20 @@ def diag_user(req, user):
         from tapiriik.services import Service
         svcRec = Service.GetServiceRecordByID(req.POST["id"])
         db.connections.update({"_id": ObjectId(req.POST["id"])}, {"$pull": {"SyncErrors": {"Scope": "activity"}}})
-        act_recs = db.activity_records.find_one({"UserID": ObjectId(user)})
-        for act in act_recs["Activities"]:
-            if "FailureCounts" in act and svcRec.Service.ID in act["FailureCounts"]:
-                del act["FailureCounts"][svcRec.Service.ID]
-        db.activity_records.save(act_recs)
+        ActivityRecordStore.ClearFailureCounts(ObjectId(user), svcRec.Service.ID)
     else:
         delta = False
 
     if delta:
         return redirect("diagnostics_user", user=user)
-    return render(req, "diag/user.html", {"diag_user": userRec})
+    return render(req, "diag/user.html", {"diag_user": userRec, "sync_logs": SyncLogStore.List(userRec["_id"])})
+
+@diag_requireAuth
+def diag_user_log(req, user, log):
+    text = SyncLogStore.Read(ObjectId(user), ObjectId(log))
+    if text is None:
+        raise Http404()
+    return HttpResponse(text, content_type="text/plain; charset=utf-8")
 
 
 @diag_requireAuth
@@ -0,0 +1,99 @@
+# This file isn't called in normal operation - it's for timing TCXIO.Parse on long activities, and how much memory it takes.
+# Compares the streaming (iterparse) Parse against the full-tree walk it replaced - that builds the whole document with
+# etree.XML first, then hands each lap and trackpoint to the same per-element parsing. Peak memory is measured in a fresh
+# process for each, as the growth in max RSS.
+# Usage: python tcx_benchmark.py [waypoints] [runs]
+
+from tapiriik.services.tcx import TCXIO, _TCX_TAGS
+from tapiriik.services.interchange import Activity, ActivityStatistic, ActivityStatisticUnit, Lap
+from tapiriik.testing.statistics import _random_activity
+from lxml import etree
+import copy
+import multiprocessing
+import os
+import pytz
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+WAYPOINTS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+RUNS = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+LAPS = 10
+
+def best_of(fn):
+	best = None
+	for x in range(RUNS):
+		start = time.time()
+		fn()
+		elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+def full_tree_parse(tcxData):
+	# As Parse used to go about it - only the laps and trackpoints, which is where the time and memory go
+	ns = copy.deepcopy(TCXIO.Namespaces)
+	ns["tcx"] = ns[None]
+	del ns[None]
+	act = Activity()
+	root = etree.XML(tcxData)
+	xact = root.find("tcx:Activities", namespaces=ns).find("tcx:Activity", namespaces=ns)
+	for xlap in xact.findall("tcx:Lap", namespaces=ns):
+		lap = Lap()
+		act.Laps.append(lap)
+		TCXIO._parseLap(xlap, lap, ns)
+		xtrkseg = xlap.find("tcx:Track", namespaces=ns)
+		if xtrkseg is None:
+			continue
+		for xtrkpt in xtrkseg.findall(_TCX_TAGS["Trackpoint"]):
+			lap.Waypoints.append(TCXIO._parseTrackpoint(xtrkpt, act))
+	TCXIO._parseActivityDetails(xact, act, ns)
+	return act
+
+def peak_memory(parse, path, results):
+	with open(path, "rb") as f:
+		tcxData = f.read()
+	before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	parse(tcxData)
+	results.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+
+def in_process(target, *args):
+	# Forked before this process has parsed (or generated) anything, so there's no freed memory lying around to reuse
+	results = multiprocessing.Queue()
+	proc = multiprocessing.Process(target=target, args=args + (results,))
+	proc.start()
+	result = results.get()
+	proc.join()
+	return result
+
+def write_large_tcx(path, results):
+	act = _random_activity(random.Random(0), laps=LAPS, points=WAYPOINTS // LAPS)
+	for lap in act.Laps:
+		for wp in lap.Waypoints:
+			wp.Timestamp = pytz.utc.localize(wp.Timestamp)
+		lap.StartTime = lap.Waypoints[0].Timestamp
+		lap.EndTime = lap.Waypoints[-1].Timestamp
+		lap.Stats.Distance = ActivityStatistic(ActivityStatisticUnit.Meters, value=1000) # Required by the parser
+	act.StartTime = act.Laps[0].StartTime
+	act.EndTime = act.Laps[-1].EndTime
+	act.TZ = pytz.utc
+	with open(path, "wb") as f:
+		f.write(TCXIO.Dump(act).encode("utf-8"))
+	results.put(None)
+
+if __name__ == "__main__":
+	workdir = tempfile.mkdtemp()
+	path = os.path.join(workdir, "large.tcx")
+	try:
+		in_process(write_large_tcx, path)
+		parsers = (("full tree", full_tree_parse), ("iterparse (Parse)", TCXIO.Parse))
+		peaks = [in_process(peak_memory, parse, path) / 1024 for label, parse in parsers] # ru_maxrss is in KB on Linux
+		with open(path, "rb") as f:
+			tcxData = f.read()
+		print("%d waypoints, %.1f MB of TCX:" % (WAYPOINTS, len(tcxData) / 1024 / 1024))
+		for (label, parse), peak in zip(parsers, peaks):
+			print("  %-34s %8.1f ms %8.1f MB peak" % (label, best_of(lambda: parse(tcxData)) * 1000, peak))
+	finally:
+		shutil.rmtree(workdir)
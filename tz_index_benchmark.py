@@ -0,0 +1,77 @@
+# This file isn't called in normal operation - it's for timing TZIndex against the Mongo geo queries TZLookup otherwise makes.
+# Uses the boundaries in the TZ DB when they've been loaded (by tz_ingest.py), or a synthetic world of jagged polygons with
+# holes otherwise - the Mongo path is only timed against the real boundaries, on a sample of the points, with --mongo.
+# Usage: python tz_index_benchmark.py [points] [--mongo]
+
+from tapiriik.database import tzdb
+from tapiriik.database.tz_index import TZIndex
+import tapiriik.database.tz as tz
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+POINTS = int(sys.argv[1]) if len(sys.argv) > 1 and not sys.argv[1].startswith("--") else 200000
+MONGO_SAMPLE = max(1, POINTS // 100)
+
+def timed(fn):
+	start = time.time()
+	result = fn()
+	return result, time.time() - start
+
+def report(label, elapsed, count):
+	print("  %-34s %8.1f ms %8.1f us/lookup" % (label, elapsed * 1000, elapsed * 1000000 / count))
+
+def synthetic_boundaries(rng):
+	# A 5-degree grid of 100-vertex polygons, shrunk a little so there are gaps for Nearest to cover - every third with a hole
+	for lat in range(-60, 75, 5):
+		for lng in range(-180, 180, 5):
+			center_lng, center_lat = lng + 2.5, lat + 2.5
+			outer = []
+			for x in range(100):
+				angle = 2 * math.pi * x / 100
+				radius = 2.2 + rng.random() * 0.3
+				outer.append([center_lng + radius * math.cos(angle), center_lat + radius * math.sin(angle)])
+			outer.append(outer[0])
+			rings = [outer]
+			if (lat + lng) % 3 == 0:
+				rings.append([[center_lng + 0.5 * math.cos(2 * math.pi * x / 20), center_lat + 0.5 * math.sin(2 * math.pi * x / 20)] for x in range(21)])
+			yield "Synthetic/%d_%d" % (lat, lng), {"type": "Polygon", "coordinates": rings}
+
+def lookup(index, lat, lng):
+	# As TZLookup does with an index
+	return index.Intersecting(lat, lng) or index.Nearest(lat, lng, 200000)
+
+rng = random.Random(0)
+use_db = tzdb.boundaries.find_one() is not None
+points = [(rng.uniform(-60, 75), rng.uniform(-180, 180)) for x in range(POINTS)]
+workdir = tempfile.mkdtemp()
+path = os.path.join(workdir, "tz.idx")
+try:
+	boundaries = [(x["TZID"], x["Boundary"]) for x in tzdb.boundaries.find({}, {"TZID": True, "Boundary": True})] if use_db else list(synthetic_boundaries(rng))
+	print("%d boundaries (%s), %d points:" % (len(boundaries), "TZ DB" if use_db else "synthetic", POINTS))
+	_, elapsed = timed(lambda: TZIndex.Build(path, boundaries))
+	print("  %-34s %8.1f ms (%.1f MB)" % ("Build", elapsed * 1000, os.path.getsize(path) / 1024 / 1024))
+	index, elapsed = timed(lambda: TZIndex(path))
+	print("  %-34s %8.1f ms" % ("open (mmap)", elapsed * 1000))
+
+	_, elapsed = timed(lambda: [index.Intersecting(lat, lng) for lat, lng in points])
+	report("Intersecting", elapsed, POINTS)
+	results, elapsed = timed(lambda: [lookup(index, lat, lng) for lat, lng in points])
+	report("Intersecting, then Nearest", elapsed, POINTS)
+
+	if "--mongo" in sys.argv and use_db:
+		tz.TZ_INDEX_PATH = None
+		tz._tz_index = None
+		sample = points[:MONGO_SAMPLE]
+		mongo_results, elapsed = timed(lambda: [tz.TZLookup(lat, lng) for lat, lng in sample])
+		report("Mongo $geoIntersects, then $near", elapsed, MONGO_SAMPLE)
+		# Where neither finds anything, TZLookup falls back on the longitude
+		agreed = sum(1 for ours, theirs, (lat, lng) in zip(results, mongo_results, sample) if (ours if ours and ours != "uninhabited" else round(lng / 15)) == theirs)
+		print("  %d of %d sample lookups agree" % (agreed, MONGO_SAMPLE))
+	index.Close()
+finally:
+	shutil.rmtree(workdir)
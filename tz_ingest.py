@@ -6,6 +6,8 @@ import shapefile
 from shapely.geometry import Polygon, mapping
 import pymongo
 from tapiriik.database import tzdb
+from tapiriik.database.tz_index import TZIndex
+from tapiriik.settings import TZ_INDEX_PATH
 
 print("Dropping boundaries collection")
 tzdb.drop_collection("boundaries")
@@ -29,4 +31,9 @@ for shape in shapeRecs:
 		polygon = polygon.buffer(0) # Resolves issues with most self-intersecting geometry
 		assert polygon.is_valid
 	record = {"TZID": tzid, "Boundary": mapping(polygon)}
+	records.append((tzid, record["Boundary"]))
 	tzdb.boundaries.insert(record) # Would be bulk insert, but that makes it a pain to debug geometry issues
+
+if TZ_INDEX_PATH:
+	print("Writing in-process index to %s" % TZ_INDEX_PATH)
+	TZIndex.Build(TZ_INDEX_PATH, records)